@@ -238,6 +238,13 @@ CF_NN_MAIN_DIAG_ONLY = None    # Only if match_nn_prog_score = False
 #                                True: use main diagonal only.
 #                                False (default): inverse of covariance matrix.
 
+CF_NN_TREE_SEARCH = None       # True: find neighbours with a KD-tree
+#                                (default). False: brute force search.
+
+CF_LEAF_CACHE = None           # True: keep terminal leaves of data used to
+#                                fill the trees with forest (default).
+#                                False: No cache.
+
 CF_RANDOM_THRESHOLDS = None     # If > 0: Do not check all possible split
 #   values of ordered variables, but only RANDOM_THRESHOLDS (new randomisation
 #   for each split)
@@ -246,6 +253,17 @@ CF_RANDOM_THRESHOLDS = None     # If > 0: Do not check all possible split
 #   Default: 4+N_train**0.2 (fewer thresholds speeds up programme but may (!)
 #   lead to less accurate results.)
 
+CF_SORTED_SPLIT_SEARCH = None  # True: Evaluate all splitting values of a
+#   variable in one pass over the sorted data of the leaf (faster, splits with
+#   almost tied objective function may differ). False: Evaluate each
+#   splitting value separately. Default: False (True if CF_SPLIT_BINS used).
+#   Split statistics of leaves shared by the trees of a tuning grid are
+#   computed once if also all thresholds are checked (CF_RANDOM_THRESHOLDS=0).
+CF_SPLIT_BINS = None           # Histogram split mode: Quantize ordered
+#   features with many values into (at most) CF_SPLIT_BINS quantile bins and
+#   consider only splits at bin boundaries (faster for large data).
+#   True: 255 bins. None: No binning (default).
+
 #   Minimum leaf size (use of a grid is possible)
 CF_N_MIN_MIN = None      # Smallest minimum leaf size
 CF_N_MIN_MAX = None      # Largest minimum leaf size.
@@ -258,6 +276,10 @@ CF_N_MIN_GRID = None     # Number of grid values (def: 1)
 #   If n_min_grid == 1: n_min=(N_MIN_MIN+N_MIN_MAX)/2
 #   If grid is used, optimal value is determined by out-of-bag estimation of
 #   objective function.
+CF_N_MIN_PRUNING = None  # True: Trees for larger minimum leaf sizes of grid
+#   are obtained by pruning (and regrowing) the tree grown with the smallest
+#   minimum leaf size (faster, random draws and tuned forest may differ).
+#   False: Grow new tree for each value of the grid (default).
 CF_N_MIN_TREAT = None    # Minimum number of observations per treatment in leaf
 #   A higher value reduces the risk that a leaf cannot be filled with
 #   outcomes from all treatment arms in the evaluation subsample.
@@ -540,6 +562,9 @@ _INT_DESCRIPTIVE_STATS = None   # Print descriptive stats of input+output files
 _INT_SHOW_PLOTS = None          # Execute plt.show() command. Default is True.
 #                                 turn off if programme runs on console.
 _INT_FONTSIZE = None            # Legend, 1(very small) to 7(very large); def:2
+_INT_FOREST_MMAP_PATH = None    # Directory in which forests are saved as
+#   memory-mapped arrays by mcf_forest_asdict_functions.save_mcf_pickle (the
+#   pickle file keeps only a reference to it). None: Forests are pickled.
 _INT_DPI = None                 # > 0: def (None): 500
 #   Only for (B, AM) GATEs: What type of plot to use for continuous variables.
 _INT_NO_FILLED_PLOT = None      # Use filled plot if more than x points(def:20)
@@ -556,6 +581,11 @@ _INT_WITH_OUTPUT = None         # Print output on txt file and/or console.
 #                                 Default is True.
 _INT_OUTPUT_NO_NEW_DIR = None   # Do not create a new directory when the path
 #                                 already exists. Default is False.
+_INT_PREDICT_STREAM_MB = None   # Memory budget (MB) of predict_stream that
+#   determines the size of the chunks of the prediction data. Default is 2000.
+_INT_MEM_BUDGET_MB = None       # Memory budget (MB) of training and
+#   prediction that determines the number of workers, the sizes of chunks and
+#   of the Ray object stores. Default is 75% of available RAM.
 _INT_MAX_SAVE_VALUES = None       # Save value of x only if < 50 (cont. vars).
 #                                 Default is 50.
 _INT_SEED_SAMPLE_SPLIT = None   # Seeding is redone when building forest
@@ -633,7 +663,10 @@ params = {
     'cf_n_min_grid': CF_N_MIN_GRID,
     'cf_n_min_max': CF_N_MIN_MAX, 'cf_n_min_min': CF_N_MIN_MIN,
     'cf_n_min_treat': CF_N_MIN_TREAT,
+    'cf_n_min_pruning': CF_N_MIN_PRUNING,
     'cf_nn_main_diag_only': CF_NN_MAIN_DIAG_ONLY,
+    'cf_nn_tree_search': CF_NN_TREE_SEARCH,
+    'cf_leaf_cache': CF_LEAF_CACHE,
     'cf_m_grid': CF_M_GRID, 'cf_m_share_max': CF_M_SHARE_MAX,
     'cf_m_random_poisson': CF_M_RANDOM_POISSON,
     'cf_m_share_min': CF_M_SHARE_MIN,
@@ -642,6 +675,8 @@ params = {
     'cf_subsample_factor_eval': CF_SUBSAMPLE_FACTOR_EVAL,
     'cf_subsample_factor_forest': CF_SUBSAMPLE_FACTOR_FOREST,
     'cf_random_thresholds': CF_RANDOM_THRESHOLDS,
+    'cf_sorted_split_search': CF_SORTED_SPLIT_SEARCH,
+    'cf_split_bins': CF_SPLIT_BINS,
     'cf_vi_oob_yes': CF_VI_OOB_YES,
     'cs_adjust_limits': CS_ADJUST_LIMITS, 'cs_max_del_train': CS_MAX_DEL_TRAIN,
     'cs_min_p': CS_MIN_P, 'cs_quantil': CS_QUANTIL, 'cs_type': CS_TYPE,
@@ -700,9 +735,11 @@ params = {
     '_int_del_forest': _INT_DEL_FOREST,
     '_int_descriptive_stats': _INT_DESCRIPTIVE_STATS, '_int_dpi': _INT_DPI,
     '_int_fontsize': _INT_FONTSIZE, '_int_keep_w0': _INT_KEEP_W0,
+    '_int_forest_mmap_path': _INT_FOREST_MMAP_PATH,
     '_int_no_filled_plot': _INT_NO_FILLED_PLOT,
     '_int_max_cats_cont_vars': _INT_MAX_CATS_CONT_VARS,
     '_int_max_save_values': _INT_MAX_SAVE_VALUES,
+    '_int_mem_budget_mb': _INT_MEM_BUDGET_MB,
     '_int_mp_ray_del': _INT_MP_RAY_DEL,
     '_int_mp_ray_objstore_multiplier': _INT_MP_RAY_OBJSTORE_MULTIPLIER,
     '_int_mp_ray_shutdown': _INT_MP_RAY_SHUTDOWN,
@@ -710,6 +747,7 @@ params = {
     '_int_mp_weights_tree_batch': _INT_MP_WEIGHTS_TREE_BATCH,
     '_int_mp_weights_type': _INT_MP_WEIGHTS_TYPE,
     '_int_output_no_new_dir': _INT_OUTPUT_NO_NEW_DIR,
+    '_int_predict_stream_mb': _INT_PREDICT_STREAM_MB,
     '_int_return_iate_sp': _INT_RETURN_IATE_SP,
     '_int_seed_sample_split': _INT_SEED_SAMPLE_SPLIT,
     '_int_share_forest_sample': _INT_SHARE_FOREST_SAMPLE,
@@ -19,10 +19,11 @@ from mcf import mcf_estimation_functions as mcf_est
 from mcf import mcf_general as mcf_gp
 from mcf import mcf_general_sys as mcf_sys
 from mcf import mcf_print_stats_functions as ps
+from mcf import mcf_weight_store_functions as mcf_ws
 
 
 def ate_est(mcf_, data_df, weights_dic, balancing_test=False,
-            w_ate_only=False, with_output=True):
+            w_ate_only=False, with_output=True, w_ate_agg=None):
     """Estimate ATE and their standard errors.
 
     Parameters
@@ -35,6 +36,10 @@ def ate_est(mcf_, data_df, weights_dic, balancing_test=False,
               Default is False.
     w_ate_only : Boolean.
               Only weights are needed as output. Default is False.
+    w_ate_agg : Numpy array or None.
+              Aggregated (not yet normalized) weights, for example summed
+              over chunks of the prediction data with w_ate_sparse. If not
+              None, weights_dic['weights'] is not used. Default is None.
 
     Returns
     -------
@@ -86,29 +91,11 @@ def ate_est(mcf_, data_df, weights_dic, balancing_test=False,
         w_ate_export = np.zeros_like(w_ate)
     ind_d_val = np.arange(no_of_treat)
     weights = weights_dic['weights']
-    if int_dic['weight_as_sparse']:
-        for i in range(n_p):
-            w_add = np.zeros((no_of_treat, n_y))
-            for t_ind, _ in enumerate(d_values):
-                w_i_csr = weights[t_ind].getrow(i)    # copy
-                if gen_dic['weighted']:
-                    w_i_csr = w_i_csr.multiply(w_dat.reshape(-1))
-                sum_wi = w_i_csr.sum()
-                if sum_wi <= 1e-15:
-                    txt = f'\nEmpty leaf. Observation: {i}'
-                    ps.print_mcf(gen_dic, txt, summary=True)
-                    raise RuntimeError(txt)
-                if not (1-1e-10) < sum_wi < (1+1e-10):
-                    w_i_csr = w_i_csr.multiply(1 / sum_wi)
-                if gen_dic['weighted']:
-                    w_i_csr = w_i_csr.multiply(w_p[i])
-                if p_dic['choice_based_sampling']:
-                    i_pos = ind_d_val[d_p[i] == d_values]
-                    w_i_csr = w_i_csr.multiply(t_probs[int(i_pos)])
-                w_add[t_ind, :] = w_i_csr.todense()
-            w_ate[0, :, :] += w_add
-            if p_dic['atet']:
-                w_ate[ind_d_val[d_p[i] == d_values]+1, :, :] += w_add
+    if w_ate_agg is not None:     # Rows beyond no_of_ates are ATETs
+        w_ate = w_ate_agg[:no_of_ates].copy()
+    elif int_dic['weight_as_sparse']:
+        w_ate = w_ate_sparse(weights, n_y, no_of_ates, d_values, d_p, w_p,
+                             w_dat, t_probs, gen_dic, p_dic)
     else:
         for i, weight_i in enumerate(weights):
             w_add = np.zeros((no_of_treat, n_y))
@@ -185,14 +172,14 @@ def ate_est(mcf_, data_df, weights_dic, balancing_test=False,
     else:
         pot_y_var = np.empty_like(pot_y)
     if p_dic['cluster_std']:
-        cl_dat = weights_dic['cl_dat_np']
+        cl_dat, cl_ind = weights_dic['cl_dat_np'], weights_dic['cl_ind']
         if p_dic['se_boot_ate'] < 1:
             w_ate_1dim = np.zeros((no_of_ates, no_of_treat_1dim,
                                    len(np.unique(cl_dat))))
         else:
             w_ate_1dim = np.zeros((no_of_ates, no_of_treat_1dim, n_y))
     else:
-        cl_dat = None
+        cl_dat = cl_ind = None
         w_ate_1dim = np.zeros((no_of_ates, no_of_treat_1dim, n_y))
     # Normalize weights
     for a_idx in range(no_of_ates):
@@ -214,7 +201,7 @@ def ate_est(mcf_, data_df, weights_dic, balancing_test=False,
                             p_dic, weights=w_dat,
                             bootstrap=p_dic['se_boot_ate'],
                             keep_all=int_dic['keep_w0'],
-                            se_yes=not p_dic['ate_no_se_only'])
+                            se_yes=not p_dic['ate_no_se_only'], cl_ind=cl_ind)
                         ti_idx = index_full[t_idx, i]  # pylint: disable=E1136
                         pot_y[a_idx, ti_idx, o_idx] = ret[0]
                         if not p_dic['ate_no_se_only']:
@@ -231,7 +218,7 @@ def ate_est(mcf_, data_df, weights_dic, balancing_test=False,
                         gen_dic, p_dic, weights=w_dat,
                         bootstrap=p_dic['se_boot_ate'],
                         keep_all=int_dic['keep_w0'],
-                        se_yes=not p_dic['ate_no_se_only'])
+                        se_yes=not p_dic['ate_no_se_only'], cl_ind=cl_ind)
                     pot_y[a_idx, t_idx, o_idx] = ret[0]
                     if not p_dic['ate_no_se_only']:
                         pot_y_var[a_idx, t_idx, o_idx] = ret[1]
@@ -251,6 +238,100 @@ def ate_est(mcf_, data_df, weights_dic, balancing_test=False,
     return w_ate_export, pot_y, pot_y_var, txt
 
 
+def w_ate_sparse(weights, n_y, no_of_ates, d_values, d_p, w_p, w_dat,
+                 t_probs, gen_dic, p_dic):
+    """Aggregate sparse weight matrices to ATE (and ATET) weights.
+
+    The weights of the prediction observations are rescaled row-wise and
+    summed by a single sparse matrix product per treatment.
+
+    Parameters
+    ----------
+    weights : Tuple of scipy.sparse.csr_matrix (N_pred x N_y) or weight
+        store. Weights. A store is aggregated chunk by chunk.
+    n_y : Int. Number of training observations.
+    no_of_ates : Int. Number of ATE types (ATE, ATETs).
+    d_values : List. Treatment values.
+    d_p : Numpy array or None. Treatment of prediction observations.
+    w_p : Numpy array or None. Sampling weights of prediction observations.
+    w_dat : Numpy array or None. Sampling weights of training observations.
+    t_probs : List or None. Choice based sampling probabilities.
+    gen_dic, p_dic : Dict. Parameters.
+
+    Returns
+    -------
+    w_ate : Numpy array (no_of_ates x no_of_treat x N_y). ATE weights.
+
+    """
+    no_of_treat = len(d_values)
+    d_pos_all = treat_position(d_p, d_values)
+    w_ate = np.zeros((no_of_ates, no_of_treat, n_y))
+    for start, weights_block in mcf_ws.weight_blocks(weights):
+        rows = slice(start, start + weights_block[0].shape[0])
+        d_pos = None if d_pos_all is None else d_pos_all[rows]
+        w_p_block = None if w_p is None else w_p[rows]
+        for t_ind in range(no_of_treat):
+            w_t, sum_w, row_mult = sparse_weights_row_scaling(
+                weights_block[t_ind], d_pos, w_p_block, w_dat, t_probs,
+                gen_dic, p_dic)
+            empty = np.flatnonzero(sum_w <= 1e-15)
+            if empty.size > 0:
+                txt = f'\nEmpty leaf. Observation: {start + empty[0]}'
+                ps.print_mcf(gen_dic, txt, summary=True)
+                raise RuntimeError(txt)
+            row_to_ate = np.zeros((no_of_ates, len(row_mult)))
+            row_to_ate[0, :] = row_mult
+            if p_dic['atet']:
+                row_to_ate[d_pos + 1, np.arange(len(d_pos))] = row_mult
+            w_ate[:, t_ind, :] += (w_t.T @ row_to_ate.T).T
+    return w_ate
+
+
+def treat_position(d_p, d_values):
+    """Get position of treatment in d_values.
+
+    Raises a ValueError if the treatment of any observation is not in
+    d_values (its weights could not be assigned to a treatment).
+    """
+    if d_p is None:
+        return None
+    d_pos = np.full(len(d_p), -1)
+    for t_ind, d_value in enumerate(d_values):
+        d_pos[d_p.reshape(-1) == d_value] = t_ind
+    if np.any(d_pos < 0):
+        unknown = np.unique(d_p.reshape(-1)[d_pos < 0])
+        raise ValueError('Treatment values of prediction data not among '
+                         f'treatment values of training data {d_values}: '
+                         f'{unknown}')
+    return d_pos
+
+
+def sparse_weights_row_scaling(weights_t, d_pos, w_p, w_dat, t_probs,
+                               gen_dic, p_dic):
+    """Get row-wise rescaling of sparse weight matrix of single treatment.
+
+    Returns
+    -------
+    weights_t : scipy.sparse.csr_matrix. Weights (times sampling weights).
+    sum_w : 1D Numpy array. Row sums of weights_t.
+    row_mult : 1D Numpy array. Rescaling factor for each row (normalisation,
+        sampling weights, choice based sampling).
+
+    """
+    weights_t = weights_t.tocsr()
+    if gen_dic['weighted']:
+        weights_t = weights_t.multiply(w_dat.reshape(1, -1)).tocsr()
+    sum_w = np.asarray(weights_t.sum(axis=1)).reshape(-1)
+    row_mult = np.ones_like(sum_w, dtype=np.float64)
+    rescale = ((sum_w <= 1-1e-10) | (sum_w >= 1+1e-10)) & (sum_w != 0)
+    row_mult[rescale] = 1 / sum_w[rescale]
+    if gen_dic['weighted']:
+        row_mult = row_mult * w_p.reshape(-1)
+    if p_dic['choice_based_sampling']:
+        row_mult = row_mult * np.asarray(t_probs)[d_pos]
+    return weights_t, sum_w, row_mult
+
+
 def ate_effects_print(mcf_, effect_dic, y_pred_lc, balancing_test=False):
     """Compute ate's from potential outcomes and print them."""
     gen_dic, ct_dic, p_dic = mcf_.gen_dict, mcf_.ct_dict, mcf_.p_dict
@@ -11,6 +11,8 @@ from math import sqrt, log2
 
 import numpy as np
 from numba import njit
+from scipy import signal as sct_signal
+from scipy import sparse
 import scipy.stats as sct
 from sklearn.ensemble import RandomForestRegressor
 from sklearn.model_selection import train_test_split
@@ -118,7 +120,7 @@ def add_with_list(pot_all, pot_add):
 
 def weight_var(w0_dat, y0_dat, cl_dat, gen_dic, p_dic, norm=True,
                w_for_diff=None, weights=None, bootstrap=0, keep_some_0=False,
-               se_yes=True, keep_all=False):
+               se_yes=True, keep_all=False, cl_ind=None):
     """Generate the weight-based variance.
 
     Parameters
@@ -126,7 +128,13 @@ def weight_var(w0_dat, y0_dat, cl_dat, gen_dic, p_dic, norm=True,
     w_dat : Numpy array. Weights.
     y_dat : Numpy array. Outcomes.
     cl_dat : Numpy array. Cluster indicator.
-    p_dic : Dict. Parameters.
+    p_dic : Dict. Parameters. With p_dic['cond_var'] and not p_dic['knn'],
+            the conditional moments are Nadaraya-Watson estimates
+            (nadaraya_watson_fast). They are exact for the Epanechikov
+            kernel. For the normal kernel, they are exact only if the number
+            of positive weights squared is at most max_exact of
+            kernel_density_fast (2**22); above, the binned approximation
+            (kernel_density_binned) is used.
     norm : Boolean. Normalisation. Default is True.
     w_for_diff : Numpy array. weights used for difference when clustering.
                  Default is None.
@@ -134,6 +142,9 @@ def weight_var(w0_dat, y0_dat, cl_dat, gen_dic, p_dic, norm=True,
     no_agg :   Boolean. No aggregation of weights. Default is False.
     bootstrap: Int. If > 1: Use bootstrap instead for SE estimation.
     keep_some_0, se_yes, keep_all: Booleans.
+    cl_ind : Sparse csr matrix or None. Cluster-indicator matrix of cl_dat
+             (see cluster_indicator). Built from cl_dat if None.
+             Default is None.
 
     Returns
     -------
@@ -144,7 +155,8 @@ def weight_var(w0_dat, y0_dat, cl_dat, gen_dic, p_dic, norm=True,
         if not gen_dic['weighted']:
             weights = None
         w_dat, y_dat, _, _ = aggregate_cluster_pos_w(
-            cl_dat, w_dat, y_dat, norma=norm, sweights=weights)
+            cl_dat, w_dat, y_dat, norma=norm, sweights=weights, cl_ind=cl_ind)
+        y_dat = y_dat.reshape(-1)   # One outcome
         if w_for_diff is not None:
             w_dat = w_dat - w_for_diff
     if not p_dic['iate_se']:
@@ -185,36 +197,17 @@ def weight_var(w0_dat, y0_dat, cl_dat, gen_dic, p_dic, norm=True,
     if se_yes:
         if bootstrap > 1:
             if p_dic['cluster_std'] and (cl_dat is not None) and not only_copy:
-                cl_dat = cl_dat[w_pos]
-                unique_cl_id = np.unique(cl_dat)
-                obs_cl = len(unique_cl_id)
-                cl_dat = np.round(cl_dat)
-            rng = np.random.default_rng(123345)
-            est_b = np.empty(bootstrap)
-            for b_idx in range(bootstrap):
-                if p_dic['cluster_std'] and (
-                        cl_dat is not None and not only_copy):
-                    # block bootstrap
-                    idx_cl = rng.integers(0, high=obs_cl, size=obs_cl)
-                    cl_boot = unique_cl_id[idx_cl]  # relevant indices
-                    idx = []
-                    for cl_i in np.round(cl_boot):
-                        select_idx = cl_dat == cl_i
-                        idx_cl_i = np.nonzero(select_idx)
-                        idx.extend(idx_cl_i[0])
-                else:
-                    idx = rng.integers(0, high=obs, size=obs)
-                w_b = np.copy(w_dat2[idx])
-                if norm:
-                    sum_w_b = np.abs(np.sum(w_b))
-                    if not ((-1e-15 < sum_w_dat < 1e-15)
-                            or (1-1e-10 < sum_w_dat < 1+1e-10)):
-                        w_b = w_b / sum_w_b
-                est_b[b_idx] = np.dot(w_b, y_dat[idx])
+                cl_boot = cl_dat[w_pos]  # block bootstrap
+            else:
+                cl_boot = None
+            norm_b = norm and not ((-1e-15 < sum_w_dat < 1e-15)
+                                   or (1-1e-10 < sum_w_dat < 1+1e-10))
+            est_b = bootstrap_weighted_means(w_dat2, y_dat, bootstrap,
+                                             norm=norm_b, cl_dat=cl_boot)
             variance = np.var(est_b)
         else:
             if p_dic['cond_var']:
-                sort_ind = np.argsort(w_dat2)
+                sort_ind = np.argsort(w_dat2, kind='stable')
                 y_s, w_s = y_dat[sort_ind], w_dat2[sort_ind]
                 if p_dic['knn']:
                     k = int(np.round(p_dic['knn_const'] * np.sqrt(obs) * 2))
@@ -225,11 +218,11 @@ def weight_var(w0_dat, y0_dat, cl_dat, gen_dic, p_dic, norm=True,
                     exp_y_cond_w, var_y_cond_w = moving_avg_mean_var(y_s, k)
                 else:
                     band = bandwidth_nw_rule_of_thumb(w_s) * p_dic['nw_bandw']
-                    exp_y_cond_w = nadaraya_watson(y_s, w_s, w_s,
-                                                   p_dic['nw_kern'], band)
-                    var_y_cond_w = nadaraya_watson((y_s - exp_y_cond_w)**2,
-                                                   w_s, w_s, p_dic['nw_kern'],
-                                                   band)
+                    exp_y_cond_w = nadaraya_watson_fast(
+                        y_s, w_s, w_s, p_dic['nw_kern'], band)
+                    var_y_cond_w = nadaraya_watson_fast(
+                        (y_s - exp_y_cond_w)**2, w_s, w_s, p_dic['nw_kern'],
+                        band)
                 variance = np.dot(w_s**2, var_y_cond_w) + obs * np.var(
                     w_s*exp_y_cond_w)
             else:
@@ -239,81 +232,192 @@ def weight_var(w0_dat, y0_dat, cl_dat, gen_dic, p_dic, norm=True,
     return est, variance, w_ret
 
 
+def bootstrap_weighted_means(w_dat, y_dat, bootstrap, norm=True, cl_dat=None,
+                             seed=123345, max_mem_mb=256):
+    """Compute bootstrap replications of the weighted mean w'y.
+
+    All replications are drawn from one generator, so results are identical
+    to drawing the indices replication by replication. The draws are turned
+    into a (bootstrap x units) matrix of multipliers (via np.bincount) and
+    the weighted means are computed as one matrix product. If this matrix
+    does not fit into max_mem_mb, a numba kernel sums directly over the
+    drawn indices in smaller chunks of replications.
+
+    Parameters
+    ----------
+    w_dat : 1D Numpy array. Weights.
+    y_dat : 1D Numpy array. Outcomes.
+    bootstrap : Int. Number of bootstrap replications.
+    norm : Boolean. Renormalise weights in every replication. Default is True.
+    cl_dat : 1D Numpy array or None. Cluster indicator. If not None, clusters
+             are resampled (block bootstrap). Default is None.
+    seed : Int. Seed of random number generator. Default is 123345.
+    max_mem_mb : Float. Memory (MB) for one chunk of replications.
+                 Default is 256.
+
+    Returns
+    -------
+    est_b : 1D Numpy array. Bootstrap replications of estimate.
+    """
+    w_dat, y_dat = w_dat.reshape(-1), y_dat.reshape(-1)
+    if cl_dat is None:
+        w_units, wy_units = w_dat, w_dat * y_dat
+    else:   # Resampling clusters: Aggregate within cluster first
+        _, cl_inv = np.unique(np.round(cl_dat.reshape(-1)),
+                              return_inverse=True)
+        w_units = np.bincount(cl_inv, weights=w_dat)
+        wy_units = np.bincount(cl_inv, weights=w_dat * y_dat)
+    units = len(w_units)
+    wy_w = np.column_stack((wy_units, w_units))
+    rng = np.random.default_rng(seed)
+    max_bytes = max_mem_mb * 1024 * 1024
+    # Indices, offset indices and multipliers: 3 x 8 bytes per element
+    rows = max_bytes // (24 * units)
+    use_blas = rows >= min(bootstrap, 32)
+    if not use_blas:   # Indices only
+        rows = max(max_bytes // (8 * units), 1)
+    rows = int(min(rows, bootstrap))
+    sums = np.empty((bootstrap, 2))
+    for start in range(0, bootstrap, rows):
+        stop = min(start + rows, bootstrap)
+        idx = rng.integers(0, high=units, size=(stop - start, units))
+        if use_blas:
+            idx += np.arange(stop - start).reshape(-1, 1) * units
+            mult = np.bincount(idx.reshape(-1),
+                               minlength=(stop - start) * units).reshape(
+                                   stop - start, units)
+            sums[start:stop, :] = mult @ wy_w
+        else:
+            sums[start:stop, :] = bootstrap_sums_numba(idx, wy_w)
+    if norm:
+        return sums[:, 0] / np.abs(sums[:, 1])
+    return sums[:, 0]
+
+
+@njit
+def bootstrap_sums_numba(idx, wy_w):
+    """Sum columns of wy_w over the bootstrap indices of each replication.
+
+    Parameters
+    ----------
+    idx : 2D Numpy array of int. Drawn indices (replication x units).
+    wy_w : 2D Numpy array. Weighted outcomes and weights (units x 2).
+
+    Returns
+    -------
+    sums : 2D Numpy array. Sums of wy_w (replication x 2).
+    """
+    rows, cols = idx.shape
+    sums = np.zeros((rows, 2))
+    for r_idx in range(rows):
+        for c_idx in range(cols):
+            sums[r_idx, 0] += wy_w[idx[r_idx, c_idx], 0]
+            sums[r_idx, 1] += wy_w[idx[r_idx, c_idx], 1]
+    return sums
+
+
 def aggregate_cluster_pos_w(cl_dat, w_dat, y_dat=None, norma=True, w2_dat=None,
-                            sweights=None, y2_compute=False):
+                            sweights=None, y2_compute=False, cl_ind=None):
     """Aggregate weighted cluster means.
 
+    All clusters are aggregated at once with the sparse cluster-indicator
+    matrix of cl_dat (see cluster_indicator). w_dat (and w2_dat) may contain
+    a batch of weight vectors in their columns.
+
     Parameters
     ----------
     cl_dat : Numpy array. Cluster indicator.
-    w_dat : Numpy array. Weights.
+    w_dat : Numpy array. Weights (obs) or batch of weights (obs x batch).
     y_dat : Numpy array. Outcomes.
     ...
+    cl_ind : Sparse csr matrix or None. Cluster-indicator matrix of cl_dat.
+             Pass it if the same cluster variable is used repeatedly.
+             Default is None (built from cl_dat).
 
     Returns
     -------
     w_agg : Numpy array. Aggregated weights. Normalised to one.
-    y_agg : Numpy array. Aggregated outcomes.
+    y_agg : Numpy array. Aggregated outcomes. For a batch of weights, the
+            last dimension is the batch (cluster x outcome x batch).
     w_agg2 : Numpy array. Aggregated weights. Normalised to one.
     y_agg2 : Numpy array. Aggregated outcomes.
     """
-    cluster_no = np.unique(cl_dat)
-    no_cluster = len(cluster_no)
+    if cl_ind is None:
+        cl_ind = cluster_indicator(cl_dat)
+    batch = w_dat.ndim == 2
+    w_dat = w_dat.reshape(len(w_dat), -1)
     w_pos = np.abs(w_dat) > 1e-15
+    w_dat_pos = np.where(w_pos, w_dat, 0)
+    cl_pos = (cl_ind @ w_pos.astype(np.float64)) > 0
+    w_agg = np.where(cl_pos, cl_ind @ w_dat_pos, 0)
+    if w2_dat is not None:
+        w2_dat = w2_dat.reshape(len(w2_dat), -1)
+        w2_agg = np.where(cl_pos, cl_ind @ w2_dat, 0)
+        w2_dat_pos = np.where(np.abs(w2_dat) > 1e-15, w2_dat, 0)
+    else:
+        w2_agg = None
     if y_dat is not None:
         if y_dat.ndim == 1:
             y_dat = np.reshape(y_dat, (-1, 1))
-        q_obs = np.size(y_dat, axis=1)
-        y_agg = np.zeros((no_cluster, q_obs))
+        if sweights is not None:
+            w_dat_pos = w_dat_pos * sweights.reshape(-1, 1)
+            if y2_compute:
+                w2_dat_pos = w2_dat_pos * sweights.reshape(-1, 1)
+        y_agg = cluster_means(cl_ind, w_dat_pos, w_agg, cl_pos, y_dat)
+        y2_agg = (cluster_means(cl_ind, w2_dat_pos, w2_agg, cl_pos, y_dat)
+                  if y2_compute else None)
     else:
-        y_agg = None
-    y2_agg = np.copy(y_agg) if y2_compute else None
-    w_agg = np.zeros(no_cluster)
-    if w2_dat is not None:
-        w2_agg = np.zeros(no_cluster)
-        w2_pos = np.abs(w2_dat) > 1e-15
-    else:
-        w2_agg = None
-    for j, cl_ind in enumerate(cluster_no):
-        in_cluster = (cl_dat == cl_ind).reshape(-1)
-        in_cluster_pos = in_cluster & w_pos
-        if y2_compute:
-            in_cluster_pos2 = in_cluster & w2_pos
-        if np.any(in_cluster_pos):
-            w_agg[j] = np.sum(w_dat[in_cluster_pos])
-            if w2_dat is not None:
-                w2_agg[j] = np.sum(w2_dat[in_cluster])
-            if (y_dat is not None) and np.any(in_cluster_pos):
-                for odx in range(q_obs):
-                    if sweights is None:
-                        y_agg[j, odx] = (np.dot(
-                            w_dat[in_cluster_pos], y_dat[in_cluster_pos, odx])
-                            / w_agg[j])
-                        if y2_compute:
-                            y2_agg[j, odx] = (np.dot(
-                                w2_dat[in_cluster_pos2],
-                                y_dat[in_cluster_pos2, odx]) / w2_agg[j])
-                    else:
-                        y_agg[j, odx] = (np.dot(
-                            w_dat[in_cluster_pos] *
-                            sweights[in_cluster_pos].reshape(-1),
-                            y_dat[in_cluster_pos, odx]) / w_agg[j])
-                        if y2_compute:
-                            y2_agg[j, odx] = (np.dot(
-                                w2_dat[in_cluster_pos2] *
-                                sweights[in_cluster_pos2].reshape(-1),
-                                y_dat[in_cluster_pos2, odx]) / w2_agg[j])
+        y_agg = y2_agg = None
     if norma:
-        sum_w_agg = np.sum(w_agg)
-        if not 1-1e-10 < sum_w_agg < 1+1e-10:
-            w_agg = w_agg / sum_w_agg
+        sum_w_agg = np.sum(w_agg, axis=0)
+        not_norm = ~((1-1e-10 < sum_w_agg) & (sum_w_agg < 1+1e-10))
+        w_agg[:, not_norm] = w_agg[:, not_norm] / sum_w_agg[not_norm]
         if w2_dat is not None:
-            sum_w2_agg = np.sum(w2_agg)
-            if not 1-1e-10 < sum_w2_agg < 1+1e-10:
-                w2_agg = w2_agg / sum_w2_agg
+            sum_w2_agg = np.sum(w2_agg, axis=0)
+            not_norm = ~((1-1e-10 < sum_w2_agg) & (sum_w2_agg < 1+1e-10))
+            w2_agg[:, not_norm] = w2_agg[:, not_norm] / sum_w2_agg[not_norm]
+    if not batch:
+        w_agg = w_agg[:, 0]
+        w2_agg = None if w2_agg is None else w2_agg[:, 0]
+        y_agg = None if y_agg is None else y_agg[:, :, 0]
+        y2_agg = None if y2_agg is None else y2_agg[:, :, 0]
     return w_agg, y_agg, w2_agg, y2_agg
 
 
+def cluster_means(cl_ind, w_dat, w_agg, cl_pos, y_dat):
+    """Compute weighted means of outcomes in clusters for a batch of weights.
+
+    Clusters without positive weights get a mean of zero.
+    """
+    y_agg = np.zeros((cl_ind.shape[0], y_dat.shape[1], w_dat.shape[1]))
+    for odx in range(y_dat.shape[1]):
+        y_sum = cl_ind @ (w_dat * y_dat[:, odx].reshape(-1, 1))
+        np.divide(y_sum, w_agg, out=y_agg[:, odx, :], where=cl_pos)
+    return y_agg
+
+
+def cluster_indicator(cl_dat):
+    """Get sparse cluster-indicator matrix (cluster x obs) of cl_dat.
+
+    Clusters are in the order of np.unique(cl_dat).
+
+    Parameters
+    ----------
+    cl_dat : Numpy array. Cluster indicator.
+
+    Returns
+    -------
+    cl_ind : Sparse csr matrix. Element (j, i) is 1 if obs i is in cluster j.
+
+    """
+    _, cl_codes = np.unique(cl_dat.reshape(-1), return_inverse=True)
+    obs = len(cl_codes)
+    cl_ind = sparse.csr_matrix(
+        (np.ones(obs), (cl_codes.reshape(-1), np.arange(obs))),
+        shape=(cl_codes.max() + 1 if obs > 0 else 0, obs))
+    return cl_ind
+
+
 def moving_avg_mean_var(data, k, mean_and_var=True):
     """Compute moving average of mean and std deviation.
 
@@ -484,6 +588,150 @@ def kernel_density_y(y_dat, x_dat, grid, kernel, bandwidth):
     return f_grid
 
 
+def nadaraya_watson_fast(y_dat, x_dat, grid, kernel, bandwidth):
+    """Compute Nadaraya-Watson regression without n x grid matrices.
+
+    Same as nadaraya_watson, but uses kernel_density_fast. Exact for the
+    Epanechikov kernel, binned approximation for the normal kernel with
+    large data.
+
+    Parameters
+    ----------
+    y_dat : Numpy array. Dependent variable.
+    x_dat :  Numpy array. Independent variable.
+    grid : Numpy array. Values of x for which to create predictions.
+    kernel : Int. 1: Epanechikov  2: Normal.
+    bandwidth : Float. Bandwidth.
+
+    Returns
+    -------
+    estimate : Numpy array. Estimated quantity.
+
+    """
+    f_yx = kernel_density_fast(x_dat, grid, kernel, bandwidth, y_dat=y_dat)
+    f_x = kernel_density_fast(x_dat, grid, kernel, bandwidth)
+    estimate = f_yx / f_x
+    return estimate
+
+
+def kernel_density_fast(data, grid, kernel, bandwidth, y_dat=None,
+                        max_exact=2**22):
+    """Compute kernel density (of data * y) without n x grid matrices.
+
+    Epanechikov kernel: Exact estimate from a sorted window (prefix sums).
+    Normal kernel: kernel_density(_y) if the n x grid matrix has less than
+    max_exact elements, otherwise linear binning and FFT convolution.
+
+    Parameters
+    ----------
+    data : Numpy array. Variable for which density is estimated.
+    grid : Numpy array. Values for which to create predictions.
+    kernel : Int. 1: Epanechikov  2: Normal.
+    bandwidth : Float. Bandwidth.
+    y_dat : Numpy array or None. If not None, density of data * y.
+            Default is None.
+    max_exact : Int. Maximum size of matrix for exact normal kernel.
+                Default is 2**22.
+
+    Returns
+    -------
+    f_grid : Numpy array. Prediction.
+
+    """
+    data, grid = np.asarray(data).reshape(-1), np.asarray(grid).reshape(-1)
+    if y_dat is not None:
+        y_dat = np.asarray(y_dat).reshape(-1)
+    if kernel == 1:
+        return kernel_density_window(data, grid, bandwidth, y_dat)
+    if len(data) * len(grid) <= max_exact:
+        if y_dat is None:
+            return kernel_density(data, grid, kernel, bandwidth)
+        return kernel_density_y(y_dat.reshape(-1, 1), data, grid, kernel,
+                                bandwidth)
+    return kernel_density_binned(data, grid, kernel, bandwidth, y_dat)
+
+
+def kernel_density_window(data, grid, bandwidth, y_dat=None):
+    """Compute exact Epanechikov kernel density from sorted windows.
+
+    Sum of the kernel over all observations within one bandwidth of a grid
+    point is a quadratic polynomial in the grid point. Its coefficients are
+    differences of prefix sums of the sorted data. O((n + grid) log n).
+
+    Parameters
+    ----------
+    data : 1D Numpy array. Variable for which density is estimated.
+    grid : 1D Numpy array. Values for which to create predictions.
+    bandwidth : Float. Bandwidth.
+    y_dat : 1D Numpy array or None. If not None, density of data * y.
+            Default is None.
+
+    Returns
+    -------
+    f_grid : Numpy array. Prediction.
+
+    """
+    centre = np.mean(data)   # Centre and scale to reduce rounding errors
+    x_s, g_s = (data - centre) / bandwidth, (grid - centre) / bandwidth
+    sort_ind = np.argsort(x_s)
+    x_s = x_s[sort_ind]
+    vals = np.ones_like(x_s) if y_dat is None else y_dat[sort_ind]
+    cum_0, cum_1, cum_2 = (np.concatenate(([0], np.cumsum(vals * x_s**j)))
+                           for j in range(3))
+    low = np.searchsorted(x_s, g_s - 1, side='right')
+    upp = np.searchsorted(x_s, g_s + 1, side='left')
+    sum_0 = cum_0[upp] - cum_0[low]
+    sum_1 = cum_1[upp] - cum_1[low]
+    sum_2 = cum_2[upp] - cum_2[low]
+    f_grid = 3/4 * (sum_0 - sum_2 + 2 * g_s * sum_1 - g_s**2 * sum_0)
+    return f_grid / (len(data) * bandwidth)
+
+
+def kernel_density_binned(data, grid, kernel, bandwidth, y_dat=None,
+                          no_bins=None):
+    """Compute binned kernel density by linear binning and FFT convolution.
+
+    Approximation of kernel_density(_y) in O(n + bins log bins) with memory
+    bounded by the number of bins.
+
+    Parameters
+    ----------
+    data : 1D Numpy array. Variable for which density is estimated.
+    grid : 1D Numpy array. Values for which to create predictions.
+    kernel : Int. 1: Epanechikov  2: Normal.
+    bandwidth : Float. Bandwidth.
+    y_dat : 1D Numpy array or None. If not None, density of data * y.
+            Default is None.
+    no_bins : Int or None. Number of bins. Default (None) is 50 bins per
+              bandwidth, between 512 and 2**16.
+
+    Returns
+    -------
+    f_grid : Numpy array. Prediction.
+
+    """
+    lower = min(data.min(), grid.min())
+    upper = max(data.max(), grid.max())
+    if no_bins is None:
+        no_bins = int(np.clip(50 * (upper - lower) / bandwidth, 512, 2**16))
+    delta = (upper - lower) / (no_bins - 1)
+    if delta < 1e-15:
+        delta = bandwidth
+    vals = np.ones_like(data) if y_dat is None else y_dat
+    pos = (data - lower) / delta
+    left = np.clip(np.floor(pos).astype(np.int64), 0, no_bins - 2)
+    frac = pos - left
+    binned = (np.bincount(left, weights=(1 - frac) * vals, minlength=no_bins)
+              + np.bincount(left + 1, weights=frac * vals, minlength=no_bins))
+    support = 1 if kernel == 1 else 6     # Normal kernel: Truncate at 6 sd
+    len_kernel = min(int(support * bandwidth / delta) + 1, no_bins - 1)
+    kernel_w = kernel_proc(np.arange(-len_kernel, len_kernel + 1) * delta
+                           / bandwidth, kernel)
+    f_bins = sct_signal.fftconvolve(binned, kernel_w, mode='same')
+    f_grid = np.interp(grid, lower + np.arange(no_bins) * delta, f_bins)
+    return f_grid / (len(data) * bandwidth)
+
+
 def kernel_proc(data, kernel):
     """Feed data through kernel for nonparametric estimation.
 
@@ -7,15 +7,18 @@ Created on Thu May 11 16:30:11 2023
 # -*- coding: utf-8 -*-
 """
 from copy import deepcopy
+from hashlib import blake2b
 from numba import njit
 
 import numpy as np
 import ray
 
+from mcf import mcf_forest_asdict_functions as mcf_fo_asdict
 from mcf import mcf_forest_data_functions as mcf_data
 from mcf import mcf_general as mcf_gp
 from mcf import mcf_general_sys as mcf_sys
 from mcf import mcf_print_stats_functions as ps
+from mcf import mcf_ray_pool_functions as mcf_pool
 
 
 def rnd_variable_for_split(x_ind_pos, x_ai_ind_pos, cf_dic, mmm, rng):
@@ -218,7 +221,7 @@ def get_terminal_leaf_no(tree_dict, x_dat):
     """
     leaf_info_int = tree_dict['leaf_info_int']
     cut_off_cont = tree_dict['leaf_info_float'][:, 1]
-    cats_prime = tree_dict['cats_prime']
+    cats_bitset = tree_dict.get('cats_bitset')
     not_terminal, leaf_id = True, 0
     while not_terminal:    # Should equally fast than 'for' loop
         leaf = leaf_info_int[leaf_id, :]
@@ -233,18 +236,247 @@ def get_terminal_leaf_no(tree_dict, x_dat):
                     leaf[2]
                     if (x_dat[leaf[4]] - 1e-15) <= cut_off_cont[leaf_id]
                     else leaf[3])
-            else:                   # Categorical variable
-                prime_factors = mcf_gp.primes_reverse(cats_prime[leaf_id],
-                                                      False)
+            elif cats_bitset is None:  # Categorical variable (old encoding)
+                prime_factors = mcf_gp.primes_reverse(
+                    tree_dict['cats_prime'][leaf_id], False)
                 leaf_id = (
                     leaf[2] if int(np.round(x_dat[leaf[4]])) in prime_factors
                     else leaf[3])
+            else:                   # Categorical variable
+                leaf_id = (
+                    leaf[2] if category_in_bitset(
+                        cats_bitset[leaf_id], int(np.round(x_dat[leaf[4]])),
+                        mcf_gp.prime_position_table())
+                    else leaf[3])
+    return leaf_no
+
+
+def terminal_leaves_forest(forest, x_dat):
+    """Get the terminal leaf numbers of all observations for all trees.
+
+    Parameters
+    ----------
+    forest : List of dict. Trees.
+    x_dat : Numpy array. Data (observations x features).
+
+    Returns
+    -------
+    leaf_no : Numpy array (observations x trees). Terminal leaf numbers
+              (smallest integer type that holds the leaf numbers).
+
+    """
+    x_dat = np.ascontiguousarray(x_dat, dtype=np.float64)
+    largest = max((len(tree_dict['leaf_info_int']) for tree_dict in forest),
+                  default=0)
+    leaf_no = np.empty((x_dat.shape[0], len(forest)),
+                       dtype=mcf_fo_asdict.smallest_int_dtype(largest))
+    for idx, tree_dict in enumerate(forest):
+        leaf_no[:, idx] = terminal_leaves_tree(tree_dict, x_dat)
+    return leaf_no
+
+
+def terminal_leaves_oob(forest, n_obs):
+    """Get terminal leaves of the OOB observations from tree building.
+
+    During tree building, the OOB observations are split together with the
+    training observations (by the same rules as in terminal_leaves_tree).
+    Their terminal leaves are therefore known from the OOB lists of the
+    terminal leaves and need not be found by sending them through the trees.
+    The OOB lists are only available before delete_data_from_forest.
+
+    Parameters
+    ----------
+    forest : List of dict. Trees (with 'oob_data_list').
+    n_obs : INT. Number of observations used to build the forest.
+
+    Returns
+    -------
+    leaf_no : Numpy array (observations x trees). Terminal leaf numbers
+              (smallest integer type that holds the leaf numbers). -1 if the
+              observation is not OOB in the tree.
+
+    """
+    largest = max((len(tree_dict['leaf_info_int']) for tree_dict in forest),
+                  default=0)
+    leaf_no = -np.ones((n_obs, len(forest)),
+                       dtype=mcf_fo_asdict.smallest_int_dtype(largest))
+    for idx, tree_dict in enumerate(forest):
+        for leaf_id in np.flatnonzero(tree_dict['leaf_info_int'][:, 7] == 1):
+            oob_list = tree_dict['oob_data_list'][leaf_id]
+            if oob_list is not None:
+                leaf_no[oob_list, idx] = leaf_id
     return leaf_no
 
 
-def fill_trees_with_y_indices_mp(mcf_, data_df, forest):
+def data_fingerprint(x_dat):
+    """Get string identifying content of data (used as key of leaf cache)."""
+    x_dat = np.ascontiguousarray(x_dat, dtype=np.float64)
+    return (f'{x_dat.shape[0]}x{x_dat.shape[1]}_'
+            + blake2b(x_dat.view(np.uint8), digest_size=16).hexdigest())
+
+
+def terminal_leaves_cached(forest, x_dat, leaf_cache=None):
+    """Get the cached terminal leaf numbers of all observations (all trees).
+
+    The cache contains only the terminal leaves of the data used to fill the
+    trees (leaf_cache['fill'], see fill_trees_with_y_indices_mp). Leaves of
+    other data are not added to the cache (it is saved with the forest).
+
+    Parameters
+    ----------
+    forest : List of dict. Trees.
+    x_dat : Numpy array. Data (observations x features).
+    leaf_cache : Dict or None. Cache (as in forest_dic['leaf_cache']). None:
+                 No caching. Default is None.
+
+    Returns
+    -------
+    leaf_no : Numpy array (observations x trees) or None. Terminal leaf
+              numbers. None if x_dat is not the data of any entry of the
+              cache.
+
+    """
+    if not leaf_cache:
+        return None
+    fingerprint = data_fingerprint(x_dat)
+    for entry in leaf_cache.values():
+        if (entry['fingerprint'] == fingerprint
+                and entry['leaf_no'].shape[1] == len(forest)):
+            return entry['leaf_no']
+    return None
+
+
+def compact_leaf_numbers(leaf_no):
+    """Store leaf numbers in the smallest integer type possible."""
+    largest = np.max(leaf_no) if leaf_no.size > 0 else 0
+    return leaf_no.astype(mcf_fo_asdict.smallest_int_dtype(largest))
+
+
+def terminal_leaves_after_merge(tree_dict, leaf_no):
+    """Replace leaves merged in fill_mp by the leaves they were merged into.
+
+    Parameters
+    ----------
+    tree_dict : Dict. Tree after filling.
+    leaf_no : 1D Numpy array. Terminal leaves before filling.
+
+    Returns
+    -------
+    leaf_no : 1D Numpy array. Terminal leaves of the filled tree.
+
+    """
+    leaf_info_int = tree_dict['leaf_info_int']
+    leaf_ids = np.unique(leaf_no)
+    new_ids = leaf_ids.copy()
+    not_terminal = leaf_info_int[new_ids, 7] != 1
+    while np.any(not_terminal):
+        new_ids[not_terminal] = leaf_info_int[new_ids[not_terminal], 1]
+        not_terminal = leaf_info_int[new_ids, 7] != 1
+    if np.array_equal(leaf_ids, new_ids):
+        return leaf_no
+    return new_ids[np.searchsorted(leaf_ids, leaf_no)].astype(leaf_no.dtype)
+
+
+def terminal_leaves_tree(tree_dict, x_dat):
+    """Get the terminal leaf numbers of all observations for single tree.
+
+    Batch version of get_terminal_leaf_no (which remains the reference
+    implementation).
+
+    Parameters
+    ----------
+    tree_dict : Dict. Single tree.
+    x_dat : Numpy array. Data (observations x features).
+
+    Returns
+    -------
+    leaf_no : 1D Numpy array. Numbers of terminal leaves.
+
+    """
+    x_dat = np.ascontiguousarray(x_dat, dtype=np.float64)
+    leaf_info_int, cut_off_cont, cats_bitset = tree_routing_arrays(tree_dict)
+    leaf_no = terminal_leaves_numba(x_dat, leaf_info_int, cut_off_cont,
+                                    cats_bitset, mcf_gp.prime_position_table())
+    if np.any(leaf_no < 0):
+        raise RuntimeError('Leaf is still active.')
+    return leaf_no
+
+
+def tree_routing_arrays(tree_dict):
+    """Collect information needed for routing observations through tree.
+
+    Trees with prime encoded categorical splits (saved with earlier versions)
+    are decoded to bitsets on the fly.
+    """
+    leaf_info_int = tree_dict['leaf_info_int'].astype(np.int64)
+    cut_off_cont = np.ascontiguousarray(tree_dict['leaf_info_float'][:, 1],
+                                        dtype=np.float64)
+    if tree_dict.get('cats_bitset') is None:
+        cats_bitset = mcf_fo_asdict.cats_prime_to_bitset(tree_dict)
+    else:
+        cats_bitset = tree_dict['cats_bitset']
+    return leaf_info_int, cut_off_cont, cats_bitset
+
+
+@njit
+def category_in_bitset(bitset, x_cat, prime_pos):
+    """Check if category (coded as prime) is included in bitset.
+
+    prime_pos is the position table from mcf_general.prime_position_table.
+    """
+    if x_cat < 0 or x_cat >= len(prime_pos) or prime_pos[x_cat] < 0:
+        return False
+    pos = prime_pos[x_cat]
+    if pos // 64 >= len(bitset):
+        return False
+    return (bitset[pos // 64] >> np.uint64(pos % 64)) & np.uint64(1) == 1
+
+
+@njit
+def terminal_leaves_numba(x_dat, leaf_info_int, cut_off_cont, cats_bitset,
+                          prime_pos):
+    """Route all observations level by level to their terminal leaves.
+
+    Returns -1 for observations that reach a leaf that is still active.
+    """
+    obs = x_dat.shape[0]
+    leaf_no = np.zeros(obs, dtype=np.int64)
+    active = np.arange(obs)
+    no_active = obs
+    while no_active > 0:             # One level of the tree per pass
+        no_next = 0
+        for pos in range(no_active):
+            i = active[pos]
+            leaf_id = leaf_no[i]
+            if leaf_info_int[leaf_id, 7] == 1:     # Terminal leaf
+                continue
+            if leaf_info_int[leaf_id, 7] != 0:     # Active leaf
+                leaf_no[i] = -1
+                continue
+            x_value = x_dat[i, leaf_info_int[leaf_id, 4]]
+            if leaf_info_int[leaf_id, 5] == 0:     # Continuous variable
+                go_left = (x_value - 1e-15) <= cut_off_cont[leaf_id]
+            else:                                  # Categorical variable
+                go_left = category_in_bitset(cats_bitset[leaf_id],
+                                             np.int64(np.round(x_value)),
+                                             prime_pos)
+            if go_left:
+                leaf_no[i] = leaf_info_int[leaf_id, 2]
+            else:
+                leaf_no[i] = leaf_info_int[leaf_id, 3]
+            active[no_next] = i
+            no_next += 1
+        no_active = no_next
+    return leaf_no
+
+
+def fill_trees_with_y_indices_mp(mcf_, data_df, forest, leaf_cache=None):
     """Fill trees with indices of outcomes, MP.
 
+    If leaf_cache is a dictionary, the terminal leaves of all observations
+    are computed for all trees at once and kept (after merging of leaves) in
+    leaf_cache['fill'] (see terminal_leaves_cached).
+
     Returns
     -------
     forest_with_y : List of lists. Updated Node_table.
@@ -255,7 +487,7 @@ def fill_trees_with_y_indices_mp(mcf_, data_df, forest):
     int_dic, gen_dic, cf_dic = mcf_.int_dict, mcf_.gen_dict, mcf_.cf_dict
     if int_dic['with_output'] and int_dic['verbose']:
         print("\nFilling trees with indicies of outcomes")
-    (x_name, _, _, cf_dic, _, data_np, _, _, x_i, _, _, d_i, _, _, _
+    (x_name, _, _, cf_dic, _, data_np, _, _, x_i, _, _, d_i, _, _, _, _
      ) = mcf_data.prepare_data_for_forest(mcf_, data_df, True)
     err_txt = 'Wrong order of variables' + str(x_name) + ': ' + str(
         cf_dic['x_name_mcf'])
@@ -279,14 +511,19 @@ def fill_trees_with_y_indices_mp(mcf_, data_df, forest):
         x_dat = data_np[:, x_i]
         d_dat = np.int16(np.round(data_np[:, d_i]))
     obs = len(x_dat)
+    if leaf_cache is None:
+        leaf_no = [None] * cf_dic['boot']
+    else:
+        leaf_no = compact_leaf_numbers(terminal_leaves_forest(forest, x_dat))
     terminal_nodes = [None] * cf_dic['boot']
     nodes_empty = np.zeros(cf_dic['boot'])
     nodes_merged = np.zeros_like(nodes_empty)
     if gen_dic['mp_parallel'] < 1.5:
         maxworkers = 1
     else:
-        maxworkers = (mcf_sys.find_no_of_workers(gen_dic['mp_parallel'],
-                                                 gen_dic['sys_share'])
+        maxworkers = (mcf_sys.find_no_of_workers(
+            gen_dic['mp_parallel'], gen_dic['sys_share'],
+            budget_mb=int_dic['mem_budget_mb'])
                       if gen_dic['mp_automatic'] else gen_dic['mp_parallel'])
     if int_dic['with_output'] and int_dic['verbose']:
         print('Number of parallel processes: ', maxworkers)
@@ -294,25 +531,20 @@ def fill_trees_with_y_indices_mp(mcf_, data_df, forest):
         for idx in range(cf_dic['boot']):
             (_, forest[idx], terminal_nodes[idx], nodes_empty[idx],
              nodes_merged[idx]) = fill_mp(forest[idx], obs, d_dat, x_dat,
-                                          idx, gen_dic, cf_dic)
+                                          idx, gen_dic, cf_dic,
+                                          leaf_no[:, idx]
+                                          if leaf_cache is not None else None)
             if int_dic['with_output'] and int_dic['verbose']:
                 mcf_gp.share_completed(idx+1, cf_dic['boot'])
     else:
         if int_dic['ray_or_dask'] == 'ray':
-            if int_dic['mem_object_store_2'] is None:
-                if not ray.is_initialized():
-                    ray.init(num_cpus=maxworkers, include_dashboard=False)
-            else:
-                if not ray.is_initialized():
-                    ray.init(num_cpus=maxworkers, include_dashboard=False,
-                             object_store_memory=int_dic['mem_object_store_2'])
-                if int_dic['with_output'] and int_dic['verbose']:
-                    num = round(int_dic["mem_object_store_2"] / (1024 * 1024))
-                    txt = f'\nSize of Ray Object Store: {num} MB'
-                    ps.print_mcf(gen_dic, txt, summary=False)
-            x_dat_ref = ray.put(x_dat)
+            mcf_pool.start_worker_pool(mcf_, maxworkers,
+                                       int_dic['mem_object_store_2'])
+            x_dat_ref = mcf_pool.put_shared(mcf_, 'fill_data', x_dat,
+                                            key=data_df)
             still_running = [ray_fill_mp.remote(
-                forest[idx], obs, d_dat, x_dat_ref, idx, gen_dic, cf_dic)
+                forest[idx], obs, d_dat, x_dat_ref, idx, gen_dic, cf_dic,
+                leaf_no[:, idx] if leaf_cache is not None else None)
                 for idx in range(cf_dic['boot'])]
             jdx = 0
             while len(still_running) > 0:
@@ -329,10 +561,19 @@ def fill_trees_with_y_indices_mp(mcf_, data_df, forest):
                     jdx += 1
             if 'refs' in int_dic['mp_ray_del']:
                 del x_dat_ref
+                mcf_pool.release_shared(mcf_, 'fill_data')
             if 'rest' in int_dic['mp_ray_del']:
                 del finished_res, finished
-            if int_dic['mp_ray_shutdown']:
-                ray.shutdown()
+    if leaf_cache is not None:
+        for idx, tree_dict in enumerate(forest):
+            leaf_no[:, idx] = terminal_leaves_after_merge(tree_dict,
+                                                          leaf_no[:, idx])
+        leaf_cache['fill'] = {'fingerprint': data_fingerprint(x_dat),
+                              'leaf_no': leaf_no}
+    if int_dic['with_output'] and int_dic['verbose']:
+        mem_list = round(mcf_sys.total_size(forest) / (1024 * 1024), 2)
+    # Flatten indices of outcomes and narrow dtypes for prediction
+    forest = mcf_fo_asdict.compact_forest(forest)
     no_of_avg_enodes = np.mean(nodes_empty)
     no_of_avg_mnodes = np.mean(nodes_merged)
     if int_dic['with_output'] and int_dic['verbose']:
@@ -345,18 +586,22 @@ def fill_trees_with_y_indices_mp(mcf_, data_df, forest):
                     ' computation.')
         txt += '\n' + '-' * 100
         mem = round(mcf_sys.total_size(forest) / (1024 * 1024), 2)
-        txt += f'\nSize of forest: {mem} MB' + '\n' + '-' * 100
+        txt += (f'\nSize of forest: {mem} MB (before compaction: {mem_list}'
+                ' MB)\n' + '-' * 100)
         ps.print_mcf(gen_dic, txt, summary=True)
     return forest, terminal_nodes, no_of_avg_enodes
 
 
 @ray.remote
-def ray_fill_mp(tree_dict, obs, d_dat, x_dat, b_idx, gen_dic, cf_dic):
+def ray_fill_mp(tree_dict, obs, d_dat, x_dat, b_idx, gen_dic, cf_dic,
+                leaf_no=None):
     """Make it work under Ray."""
-    return fill_mp(tree_dict, obs, d_dat, x_dat, b_idx, gen_dic, cf_dic)
+    return fill_mp(tree_dict, obs, d_dat, x_dat, b_idx, gen_dic, cf_dic,
+                   leaf_no)
 
 
-def fill_mp(tree_dict_g, obs, d_dat, x_dat, b_idx, gen_dic, cf_dic):
+def fill_mp(tree_dict_g, obs, d_dat, x_dat, b_idx, gen_dic, cf_dic,
+            leaf_no=None):
     """Compute new node_table and list of final leaves.
 
     Parameters
@@ -367,6 +612,9 @@ def fill_mp(tree_dict_g, obs, d_dat, x_dat, b_idx, gen_dic, cf_dic):
     x_dat : Numpy array. Features.
     b_idx : Int. Tree number.
     gen_dic, cf_dic : Dict. Controls.
+    leaf_no : 1D Numpy array or None. Terminal leaves of all observations
+              (from terminal_leaves_cached). None: Route x_dat through tree.
+              Default is None.
 
     Returns
     -------
@@ -393,8 +641,10 @@ def fill_mp(tree_dict_g, obs, d_dat, x_dat, b_idx, gen_dic, cf_dic):
     else:
         obs_in_leaf = np.zeros((obs, 1), dtype=np.uint64)
 
-    for i, idx in enumerate(indices):
-        obs_in_leaf[i] = get_terminal_leaf_no(tree_dict, x_dat[idx, :])
+    if leaf_no is None:
+        obs_in_leaf[:, 0] = terminal_leaves_tree(tree_dict, x_dat[indices, :])
+    else:
+        obs_in_leaf[:, 0] = leaf_no[indices]
     unique_leafs = np.unique(obs_in_leaf)
     if subsam:
         # unique_leafs = unique_leafs[1:]  # remove first index: obs not used
@@ -471,7 +721,7 @@ def save_forests_in_cf_dic(forest_dic, forest_list, fold, no_folds, reg_round,
     return forest_list
 
 
-def train_save_data(mcf_, data_df, forest):
+def train_save_data(mcf_, data_df, forest, leaf_cache=None):
     """Save data needed in the prediction part of mcf."""
     y_train_df = data_df[mcf_.var_dict['y_name']]
     d_train_df = data_df[mcf_.var_dict['d_name']]
@@ -489,5 +739,6 @@ def train_save_data(mcf_, data_df, forest):
         x_bala_train_df = None
     forest_dic = {'forest': forest, 'y_train_df': y_train_df,
                   'd_train_df': d_train_df, 'x_bala_df': x_bala_train_df,
-                  'cl_train_df': cl_train_df, 'w_train_df': w_train_df}
+                  'cl_train_df': cl_train_df, 'w_train_df': w_train_df,
+                  'leaf_cache': leaf_cache}
     return forest_dic
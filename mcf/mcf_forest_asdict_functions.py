@@ -6,55 +6,66 @@ Contains the functions for saving trees and travelling inside them.
 @author: Michael Lechner
 # -*- coding: utf-8 -*-
 """
+import json
+import os
+
 import numpy as np
+import pandas as pd
+
+from mcf import mcf_general as mcf_gp
+from mcf import mcf_general_sys as mcf_sys
+
+
+def leaf_info_int_dtype(no_leaves, number_of_features, no_train, no_oob):
+    """Find smallest integer type for all entries of leaf_info_int."""
+    return smallest_int_dtype(max(no_leaves, number_of_features, no_train,
+                                  no_oob))
+
+
+def smallest_int_dtype(largest):
+    """Find smallest signed integer type that can hold values up to largest."""
+    if largest < 127:
+        return np.int8
+    if largest < 32767:
+        return np.int16
+    if largest < 2147483647:
+        return np.int32
+    return np.int64
 
 
-def make_default_tree_dict(n_leaf_min, number_of_features, indices_train,
-                           indices_oob):
+def make_tree_store(n_leaf_min, number_of_features, indices_train,
+                    indices_oob):
     """
-    Define a dict. containing the full information of the causal mcf tree.
+    Define a growable node store used while building a causal mcf tree.
+
+    leaf_info_int and leaf_info_float are kept as int64 and float64 during
+    tree building and the capacity of the store is doubled if more leaves
+    are needed. Use tree_store_to_dict to obtain the final tree.
 
     Parameters
     ----------
     n_leaf_min : Int.
-        Minimum number of observations per lead.
-    ...
+        Minimum number of observations per leaf (used for initial capacity).
+    number_of_features : Int.
+        Number of features.
+    indices_train : List or 1D Numpy array.
+        Indices of training data of tree.
+    indices_oob : 1D Numpy array.
+        Indices of OOB data of tree.
 
     Returns
     -------
-    Causal_tree : Dict.
-        All information about the causal tree.
+    tree_store : Dict.
+        Node store with root leaf initialised.
     """
-    leaves_max = int(np.ceil(len(indices_train) / n_leaf_min) * 2)
-    max_cols_int, max_cols_float = 10, 3
-    if (leaves_max < 127 and number_of_features < 127
-            and len(indices_train) < 127 and len(indices_oob) < 127):
-        leaf_info_int = -np.ones((leaves_max, max_cols_int), dtype=np.int8)
-        leaf_ids = np.arange(leaves_max, dtype=np.int8)
-    elif (leaves_max < 32767 and number_of_features < 32767
-          and len(indices_train) < 32767 and len(indices_oob) < 32767):
-        leaf_info_int = -np.ones((leaves_max, max_cols_int), dtype=np.int16)
-        leaf_ids = np.arange(leaves_max, dtype=np.int16)
-    elif (leaves_max < 2147483647 and number_of_features < 2147483647
-          and len(indices_train) < 2147483647
-          and len(indices_oob) < 2147483647):
-        leaf_info_int = -np.ones((leaves_max, max_cols_int), dtype=np.int32)
-        leaf_ids = np.arange(leaves_max, dtype=np.int32)
-    else:
-        leaf_info_int = -np.ones((leaves_max, max_cols_int), dtype=np.int64)
-        leaf_ids = np.arange(leaves_max, dtype=np.int64)
-    leaf_info_int[:, 0] = leaf_ids
-    leaf_info_int[0, 1] = -1
-    leaf_info_int[0, 6] = 0
-    leaf_info_int[0, 7] = 2
-    leaf_info_int[0, 8] = len(indices_train)
-    leaf_info_int[0, 9] = len(indices_oob)
+    capacity = max(int(np.ceil(len(indices_train) / n_leaf_min) * 2), 3)
+    leaf_info_int = -np.ones((capacity, 10), dtype=np.int64)
     # leaf_info_int 0: ID of leaf
     #               1: ID of parent (or -1 for root)
     #               2: ID of left daughter (values <=, cats of values
-    #                                                  included in Prime)
+    #                                                  included in bitset)
     #               3: ID of right daughter (values >, cats of values
-    #                                                  not included in Prime)
+    #                                                  not included in bitset)
     #               4: Index of splitting variable to go to daughter
     #               5: Type of splitting variable to go to daughter
     #                   (Ordered or categorical)
@@ -63,60 +74,165 @@ def make_default_tree_dict(n_leaf_min, number_of_features, indices_train,
     #                  1: Terminal leaf.
     #               8: Leaf size of training data in leaf
     #               9: Leaf size of OOB data in leaf
-
-    leaf_info_float = -np.ones((leaves_max, max_cols_float), dtype=np.float64)
-    leaf_info_float[:, 0] = leaf_ids
+    leaf_info_float = -np.ones((capacity, 3), dtype=np.float64)
     # leaf_info_float 0: ID of leaf
     #                 1: Cut-of value of ordered variables
     #                 2: OOB value of leaf
-
-    # Primes need to stored separately as np.int64 may not be sufficient to
-    # store extra large values
-    cats_prime = [0] * leaves_max   # List, otherwise could not hold long int
-    indices_train_all = [None] * leaves_max
-    indices_oob_all = [None] * leaves_max
-    indices_train_all[0] = indices_train
-    indices_oob_all[0] = indices_oob
-    causal_tree_empty_dic = {
+    leaf_info_int[0, 0] = leaf_info_float[0, 0] = 0
+    leaf_info_int[0, 6] = 0
+    leaf_info_int[0, 7] = 2
+    leaf_info_int[0, 8] = len(indices_train)
+    leaf_info_int[0, 9] = len(indices_oob)
+    train_data_list = [None] * capacity
+    oob_data_list = [None] * capacity
+    train_data_list[0] = indices_train
+    oob_data_list[0] = indices_oob
+    tree_store = {
         'leaf_info_int': leaf_info_int,
-        # 2dnarray with leaf info, integers
         'leaf_info_float': leaf_info_float,
-        # 2dnarray, with leaf info for floats
-        'cats_prime': cats_prime,
-        # 2dnarray, prime value for categorical features
+        'cats_bitset': [None] * capacity,
         'oob_indices': indices_oob,
+        'train_data_list': train_data_list,
+        'oob_data_list': oob_data_list,
+        'no_leaves': 1,
+        # Number of leaves used so far
+        'no_features': number_of_features,
+        'no_train': len(indices_train),
+        }
+    return tree_store
+
+
+def add_daughters_tree_store(tree_store):
+    """Reserve two new leaves in the node store and return their IDs."""
+    id_l = tree_store['no_leaves']
+    capacity = tree_store['leaf_info_int'].shape[0]
+    if id_l + 2 > capacity:
+        grow_tree_store(tree_store, 2 * capacity)
+    tree_store['leaf_info_int'][id_l:id_l+2, 0] = (id_l, id_l + 1)
+    tree_store['leaf_info_float'][id_l:id_l+2, 0] = (id_l, id_l + 1)
+    tree_store['no_leaves'] = id_l + 2
+    return id_l, id_l + 1
+
+
+def grow_tree_store(tree_store, capacity_new):
+    """Enlarge the capacity of the node store (in place)."""
+    capacity = tree_store['leaf_info_int'].shape[0]
+    extra = capacity_new - capacity
+    tree_store['leaf_info_int'] = np.concatenate(
+        (tree_store['leaf_info_int'], -np.ones((extra, 10), dtype=np.int64)))
+    tree_store['leaf_info_float'] = np.concatenate(
+        (tree_store['leaf_info_float'],
+         -np.ones((extra, 3), dtype=np.float64)))
+    tree_store['cats_bitset'].extend([None] * extra)
+    tree_store['train_data_list'].extend([None] * extra)
+    tree_store['oob_data_list'].extend([None] * extra)
+
+
+def tree_store_to_dict(tree_store):
+    """Convert node store to dictionary containing the causal mcf tree."""
+    no_leaves = tree_store['no_leaves']
+    oob_indices = tree_store['oob_indices']
+    int_type = leaf_info_int_dtype(no_leaves, tree_store['no_features'],
+                                   tree_store['no_train'], len(oob_indices))
+    tree = {
+        'leaf_info_int': tree_store['leaf_info_int'][:no_leaves, :].astype(
+            int_type),
+        'leaf_info_float': tree_store['leaf_info_float'][:no_leaves, :].copy(),
+        'cats_prime': None,
+        # Prime value for categorical features (old encoding)
+        'cats_bitset': pack_bitsets(tree_store['cats_bitset'][:no_leaves]),
+        # Categories going to left daughter: Bitset of positions of their
+        # primes (2D ndarray of uint64, leaves x words)
+        'oob_indices': oob_indices,
         # 1D ndarray, indices of tree-specific OOB data
-        'train_data_list': indices_train_all,
-        # Indices of data needed during tree building, will be removed use
-        'oob_data_list': indices_oob_all,
+        'train_data_list': tree_store['train_data_list'][:no_leaves],
+        # Indices of data needed during tree building, will be removed
+        'oob_data_list': tree_store['oob_data_list'][:no_leaves],
         # Indices of oob data needed during tree building, will be removed
-        # use
-        'fill_y_indices_list': None,
+        'fill_y_indices_list': [None] * no_leaves,
         # list (dim: # of leaves) of leaf-specific indices (to be filled after
         # forest building) - for terminal leaves only
         'fill_y_empty_leave': None,
-        # list (dim: # of leaves) of leaf-specific indices (to be filled after
-        # forest building) - for terminal leaves only
+        'fill_y_offsets': None,
+        'fill_y_indices': None,
+        # fill_y_indices_list in CSR format (after compact_tree): indices of
+        # leaf j are fill_y_indices[fill_y_offsets[j]:fill_y_offsets[j+1]]
         }
-    return causal_tree_empty_dic
-
-
-def cut_back_empty_cells_tree(tree):
-    """Cut back matrices and vector to max element."""
-    no_leaves = 0
-    for active in tree['leaf_info_int'][:, 7]:
-        if active == -1:
-            break
-        no_leaves += 1
-    tree['leaf_info_int'] = tree['leaf_info_int'][:no_leaves, :]
-    tree['leaf_info_float'] = tree['leaf_info_float'][:no_leaves, :]
-    tree['cats_prime'] = tree['cats_prime'][:no_leaves]
-    tree['train_data_list'] = tree['train_data_list'][:no_leaves]
-    tree['oob_data_list'] = tree['oob_data_list'][:no_leaves]
-    tree['fill_y_indices_list'] = [None] * no_leaves
     return tree
 
 
+def tree_dict_to_store(tree, number_of_features, no_train):
+    """Convert tree (see tree_store_to_dict) to node store to grow it further.
+
+    Parameters
+    ----------
+    tree : Dict.
+        Tree without active leaves.
+    number_of_features : Int.
+        Number of features.
+    no_train : Int.
+        Number of observations used to build tree.
+
+    Returns
+    -------
+    tree_store : Dict.
+        Node store (see make_tree_store).
+    """
+    no_leaves = tree['leaf_info_int'].shape[0]
+    leaf_info_int = tree['leaf_info_int'].astype(np.int64)
+    cats_bitset = [tree['cats_bitset'][leaf_id].copy()
+                   if leaf_info_int[leaf_id, 7] == 0
+                   and leaf_info_int[leaf_id, 5] > 0 else None
+                   for leaf_id in range(no_leaves)]
+    tree_store = {
+        'leaf_info_int': leaf_info_int,
+        'leaf_info_float': tree['leaf_info_float'].astype(np.float64),
+        'cats_bitset': cats_bitset,
+        'oob_indices': tree['oob_indices'],
+        'train_data_list': list(tree['train_data_list']),
+        'oob_data_list': list(tree['oob_data_list']),
+        'no_leaves': no_leaves,
+        'no_features': number_of_features,
+        'no_train': no_train,
+        }
+    return tree_store
+
+
+def pack_bitsets(bitset_list):
+    """Pack list of leaf-specific bitsets (or None) into 2D array."""
+    no_words = max((len(bitset) for bitset in bitset_list
+                    if bitset is not None), default=1)
+    cats_bitset = np.zeros((len(bitset_list), no_words), dtype=np.uint64)
+    for leaf_id, bitset in enumerate(bitset_list):
+        if bitset is not None:
+            cats_bitset[leaf_id, :len(bitset)] = bitset
+    return cats_bitset
+
+
+def cats_prime_to_bitset(tree):
+    """Get bitsets of categorical splits of tree saved as product of primes."""
+    bitset_list = [None] * len(tree['cats_prime'])
+    for leaf_id, prime_prod in enumerate(tree['cats_prime']):
+        if prime_prod > 1:
+            bitset_list[leaf_id] = mcf_gp.primes_to_bitset(
+                mcf_gp.primes_reverse(prime_prod, False))
+    return pack_bitsets(bitset_list)
+
+
+def convert_forest_cats_prime_to_bitset(forest):
+    """Convert forest with prime encoded categorical splits (in place).
+
+    Forests saved with earlier versions store the categories going to the
+    left daughter as product of primes. This converts them to the bitset
+    encoding used for new trees.
+    """
+    for tree in forest:
+        if tree.get('cats_bitset') is None:
+            tree['cats_bitset'] = cats_prime_to_bitset(tree)
+            tree['cats_prime'] = None
+    return forest
+
+
 def delete_training_data_forest(forest):
     """Delete training data from forest."""
     for tree in forest:
@@ -131,3 +247,423 @@ def delete_data_from_forest(forest):
         tree['oob_data_list'] = None
         tree['train_data_list'] = None
     return forest
+
+
+def compact_forest(forest):
+    """Compact all trees of a filled forest (in place), see compact_tree."""
+    for tree in forest:
+        compact_tree(tree)
+    return forest
+
+
+def compact_tree(tree):
+    """Reduce memory of a filled tree needed for prediction (in place).
+
+    - Indices of outcomes in leaves are stored as one CSR-style pair
+      (fill_y_offsets, fill_y_indices) instead of a list of arrays.
+    - Integers are stored in the smallest sufficient dtype.
+    - leaf_info_float is stored as float32 if all cut-off values are
+      exactly representable, see leaf_info_float32. The OOB values of the
+      leaves are only used while building the tree and may lose precision.
+    - Data only needed for building the tree is deleted.
+
+    Parameters
+    ----------
+    tree : Dict. Tree filled with indices of outcomes.
+
+    Returns
+    -------
+    tree : Dict. Compacted tree.
+    """
+    tree['oob_indices'] = tree['oob_data_list'] = None
+    tree['train_data_list'] = None
+    if tree.get('fill_y_offsets') is None:
+        tree['fill_y_offsets'], tree['fill_y_indices'] = fill_y_csr(tree)
+        tree['fill_y_indices_list'] = None
+    offsets, indices = tree['fill_y_offsets'], tree['fill_y_indices']
+    tree['fill_y_offsets'] = offsets.astype(smallest_int_dtype(offsets[-1]))
+    tree['fill_y_indices'] = indices.astype(smallest_int_dtype(
+        indices.max() if len(indices) > 0 else 0))
+    tree['leaf_info_int'] = tree['leaf_info_int'].astype(smallest_int_dtype(
+        np.abs(tree['leaf_info_int']).max()))
+    if tree['leaf_info_float'].dtype != np.float32:
+        leaf_info_float = leaf_info_float32(tree)
+        if leaf_info_float is not None:
+            tree['leaf_info_float'] = leaf_info_float
+    return tree
+
+
+def leaf_info_float32(tree):
+    """Get leaf_info_float as float32 if no cut-off value changes.
+
+    Any observation (also of new data) is then split as in the float64 tree.
+
+    Parameters
+    ----------
+    tree : Dict. Tree.
+
+    Returns
+    -------
+    leaf_info_float : 2D Numpy array (float32) or None (if not lossless).
+    """
+    leaf_info_int = tree['leaf_info_int']
+    leaf_info_float = tree['leaf_info_float'].astype(np.float32)
+    split_cont = (leaf_info_int[:, 7] == 0) & (leaf_info_int[:, 5] == 0)
+    if np.array_equal(tree['leaf_info_float'][split_cont, 1],
+                      leaf_info_float[split_cont, 1]):
+        return leaf_info_float
+    return None
+
+
+def fill_y_csr(tree):
+    """Get indices of outcomes of all leaves as CSR-style pair.
+
+    Parameters
+    ----------
+    tree : Dict. Filled tree (list or compact format).
+
+    Returns
+    -------
+    offsets : 1D Numpy array. Indices of leaf j are in
+              indices[offsets[j]:offsets[j+1]] (empty: leaf not filled).
+    indices : 1D Numpy array. Indices of outcomes.
+    """
+    if tree.get('fill_y_offsets') is not None:
+        return tree['fill_y_offsets'], tree['fill_y_indices']
+    fill_y = tree['fill_y_indices_list']
+    if fill_y is None:
+        fill_y = [None] * len(tree['leaf_info_int'])
+    offsets = np.zeros(len(fill_y) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([0 if leaf is None else len(leaf)
+                             for leaf in fill_y])
+    filled = [leaf for leaf in fill_y if leaf is not None]
+    indices = (np.concatenate(filled).astype(np.int64) if filled
+               else np.zeros(0, dtype=np.int64))
+    return offsets, indices
+
+
+def leaf_fill_y_indices(tree, leaf_id):
+    """Get indices of outcomes in leaf (None if leaf is not filled)."""
+    if tree.get('fill_y_offsets') is None:
+        return tree['fill_y_indices_list'][leaf_id]
+    start = tree['fill_y_offsets'][leaf_id]
+    stop = tree['fill_y_offsets'][leaf_id + 1]
+    return tree['fill_y_indices'][start:stop] if stop > start else None
+
+
+def forest_to_columns(forest):
+    """Convert list of tree dictionaries to flat arrays (columnar format).
+
+    Only the information needed for prediction is kept (leaf tables,
+    categorical splits and indices of outcomes in terminal leaves).
+
+    Parameters
+    ----------
+    forest : List of dict. Trees (after filling with outcomes).
+
+    Returns
+    -------
+    columns : Dict of Numpy arrays. Leaves of all trees stacked, the
+              leaves of tree j are in rows tree_offsets[j]:tree_offsets[j+1].
+              Indices of outcomes of leaf k are in fill_y_indices[
+              fill_y_offsets[k]:fill_y_offsets[k+1]].
+    """
+    # Trees with prime encoded splits are converted without changing forest
+    bitsets = [cats_prime_to_bitset(tree) if tree.get('cats_bitset') is None
+               else tree['cats_bitset'] for tree in forest]
+    no_leaves = [len(tree['leaf_info_int']) for tree in forest]
+    tree_offsets = np.zeros(len(forest) + 1, dtype=np.int64)
+    tree_offsets[1:] = np.cumsum(no_leaves)
+    no_words = max(bitset.shape[1] for bitset in bitsets)
+    cats_bitset = np.zeros((tree_offsets[-1], no_words), dtype=np.uint64)
+    fill_y_len, fill_y_list, fill_y_empty = [], [], []
+    for tree, bitset, start in zip(forest, bitsets, tree_offsets[:-1]):
+        cats_bitset[start:start+len(bitset), :bitset.shape[1]] = bitset
+        offsets, indices = fill_y_csr(tree)
+        fill_y_len.append(np.diff(offsets))
+        fill_y_list.append(indices)
+        fill_y_empty.append(np.zeros(len(offsets) - 1, dtype=np.int8)
+                            if tree['fill_y_empty_leave'] is None
+                            else tree['fill_y_empty_leave'])
+    fill_y_offsets = np.zeros(tree_offsets[-1] + 1, dtype=np.int64)
+    fill_y_offsets[1:] = np.cumsum(np.concatenate(fill_y_len))
+    fill_y_indices = np.concatenate(fill_y_list)
+    columns = {
+        'tree_offsets': tree_offsets,
+        'leaf_info_int': np.concatenate(
+            [tree['leaf_info_int'] for tree in forest]),
+        'leaf_info_float': np.concatenate(
+            [tree['leaf_info_float'] for tree in forest]),
+        'cats_bitset': cats_bitset,
+        'fill_y_indices': fill_y_indices.astype(smallest_int_dtype(
+            fill_y_indices.max() if len(fill_y_indices) > 0 else 0)),
+        'fill_y_offsets': fill_y_offsets,
+        'fill_y_empty_leave': np.concatenate(fill_y_empty).astype(np.int8),
+        }
+    return columns
+
+
+def columns_to_forest(columns):
+    """Convert columnar format to list of compact tree dictionaries.
+
+    The arrays of the trees are views into the arrays in columns (no copies
+    are made; memory mapped arrays remain memory mapped). Only the small
+    leaf offsets of the outcome indices are copied.
+
+    Parameters
+    ----------
+    columns : Dict of Numpy arrays. As returned by forest_to_columns.
+
+    Returns
+    -------
+    forest : List of dict. Trees.
+    """
+    tree_offsets = columns['tree_offsets']
+    fill_y_offsets = columns['fill_y_offsets']
+    forest = []
+    for start, stop in zip(tree_offsets[:-1], tree_offsets[1:]):
+        offsets = np.asarray(fill_y_offsets[start:stop+1])
+        forest.append({
+            'leaf_info_int': columns['leaf_info_int'][start:stop],
+            'leaf_info_float': columns['leaf_info_float'][start:stop],
+            'cats_prime': None,
+            'cats_bitset': columns['cats_bitset'][start:stop],
+            'oob_indices': None,
+            'train_data_list': None,
+            'oob_data_list': None,
+            'fill_y_indices_list': None,
+            'fill_y_offsets': offsets - offsets[0],
+            'fill_y_indices': columns['fill_y_indices'][
+                offsets[0]:offsets[-1]],
+            'fill_y_empty_leave': columns['fill_y_empty_leave'][start:stop],
+            })
+    return forest
+
+
+def save_forest_dic_mmap(path, forest_dic):
+    """Save forest and training data in a directory of .npy files.
+
+    The forest can be reloaded with load_forest_dic_mmap as memory mapped
+    arrays, i.e. without reading it into memory and with pages shared by all
+    processes using the same files.
+
+    Parameters
+    ----------
+    path : String. Directory (created if it does not exist).
+    forest_dic : Dict. Forest and training data (as from train_save_data).
+
+    Returns
+    -------
+    None.
+    """
+    os.makedirs(path, exist_ok=True)
+    for key, array in forest_to_columns(forest_dic['forest']).items():
+        file_name = os.path.join(path, key + '.npy')
+        mcf_sys.delete_file_if_exists(file_name)
+        np.save(file_name, array)
+    meta = {'format_version': 2, 'no_of_trees': len(forest_dic['forest']),
+            'data': {}, 'leaf_cache': {}}
+    for name, entry in (forest_dic.get('leaf_cache') or {}).items():
+        if name != 'fill':       # Entries of prediction data (old versions)
+            continue
+        file_name = os.path.join(path, f'leaf_cache_{name}.npy')
+        mcf_sys.delete_file_if_exists(file_name)
+        np.save(file_name, entry['leaf_no'])
+        meta['leaf_cache'][name] = entry['fingerprint']
+    for key, data_df in forest_dic.items():
+        if key in ('forest', 'leaf_cache') or data_df is None:
+            continue
+        meta['data'][key] = save_data_df_mmap(path, key, data_df)
+    with open(os.path.join(path, 'meta.json'), 'w', encoding='utf-8') as file:
+        json.dump(meta, file)
+
+
+def load_forest_dic_mmap(path, mmap_mode='r'):
+    """Load forest saved by save_forest_dic_mmap.
+
+    Parameters
+    ----------
+    path : String. Directory.
+    mmap_mode : String or None. Mode of np.load. 'r': Read-only memory map.
+                None: Read arrays into memory. Default is 'r'.
+
+    Returns
+    -------
+    forest_dic : Dict. Forest and training data. Numeric DataFrames of
+                 training data with one dtype and cached terminal leaves are
+                 memory mapped as well.
+    """
+    with open(os.path.join(path, 'meta.json'), encoding='utf-8') as file:
+        meta = json.load(file)
+    if meta['format_version'] not in (1, 2):
+        raise ValueError(f'Unknown format of saved forest in {path}.')
+    columns = {key: np.load(os.path.join(path, key + '.npy'),
+                            mmap_mode=mmap_mode, allow_pickle=False)
+               for key in ('tree_offsets', 'leaf_info_int', 'leaf_info_float',
+                           'cats_bitset', 'fill_y_indices', 'fill_y_offsets',
+                           'fill_y_empty_leave')}
+    forest_dic = {'forest': columns_to_forest(columns), 'y_train_df': None,
+                  'd_train_df': None, 'x_bala_df': None, 'cl_train_df': None,
+                  'w_train_df': None, 'leaf_cache': None}
+    if 'leaf_cache' in meta:
+        forest_dic['leaf_cache'] = {
+            name: {'fingerprint': fingerprint,
+                   'leaf_no': np.load(
+                       os.path.join(path, f'leaf_cache_{name}.npy'),
+                       mmap_mode=mmap_mode, allow_pickle=False)}
+            for name, fingerprint in meta['leaf_cache'].items()}
+    for key, entry in meta['data'].items():
+        if meta['format_version'] == 1:      # Columns, default index
+            forest_dic[key] = pd.DataFrame({
+                name: np.load(os.path.join(path, f'{key}_{idx}.npy'),
+                              allow_pickle=False)
+                for idx, name in enumerate(entry)})
+        else:
+            forest_dic[key] = load_data_df_mmap(path, key, entry, mmap_mode)
+    return forest_dic
+
+
+def save_data_df_mmap(path, key, data_df):
+    """Save DataFrame of training data for save_forest_dic_mmap.
+
+    DataFrames with numeric columns of one dtype, column names and index
+    names that are strings or integers, and a range or numeric index are
+    saved as one .npy file (columns x observations) that can be memory
+    mapped. All other DataFrames are pickled.
+
+    Parameters
+    ----------
+    path : String. Directory.
+    key : String. Name of DataFrame in forest_dic.
+    data_df : DataFrame.
+
+    Returns
+    -------
+    entry : Dict. Description of saved DataFrame for meta.json.
+    """
+    index = data_df.index
+    names = list(data_df.columns) + [data_df.columns.name, index.name]
+    dtypes = data_df.dtypes.unique()
+    as_array = (
+        len(dtypes) == 1 and dtypes[0].kind in 'biuf'
+        and all(name is None or isinstance(name, (str, int))
+                for name in names)
+        and not isinstance(index, pd.MultiIndex)
+        and (isinstance(index, pd.RangeIndex) or index.dtype.kind in 'iuf'))
+    for file_name in (f'{key}.npy', f'{key}_index.npy', f'{key}.pickle'):
+        mcf_sys.delete_file_if_exists(os.path.join(path, file_name))
+    if not as_array:
+        data_df.to_pickle(os.path.join(path, f'{key}.pickle'))
+        return {'pickle': True}
+    # Transposed: Rows of file are the (contiguous) columns of the frame
+    np.save(os.path.join(path, f'{key}.npy'),
+            np.ascontiguousarray(data_df.to_numpy().T))
+    entry = {'pickle': False, 'columns': list(data_df.columns),
+             'columns_name': data_df.columns.name, 'index_name': index.name}
+    if isinstance(index, pd.RangeIndex):
+        entry['index_range'] = [index.start, index.stop, index.step]
+    else:
+        np.save(os.path.join(path, f'{key}_index.npy'), index.to_numpy())
+    return entry
+
+
+def load_data_df_mmap(path, key, entry, mmap_mode='r'):
+    """Load DataFrame saved by save_data_df_mmap.
+
+    Parameters
+    ----------
+    path : String. Directory.
+    key : String. Name of DataFrame in forest_dic.
+    entry : Dict. Description of saved DataFrame from meta.json.
+    mmap_mode : String or None. Mode of np.load. Default is 'r'.
+
+    Returns
+    -------
+    data_df : DataFrame. Values are memory mapped if not pickled and
+              mmap_mode is not None.
+    """
+    if entry['pickle']:
+        return pd.read_pickle(os.path.join(path, f'{key}.pickle'))
+    values = np.load(os.path.join(path, f'{key}.npy'), mmap_mode=mmap_mode,
+                     allow_pickle=False)
+    if 'index_range' in entry:
+        index = pd.RangeIndex(*entry['index_range'], name=entry['index_name'])
+    else:
+        index = pd.Index(np.load(os.path.join(path, f'{key}_index.npy'),
+                                 allow_pickle=False), name=entry['index_name'])
+    columns = pd.Index(entry['columns'], name=entry['columns_name'])
+    return pd.DataFrame(values.T, index=index, columns=columns, copy=False)
+
+
+def save_forest_list_mmap(path, forest_list):
+    """Save all forests of mcf (folds x rounds) with save_forest_dic_mmap."""
+    os.makedirs(path, exist_ok=True)
+    saved = [[forest_dic is not None for forest_dic in forests_fold]
+             for forests_fold in forest_list]
+    for fold, forests_fold in enumerate(forest_list):
+        for round_, forest_dic in enumerate(forests_fold):
+            if forest_dic is not None:
+                save_forest_dic_mmap(
+                    os.path.join(path, f'fold{fold}_round{round_}'),
+                    forest_dic)
+    # Written last: Forests of earlier saves in path are ignored
+    with open(os.path.join(path, 'forest_list.json'), 'w',
+              encoding='utf-8') as file:
+        json.dump({'format_version': 1, 'saved': saved}, file)
+
+
+def save_mcf_pickle(mcf_, file_name, output=True):
+    """Pickle mcf instance, forests as memory-mapped arrays if requested.
+
+    If int_dict['forest_mmap_path'] is set, the forests are saved in this
+    directory (relative paths are relative to the directory of file_name)
+    and the pickle file keeps only a reference to it. The instance itself is
+    not changed.
+
+    Parameters
+    ----------
+    mcf_ : mcf-object. Trained instance.
+    file_name : String. Pickle file.
+    output : Boolean. Print where object is saved. Default is True.
+
+    Returns
+    -------
+    None.
+
+    """
+    path = mcf_.int_dict['forest_mmap_path']
+    if path is None or not isinstance(mcf_.forest, list):
+        mcf_sys.save_load(file_name, mcf_, save=True, output=output)
+        return
+    save_forest_list_mmap(
+        os.path.join(os.path.dirname(os.path.abspath(file_name)), path),
+        mcf_.forest)
+    forest = mcf_.forest
+    try:
+        mcf_.forest = {'mmap_path': path}
+        mcf_sys.save_load(file_name, mcf_, save=True, output=output)
+    finally:
+        mcf_.forest = forest
+
+
+def load_mcf_pickle(file_name, mmap_mode='r', output=True):
+    """Load mcf instance saved by save_mcf_pickle (forests memory mapped)."""
+    mcf_ = mcf_sys.save_load(file_name, save=False, output=output)
+    if isinstance(mcf_.forest, dict):
+        mcf_.forest = load_forest_list_mmap(
+            os.path.join(os.path.dirname(os.path.abspath(file_name)),
+                         mcf_.forest['mmap_path']), mmap_mode)
+    return mcf_
+
+
+def load_forest_list_mmap(path, mmap_mode='r'):
+    """Load all forests of mcf saved by save_forest_list_mmap."""
+    with open(os.path.join(path, 'forest_list.json'), encoding='utf-8'
+              ) as file:
+        meta = json.load(file)
+    if meta['format_version'] != 1:
+        raise ValueError(f'Unknown format of saved forests in {path}.')
+    return [[load_forest_dic_mmap(os.path.join(
+                path, f'fold{fold}_round{round_}'), mmap_mode)
+             if saved else None for round_, saved in enumerate(saved_fold)]
+            for fold, saved_fold in enumerate(meta['saved'])]
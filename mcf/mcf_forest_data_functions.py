@@ -11,12 +11,14 @@ import math
 import numpy as np
 import pandas as pd
 import ray
+from scipy.spatial import cKDTree
 from sklearn.ensemble import RandomForestClassifier, RandomForestRegressor
 
 from mcf import mcf_data_functions as data
 from mcf import mcf_general as gp
 from mcf import mcf_general_sys as gp_sys
 from mcf import mcf_print_stats_functions as ps
+from mcf import mcf_ray_pool_functions as mcf_pool
 
 
 def prepare_data_for_forest(mcf_, data_df, no_y_nn=False):
@@ -43,6 +45,9 @@ def prepare_data_for_forest(mcf_, data_df, no_y_nn=False):
     d_i : INT.
     w_i : INT.
     cl_i : INT.
+    d_grid_i : INT.
+    cl_rows : Tuple of 1D Numpy arrays or None. Rows of clusters (see
+              cluster_row_index). None if panel_in_rf is False.
 
     """
     cf_dic, var_dic = mcf_.cf_dict, mcf_.var_dict
@@ -91,8 +96,9 @@ def prepare_data_for_forest(mcf_, data_df, no_y_nn=False):
         cl_dat = data_df[var_dic['cluster_name']].to_numpy()
         data_np = np.concatenate((data_np, cl_dat), axis=1)
         cl_i = data_np.shape[1] - 1
+        cl_rows = cluster_row_index(data_np[:, cl_i])
     else:
-        cl_i = None
+        cl_i = cl_rows = None
     if mcf_.gen_dict['d_type'] == 'continuous':
         d_grid_dat = data_df[var_dic['grid_nn_name']].to_numpy()
         data_np = np.concatenate((data_np, d_grid_dat), axis=1)
@@ -101,7 +107,49 @@ def prepare_data_for_forest(mcf_, data_df, no_y_nn=False):
         d_grid_i = None
     y_i = [0]
     return (x_name, x_type, x_values, cf_dic, pen_mult, data_np,
-            y_i, y_nn_i, x_i, x_ind, x_ai_ind, d_i, w_i, cl_i, d_grid_i)
+            y_i, y_nn_i, x_i, x_ind, x_ai_ind, d_i, w_i, cl_i, d_grid_i,
+            cl_rows)
+
+
+def cluster_row_index(cl_dat):
+    """Index of rows belonging to each cluster (sorted by cluster).
+
+    Parameters
+    ----------
+    cl_dat : 1D Numpy array. Cluster variable.
+
+    Returns
+    -------
+    cl_rows : Tuple of 1D Numpy arrays. Rows sorted by cluster, position of
+              the first row of each cluster in this order, number of rows of
+              each cluster (clusters in ascending order).
+
+    """
+    order = np.argsort(cl_dat, kind='stable')
+    _, start, count = np.unique(cl_dat[order], return_index=True,
+                                return_counts=True)
+    return order, start, count
+
+
+def rows_of_clusters(cl_rows, clusters):
+    """Get rows (in ascending order) of selected clusters.
+
+    Parameters
+    ----------
+    cl_rows : Tuple of 1D Numpy arrays. See cluster_row_index.
+    clusters : 1D Numpy array of INT. Position of selected clusters.
+
+    Returns
+    -------
+    rows : 1D Numpy array of INT. Rows of selected clusters.
+
+    """
+    order, start, count = cl_rows
+    count_sel = count[clusters]
+    # Position in order: Start of cluster plus running number within cluster
+    shift = start[clusters] - np.cumsum(count_sel) + count_sel
+    pos = np.repeat(shift, count_sel) + np.arange(count_sel.sum())
+    return np.sort(order[pos])
 
 
 def m_n_grid(cf_dic, no_vars):
@@ -135,6 +183,59 @@ def m_n_grid(cf_dic, no_vars):
     return cf_dic
 
 
+def bin_ordered_features(data_np, y_i, y_nn_i, x_i, x_type, x_values,
+                         no_of_bins, with_y_nn=True):
+    """Quantize ordered covariates with many values into quantile bins.
+
+    Used by the histogram split mode. Bins are defined by their upper
+    boundaries, which are observed values of the covariate. Thus, x <= edge[b]
+    is equivalent to code <= b and splits of binned and unbinned covariates
+    are stored and used for prediction in the same way.
+
+    Parameters
+    ----------
+    data_np : Numpy array. Data for forest building.
+    y_i : List of INT. Position of outcome in data_np.
+    y_nn_i : Numpy array of INT. Position of matched outcomes in data_np.
+    x_i : Numpy array of INT. Position of covariates in data_np.
+    x_type : Numpy array of INT. Type of covariates (0: ordered).
+    x_values : List of lists. Values of covariates (empty if many values).
+    no_of_bins : INT. Maximum number of bins per covariate (<= 65536).
+    with_y_nn : Bool. Matched outcomes are used in the splitting rule.
+                Default is True.
+
+    Returns
+    -------
+    x_bins : Dict or None. Bin codes of binned covariates ('codes', uint8 or
+             uint16), column of covariate in codes ('col', -1 if not binned),
+             upper bin boundaries ('edges', None if not binned) and constants
+             used to center the outcomes ('y_center', 'y_nn_center'). None if
+             no covariate is binned.
+
+    """
+    col = -np.ones(len(x_i), dtype=np.int64)
+    edges, codes = [None] * len(x_i), []
+    quantiles = np.linspace(0, 1, no_of_bins + 1)[1:]
+    for idx, x_pos in enumerate(x_i):
+        if x_type[idx] > 0 or x_values[idx]:   # Few values: No binning
+            continue
+        x_dat = data_np[:, x_pos]
+        edges[idx] = np.unique(x_dat)
+        if len(edges[idx]) > no_of_bins:
+            edges[idx] = np.unique(np.quantile(x_dat, quantiles,
+                                               method='inverted_cdf'))
+        col[idx] = len(codes)
+        codes.append(np.searchsorted(edges[idx], x_dat, side='left'))
+    if not codes:
+        return None
+    code_type = np.uint8 if no_of_bins <= 256 else np.uint16
+    y_nn_center = (np.mean(data_np[:, y_nn_i], axis=0) if with_y_nn
+                   else 0)
+    return {'codes': np.column_stack(codes).astype(code_type), 'col': col,
+            'edges': edges, 'y_center': np.mean(data_np[:, y_i]),
+            'y_nn_center': y_nn_center}
+
+
 def nn_matched_outcomes(mcf_, data_df, print_out=True):
     """Find nearest neighbours."""
     var_dic, gen_dic, cf_dic = mcf_.var_dict, mcf_.gen_dict, mcf_.cf_dict
@@ -229,8 +330,9 @@ def nn_matched_outcomes(mcf_, data_df, print_out=True):
             maxworkers = 1
         else:
             if gen_dic['mp_automatic']:
-                maxworkers = gp_sys.find_no_of_workers(gen_dic['mp_parallel'],
-                                                       gen_dic['sys_share'])
+                maxworkers = gp_sys.find_no_of_workers(
+                    gen_dic['mp_parallel'], gen_dic['sys_share'],
+                    budget_mb=mcf_.int_dict['mem_budget_mb'])
             else:
                 maxworkers = gen_dic['mp_parallel']
         if gen_dic['with_output'] and gen_dic['verbose']:
@@ -239,18 +341,20 @@ def nn_matched_outcomes(mcf_, data_df, print_out=True):
         if maxworkers == 1:
             for i_treat, i_value in enumerate(d_values):
                 y_match[:, i_treat] = nn_neighbour_mcf2(
-                    y_dat, x_dat, d_dat, obs, cov_x_inv, i_value)
+                    y_dat, x_dat, d_dat, obs, cov_x_inv, i_value,
+                    tree_search=cf_dic['nn_tree_search'])
         else:  # Later on more workers needed
-            if int_dic['mp_ray_shutdown'] or int_dic['ray_or_dask'] == 'dask':
+            if int_dic['ray_or_dask'] == 'dask':
                 if maxworkers > math.ceil(no_of_treat/2):
                     maxworkers = math.ceil(no_of_treat/2)
             if int_dic['ray_or_dask'] == 'ray':
-                if not ray.is_initialized():
-                    ray.init(num_cpus=maxworkers, include_dashboard=False)
+                # Workers are kept for later stages: Start all of them
+                mcf_pool.start_worker_pool(mcf_, maxworkers)
                 x_dat_ref = ray.put(x_dat)
                 still_running = [ray_nn_neighbour_mcf2.remote(
                     y_dat, x_dat_ref, d_dat, obs, cov_x_inv, d_values[idx],
-                    idx) for idx in range(no_of_treat)]
+                    idx, cf_dic['nn_tree_search'])
+                    for idx in range(no_of_treat)]
                 while len(still_running) > 0:
                     finished, still_running = ray.wait(still_running)
                     finished_res = ray.get(finished)
@@ -260,8 +364,6 @@ def nn_matched_outcomes(mcf_, data_df, print_out=True):
                     del x_dat_ref
                 if 'rest' in int_dic['mp_ray_del']:
                     del finished_res, finished
-                if int_dic['mp_ray_shutdown']:
-                    ray.shutdown()
     else:
         y_match = np.zeros((obs, no_of_treat))
     treat_val_str = [str(i) for i in d_values]
@@ -289,14 +391,14 @@ def nn_matched_outcomes(mcf_, data_df, print_out=True):
 
 @ray.remote
 def ray_nn_neighbour_mcf2(y_dat, x_dat, d_dat, obs, cov_x_inv, treat_value,
-                          i_treat=None):
+                          i_treat=None, tree_search=False):
     """Make procedure compatible for Ray."""
     return nn_neighbour_mcf2(y_dat, x_dat, d_dat, obs, cov_x_inv, treat_value,
-                             i_treat)
+                             i_treat, tree_search)
 
 
 def nn_neighbour_mcf2(y_dat, x_dat, d_dat, obs, cov_x_inv, treat_value,
-                      i_treat=None):
+                      i_treat=None, tree_search=False):
     """Find nearest neighbour-y in subsamples by value of d.
 
     Parameters
@@ -308,6 +410,8 @@ def nn_neighbour_mcf2(y_dat, x_dat, d_dat, obs, cov_x_inv, treat_value,
     cov_x_inv : Numpy array: inverse of covariance matrix
     treat_values : Numpy array: possible values of D
     i_treat : Position treat_values investigated
+    tree_search : Boolean. Use KD-tree instead of brute force search.
+                  Default is False.
 
     Returns
     -------
@@ -316,6 +420,11 @@ def nn_neighbour_mcf2(y_dat, x_dat, d_dat, obs, cov_x_inv, treat_value,
                         positions).
 
     """
+    if tree_search:
+        y_all = nn_neighbour_tree(y_dat, x_dat, d_dat, cov_x_inv, treat_value)
+        if i_treat is None:
+            return y_all
+        return y_all, i_treat
     cond = (d_dat == treat_value).reshape(-1)
     x_t = x_dat[cond, :]
     y_t = y_dat[cond]
@@ -331,3 +440,65 @@ def nn_neighbour_mcf2(y_dat, x_dat, d_dat, obs, cov_x_inv, treat_value,
     if i_treat is None:
         return y_all  # i_treat is returned for multithreading
     return y_all, i_treat  # i_treat is returned for multithreading
+
+
+def nn_neighbour_tree(y_dat, x_dat, d_dat, cov_x_inv, treat_value,
+                      no_of_neighbours=8):
+    """Find nearest neighbour-y in subsamples by value of d with KD-tree.
+
+    The covariates are whitened such that Euclidean distances equal the
+    Mahalanobis distances based on cov_x_inv. As in nn_neighbour_mcf2, the
+    outcomes of all (tied) nearest neighbours are averaged.
+
+    Parameters
+    ----------
+    y_dat : Numpy array: Outcome variable
+    x_dat : Numpy array: Covariates
+    d_dat : Numpy array: Treatment
+    cov_x_inv : Numpy array: inverse of covariance matrix
+    treat_value : Value of D investigated
+    no_of_neighbours : Int. Number of neighbours found in first query. Only
+                       observations with more ties are queried again.
+                       Default is 8.
+
+    Returns
+    -------
+    y_all : Numpy series with matched values.
+
+    """
+    cond = (d_dat == treat_value).reshape(-1)
+    y_dat = y_dat.reshape(-1)
+    x_white = whiten_mahalanobis(x_dat, cov_x_inv)
+    y_t = y_dat[cond]
+    y_all = y_dat.astype(np.float64)
+    query = np.flatnonzero(~cond)
+    if len(query) == 0:
+        return y_all
+    tree = cKDTree(x_white[cond])
+    no_of_neighbours = min(no_of_neighbours, len(y_t))
+    dist, ind = tree.query(x_white[query], k=no_of_neighbours)
+    dist, ind = dist.reshape(len(query), -1), ind.reshape(len(query), -1)
+    dist2 = dist**2
+    tied = dist2 <= dist2[:, :1] + 1e-15
+    y_all[query] = np.sum(y_t[ind] * tied, axis=1) / np.sum(tied, axis=1)
+    more_ties = tied[:, -1] if no_of_neighbours < len(y_t) else np.zeros(
+        len(query), dtype=bool)
+    if np.any(more_ties):       # Collect all neighbours at minimum distance
+        radius = np.sqrt(dist2[more_ties, 0] + 1e-15)
+        neighbours = tree.query_ball_point(x_white[query[more_ties]], radius)
+        y_all[query[more_ties]] = [np.mean(y_t[nbs]) for nbs in neighbours]
+    return y_all
+
+
+def whiten_mahalanobis(x_dat, cov_x_inv):
+    """Transform data such that Euclidean equal Mahalanobis distances."""
+    x_dat = np.asarray(x_dat, dtype=np.float64).reshape(len(x_dat), -1)
+    if np.isscalar(cov_x_inv) or np.size(cov_x_inv) == 1:
+        return x_dat * np.sqrt(np.asarray(cov_x_inv, dtype=np.float64
+                                          ).reshape(-1)[0])
+    try:
+        chol = np.linalg.cholesky(cov_x_inv)
+    except np.linalg.LinAlgError:
+        eig_val, eig_vec = np.linalg.eigh(cov_x_inv)
+        chol = eig_vec * np.sqrt(np.maximum(eig_val, 0))
+    return x_dat @ chol
@@ -6,7 +6,8 @@ Created on Thu May 11 16:30:11 2023
 @author: MLechner
 # -*- coding: utf-8 -*-
 """
-from copy import copy, deepcopy
+from copy import copy
+from hashlib import blake2b
 from math import inf
 from time import time
 
@@ -21,6 +22,7 @@ from mcf import mcf_forest_asdict_functions as mcf_fo_asdict
 from mcf import mcf_general as mcf_gp
 from mcf import mcf_general_sys as mcf_sys
 from mcf import mcf_print_stats_functions as ps
+from mcf import mcf_ray_pool_functions as mcf_pool
 from mcf import mcf_variable_importance_functions as mcf_vi
 
 
@@ -70,8 +72,14 @@ def train_forest(mcf_, tree_df, fill_y_df):
             if all((cf_dic['vi_oob_yes'], gen_dic['with_output'], reg_round,
                     splits == 0)):
                 time_start = time()
+                # Terminal leaves of OOB observations are known from building
+                leaf_no_oob = (mcf_fo_add.terminal_leaves_oob(
+                    forest, len(tree_fold_df))
+                    if cf_dic['leaf_cache']
+                    and gen_dic['d_type'] != 'continuous' else None)
                 mcf_vi.variable_importance(mcf_, tree_fold_df, forest,
-                                           x_name_mcf)
+                                           x_name_mcf, leaf_no_oob)
+                del leaf_no_oob
                 time_vi = time() - time_start
             else:
                 time_vi = 0
@@ -79,10 +87,11 @@ def train_forest(mcf_, tree_df, fill_y_df):
             # Fill tree with outcomes(regular, , efficient IATE)
             if gen_dic['with_output']:
                 print(f'Filling {splits+1} / {folds} forests, {round_}')
+            leaf_cache = {} if cf_dic['leaf_cache'] else None
             forest, _, _ = mcf_fo_add.fill_trees_with_y_indices_mp(
-                mcf_, fill_y_fold_df, forest)
+                mcf_, fill_y_fold_df, forest, leaf_cache)
             forest_dic = mcf_fo_add.train_save_data(mcf_, fill_y_fold_df,
-                                                    forest)
+                                                    forest, leaf_cache)
             forest_list = mcf_fo_add.save_forests_in_cf_dic(
                 forest_dic, forest_list, splits, folds, reg_round,
                 gen_dic['iate_eff'])
@@ -99,13 +108,19 @@ def build_forest(mcf_, tree_df):
             ps.print_mcf(gen_dic, '\nNo use of ray in forest building.',
                          summary=False)
     (x_name, x_type, x_values, cf_dic, pen_mult, data_np, y_i, y_nn_i, x_i,
-     x_ind, x_ai_ind, d_i, w_i, cl_i, d_grid_i
+     x_ind, x_ai_ind, d_i, w_i, cl_i, d_grid_i, cl_rows
      ) = mcf_fo_data.prepare_data_for_forest(mcf_, tree_df)
+    x_bins = histogram_bins(data_np, y_i, y_nn_i, x_i, x_type, x_values,
+                            cf_dic, gen_dic)
     if gen_dic['mp_parallel'] < 1.5:
         maxworkers = 1
     else:
-        maxworkers = (mcf_sys.find_no_of_workers(gen_dic['mp_parallel'],
-                                                 gen_dic['sys_share'])
+        task_mb = mcf_sys.task_memory_mb('tree', n_rows=data_np.shape[0],
+                                         n_cols=data_np.shape[1])
+        maxworkers = (mcf_sys.find_no_of_workers(
+            gen_dic['mp_parallel'], gen_dic['sys_share'], task_mb=task_mb,
+            shared_mb=data_np.nbytes / (1024 * 1024),
+            budget_mb=int_dic['mem_budget_mb'])
                       if gen_dic['mp_automatic'] else gen_dic['mp_parallel'])
     if int_dic['with_output'] and int_dic['verbose']:
         ps.print_mcf(gen_dic, f'\nNumber of parallel processes: {maxworkers}',
@@ -116,27 +131,23 @@ def build_forest(mcf_, tree_df):
             forest[idx] = build_tree_mcf(
                 data_np, y_i, y_nn_i, x_i, d_i, d_grid_i, cl_i, w_i, x_type,
                 x_values, x_ind, x_ai_ind, gen_dic, cf_dic, mcf_.ct_dict, idx,
-                pen_mult)
+                pen_mult, x_bins=x_bins, cl_rows=cl_rows)
             if int_dic['with_output'] and int_dic['verbose']:
                 mcf_gp.share_completed(idx+1, cf_dic['boot'])
     else:
         if with_ray:
-            if int_dic['mem_object_store_1'] is None:
-                if not ray.is_initialized():
-                    ray.init(num_cpus=maxworkers, include_dashboard=False)
-            else:
-                if not ray.is_initialized():
-                    ray.init(
-                        num_cpus=maxworkers, include_dashboard=False,
-                        object_store_memory=int_dic['mem_object_store_1'])
-                if int_dic['with_output'] and int_dic['verbose']:
-                    print("Size of Ray Object Store: ", round(
-                        int_dic['mem_object_store_1']/(1024*1024)), " MB")
-            data_np_ref = ray.put(data_np)
+            mcf_pool.start_worker_pool(mcf_, maxworkers,
+                                       int_dic['mem_object_store_1'])
+            data_np_ref = mcf_pool.put_shared(mcf_, 'tree_data', data_np,
+                                              key=tree_df)
+            x_bins_ref = (None if x_bins is None else mcf_pool.put_shared(
+                mcf_, 'tree_bins', x_bins, key=tree_df))
+            cl_rows_ref = (None if cl_rows is None else mcf_pool.put_shared(
+                mcf_, 'tree_cl_rows', cl_rows, key=tree_df))
             still_running = [ray_build_tree_mcf.remote(
                 data_np_ref, y_i, y_nn_i, x_i, d_i, d_grid_i, cl_i, w_i,
                 x_type, x_values, x_ind, x_ai_ind, gen_dic, cf_dic,
-                mcf_.ct_dict, boot, pen_mult)
+                mcf_.ct_dict, boot, pen_mult, x_bins_ref, cl_rows_ref)
                 for boot in range(cf_dic['boot'])]
             jdx = 0
             while len(still_running) > 0:
@@ -150,11 +161,9 @@ def build_forest(mcf_, tree_df):
                 if jdx % 50 == 0:   # every 50'th tree
                     mcf_sys.auto_garbage_collect(50)  # do if half mem full
             if 'refs' in int_dic['mp_ray_del']:
-                del data_np_ref
+                del data_np_ref, x_bins_ref, cl_rows_ref
             if 'rest' in int_dic['mp_ray_del']:
                 del finished_res, finished
-            if int_dic['mp_ray_shutdown']:
-                ray.shutdown()
         else:
             raise RuntimeError('USE RAY')
         if len(forest) != cf_dic['boot']:
@@ -174,16 +183,28 @@ def build_forest(mcf_, tree_df):
 @ray.remote
 def ray_build_tree_mcf(data_np, y_i, y_nn_i, x_i, d_i, d_grid_i, cl_i, w_i,
                        x_type, x_values, x_ind, x_ai_ind, gen_dic, cf_dic,
-                       ct_dic, boot, pen_mult):
+                       ct_dic, boot, pen_mult, x_bins=None, cl_rows=None):
     """Prepare function for Ray."""
     return build_tree_mcf(data_np, y_i, y_nn_i, x_i, d_i, d_grid_i, cl_i, w_i,
                           x_type, x_values, x_ind, x_ai_ind, gen_dic, cf_dic,
-                          ct_dic, boot, pen_mult)
+                          ct_dic, boot, pen_mult, x_bins=x_bins,
+                          cl_rows=cl_rows)
+
+
+def histogram_bins(data_np, y_i, y_nn_i, x_i, x_type, x_values, cf_dic,
+                   gen_dic):
+    """Bin ordered covariates if the histogram split mode is used."""
+    if (cf_dic['split_bins'] and cf_dic['sorted_split_search']
+            and gen_dic['d_type'] != 'continuous'):
+        return mcf_fo_data.bin_ordered_features(
+            data_np, y_i, y_nn_i, x_i, x_type, x_values, cf_dic['split_bins'],
+            cf_dic['mtot'] in (1, 4))
+    return None
 
 
 def build_tree_mcf(data_np, y_i, y_nn_i, x_i, d_i, d_grid_i, cl_i, w_i, x_type,
                    x_values, x_ind, x_ai_ind, gen_dic, cf_dic, ct_dic, boot,
-                   pen_mult):
+                   pen_mult, x_bins=None, cl_rows=None):
     """Build single trees for all values of tuning parameters.
 
     Parameters
@@ -201,52 +222,330 @@ def build_tree_mcf(data_np, y_i, y_nn_i, x_i, d_i, d_grid_i, cl_i, w_i, x_type,
     x_ai_ind : List of INT. 1 if variable is included in every split
     ..._dict : Dict. Control parameters
     boot : INT. Counter for bootstrap replication (currently not used)
+    x_bins : Dict or None. Binned ordered covariates (histogram split mode).
+    cl_rows : Tuple or None. Rows of clusters (see
+              mcf_forest_data_functions.cluster_row_index). None: Computed
+              here if needed.
     ....
 
     Returns
     -------
     tree_all : Dict (m_grid x N_min_grid x alpha_grid) with trees for all
                values of tuning parameters
+
+    If there is more than one combination of tuning parameters, the trees
+    share the split statistics of common leaves (see init_split_cache) and
+    contain their OOB objective function ('oob_obj'). The split cache is
+    opt-in: With the defaults (random thresholds, no sorted split search),
+    the trees share no work. If cf_dic['n_min_pruning'] is True, trees for
+    larger n_min are obtained by pruning the tree grown with the smallest
+    n_min and growing the pruned leaves further (see prune_tree_n_min and
+    regrow_pruned_leaves).
     """
     # split data into OOB and tree data
     n_obs = data_np.shape[0]
     # Random number initialisation. This seeds rnd generator within process.
     rng = np.random.default_rng((10+boot)**2+121)
     if gen_dic['panel_in_rf']:
-        cl_unique = np.unique(data_np[:, cl_i])
-        n_cl = cl_unique.shape[0]
+        if cl_rows is None:
+            cl_rows = mcf_fo_data.cluster_row_index(data_np[:, cl_i])
+        n_cl = len(cl_rows[1])
         n_train = round(n_cl * cf_dic['subsample_share_forest'])
-        indices_cl = list(rng.choice(n_cl, size=n_train, replace=False))
-        indices = [i for i in range(n_obs) if data_np[i, cl_i] in indices_cl]
+        indices_cl = rng.choice(n_cl, size=n_train, replace=False)
+        indices = mcf_fo_data.rows_of_clusters(cl_rows, indices_cl)
     else:
         n_train = round(n_obs * cf_dic['subsample_share_forest'])
         indices = list(rng.choice(n_obs, size=n_train, replace=False))
     indices_oob = np.delete(np.arange(n_obs), indices, axis=0)
-    tree_empty = mcf_fo_asdict.make_default_tree_dict(
-        np.max(cf_dic['n_min_values']), len(x_i), indices, indices_oob)
     # build trees for all m,n combinations
     grid_for_m = mcf_gp.check_if_iterable(cf_dic['m_values'])
     grid_for_n_min = mcf_gp.check_if_iterable(cf_dic['n_min_values'])
     grid_for_alpha_reg = mcf_gp.check_if_iterable(cf_dic['alpha_reg_values'])
     tree_all = [None] * len(grid_for_m) * len(grid_for_n_min) * len(
         grid_for_alpha_reg)
+    # Trees differing only in n_min are obtained by pruning the tree grown
+    # with the smallest n_min
+    n_min_pruning = cf_dic['n_min_pruning'] and len(grid_for_n_min) > 1
+    split_cache = init_split_cache(len(indices), len(tree_all), cf_dic,
+                                   gen_dic)
+    rng_oob = np.random.default_rng((10+boot)**2+122)
+    trees_grown = {}
     j = 0
     for m_idx in grid_for_m:
         for n_min in grid_for_n_min:
             for alpha_reg in grid_for_alpha_reg:
-                tree_all[j] = build_single_tree(
-                    data_np, y_i, y_nn_i, d_i, d_grid_i, x_i, w_i,
-                    x_type, x_values, x_ind, x_ai_ind, cf_dic, gen_dic,
-                    ct_dic['grid_nn_val'], m_idx, n_min, alpha_reg,
-                    deepcopy(tree_empty), pen_mult, rng)
+                n_min_grow = min(grid_for_n_min) if n_min_pruning else n_min
+                if (m_idx, n_min_grow, alpha_reg) not in trees_grown:
+                    tree_store = mcf_fo_asdict.make_tree_store(
+                        n_min_grow, len(x_i), indices, indices_oob)
+                    trees_grown[(m_idx, n_min_grow, alpha_reg)] = (
+                        build_single_tree(
+                            data_np, y_i, y_nn_i, d_i, d_grid_i, x_i, w_i,
+                            x_type, x_values, x_ind, x_ai_ind, cf_dic,
+                            gen_dic, ct_dic['grid_nn_val'], m_idx, n_min_grow,
+                            alpha_reg, tree_store, pen_mult, rng,
+                            split_cache, x_bins))
+                tree_all[j], leaves_to_grow = prune_tree_n_min(
+                    trees_grown[(m_idx, n_min_grow, alpha_reg)], n_min,
+                    data_np, y_i, y_nn_i, d_i, d_grid_i, w_i,
+                    ct_dic['grid_nn_val'], gen_dic, cf_dic, rng_oob)
+                if len(leaves_to_grow) > 0:
+                    tree_all[j] = regrow_pruned_leaves(
+                        tree_all[j], leaves_to_grow, indices, data_np, y_i,
+                        y_nn_i, d_i, d_grid_i, x_i, w_i, x_type, x_values,
+                        x_ind, x_ai_ind, cf_dic, gen_dic,
+                        ct_dic['grid_nn_val'], m_idx, n_min, alpha_reg,
+                        pen_mult, rng, split_cache, x_bins)
+                if len(tree_all) > 1:   # Needed to select best tree
+                    tree_all[j]['oob_obj'] = tree_oob_objective(
+                        tree_all[j], data_np, y_i, y_nn_i, d_i, d_grid_i, w_i,
+                        ct_dic['grid_nn_val'], gen_dic, cf_dic, rng_oob)
                 j += 1
-    return deepcopy(tree_all)
+    return tree_all
+
+
+def init_split_cache(n_train, no_of_trees, cf_dic, gen_dic, max_mb=256):
+    """Initialise cache of split statistics shared by the trees of one sample.
+
+    The trees for the different values of the tuning parameters are grown
+    on the same sample. As long as they agree (root and shallow levels),
+    the same leaves are split. The split values and the statistics of the
+    sorted split search of a variable in a leaf are therefore computed once
+    and reused. Results are identical to computing them for each tree.
+
+    The cache is opt-in: It requires the sorted split search
+    (cf_dic['sorted_split_search']) and that all thresholds are checked
+    (cf_dic['random_thresholds'] == 0, e.g. in histogram split mode). With
+    the defaults (no sorted split search, random thresholds), no cache is
+    used, because random thresholds differ between trees.
+
+    Parameters
+    ----------
+    n_train : Int. Number of observations used to build trees.
+    no_of_trees : Int. Number of trees grown on the same sample.
+    cf_dic, gen_dic : Dict. Parameters.
+    max_mb : Int. Maximum memory used by cache (MB). Default is 256.
+
+    Returns
+    -------
+    split_cache : Dict or None. None if caching is not useful or possible.
+
+    """
+    if (no_of_trees < 2 or not cf_dic['sorted_split_search']
+            or gen_dic['d_type'] == 'continuous'
+            or cf_dic['random_thresholds'] > 0):   # Thresholds are random
+        return None
+    return {'entries': {}, 'bytes': 0, 'max_bytes': max_mb * 1024 * 1024,
+            'min_leaf_size': max(n_train // 8, 2)}  # Root & shallow levels
+
+
+def split_cache_key(split_cache, indices_train):
+    """Get key of leaf in split cache (None if leaf is not cached)."""
+    if (split_cache is None
+            or len(indices_train) < split_cache['min_leaf_size']):
+        return None
+    return blake2b(np.ascontiguousarray(indices_train).view(np.uint8),
+                   digest_size=16).digest()
+
+
+def add_to_split_cache(split_cache, key, split_values, split_stats):
+    """Add split values and statistics of variable in leaf to cache."""
+    size = 8 * len(split_values) + sum(
+        value.nbytes for value in split_stats.values()
+        if isinstance(value, np.ndarray))
+    if split_cache['bytes'] + size <= split_cache['max_bytes']:
+        split_cache['entries'][key] = (split_values, split_stats)
+        split_cache['bytes'] += size
+
+
+def prune_tree_n_min(tree, n_min, data, y_i, y_nn_i, d_i, d_grid_i, w_i,
+                     ct_grid_nn_val, gen_dic, cf_dic, rng):
+    """Prune tree such that all leaves have at least n_min observations.
+
+    Splits leading to a daughter leaf with less than n_min training
+    observations are removed. Leaves are renumbered such that daughters
+    still have larger IDs than their parents. OOB data of the new terminal
+    leaves are collected from their former terminal leaves. New terminal
+    leaves with at least 2 * n_min observations may still be split with
+    another variable or value. They are returned to be grown further (see
+    regrow_pruned_leaves). Their OOB value is not computed here.
+
+    Parameters
+    ----------
+    tree : Dict. Tree grown with a smaller minimum leaf size.
+    n_min : Int. Minimum leaf size.
+    data : Numpy array. Data used to build tree.
+    ... : Positions of variables in data and parameters (as in update_tree).
+    rng : Numpy default random number generator object.
+
+    Returns
+    -------
+    tree_pruned : Dict. Pruned tree (tree itself if nothing is pruned).
+    leaves_to_grow : 1D Numpy array. IDs of new terminal leaves of
+                     tree_pruned to be grown further.
+
+    """
+    leaf_info_int = tree['leaf_info_int']
+    no_leaves = leaf_info_int.shape[0]
+    no_of_treat = (2 if gen_dic['d_type'] == 'continuous'
+                   else gen_dic['no_of_treat'])
+    keep = np.zeros(no_leaves, dtype=bool)
+    owner = -np.ones(no_leaves, dtype=np.int64)   # New terminal leaf above
+    keep[0] = True
+    # Daughters have larger IDs than their parents: One pass in order of IDs
+    for leaf_id in range(no_leaves):
+        if leaf_info_int[leaf_id, 7] != 0:          # Terminal leaf
+            continue
+        daughters = leaf_info_int[leaf_id, 2:4]
+        if owner[leaf_id] >= 0:
+            owner[daughters] = owner[leaf_id]
+        elif keep[leaf_id]:
+            if np.min(leaf_info_int[daughters, 8]) < n_min:
+                owner[daughters] = leaf_id
+            else:
+                keep[daughters] = True
+    if np.all(keep):
+        return tree, np.empty(0, dtype=np.int64)
+    new_terminal = np.unique(owner[owner >= 0])
+    new_ids = np.cumsum(keep) - 1
+    leaf_info_int_new = leaf_info_int[keep].copy()
+    leaf_info_float_new = tree['leaf_info_float'][keep].copy()
+    leaf_info_int_new[:, 0] = leaf_info_float_new[:, 0] = np.arange(
+        len(leaf_info_int_new))
+    for col in (1, 2, 3):
+        linked = leaf_info_int_new[:, col] >= 0
+        leaf_info_int_new[linked, col] = new_ids[
+            leaf_info_int_new[linked, col]]
+    oob_data_list = [tree['oob_data_list'][leaf_id]
+                     for leaf_id in np.flatnonzero(keep)]
+    for leaf_id in new_terminal:
+        oob_list = [tree['oob_data_list'][leaf_o]
+                    for leaf_o in np.flatnonzero(owner == leaf_id)
+                    if leaf_info_int[leaf_o, 7] == 1
+                    and tree['oob_data_list'][leaf_o] is not None]
+        oob_list = (np.concatenate(oob_list) if oob_list
+                    else np.empty(0, dtype=np.int64))
+        new_id = new_ids[leaf_id]
+        leaf_info_int_new[new_id, 2:6] = -1
+        leaf_info_int_new[new_id, 6] = leaf_info_int_new[new_id, 7] = 1
+        leaf_info_float_new[new_id, 1] = -1
+        oob_data_list[new_id] = oob_list
+        if leaf_info_int[leaf_id, 8] >= 2 * n_min:   # Grown further
+            continue
+        mse_mce, obs_oob_list = leaf_oob_mse_mce(
+            data[oob_list, :], d_i, w_i, d_grid_i, y_nn_i, y_i,
+            ct_grid_nn_val, gen_dic, cf_dic, rng)
+        if mse_mce is None:
+            leaf_info_float_new[new_id, 2] = 0    # MSE cannot be computed
+            leaf_info_int_new[new_id, 9] = len(oob_list)
+        else:
+            leaf_info_float_new[new_id, 2] = mcf_fo_obj.compute_mse_mce(
+                mse_mce, cf_dic['mtot'], no_of_treat)
+            leaf_info_int_new[new_id, 9] = np.sum(obs_oob_list)
+    cats_bitset = tree['cats_bitset'][keep].copy()
+    cats_bitset[new_ids[new_terminal]] = 0
+    tree_pruned = {
+        'leaf_info_int': leaf_info_int_new,
+        'leaf_info_float': leaf_info_float_new,
+        'cats_prime': None,
+        'cats_bitset': cats_bitset,
+        'oob_indices': tree['oob_indices'],
+        'train_data_list': [None] * len(leaf_info_int_new),
+        'oob_data_list': oob_data_list,
+        'fill_y_indices_list': [None] * len(leaf_info_int_new),
+        'fill_y_empty_leave': None,
+        'fill_y_offsets': None,
+        'fill_y_indices': None,
+        }
+    leaves_to_grow = new_ids[new_terminal[
+        leaf_info_int[new_terminal, 8] >= 2 * n_min]]
+    return tree_pruned, leaves_to_grow
+
+
+def regrow_pruned_leaves(tree, leaves_to_grow, indices_train, data, y_i,
+                         y_nn_i, d_i, d_grid_i, x_i, w_i, x_type, x_values,
+                         x_ind, x_ai_ind, cf_dic, gen_dic, ct_grid_nn_val,
+                         mmm, n_min, alpha_reg, pen_mult, rng,
+                         split_cache=None, x_bins=None):
+    """Grow leaves of pruned tree further with minimum leaf size n_min.
+
+    A leaf is made terminal by prune_tree_n_min if its best split for the
+    smaller minimum leaf size leads to a daughter leaf that is too small.
+    The best split among those valid for n_min is searched for here, such
+    that the tree equals the tree grown with n_min (up to the numbering of
+    the leaves and the random numbers drawn, e.g. for the splitting
+    variables). Training (OOB) data of the leaves are in the same order as
+    in build_single_tree.
+
+    Parameters
+    ----------
+    tree : Dict. Pruned tree.
+    leaves_to_grow : 1D Numpy array. IDs of leaves to grow.
+    indices_train : List or 1D Numpy array. Indices of training data of tree.
+    ... : As in build_single_tree.
+
+    Returns
+    -------
+    tree_dict : Dict. Final tree.
+
+    """
+    indices_train = np.asarray(indices_train)
+    leaf_no = mcf_fo_add.terminal_leaves_tree(
+        tree, data[np.ix_(indices_train, x_i)])
+    tree_store = mcf_fo_asdict.tree_dict_to_store(tree, len(x_i),
+                                                  len(indices_train))
+    for leaf_id in leaves_to_grow:
+        tree_store['leaf_info_int'][leaf_id, 6] = 0
+        tree_store['leaf_info_int'][leaf_id, 7] = 2   # Active
+        tree_store['train_data_list'][leaf_id] = indices_train[
+            leaf_no == leaf_id]
+        tree_store['oob_data_list'][leaf_id] = np.sort(
+            tree_store['oob_data_list'][leaf_id])
+    return build_single_tree(
+        data, y_i, y_nn_i, d_i, d_grid_i, x_i, w_i, x_type, x_values, x_ind,
+        x_ai_ind, cf_dic, gen_dic, ct_grid_nn_val, mmm, n_min, alpha_reg,
+        tree_store, pen_mult, rng, split_cache, x_bins)
+
+
+def tree_oob_objective(tree, data, y_i, y_nn_i, d_i, d_grid_i, w_i,
+                       ct_grid_nn_val, gen_dic, cf_dic, rng):
+    """Compute objective function of tree with its OOB data.
+
+    Returns
+    -------
+    oob_obj : Float or None. None if no leaf has OOB data of all treatments.
+
+    """
+    no_of_treat = (2 if gen_dic['d_type'] == 'continuous'
+                   else gen_dic['no_of_treat'])
+    mse_mce_tree = np.zeros((no_of_treat, no_of_treat))
+    obs_t_tree = np.zeros(no_of_treat)
+    leaves_with_oob = False
+    for leaf_id in np.flatnonzero(tree['leaf_info_int'][:, 7] == 1):
+        oob_list = tree['oob_data_list'][leaf_id]
+        if oob_list is None or len(oob_list) < no_of_treat:
+            continue
+        mse_mce, obs_oob_list = leaf_oob_mse_mce(
+            data[oob_list, :], d_i, w_i, d_grid_i, y_nn_i, y_i,
+            ct_grid_nn_val, gen_dic, cf_dic, rng)
+        if mse_mce is not None:
+            mse_mce_tree, obs_t_tree = mcf_fo_obj.add_rescale_mse_mce(
+                mse_mce, obs_oob_list, cf_dic['mtot'], no_of_treat,
+                mse_mce_tree, obs_t_tree)
+            leaves_with_oob = True
+    if not leaves_with_oob:
+        return None
+    mse_mce_tree = mcf_fo_obj.get_avg_mse_mce(mse_mce_tree, obs_t_tree,
+                                              cf_dic['mtot'], no_of_treat)
+    return mcf_fo_obj.compute_mse_mce(mse_mce_tree, cf_dic['mtot'],
+                                      no_of_treat)
 
 
 def build_single_tree(data, y_i, y_nn_i, d_i, d_grid_i, x_i, w_i,
                       x_type, x_values, x_ind, x_ai_ind, cf_dic, gen_dic,
                       ct_grid_nn_val, mmm, n_min, alpha_reg,
-                      tree_dict_global, pen_mult, rng):
+                      tree_store, pen_mult, rng, split_cache=None,
+                      x_bins=None):
     """Build single tree given random sample split.
 
     Parameters
@@ -266,9 +565,14 @@ def build_single_tree(data, y_i, y_nn_i, d_i, d_grid_i, x_i, w_i,
     m : INT. Number of covariates to be included.
     n_min : Int. Minimum leaf size.
     alpha_reg : Float. alpha regularity.
-    tree_dict : Dict. Initial tree.
+    tree_store : Dict. Node store with root leaf (modified in place).
     pen_mult: Float. Multiplier of penalty.
     rng : Default random number generator object.
+    split_cache : Dict or None. Split statistics shared with other trees
+                  grown on the same sample (see init_split_cache).
+                  Default is None.
+    x_bins : Dict or None. Binned ordered covariates (see
+             mcf_forest_data_functions.bin_ordered_features). Default is None.
 
     Returns
     -------
@@ -297,7 +601,8 @@ def build_single_tree(data, y_i, y_nn_i, d_i, d_grid_i, x_i, w_i,
     # causal_tree_empty_dic = {
     # 'leaf_info_int': leaf_info_int, 2dnarray with leaf info, integers
     # 'leaf_info_float': leaf_info_float, 2dnarray, with leaf info for floats
-    # 'cats_prime': cats_prime, list, prime value for categorical features
+    # 'cats_prime': None (old encoding: product of primes)
+    # 'cats_bitset': 2D ndarray of uint64, bitset of categories going left
     # 'oob_indices': indices_oob, 1D ndarray, indices of tree-specific OOB data
     # 'train_data_list': indices_train,
     #          Indices of data needed during tree building, will be removed use
@@ -307,46 +612,67 @@ def build_single_tree(data, y_i, y_nn_i, d_i, d_grid_i, x_i, w_i,
     #      list (dim: # of leaves) of leaf-specific indices (to be filled after
     #      forest building) - for terminal leaves only
 
-    tree_dict = deepcopy(tree_dict_global)
-    leaf_ids = tree_dict['leaf_info_int'][:, 0]
-    availabe_leaf_id_daughters = tree_dict['leaf_info_int'][1:, 0]
-    for leaf_idx, idx in enumerate(leaf_ids):
-        if leaf_idx != idx:
-            raise ValueError('ID in Tree differes from position of leaf in '
-                             'tree. Something went totally wrong.')
-        if tree_dict['leaf_info_int'][leaf_idx, 7] != 2:  # Leaf not to split
+    # Daughters always get larger IDs than their parent. Therefore, a single
+    # pass over the (growing) node store visits every leaf to be split.
+    # Histograms are kept until the histogram of the sibling is computed.
+    hist_store = None if x_bins is None else {}
+    leaf_idx = 0
+    while leaf_idx < tree_store['no_leaves']:
+        if tree_store['leaf_info_int'][leaf_idx, 7] != 2:  # Leaf not to split
+            leaf_idx += 1
             continue
 
-        data_leaf = data[tree_dict['train_data_list'][leaf_idx], :]
-        data_oob_leaf = data[tree_dict['oob_data_list'][leaf_idx], :]
-
+        data_leaf = data[tree_store['train_data_list'][leaf_idx], :]
+        data_oob_leaf = data[tree_store['oob_data_list'][leaf_idx], :]
+        if hist_store is None:
+            hist_dic = None
+        else:
+            parent_idx, sibling_idx = leaf_family(tree_store, leaf_idx)
+            hist_dic = {
+                'x_bins': x_bins, 'leaf': {},
+                'codes': x_bins['codes'][
+                    tree_store['train_data_list'][leaf_idx], :],
+                'parent': hist_store.get(parent_idx),
+                'sibling': hist_store.get(sibling_idx)}
         (terminal, split_var_i, split_type, split_n_l, split_n_r, split_leaf_l,
          split_leaf_r, split_leaf_oob_l, split_leaf_oob_r, split_n_oob_l,
          split_n_oob_r, split_value) = next_split(
              data_leaf, data_oob_leaf, y_i, y_nn_i, d_i, d_grid_i, x_i, w_i,
              x_type, x_values, x_ind, x_ai_ind, cf_dic, gen_dic,
-             ct_grid_nn_val, mmm, n_min, alpha_reg, pen_mult, rng)
+             ct_grid_nn_val, mmm, n_min, alpha_reg, pen_mult, rng,
+             split_cache, split_cache_key(
+                 split_cache, tree_store['train_data_list'][leaf_idx]),
+             hist_dic=hist_dic)
         if terminal:
             leaf_id_daughters = None
         else:
-            leaf_id_daughters = availabe_leaf_id_daughters[0:2]
-            availabe_leaf_id_daughters = availabe_leaf_id_daughters[2:].copy()
-            if leaf_id_daughters is None or len(leaf_id_daughters) < 2:
-                raise RuntimeError('Not enough daughter leaves available for '
-                                   'further splitting: '
-                                   f'\n{leaf_id_daughters=:}'
-                                   f'\n{availabe_leaf_id_daughters=:}'
-                                   f'\n{leaf_ids=:}'
-                                   f'\n{leaf_idx=:}')
-        tree_dict = update_tree(
-             data_oob_leaf, tree_dict, leaf_idx,
+            leaf_id_daughters = mcf_fo_asdict.add_daughters_tree_store(
+                tree_store)
+        update_tree(
+             data_oob_leaf, tree_store, leaf_idx,
              split_var_i, split_type, split_value,
              split_n_l, split_n_r, split_leaf_l, split_leaf_r,
              split_leaf_oob_l, split_leaf_oob_r, split_n_oob_l, split_n_oob_r,
              terminal, leaf_id_daughters, d_i, w_i, d_grid_i, y_nn_i, y_i,
              ct_grid_nn_val, gen_dic, cf_dic, rng)
-    tree_dict = mcf_fo_asdict.cut_back_empty_cells_tree(tree_dict)
-    return tree_dict
+        if hist_store is not None:
+            hist_store[leaf_idx] = hist_dic['leaf']
+            if parent_idx < 0 or sibling_idx < leaf_idx:   # Right daughter
+                hist_store.pop(parent_idx, None)
+                for idx in (sibling_idx, leaf_idx):
+                    if idx >= 0 and tree_store['leaf_info_int'][idx, 7] == 1:
+                        hist_store.pop(idx, None)
+        leaf_idx += 1
+    return mcf_fo_asdict.tree_store_to_dict(tree_store)
+
+
+def leaf_family(tree_store, leaf_idx):
+    """Return IDs of parent and sibling of leaf (-1 for root)."""
+    parent_idx = tree_store['leaf_info_int'][leaf_idx, 1]
+    if parent_idx < 0:
+        return -1, -1
+    id_l, id_r = tree_store['leaf_info_int'][parent_idx, 2:4]
+    return parent_idx, (id_r if leaf_idx == id_l else id_l)
 
 
 def best_m_n_min_alpha_reg(forest, gen_dic, cf_dic):
@@ -376,46 +702,12 @@ def best_m_n_min_alpha_reg(forest, gen_dic, cf_dic):
     if (dim_m_n_min_ar) > 1:       # Find best of trees
         mse_oob = np.zeros(dim_m_n_min_ar)
         trees_without_oob = np.zeros(dim_m_n_min_ar)
-        if gen_dic['d_type'] == 'continuous':
-            no_of_treat = 2
-        else:
-            no_of_treat = gen_dic['no_of_treat']
         for trees_m_n_min_ar in forest:                  # different forests
             for j, tree in enumerate(trees_m_n_min_ar):  # trees within forest
-                n_lost = n_total = 0
-                if no_of_treat is not None:
-                    mse_mce_tree = np.zeros((no_of_treat, no_of_treat))
-                    obs_t_tree = np.zeros(no_of_treat)
-                tree_mse = 0
-                for leaf in tree:                        # leaves within tree
-                    if leaf[4] == 1:   # Terminal leafs only
-                        n_total += np.sum(leaf[6])
-                        if leaf[7] is None:
-                            if no_of_treat is None:
-                                n_lost += leaf[6]
-                            else:
-                                n_lost += np.sum(leaf[6])  # [6]: Leaf size
-                        else:
-                            if no_of_treat is None:  # [7]: leaf_mse
-                                tree_mse += leaf[6] * leaf[7]
-                            else:
-                                mse_mce_tree, obs_t_tree = (
-                                    mcf_fo_obj.add_rescale_mse_mce(
-                                        leaf[7], leaf[6], cf_dic['mtot'],
-                                        no_of_treat, mse_mce_tree, obs_t_tree)
-                                    )
-                if n_lost > 0:
-                    if no_of_treat is None:
-                        tree_mse = tree_mse * n_total / (n_total - n_lost)
-                    else:
-                        if (n_total - n_lost) < 1:
-                            trees_without_oob[j] += 1
-                if no_of_treat is not None:
-                    mse_mce_tree = mcf_fo_obj.get_avg_mse_mce(
-                        mse_mce_tree, obs_t_tree, cf_dic['mtot'], no_of_treat)
-                    tree_mse = mcf_fo_obj.compute_mse_mce(
-                        mse_mce_tree, cf_dic['mtot'], no_of_treat)
-                mse_oob[j] += tree_mse     # Add MSE to MSE of forest j
+                if tree['oob_obj'] is None:     # No OOB value (build_tree_mcf)
+                    trees_without_oob[j] += 1
+                else:
+                    mse_oob[j] += tree['oob_obj']  # Add MSE to MSE of forest j
         if np.any(trees_without_oob) > 0:
             for j, trees_without_oob_j in enumerate(trees_without_oob):
                 if trees_without_oob_j > 0:
@@ -451,6 +743,8 @@ def best_m_n_min_alpha_reg(forest, gen_dic, cf_dic):
             txt += '\n' + '-' * 100
             ps.print_mcf(gen_dic, txt, summary=True)
         forest_final = [trees_m_n_min[min_i] for trees_m_n_min in forest]
+        for tree in forest_final:
+            del tree['oob_obj']
         m_n_min_ar_opt = m_n_min_ar_combi[min_i]
     else:       # Find best of trees
         forest_final = [trees_m_n_min_ar[0] for trees_m_n_min_ar in forest]
@@ -470,7 +764,8 @@ def efficient_iate(mcf_, fill_y_df, tree_df, summary=False):
 
 def next_split(data_train, data_oob, y_i, y_nn_i, d_i, d_grid_i, x_i, w_i,
                x_type, x_values, x_ind, x_ai_ind, cf_dic, gen_dic,
-               ct_grid_nn_val, mmm, n_min, alpha_reg, pen_mult, rng):
+               ct_grid_nn_val, mmm, n_min, alpha_reg, pen_mult, rng,
+               split_cache=None, leaf_key=None, hist_dic=None):
     """Find best next split of leaf (or terminate splitting for this leaf).
 
     Parameters
@@ -491,6 +786,11 @@ def next_split(data_train, data_oob, y_i, y_nn_i, d_i, d_grid_i, x_i, w_i,
     alpha_reg : Float. Alpha regularity.
     pen_mult: Float. Penalty multiplier.
     rng: Numpy default random number generator object.
+    split_cache : Dict or None. Shared split statistics (init_split_cache).
+    leaf_key : Bytes or None. Key of leaf in split_cache (None: leaf is not
+               cached).
+    hist_dic : Dict or None. Histograms of binned ordered variables (see
+               histogram_split_statistics). None: No histogram split mode.
 
     Returns
     -------
@@ -546,6 +846,8 @@ def next_split(data_train, data_oob, y_i, y_nn_i, d_i, d_grid_i, x_i, w_i,
         else:
             y_nn = y_nn_l = y_nn_r = 0
         w_dat = data_train[:, [w_i]] if w_yes else [1]
+        # Sorted split search (all thresholds of a variable in one pass)
+        sorted_search = cf_dic['sorted_split_search'] and not continuous
         if continuous:
             d_bin_dat = d_dat > 1e-15   # Binary treatment indicator
             x_no_varia.append(np.all(d_bin_dat == d_bin_dat[0]))
@@ -572,11 +874,65 @@ def next_split(data_train, data_oob, y_i, y_nn_i, d_i, d_grid_i, x_i, w_i,
                     if x_type_split[j] > 0:
                         x_j = x_j.astype(np.int32)
                         x_oob_j = x_oob_j.astype(np.int32)
-                    split_values = get_split_values(
-                        y_dat, w_dat, x_j, x_type_split[j], x_values_split[j],
-                        leaf_size_train, cf_dic['random_thresholds'],
-                        gen_dic['weighted'], rng=rng)
+                    cache_key = (None if leaf_key is None
+                                 else (leaf_key, x_ind_split[j]))
+                    cached = (None if cache_key is None
+                              else split_cache['entries'].get(cache_key))
+                    binned = (hist_dic is not None and x_type_split[j] == 0
+                              and hist_dic['x_bins']['col'][
+                                  x_ind_split[j]] >= 0)
+                    if cached is not None:
+                        split_values, split_stats = cached
+                    elif binned:
+                        split_values, split_stats = (
+                            histogram_split_statistics(
+                                hist_dic, x_ind_split[j], y_dat, y_nn, d_dat,
+                                w_dat, cf_dic['n_min_treat'], mtot,
+                                no_of_treat, d_values, w_yes,
+                                cf_dic['random_thresholds'], rng))
+                    else:
+                        split_values = get_split_values(
+                            y_dat, w_dat, x_j, x_type_split[j],
+                            x_values_split[j], leaf_size_train,
+                            cf_dic['random_thresholds'], gen_dic['weighted'],
+                            rng=rng)
+                        split_stats = None
                     split_values_unord_j = []
+                if sorted_search:
+                    if len(split_values) == 0:
+                        continue
+                    if cached is None:
+                        if split_stats is None:
+                            split_stats = sorted_split_statistics(
+                                y_dat, y_nn, d_dat, w_dat, x_j,
+                                x_type_split[j], split_values,
+                                cf_dic['n_min_treat'], mtot, no_of_treat,
+                                d_values, w_yes)
+                        if cache_key is not None:
+                            add_to_split_cache(split_cache, cache_key,
+                                               split_values, split_stats)
+                    mse_split, val_idx = best_sorted_split(
+                        split_stats, obs_min, mtot, pen_mult, rng)
+                    if mse_split < best_mse:
+                        split_done = True
+                        best_mse = mse_split
+                        best_var_i = copy(x_ind_split[j])
+                        best_type = copy(x_type_split[j])
+                        if best_type == 0:
+                            best_value = copy(split_values[val_idx])
+                            best_leaf_l = (x_j - 1e-15) <= best_value
+                            best_leaf_oob_l = (x_oob_j - 1e-15) <= best_value
+                        else:
+                            best_value = split_values[:val_idx+1]
+                            best_leaf_l = np.isin(x_j, best_value)
+                            best_leaf_oob_l = np.isin(x_oob_j, best_value)
+                        best_leaf_r = np.invert(best_leaf_l)
+                        best_leaf_oob_r = np.invert(best_leaf_oob_l)
+                        best_n_l = np.count_nonzero(best_leaf_l)
+                        best_n_r = leaf_size_train - best_n_l
+                        best_n_oob_l = np.count_nonzero(best_leaf_oob_l)
+                        best_n_oob_r = data_oob.shape[0] - best_n_oob_l
+                    continue
                 if d_cont_split:
                     # Randomly allocate half the controls to left leaf
                     rnd_in = rng.choice([True, False], size=(nr_all, 1))
@@ -697,41 +1053,312 @@ def next_split(data_train, data_oob, y_i, y_nn_i, d_i, d_grid_i, x_i, w_i,
             best_n_oob_r, best_value)
 
 
+def sorted_split_search(y_dat, y_nn, d_dat, w_dat, x_j, x_type, split_values,
+                        obs_min, n_min_treat, mtot, no_of_treat, d_values,
+                        w_yes, pen_mult, rng):
+    """Evaluate all splitting values of one variable in one sorted pass.
+
+    The observations of the leaf are sorted once by the splitting variable.
+    Cumulative sums of (weighted) outcomes, squared outcomes, matched outcomes
+    and treatment counts then give the sufficient statistics of the left and
+    right daughter leaves for every threshold. The objective function is the
+    same as the one obtained by calling mcf_mse for each leaf.
+
+    Parameters
+    ----------
+    y_dat : Numpy array (N x 1). Outcome.
+    y_nn : Numpy array (N x no_of_treat). Matched outcomes (if mtot in 1, 4).
+    d_dat : Numpy array (N x 1). Treatment.
+    w_dat : Numpy array (N x 1). Sampling weights (if w_yes).
+    x_j : 1-d Numpy array. Splitting variable.
+    x_type : INT. Type of splitting variable (0: ordered, >0: categorical).
+    split_values : List or Numpy array. Values used for splitting (as coming
+                   from get_split_values).
+    obs_min : INT. Minimum number of observations in daughter leaves.
+    n_min_treat : INT. Minimum number of observations per treatment.
+    mtot : INT. Method.
+    no_of_treat : INT. Number of treatments.
+    d_values : List of INT. Treatment values.
+    w_yes : Boolean. Weighted estimation.
+    pen_mult : Float. Penalty multiplier.
+    rng : Numpy default random number generator object.
+
+    Returns
+    -------
+    best_mse : Float. Best value of objective function (inf if no split).
+    best_idx : INT. Position of best value in split_values (None if no split).
+
+    """
+    split_stats = sorted_split_statistics(
+        y_dat, y_nn, d_dat, w_dat, x_j, x_type, split_values, n_min_treat,
+        mtot, no_of_treat, d_values, w_yes)
+    return best_sorted_split(split_stats, obs_min, mtot, pen_mult, rng)
+
+
+def sorted_split_statistics(y_dat, y_nn, d_dat, w_dat, x_j, x_type,
+                            split_values, n_min_treat, mtot, no_of_treat,
+                            d_values, w_yes):
+    """Compute objective function for all splitting values of one variable.
+
+    First part of sorted_split_search. The results do not depend on the
+    minimum leaf size and can therefore be shared by trees grown with
+    different tuning parameters.
+
+    Returns
+    -------
+    split_stats : Dict. Position in split_values ('cand'), size of left and
+                  right leaf ('n_l', 'n_r'), objective function without
+                  penalty ('mse') and penalty ('penalty', if mtot is 1 or 4)
+                  of all splits with enough observations in all treatments.
+
+    """
+    n_obs = len(x_j)
+    if x_type == 0:
+        key = x_j - 1e-15       # because of float (as in leaf_l of next_split)
+        thresholds = np.asarray(split_values, dtype=np.float64)
+    else:   # Categories in order of split_values; all others at the end
+        cats = np.asarray(split_values, dtype=x_j.dtype)
+        sorter = np.argsort(cats)
+        pos = np.minimum(np.searchsorted(cats[sorter], x_j), len(cats) - 1)
+        key = np.where(cats[sorter][pos] == x_j, sorter[pos], len(cats))
+        thresholds = np.arange(len(cats))
+    order = np.argsort(key, kind='stable')
+    n_l = np.searchsorted(key[order], thresholds, side='right')
+    n_r = n_obs - n_l
+    treat_dummies = (d_dat.reshape(-1)[order].reshape(-1, 1)
+                     == np.asarray(d_values).reshape(1, -1))
+    cnt_l, cnt_all = prefix_sums(treat_dummies.astype(np.int64), n_l)
+    cnt_r = cnt_all - cnt_l
+    min_treat = max(n_min_treat, 1)
+    valid = (np.all(cnt_l >= min_treat, axis=1)
+             & np.all(cnt_r >= min_treat, axis=1))
+    cand = np.flatnonzero(valid)
+    split_stats = {'cand': cand, 'n_l': n_l[cand], 'n_r': n_r[cand],
+                   'mse': np.empty(0), 'penalty': None}
+    if len(cand) == 0:
+        return split_stats
+    n_l, cnt_l, cnt_r = n_l[cand], cnt_l[cand], cnt_r[cand]
+    # Centering does not change the objective, but improves precision
+    y_s = y_dat.reshape(-1)[order]
+    y_s = y_s - np.mean(y_s)
+    w_s = w_dat.reshape(-1)[order] if w_yes else None
+    treat_w = treat_dummies * w_s.reshape(-1, 1) if w_yes else treat_dummies
+    stats = np.concatenate((treat_w, treat_w * y_s.reshape(-1, 1),
+                            treat_w * (y_s**2).reshape(-1, 1)), axis=1)
+    stats_l, stats_all = prefix_sums(stats, n_l)
+    stats_r = stats_all - stats_l
+    pair_l, pair_r = [], []
+    if mtot in (1, 4):
+        y_nn_s = y_nn[order, :]
+        y_nn_s = y_nn_s - np.mean(y_nn_s, axis=0)
+        for m_idx in range(no_of_treat):
+            for v_idx in range(m_idx + 1, no_of_treat):
+                w_ml = treat_w[:, m_idx] + treat_w[:, v_idx]
+                y_m, y_v = y_nn_s[:, m_idx], y_nn_s[:, v_idx]
+                pair = np.column_stack((w_ml, w_ml * y_m, w_ml * y_v,
+                                        w_ml * y_m * y_v))
+                pair_cum_l, pair_all = prefix_sums(pair, n_l)
+                pair_cum_r = pair_all - pair_cum_l
+                pair_l.append(tuple(pair_cum_l.T))
+                pair_r.append(tuple(pair_cum_r.T))
+    split_stats['mse'], split_stats['penalty'] = split_objective(
+        cnt_l, cnt_r, stats_l, stats_r, pair_l, pair_r, mtot, no_of_treat)
+    return split_stats
+
+
+def split_objective(cnt_l, cnt_r, stats_l, stats_r, pair_l, pair_r, mtot,
+                    no_of_treat):
+    """Objective function and penalty of splits from sums of both leaves.
+
+    Parameters
+    ----------
+    cnt_l, cnt_r : Numpy array (splits x treatments). Number of observations.
+    stats_l, stats_r : Numpy array (splits x 3*treatments). Sums of weights,
+                       weighted outcomes and weighted squared outcomes.
+    pair_l, pair_r : List of tuples. Sums of pairs of treatments (see
+                     mcf_mse_prefix). Empty if mtot is not 1 or 4.
+    mtot : Int. Method.
+    no_of_treat : Int. Number of treatments.
+
+    Returns
+    -------
+    mse : Numpy array. Objective function without penalty.
+    penalty : Numpy array or None. Penalty (None if mtot is not 1 or 4).
+
+    """
+    k_t = no_of_treat
+    mse_mce_l, shares_l, obs_by_treat_l = mcf_fo_obj.mcf_mse_prefix(
+        cnt_l, stats_l[:, :k_t], stats_l[:, k_t:2*k_t], stats_l[:, 2*k_t:],
+        pair_l, mtot, no_of_treat)
+    mse_mce_r, shares_r, obs_by_treat_r = mcf_fo_obj.mcf_mse_prefix(
+        cnt_r, stats_r[:, :k_t], stats_r[:, k_t:2*k_t], stats_r[:, 2*k_t:],
+        pair_r, mtot, no_of_treat)
+    mse_mce = mcf_fo_obj.add_mse_mce_split_vec(
+        mse_mce_l, mse_mce_r, obs_by_treat_l, obs_by_treat_r, mtot,
+        no_of_treat)
+    mse = mcf_fo_obj.compute_mse_mce_vec(mse_mce, mtot, no_of_treat)
+    penalty = (mcf_fo_obj.mcf_penalty_vec(shares_l, shares_r)
+               if mtot in (1, 4) else None)
+    return mse, penalty
+
+
+def histogram_split_statistics(hist_dic, var_i, y_dat, y_nn, d_dat, w_dat,
+                               n_min_treat, mtot, no_of_treat, d_values,
+                               w_yes, random_thresholds, rng):
+    """Compute split values and statistics of a binned ordered variable.
+
+    Histogram version of sorted_split_statistics (see bin_ordered_features).
+    Sums are collected per bin instead of per observation, such that no
+    sorting is needed and all bin boundaries can be evaluated at low cost.
+    If the histograms of the parent and the sibling leaf are available for
+    the same variable, the histogram is obtained by subtraction.
+
+    Parameters
+    ----------
+    hist_dic : Dict. Binned features ('x_bins'), bin codes of the leaf
+               ('codes'), histograms of this leaf (filled), of its parent and
+               of its sibling ('leaf', 'parent', 'sibling').
+    var_i : Int. Position of variable in x.
+    ... : See sorted_split_statistics.
+    random_thresholds : Int. Number of randomly drawn bin boundaries
+                        (0: all boundaries).
+    rng : Numpy default random number generator object.
+
+    Returns
+    -------
+    split_values : List. Upper bin boundaries (values of x) used as splits.
+    split_stats : Dict. See sorted_split_statistics.
+
+    """
+    x_bins, k_t = hist_dic['x_bins'], no_of_treat
+    edges = x_bins['edges'][var_i]
+    parent, sibling = hist_dic['parent'], hist_dic['sibling']
+    if (parent is not None and sibling is not None and var_i in parent
+            and var_i in sibling):
+        hist = parent[var_i] - sibling[var_i]
+    else:
+        hist = bin_histogram(
+            y_dat, y_nn, d_dat, w_dat,
+            hist_dic['codes'][:, x_bins['col'][var_i]], len(edges),
+            x_bins['y_center'], x_bins['y_nn_center'], mtot, no_of_treat,
+            d_values, w_yes)
+    hist_dic['leaf'][var_i] = hist
+    bins = np.flatnonzero(hist[:, :k_t].sum(axis=1) > 0.5)[:-1]
+    if 0 < random_thresholds < len(bins):
+        bins = np.sort(rng.choice(bins, size=random_thresholds,
+                                  replace=False))
+    split_values = edges[bins].tolist()
+    cum_sum = np.cumsum(hist, axis=0)
+    sums_l = cum_sum[bins]
+    sums_r = cum_sum[-1] - sums_l
+    cnt_l = np.rint(sums_l[:, :k_t]).astype(np.int64)
+    cnt_r = np.rint(sums_r[:, :k_t]).astype(np.int64)
+    min_treat = max(n_min_treat, 1)
+    cand = np.flatnonzero(np.all(cnt_l >= min_treat, axis=1)
+                          & np.all(cnt_r >= min_treat, axis=1))
+    split_stats = {'cand': cand, 'n_l': cnt_l[cand].sum(axis=1),
+                   'n_r': cnt_r[cand].sum(axis=1), 'mse': np.empty(0),
+                   'penalty': None}
+    if len(cand) == 0:
+        return split_values, split_stats
+    sums_l, sums_r = sums_l[cand], sums_r[cand]
+    pair_l, pair_r = [], []
+    if mtot in (1, 4):
+        for col in range(4*k_t, hist.shape[1], 4):
+            pair_l.append(tuple(sums_l[:, col:col+4].T))
+            pair_r.append(tuple(sums_r[:, col:col+4].T))
+    split_stats['mse'], split_stats['penalty'] = split_objective(
+        cnt_l[cand], cnt_r[cand], sums_l[:, k_t:4*k_t], sums_r[:, k_t:4*k_t],
+        pair_l, pair_r, mtot, no_of_treat)
+    return split_values, split_stats
+
+
+def bin_histogram(y_dat, y_nn, d_dat, w_dat, codes, no_of_bins, y_center,
+                  y_nn_center, mtot, no_of_treat, d_values, w_yes):
+    """Sum statistics needed for the objective function within bins.
+
+    Columns are the number of observations, the sums of weights, weighted
+    outcomes and weighted squared outcomes (by treatment), followed by the
+    sums of the pairs of treatments if mtot is 1 or 4. Outcomes are centered
+    by constants that are the same for all leaves, such that the histograms
+    of daughter leaves add up to the histogram of their parent.
+    """
+    treat_dummies = (d_dat.reshape(-1, 1)
+                     == np.asarray(d_values).reshape(1, -1)).astype(np.float64)
+    treat_w = treat_dummies * w_dat.reshape(-1, 1) if w_yes else treat_dummies
+    y_c = (y_dat.reshape(-1) - y_center).reshape(-1, 1)
+    stats = [treat_dummies, treat_w, treat_w * y_c, treat_w * y_c**2]
+    if mtot in (1, 4):
+        y_nn_c = y_nn - y_nn_center
+        for m_idx in range(no_of_treat):
+            for v_idx in range(m_idx + 1, no_of_treat):
+                w_ml = treat_w[:, m_idx] + treat_w[:, v_idx]
+                y_m, y_v = y_nn_c[:, m_idx], y_nn_c[:, v_idx]
+                stats.append(np.column_stack((w_ml, w_ml * y_m, w_ml * y_v,
+                                              w_ml * y_m * y_v)))
+    stats = np.concatenate(stats, axis=1)
+    hist = np.empty((no_of_bins, stats.shape[1]))
+    for col in range(stats.shape[1]):
+        hist[:, col] = np.bincount(codes, weights=stats[:, col],
+                                   minlength=no_of_bins)
+    return hist
+
+
+def best_sorted_split(split_stats, obs_min, mtot, pen_mult, rng):
+    """Find best split given minimum leaf size (see sorted_split_search)."""
+    valid = (split_stats['n_l'] >= obs_min) & (split_stats['n_r'] >= obs_min)
+    if not np.any(valid):
+        return inf, None
+    cand = np.flatnonzero(valid)
+    mse_split = split_stats['mse'][cand]
+    # Add penalty (random draws in the same order as in next_split)
+    if mtot == 1:
+        with_penalty = np.ones(len(cand), dtype=bool)
+    elif mtot == 4:
+        with_penalty = rng.random(len(cand)) > 0.5
+    else:
+        with_penalty = np.zeros(len(cand), dtype=bool)
+    if np.any(with_penalty):
+        mse_split = np.where(
+            with_penalty,
+            mse_split + pen_mult * split_stats['penalty'][cand], mse_split)
+    best = np.argmin(mse_split)
+    return mse_split[best], split_stats['cand'][cand[best]]
+
+
+def prefix_sums(data_sorted, n_l):
+    """Sums over the first n_l rows of data (for all values in n_l) & total."""
+    cum_sum = np.cumsum(data_sorted, axis=0)
+    total = cum_sum[-1].copy()
+    prefix = np.zeros((len(n_l), data_sorted.shape[1]), dtype=cum_sum.dtype)
+    pos = n_l > 0
+    prefix[pos] = cum_sum[n_l[pos] - 1]
+    return prefix, total
+
+
 def update_tree(
-        data_oob_parent, tree_dict_global, parent_idx,
+        data_oob_parent, tree, parent_idx,
         split_var_i, split_type, split_value,
         split_n_l, split_n_r, split_leaf_l, split_leaf_r, split_leaf_oob_l,
         split_leaf_oob_r, split_n_oob_l, split_n_oob_r, terminal,
         leaf_id_daughters, d_i, w_i, d_grid_i, y_nn_i, y_i, ct_grid_nn_val,
         gen_dic, cf_dic, rng):
-    """Assign values obtained from splitting to parent & daughter leaves."""
-    tree = deepcopy(tree_dict_global)
-    if gen_dic['d_type'] == 'continuous':
-        no_of_treat, d_values, continuous = 2, [0, 1], True
-    else:
-        no_of_treat, d_values = gen_dic['no_of_treat'], gen_dic['d_values']
-        continuous = False
+    """Assign values obtained from splitting to parent & daughter leaves.
+
+    The node store TREE is modified in place.
+    """
+    no_of_treat = (2 if gen_dic['d_type'] == 'continuous'
+                   else gen_dic['no_of_treat'])
     if terminal:
         tree['leaf_info_int'][parent_idx, 7] = 1  # Terminal
         tree['leaf_info_int'][parent_idx, 6] = 1  # Terminal
-        w_oob = data_oob_parent[:, [w_i]] if gen_dic['weighted'] else 0
-        n_oob = data_oob_parent.shape[0]
-        if continuous:
-            d_oob = data_oob_parent[:, d_i] > 1e-15
+        mse_mce, obs_oob_list = leaf_oob_mse_mce(
+            data_oob_parent, d_i, w_i, d_grid_i, y_nn_i, y_i, ct_grid_nn_val,
+            gen_dic, cf_dic, rng)
+        if mse_mce is None:
+            obj_fct_oob = 0                      # MSE cannot be computed
+            obs_oob = data_oob_parent.shape[0]
         else:
-            d_oob = data_oob_parent[:, d_i]
-        if len(np.unique(d_oob)) < no_of_treat:
-            obj_fct_oob, obs_oob = 0, n_oob      # MSE cannot be computed
-        else:
-            if continuous:
-                y_nn = mcf_fo_add.match_cont(data_oob_parent[:, d_grid_i],
-                                             data_oob_parent[:, y_nn_i],
-                                             ct_grid_nn_val, rng)
-            else:
-                y_nn = data_oob_parent[:, y_nn_i]
-            mse_mce, _, obs_oob_list = mcf_fo_obj.mcf_mse(
-                data_oob_parent[:, y_i], y_nn, d_oob, w_oob, n_oob,
-                cf_dic['mtot'], no_of_treat, d_values, gen_dic['weighted'])
             obj_fct_oob = mcf_fo_obj.compute_mse_mce(mse_mce, cf_dic['mtot'],
                                                      no_of_treat)
             obs_oob = np.sum(obs_oob_list)
@@ -750,8 +1377,9 @@ def update_tree(
         tree['leaf_info_int'][parent_idx, 7] = 0
         #                             not active, not terminal - intermediate
         tree['leaf_info_int'][parent_idx, 4] = split_var_i
-        if split_type > 0:  # Save as product of primes
-            tree['cats_prime'][parent_idx] = mcf_gp.list_product(split_value)
+        if split_type > 0:  # Save as bitset of positions of primes
+            tree['cats_bitset'][parent_idx] = mcf_gp.primes_to_bitset(
+                split_value)
         else:
             tree['leaf_info_float'][parent_idx, 1] = split_value
         tree['leaf_info_int'][parent_idx, 5] = split_type
@@ -778,6 +1406,41 @@ def update_tree(
     return tree
 
 
+def leaf_oob_mse_mce(data_oob_leaf, d_i, w_i, d_grid_i, y_nn_i, y_i,
+                     ct_grid_nn_val, gen_dic, cf_dic, rng):
+    """Compute MSE/MCE matrix of leaf with its OOB data.
+
+    Returns
+    -------
+    mse_mce : Numpy array or None. None if a treatment is missing in leaf.
+    obs_oob_list : Numpy array or None. Number of OOB obs. by treatment.
+
+    """
+    if gen_dic['d_type'] == 'continuous':
+        no_of_treat, d_values, continuous = 2, [0, 1], True
+    else:
+        no_of_treat, d_values = gen_dic['no_of_treat'], gen_dic['d_values']
+        continuous = False
+    w_oob = data_oob_leaf[:, [w_i]] if gen_dic['weighted'] else 0
+    n_oob = data_oob_leaf.shape[0]
+    if continuous:
+        d_oob = data_oob_leaf[:, d_i] > 1e-15
+    else:
+        d_oob = data_oob_leaf[:, d_i]
+    if len(np.unique(d_oob)) < no_of_treat:
+        return None, None
+    if continuous:
+        y_nn = mcf_fo_add.match_cont(data_oob_leaf[:, d_grid_i],
+                                     data_oob_leaf[:, y_nn_i],
+                                     ct_grid_nn_val, rng)
+    else:
+        y_nn = data_oob_leaf[:, y_nn_i]
+    mse_mce, _, obs_oob_list = mcf_fo_obj.mcf_mse(
+        data_oob_leaf[:, y_i], y_nn, d_oob, w_oob, n_oob, cf_dic['mtot'],
+        no_of_treat, d_values, gen_dic['weighted'])
+    return mse_mce, obs_oob_list
+
+
 def get_split_values(y_dat, w_dat, x_dat, x_type, x_values, leaf_size,
                      random_thresholds, w_yes, rng=None):
     """Determine the values used for splitting.
@@ -930,14 +1593,47 @@ def oob_in_tree(obs_in_leaf, y_dat, y_nn, d_dat, w_dat, mtot, no_of_treat,
     oob_tree : INT. OOB value of the MSE of the tree
 
     """
-    leaf_no = np.unique(obs_in_leaf[:, 1])
-    oob_tree = n_lost = n_total = 0
+    mse_mce_tree, obs_t_tree = oob_sums_in_tree(
+        obs_in_leaf[:, 1], y_dat, y_nn, d_dat, w_dat, mtot, no_of_treat,
+        treat_values, w_yes, cont)
+    return oob_from_sums(mse_mce_tree, obs_t_tree, mtot, no_of_treat)
+
+
+def oob_sums_in_tree(leaf_no, y_dat, y_nn, d_dat, w_dat, mtot, no_of_treat,
+                     treat_values, w_yes, cont=False, leaves=None):
+    """Sum up rescaled MSE/MCE matrices of the leaves of a tree.
+
+    Observations are sorted by leaf once, instead of searching the
+    observations of every leaf separately.
+
+    Parameters
+    ----------
+    leaf_no : 1D Numpy array of INT. Terminal leaf of observation.
+    ... : See oob_in_tree.
+    leaves : 1D Numpy array of INT or None. Leaves to be included. None: All
+             leaves. Default is None.
+
+    Returns
+    -------
+    mse_mce_tree : Numpy array. Sum of rescaled MSE/MCE matrices.
+    obs_t_tree : Numpy array. Number of observations by treatment.
+
+    """
     mse_mce_tree = np.zeros((no_of_treat, no_of_treat))
     obs_t_tree = np.zeros(no_of_treat)
-    for leaf in leaf_no:
-        in_leaf = obs_in_leaf[:, 1] == leaf
+    rows = (np.arange(len(leaf_no)) if leaves is None
+            else np.flatnonzero(np.isin(leaf_no, leaves)))
+    if len(rows) == 0:
+        return mse_mce_tree, obs_t_tree
+    order = rows[np.argsort(leaf_no[rows], kind='stable')]
+    leaf_sorted = leaf_no[order]
+    starts = np.flatnonzero(np.concatenate(
+        ([True], leaf_sorted[1:] != leaf_sorted[:-1])))
+    ends = np.append(starts[1:], len(order))
+    for start, end in zip(starts, ends):
+        in_leaf = order[start:end]
         w_l = w_dat[in_leaf] if w_yes else 0
-        n_l = np.count_nonzero(in_leaf)
+        n_l = len(in_leaf)
         d_dat_in_leaf = d_dat[in_leaf]  # makes a copy
         if n_l < no_of_treat:
             enough_data_in_leaf = False
@@ -956,10 +1652,11 @@ def oob_in_tree(obs_in_leaf, y_dat, y_nn, d_dat, w_dat, mtot, no_of_treat,
             mse_mce_tree, obs_t_tree = mcf_fo_obj.add_rescale_mse_mce(
                 mse_mce_leaf, obs_by_treat_leaf, mtot, no_of_treat,
                 mse_mce_tree, obs_t_tree)
-        else:
-            n_lost += n_l
-        n_total += n_l
+    return mse_mce_tree, obs_t_tree
+
+
+def oob_from_sums(mse_mce_tree, obs_t_tree, mtot, no_of_treat):
+    """Compute OOB value of tree from sums of oob_sums_in_tree."""
     mse_mce_tree = mcf_fo_obj.get_avg_mse_mce(mse_mce_tree, obs_t_tree, mtot,
                                               no_of_treat)
-    oob_tree = mcf_fo_obj.compute_mse_mce(mse_mce_tree, mtot, no_of_treat)
-    return oob_tree
+    return mcf_fo_obj.compute_mse_mce(mse_mce_tree, mtot, no_of_treat)
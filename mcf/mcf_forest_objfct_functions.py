@@ -34,10 +34,12 @@ def mcf_mse(y_dat, y_nn, d_dat, w_dat, n_obs, mtot, no_of_treat, treat_values,
     treat_share: 1D Numpy array. Treatment shares.
 
     """
-    if w_yes or mtot in (2, 3):
-        mse_mce, treat_shares, no_of_obs_by_treat = mcf_mse_not_numba(
+    if not isinstance(y_nn, np.ndarray):   # Not used (mtot 2, 3)
+        y_nn = np.zeros((0, no_of_treat))
+    if w_yes:
+        mse_mce, treat_shares, no_of_obs_by_treat = mcf_mse_numba_w(
             y_dat, y_nn, d_dat, w_dat, n_obs, mtot, no_of_treat,
-            treat_values, w_yes, splitting)
+            np.array(treat_values, dtype=np.int8), splitting)
     else:
         mse_mce, treat_shares, no_of_obs_by_treat = mcf_mse_numba(
             y_dat, y_nn, d_dat, n_obs, mtot, no_of_treat,
@@ -49,7 +51,7 @@ def mcf_mse_not_numba(y_dat, y_nn, d_dat, w_dat, n_obs, mtot, no_of_treat,
                       treat_values, w_yes, splitting=False):
     """Compute average mse for the data passed. Based on different methods.
 
-    CURRENTLY ONLY USED FOR WEIGHTED.
+    NOT USED (reference implementation of mcf_mse_numba and mcf_mse_numba_w).
 
     Parameters
     ----------
@@ -132,8 +134,7 @@ def mcf_mse_not_numba(y_dat, y_nn, d_dat, w_dat, n_obs, mtot, no_of_treat,
 def mcf_mse_numba(y_dat, y_nn, d_dat, n_obs, mtot, no_of_treat, treat_values):
     """Compute average mse for the data passed. Based on different methods.
 
-       WEIGHTED VERSION DOES NOT YET WORK. TRY with next Numba version.
-       Need to change list format soon.
+       Unweighted version (see mcf_mse_numba_w for weighted version).
 
     Parameters
     ----------
@@ -204,6 +205,82 @@ def mcf_mse_numba(y_dat, y_nn, d_dat, n_obs, mtot, no_of_treat, treat_values):
     return mse_mce, treat_shares, no_of_obs_by_treat
 
 
+@njit
+def mcf_mse_numba_w(y_dat, y_nn, d_dat, w_dat, n_obs, mtot, no_of_treat,
+                    treat_values, splitting):
+    """Compute average weighted mse for the data passed (all methods).
+
+    Same results as mcf_mse_not_numba with w_yes=True. Means and variances
+    are computed in two passes over the data without copying subsamples.
+
+    Parameters
+    ----------
+    y_dat : Numpy Nx1 vector. Outcome variable of observation.
+    y_nn : Numpy N x no_of_treatments array. Matched outcomes.
+    d_dat : Numpy Nx1 vector. Treatment.
+    w_dat : Numpy Nx1 vector. Weights.
+    n_obs : INT. Leaf size.
+    mtot : INT. Method.
+    no_of_treat : INT. Number of treated.
+    treat_values : 1D Numpy array of INT. Treatment values.
+    splitting : Boolean. Simplified MCE for 2 treatments (splitting only).
+
+    Returns
+    -------
+    mse : Mean squared error (average not acccount of number of obs).
+    treat_share: 1D Numpy array. Treatment shares.
+    """
+    obs = len(y_dat)
+    treat_shares = np.zeros(no_of_treat) if mtot in (1, 3, 4) else np.zeros(1)
+    mse_mce = np.zeros((no_of_treat, no_of_treat))
+    no_of_obs_by_treat = np.zeros(no_of_treat)
+    sum_w, y_mean = np.zeros(no_of_treat), np.zeros(no_of_treat)
+    treat_idx = np.full(obs, -1)
+    for i in range(obs):
+        for m_idx in range(no_of_treat):
+            if d_dat[i, 0] == treat_values[m_idx]:
+                treat_idx[i] = m_idx
+                no_of_obs_by_treat[m_idx] += 1
+                sum_w[m_idx] += w_dat[i, 0]
+                y_mean[m_idx] += w_dat[i, 0] * y_dat[i, 0]
+                break
+    y_mean = y_mean / sum_w
+    if mtot in (1, 3, 4):
+        sum_sq = np.zeros(no_of_treat)
+        for i in range(obs):
+            if treat_idx[i] >= 0:
+                dev = y_dat[i, 0] - y_mean[treat_idx[i]]
+                sum_sq[treat_idx[i]] += w_dat[i, 0] * dev * dev
+        for m_idx in range(no_of_treat):
+            mse_mce[m_idx, m_idx] = sum_sq[m_idx] / sum_w[m_idx]
+            treat_shares[m_idx] = no_of_obs_by_treat[m_idx] / n_obs
+    if mtot == 2:  # Variance of effects
+        for m_idx in range(no_of_treat):
+            for v_idx in range(m_idx + 1, no_of_treat):
+                mse_mce[m_idx, v_idx] = (y_mean[m_idx] - y_mean[v_idx])**2
+    elif mtot in (1, 4):
+        for m_idx in range(no_of_treat):
+            for v_idx in range(m_idx + 1, no_of_treat):
+                sum_w_ml = sum_w[m_idx] + sum_w[v_idx]
+                mean_m = mean_v = 0.0
+                for i in range(obs):
+                    if treat_idx[i] == m_idx or treat_idx[i] == v_idx:
+                        mean_m += w_dat[i, 0] * y_nn[i, m_idx]
+                        mean_v += w_dat[i, 0] * y_nn[i, v_idx]
+                mean_m, mean_v = mean_m / sum_w_ml, mean_v / sum_w_ml
+                if splitting and no_of_treat == 2:
+                    mse_mce[m_idx, v_idx] = -mean_m * mean_v
+                else:
+                    cov_ml = 0.0
+                    for i in range(obs):
+                        if treat_idx[i] == m_idx or treat_idx[i] == v_idx:
+                            cov_ml += w_dat[i, 0] * (
+                                (y_nn[i, m_idx] - mean_m)
+                                * (y_nn[i, v_idx] - mean_v))
+                    mse_mce[m_idx, v_idx] = cov_ml / sum_w_ml
+    return mse_mce, treat_shares, no_of_obs_by_treat
+
+
 def compute_mse_mce(mse_mce, mtot, no_of_treat):
     """Sum up MSE parts for use in splitting rule and else."""
     if no_of_treat > 4:
@@ -294,3 +371,101 @@ def add_mse_mce_split(mse_mce_l, mse_mce_r, obs_by_treat_l, obs_by_treat_r,
                      + mse_mce_r[m_idx, v_idx] * n_ml_r)
                     / (n_ml_l + n_ml_r))
     return mse_mce
+
+
+def mcf_mse_prefix(cnt, sum_w, sum_y, sum_y2, pair_stats, mtot, no_of_treat):
+    """Compute MSE/MCE matrices for many leaves from sufficient statistics.
+
+    Vectorised counterpart of mcf_mse for the sorted split search. All
+    statistics refer to C candidate leaves (rows) and are weighted sums (or
+    plain sums if there are no sampling weights).
+
+    Parameters
+    ----------
+    cnt : Numpy array (C x no_of_treat). Number of obs. by treatment.
+    sum_w : Numpy array (C x no_of_treat). Sum of weights by treatment.
+    sum_y : Numpy array (C x no_of_treat). Sum of (weighted) outcomes.
+    sum_y2 : Numpy array (C x no_of_treat). Sum of (weighted) squared outcomes.
+    pair_stats : List of tuples (one for each pair m < v, in the order of
+                 mcf_mse) with sums of weights, matched outcomes m, matched
+                 outcomes v and their product. Only used if mtot is 1 or 4.
+    mtot : INT. Method.
+    no_of_treat : INT. Number of treatments.
+
+    Returns
+    -------
+    mse_mce : Numpy array (C x no_of_treat x no_of_treat).
+    treat_shares : Numpy array (C x no_of_treat).
+    obs_by_treat : Numpy array (C x no_of_treat).
+
+    """
+    no_cand = cnt.shape[0]
+    mse_mce = np.zeros((no_cand, no_of_treat, no_of_treat))
+    obs_by_treat = cnt.astype(np.float64)
+    treat_shares = obs_by_treat / np.sum(obs_by_treat, axis=1, keepdims=True)
+    y_mean = sum_y / sum_w
+    if mtot in (1, 3, 4):
+        diag = np.arange(no_of_treat)
+        mse_mce[:, diag, diag] = sum_y2 / sum_w - y_mean**2
+    if mtot != 3:
+        pair = 0
+        for m_idx in range(no_of_treat):
+            for v_idx in range(m_idx + 1, no_of_treat):
+                if mtot == 2:  # Variance of effects mtot = 2
+                    mse_mce[:, m_idx, v_idx] = (y_mean[:, m_idx]
+                                                - y_mean[:, v_idx])**2
+                else:
+                    sum_w_ml, sum_m, sum_v, sum_mv = pair_stats[pair]
+                    mse_mce[:, m_idx, v_idx] = (
+                        sum_mv / sum_w_ml
+                        - (sum_m / sum_w_ml) * (sum_v / sum_w_ml))
+                pair += 1
+    return mse_mce, treat_shares, obs_by_treat
+
+
+def add_mse_mce_split_vec(mse_mce_l, mse_mce_r, obs_by_treat_l,
+                          obs_by_treat_r, mtot, no_of_treat):
+    """Sum up MSE parts of many candidate splits (see add_mse_mce_split)."""
+    mse_mce = np.zeros_like(mse_mce_l)
+    obs_by_treat = obs_by_treat_l + obs_by_treat_r
+    for m_idx in range(no_of_treat):
+        mse_mce[:, m_idx, m_idx] = (
+            (mse_mce_l[:, m_idx, m_idx] * obs_by_treat_l[:, m_idx]
+             + mse_mce_r[:, m_idx, m_idx] * obs_by_treat_r[:, m_idx])
+            / obs_by_treat[:, m_idx])
+        if mtot != 3:
+            for v_idx in range(m_idx+1, no_of_treat):
+                n_ml_l = obs_by_treat_l[:, m_idx] + obs_by_treat_l[:, v_idx]
+                n_ml_r = obs_by_treat_r[:, m_idx] + obs_by_treat_r[:, v_idx]
+                mse_mce[:, m_idx, v_idx] = (
+                    (mse_mce_l[:, m_idx, v_idx] * n_ml_l
+                     + mse_mce_r[:, m_idx, v_idx] * n_ml_r)
+                    / (n_ml_l + n_ml_r))
+    return mse_mce
+
+
+def compute_mse_mce_vec(mse_mce, mtot, no_of_treat):
+    """Sum up MSE parts of many candidate splits (see compute_mse_mce)."""
+    trace = np.trace(mse_mce, axis1=1, axis2=2)
+    if no_of_treat > 4:
+        if mtot in (1, 4):
+            mse = no_of_treat * trace - mse_mce.sum(axis=(1, 2))
+        elif mtot == 2:
+            mse = 2 * trace - mse_mce.sum(axis=(1, 2))
+        elif mtot == 3:
+            mse = trace
+    else:
+        mse = (no_of_treat - 1) * trace if mtot in (1, 4) else trace
+        if mtot != 3:
+            mce = np.zeros_like(trace)
+            for m_idx in range(no_of_treat):
+                for v_idx in range(m_idx+1, no_of_treat):
+                    mce += mse_mce[:, m_idx, v_idx]
+            mse = mse - 2 * mce
+    return mse
+
+
+def mcf_penalty_vec(shares_l, shares_r):
+    """Generate the (unscaled) penalty of many candidate splits."""
+    diff = (shares_l - shares_r) ** 2
+    return 1 - (np.sum(diff, axis=1) / shares_l.shape[1])
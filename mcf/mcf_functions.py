@@ -1,10 +1,11 @@
-from ray import is_initialized, shutdown
-
 from mcf.mcf_general import check_reduce_dataframe
 from mcf.mcf_iv_functions import train_iv_main, predict_iv_main
 from mcf import mcf_init_functions as mcf_init
 
+from mcf.mcf_predict_stream_functions import predict_stream_main
 from mcf.mcf_print_stats_functions import print_mcf
+from mcf.mcf_ray_pool_functions import end_worker_pool, pool_init
+from mcf.mcf_ray_pool_functions import release_shared
 from mcf.mcf_sensitivity_functions import sensitivity_main
 from mcf.mcf_unconfound_functions import train_main, predict_main, analyse_main
 from mcf.mcf_unconfound_functions import blinder_iates_main
@@ -173,6 +174,22 @@ class ModifiedCausalForest:
        control group (i.e., IATEs of treatments vs. control group).
        Default (or None) is False.
 
+    cf_leaf_cache : Boolean (or None), optional
+        Cache terminal leaves (one small integer per observation and tree)
+        instead of sending observations through the trees again.
+        Data used to build the trees: The terminal leaves of the out-of-bag
+        observations are kept from building the trees and used for the
+        variable importance measures (cf_vi_oob_yes), after the forest is
+        built and before it is filled. Not used for continuous treatments.
+        These leaves are not kept with the forest.
+        Data used to fill the trees: The terminal leaves are computed once
+        for all trees when filling the forest and kept (and saved) with the
+        forest. They are reused when weights are computed for the same data
+        (e.g. if training and prediction data are the same). Terminal leaves
+        of other prediction data are not cached.
+        False : Nothing is cached (less memory).
+        Default (or None) is True.
+
     cf_n_min_grid : Integer (or None), optional
         Minimum leaf size: Number of grid values.
         If grid is used, optimal value is determined by out-of-bag
@@ -201,6 +218,20 @@ class ModifiedCausalForest:
         :math:`\\text{cf_n_min_min} = \\text{round}(A \\times \\text{number of treatments})`
         Default is None.
 
+    cf_n_min_pruning : Boolean (or None), optional
+        Tuning of the minimum leaf size (cf_n_min_grid > 1): For each
+        subsample and each value of the other tuning parameters, a single
+        tree is grown with the smallest minimum leaf size. The trees for the
+        larger minimum leaf sizes are obtained by removing all splits
+        leading to leaves that are too small and by growing these leaves
+        further with the larger minimum leaf size. This is faster than
+        growing a new tree for each value of the grid. The trees equal trees
+        grown with the larger minimum leaf size, up to the random numbers
+        drawn (e.g. for the splitting variables), so the tuned forest may
+        differ somewhat.
+        False : Grow new tree for each value of the grid.
+        Default (or None) is False.
+
     cf_n_min_treat : Integer (or None), optional
         Minimum number of observations per treatment in leaf.
         A higher value reduces the risk that a leaf cannot be filled with
@@ -267,6 +298,15 @@ class ModifiedCausalForest:
         & penalty functions.
         Default (or None) is 1.
 
+    cf_nn_tree_search : Boolean (or None), optional
+        Nearest neighbour matching: Find neighbours with a KD-tree on the
+        (Mahalanobis) transformed features instead of computing the
+        distances to all observations of the other treatment group. Both
+        methods find the same neighbours (the outcomes of tied neighbours
+        are averaged).
+        False : Brute force search.
+        Default (or None) is True.
+
     cf_p_diff_penalty : Integer (or None), optional
             Penalty function (depends on the value of `mce_vart`).
     
@@ -310,6 +350,39 @@ class ModifiedCausalForest:
         :math:`4 + \\text{number of training observations}^{0.2}`
         Default is None.
 
+    cf_sorted_split_search : Boolean (or None), optional
+        Evaluate all splitting values of a variable in one pass over the
+        sorted data of the leaf (using cumulative sums of outcomes, matched
+        outcomes and treatment counts) instead of recomputing the objective
+        function separately for each value. This is much faster for large
+        leaves. The objective function is computed from sums of squares in a
+        different order. Therefore, splits with (almost) tied values of the
+        objective function may differ from the default.
+        If several trees are grown on the same subsample (tuning grids), the
+        split statistics of their common leaves are computed only once. This
+        requires that all thresholds are checked (cf_random_thresholds=0 or
+        cf_split_bins).
+        Not used for continuous treatments.
+        False : Evaluate each splitting value separately.
+        Default (or None) is False (True if cf_split_bins is used).
+
+    cf_split_bins : Integer or Boolean (or None), optional
+        Histogram split mode. Ordered features with many values are
+        quantized once into (at most) this number of quantile bins before
+        the forest is built. Splits are only considered at bin boundaries
+        (which are observed values of the feature), and the objective
+        function of all boundaries is obtained from per-bin sums. The sums of
+        the second daughter leaf are obtained by subtracting those of its
+        sibling from those of the parent leaf. This is much faster for large
+        data, in particular when all thresholds are checked (the default of
+        cf_random_thresholds becomes 0 in this mode). Requires
+        cf_sorted_split_search (which is switched on unless it is set to
+        False). Not used for continuous treatments.
+        True : 255 bins (features are stored as 8 bit integers).
+        Integer > 256 : Features are stored as 16 bit integers (at most
+        65536 bins).
+        Default (or None) is None (no binning).
+
     cf_subsample_factor_forest : Float (or None), optional
         Multiplier of default size of subsampling sample (S) used to build
         tree.
@@ -917,8 +990,22 @@ class ModifiedCausalForest:
         Default is 50'000.
         Internal variable, change default only if you know what you do.
 
+    _int_mem_budget_mb : Integer or float (or None), optional
+        Memory budget (in MB) of training and prediction. The number of
+        workers, the sizes of the chunks of trees, observations and sparse
+        weights processed by a worker are derived from this budget and from
+        estimates of the memory needed by a single task (based on the number
+        of observations, features, treatments and the size of the forest).
+        Only if a budget is set, the Ray object stores are limited to half of
+        it and the default cf_chunks_maxsize is reduced such that the
+        training data of all workers fits into the budget.
+        None: 75% of the available RAM.
+        Default is None.
+        Internal variable, change default only if you know what you do.
+
     _int_mp_ray_del : Tuple of strings (or None), optional
-        'refs' : Delete references to object store.
+        'refs' : Delete references to object store. Forests and training data
+        remain in the object store until the Ray workers are shut down.
         'rest' : Delete all other objects of Ray task.
         'none' : Delete no objects.
         These 3 options can be combined.
@@ -935,6 +1022,9 @@ class ModifiedCausalForest:
     _int_mp_ray_shutdown : Boolean (or None), optional
         When computing the mcf repeatedly like in Monte Carlo studies,
         setting _int_mp_ray_shutdown to True may be a good idea.
+        Ray workers are started once and shared by all stages of the
+        estimation. If True, they are shut down at the end of each call of
+        the train and predict methods.
         None: False if obs < 100000, True otherwise.
         Default is None.
         Internal variable, change default only if you know what you do.
@@ -948,11 +1038,26 @@ class ModifiedCausalForest:
         Default is None.
         Internal variable, change default only if you know what you do.
 
+    _int_forest_mmap_path : String (or None), optional
+        Format of the forests when the instance is saved with
+        mcf_forest_asdict_functions.save_mcf_pickle (pickle, copy and
+        deepcopy are not affected).
+        String : Directory in which the forests are saved as memory-mapped
+        arrays (one .npy file per array). Relative paths are relative to the
+        directory of the pickle file. The pickle file contains only a
+        reference to this directory. When it is loaded with load_mcf_pickle,
+        the forests are memory mapped, i.e. prediction starts without reading
+        the forests into memory and several processes share the same pages.
+        The directory must be kept together with the pickle file.
+        None : Forests are pickled together with the instance.
+        Default is None.
+
     _int_iate_chunk_size : Integer or None, optional
         Number of IATEs that are estimated in a single ray worker.
-        Default is number of prediction observations / workers.
+        Default (or None) is determined from the number of prediction
+        observations, the workers and _int_mem_budget_mb.
         If programme crashes in second part of IATE because of excess memory
-        consumption, reduce _int_iate_chunk_size.
+        consumption, reduce _int_iate_chunk_size or _int_mem_budget_mb.
 
     _int_mp_weights_tree_batch : Integer (or None), optional
         Number of batches to split data in weight computation for variable
@@ -984,6 +1089,13 @@ class ModifiedCausalForest:
         Do not create a new directory when the path already exists.
         Default (or None) is False.
 
+    _int_predict_stream_mb : Integer or float (or None), optional
+        Memory budget (in MB) of the
+        :meth:`~ModifiedCausalForest.predict_stream` method. The prediction
+        data is processed in chunks whose size is derived from this budget
+        and the size of the training data.
+        Default (or None) is 2000.
+
     _int_report : Boolean (or None), optional
         Provide information for McfOptPolReports to construct informative
         reports.
@@ -1021,7 +1133,9 @@ class ModifiedCausalForest:
         Internal variable, change default only if you know what you do.
 
     _int_weight_as_sparse_splits : Integer (or None), optional
-        Compute sparse weight matrix in several chunks.
+        Compute sparse weight matrix in several chunks. If larger than 1, the
+        chunks are kept on disk (memory-mapped) and are never combined into
+        one matrix in memory.
         None: Automatically determined as:
         (Rows of prediction data * Rows of Fill_y data)
         /(Number of training splits * 25,000 * 25,000)
@@ -1130,12 +1244,15 @@ class ModifiedCausalForest:
             cf_alpha_reg_grid=1, cf_alpha_reg_max=0.15, cf_alpha_reg_min=0.05,
             cf_boot=1000, cf_chunks_maxsize=None, cf_compare_only_to_zero=False,
             cf_n_min_grid=1, cf_n_min_max=None, cf_n_min_min=None,
-            cf_n_min_treat=None, cf_nn_main_diag_only=False, cf_m_grid=1,
+            cf_n_min_treat=None, cf_n_min_pruning=False,
+            cf_nn_main_diag_only=False,
+            cf_nn_tree_search=True, cf_leaf_cache=True, cf_m_grid=1,
             cf_m_random_poisson=True, cf_m_share_max=0.6, cf_m_share_min=0.1,
             cf_match_nn_prog_score=True, cf_mce_vart=1,
             cf_random_thresholds=None, cf_p_diff_penalty=None,
-            cf_penalty_type='mse_d',
-            cf_subsample_factor_eval=None, cf_subsample_factor_forest=1,
+            cf_penalty_type='mse_d', cf_sorted_split_search=None,
+            cf_split_bins=None, cf_subsample_factor_eval=None,
+            cf_subsample_factor_forest=1,
             cf_tune_all=False, cf_vi_oob_yes=False,
             cs_adjust_limits=None, cs_max_del_train=0.5, cs_min_p=0.01,
             cs_quantil=1, cs_type=1,
@@ -1177,16 +1294,19 @@ class ModifiedCausalForest:
             post_tree=True,
             _int_cuda=False, _int_del_forest=False,
             _int_descriptive_stats=True, _int_dpi=500, _int_fontsize=2,
+            _int_forest_mmap_path=None,
             _int_iate_chunk_size=None,
             _int_keep_w0=False, _int_no_filled_plot=20,
             _int_max_cats_cont_vars=None, _int_max_save_values=50,
             _int_max_obs_training=float('inf'), _int_max_obs_prediction=250000,
             _int_max_obs_kmeans=200000, _int_max_obs_post_rel_graphs=50000,
+            _int_mem_budget_mb=None,
             _int_mp_ray_del=('refs',), _int_mp_ray_objstore_multiplier=1,
             _int_mp_ray_shutdown=None, _int_mp_vim_type=None,
             _int_mp_weights_tree_batch=None, _int_mp_weights_type=1,
             _int_obs_bigdata=1000000,
-            _int_output_no_new_dir=False, _int_red_largest_group_train=False,
+            _int_output_no_new_dir=False, _int_predict_stream_mb=None,
+            _int_red_largest_group_train=False,
             _int_replication=False, _int_report=True, _int_return_iate_sp=False,
             _int_seed_sample_split=67567885, _int_share_forest_sample=0.5,
             _int_show_plots=True, _int_verbose=True,
@@ -1222,7 +1342,10 @@ class ModifiedCausalForest:
             max_obs_prediction=_int_max_obs_prediction,
             max_obs_kmeans=_int_max_obs_kmeans,
             max_obs_post_rel_graphs=_int_max_obs_post_rel_graphs,
-            p_ate_no_se_only=p_ate_no_se_only
+            p_ate_no_se_only=p_ate_no_se_only,
+            predict_stream_mb=_int_predict_stream_mb,
+            mem_budget_mb=_int_mem_budget_mb,
+            forest_mmap_path=_int_forest_mmap_path
             )
         gen_dict = mcf_init.gen_init(
             self.int_dict,
@@ -1263,7 +1386,10 @@ class ModifiedCausalForest:
             subsample_factor_eval=cf_subsample_factor_eval,
             subsample_factor_forest=cf_subsample_factor_forest,
             tune_all=cf_tune_all,
-            random_thresholds=cf_random_thresholds)
+            random_thresholds=cf_random_thresholds,
+            sorted_split_search=cf_sorted_split_search,
+            nn_tree_search=cf_nn_tree_search, leaf_cache=cf_leaf_cache,
+            n_min_pruning=cf_n_min_pruning, split_bins=cf_split_bins)
         p_dict = mcf_init.p_init(
             gen_dict,
             ate_no_se_only=p_ate_no_se_only, cbgate=p_cbgate, atet=p_atet,
@@ -1321,11 +1447,19 @@ class ModifiedCausalForest:
         self.blind_dict = self.sens_dict = None
         self.data_train_dict = self.var_x_type = self.var_x_values = None
         self.forest, self.time_strings = None, {}
+        # Ray workers and object store references shared by all stages
+        self.pool_dict = pool_init()
         self.report = {'predict_list': [],   # Needed for multiple predicts
                        'analyse_list': []
                        }
         self.iv_mcf = {'firststage': None, 'reducedform': None}
 
+    def __getstate__(self):
+        """Do not pickle references to the Ray object store."""
+        state = self.__dict__.copy()
+        state['pool_dict'] = None
+        return state
+
     def train(self, data_df):
         """
         Build the modified causal forest on the training data.
@@ -1348,8 +1482,10 @@ class ModifiedCausalForest:
             Location of directory in which output is saved.
 
         """
+        release_shared(self)     # Objects of earlier training are outdated
         (tree_df, fill_y_df, self.gen_dict['outpath']) = train_main(self,
                                                                     data_df)
+        end_worker_pool(self)
 
         return tree_df, fill_y_df, self.gen_dict['outpath']
 
@@ -1375,7 +1511,9 @@ class ModifiedCausalForest:
             Location of directory in which output is saved.
 
         """
+        release_shared(self)     # Objects of earlier training are outdated
         tree_df, fill_y_df = train_iv_main(self, data_df)
+        end_worker_pool(self)
 
         return tree_df, fill_y_df, self.gen_dict['outpath']
 
@@ -1425,6 +1563,49 @@ class ModifiedCausalForest:
             Location of directory in which output is saved.
         """
         results, self.gen_dict['outpath'] = predict_main(self, data_df)
+        end_worker_pool(self)
+
+        return results, self.gen_dict['outpath']
+
+    def predict_stream(self, data, iate_file=None):
+        """
+        Compute effects for large prediction data in chunks of bounded size.
+
+        The prediction data is not reduced to _int_max_obs_prediction
+        observations. Instead, it is processed in chunks whose size follows
+        from the memory budget _int_predict_stream_mb. The weights of the
+        chunks are aggregated to the ATEs (and GATEs) and saved temporarily on
+        disk. The IATEs are then computed chunk by chunk and written to a
+        csv-file. Efficient IATEs, smoothed GATEs, BGATEs and AMGATEs are not
+        computed.
+
+        Parameters
+        ----------
+        data : DataFrame or String or Pathlib object
+            Prediction data or name of csv-file containing the prediction
+            data. It must contain information about features (and treatment
+            if effects for treatment specific subpopulations are desired as
+            well).
+
+        iate_file : String or Pathlib object, optional
+            Name of csv-file to which the IATEs (and their standard errors)
+            are written. Default (or None) is iate_stream.csv in the output
+            directory.
+
+        Returns
+        -------
+        results : Dictionary.
+            Results. Same structure as the results of the
+            :meth:`~ModifiedCausalForest.predict` method. 'iate_data_df' is
+            None and 'iate_file' contains the name of the csv-file with the
+            IATEs.
+
+        outpath : Pathlib object
+            Location of directory in which output is saved.
+        """
+        results, self.gen_dict['outpath'] = predict_stream_main(
+            self, data, iate_file=iate_file)
+        end_worker_pool(self)
 
         return results, self.gen_dict['outpath']
 
@@ -1501,10 +1682,10 @@ class ModifiedCausalForest:
 
         results = predict_iv_main(self, data_df)
 
-        if (is_initialized()
-            and self.gen_dict['mp_parallel'] > 1
-                and len(data_df) > self.int_dict['obs_bigdata']):
-            shutdown()
+        end_worker_pool(self, shutdown=(
+            self.int_dict['mp_ray_shutdown']
+            or (self.gen_dict['mp_parallel'] > 1
+                and len(data_df) > self.int_dict['obs_bigdata'])))
 
         return results, self.gen_dict['outpath']
 
@@ -13,18 +13,28 @@ import os
 
 import numpy as np
 import ray
+from scipy import sparse
 
 from mcf import mcf_ate_functions as mcf_ate
 from mcf import mcf_estimation_functions as mcf_est
 from mcf import mcf_general as mcf_gp
 from mcf import mcf_general_sys as mcf_sys
 from mcf import mcf_print_stats_functions as ps
+from mcf import mcf_ray_pool_functions as mcf_pool
 from mcf import mcf_weight_functions as mcf_w
+from mcf import mcf_weight_store_functions as mcf_ws
 
 
 def gate_est(mcf_, data_df, weights_dic, w_atemain, gate_type='GATE',
-             z_name_amgate=None, with_output=True, paras_amgate=None):
-    """Estimate GATE(T)s, BGATE and AMGATE and their standard errors."""
+             z_name_amgate=None, with_output=True, paras_amgate=None,
+             w_gate_agg_all=None):
+    """Estimate GATE(T)s, BGATE and AMGATE and their standard errors.
+
+    w_gate_agg_all is None or a list with the aggregated weights of
+    gate_weights_sparse for each variable in z_name (for example summed over
+    chunks of the prediction data). If not None, the weights in weights_dic
+    are not used.
+    """
     if gate_type not in ('GATE', 'AMGATE', 'BGATE'):
         raise ValueError('Wrong GATE specifified ({gate_type}). gate_type must'
                          'be on of the following: GATE, AMGATE, BGATE')
@@ -49,7 +59,10 @@ def gate_est(mcf_, data_df, weights_dic, w_atemain, gate_type='GATE',
     y_dat = weights_dic['y_dat_np']
     weights_all = weights_dic['weights']
     w_dat = weights_dic['w_dat_np'] if gen_dic['weighted'] else None
-    cl_dat = weights_dic['cl_dat_np'] if p_dic['cluster_std'] else None
+    if p_dic['cluster_std']:
+        cl_dat, cl_ind = weights_dic['cl_dat_np'], weights_dic['cl_ind']
+    else:
+        cl_dat = cl_ind = None
     n_y, no_of_out = len(y_dat), len(var_dic['y_name'])
     d_p, z_p, w_p, _ = mcf_ate.get_data_for_final_ate_estimation(
         data_df, gen_dic, p_dic, var_dic, ate=False, need_count=False)
@@ -103,13 +116,11 @@ def gate_est(mcf_, data_df, weights_dic, w_atemain, gate_type='GATE',
                     w_ate[a_idx, t_idx, :] = (w_ate[a_idx, t_idx, :]
                                               / w_ate_sum[a_idx, t_idx])
     files_to_delete, save_w_file = set(), None
-    if gen_dic['mp_parallel'] > 1 and int_dic['ray_or_dask'] != 'ray':
+    # Sparse weights are aggregated for all z-values before any MP, so
+    # weights need not be passed to (or saved for) the MP processes.
+    if (gen_dic['mp_parallel'] > 1 and int_dic['ray_or_dask'] != 'ray'
+            and not int_dic['weight_as_sparse']):
         memory_weights = mcf_sys.total_size(weights_all)
-        if int_dic['weight_as_sparse']:
-            for d_idx in range(no_of_treat):
-                memory_weights += (weights_all[d_idx].data.nbytes
-                                   + weights_all[d_idx].indices.nbytes
-                                   + weights_all[d_idx].indptr.nbytes)
         if memory_weights > 2e+9:  # Two Gigabytes (2e+9)
             if int_dic['with_output'] and int_dic['verbose']:
                 txt += ('Weights need ', memory_weights/1e+9, 'GB RAM'
@@ -127,8 +138,9 @@ def gate_est(mcf_, data_df, weights_dic, w_atemain, gate_type='GATE',
         maxworkers = 1
     else:
         if gen_dic['mp_automatic']:
-            maxworkers = mcf_sys.find_no_of_workers(gen_dic['mp_parallel'],
-                                                    gen_dic['sys_share']/2)
+            maxworkers = mcf_sys.find_no_of_workers(
+                gen_dic['mp_parallel'], gen_dic['sys_share']/2,
+                budget_mb=int_dic['mem_budget_mb'])
         else:
             maxworkers = gen_dic['mp_parallel']
         if weights_all2 is None:
@@ -138,17 +150,11 @@ def gate_est(mcf_, data_df, weights_dic, w_atemain, gate_type='GATE',
     if int_dic['with_output'] and int_dic['verbose'] and with_output:
         print('Number of parallel processes: ', maxworkers, flush=True)
     if int_dic['ray_or_dask'] == 'ray':
-        if int_dic['mem_object_store_3'] is None:
-            if not ray.is_initialized():
-                ray.init(num_cpus=maxworkers, include_dashboard=False)
-        else:
-            if not ray.is_initialized():
-                ray.init(num_cpus=maxworkers, include_dashboard=False,
-                         object_store_memory=int_dic['mem_object_store_3'])
-            if int_dic['with_output'] and int_dic['verbose']:
-                print('Size of Ray Object Store: ',
-                      round(int_dic['mem_object_store_3']/(1024*1024)), " MB")
-        weights_all_ref = ray.put(weights_all)
+        mcf_pool.start_worker_pool(mcf_, maxworkers,
+                                   int_dic['mem_object_store_3'])
+        weights_all_ref = (None if int_dic['weight_as_sparse']
+                           else mcf_pool.put_shared(mcf_, 'gate_weights',
+                                                    weights_all))
     y_pot_all, y_pot_var_all, y_pot_mate_all = [], [], []
     y_pot_mate_var_all, txt_all = [], []
     for z_name_j, z_name in enumerate(var_dic['z_name']):
@@ -172,6 +178,15 @@ def gate_est(mcf_, data_df, weights_dic, w_atemain, gate_type='GATE',
         w_gate_unc = np.zeros_like(w_gate)
         w_censored = np.zeros((no_of_zval, no_of_tgates, no_of_treat))
         w_gate0_dim = (no_of_treat, n_y)
+        if w_gate_agg_all is not None:
+            w_gate_agg = w_gate_agg_all[z_name_j]
+        elif int_dic['weight_as_sparse']:
+            w_gate_agg = gate_weights_sparse(
+                z_p[:, z_name_j], z_values, weights_all, d_p, w_p, w_dat,
+                t_probs, no_of_tgates, d_values, gen_dic, p_dic,
+                smooth_it=z_smooth, bandwidth=bandw_z, kernel=kernel)
+        else:
+            w_gate_agg = [None] * no_of_zval
         if (maxworkers == 1) or p_dic['gates_minus_previous']:
             for zj_idx in range(no_of_zval):
                 if p_dic['gates_minus_previous']:
@@ -180,14 +195,15 @@ def gate_est(mcf_, data_df, weights_dic, w_atemain, gate_type='GATE',
                     else:
                         w_ate = w_gate_unc[zj_idx, :, :, :]
                 results_fut_zj = gate_zj(
-                    z_values[zj_idx], zj_idx, y_dat, cl_dat, w_dat, z_p, d_p,
-                    w_p, z_name_j, weights_all, w_gate0_dim,
+                    z_values[zj_idx], zj_idx, y_dat, cl_dat, cl_ind, w_dat,
+                    z_p, d_p, w_p, z_name_j, weights_all, w_gate0_dim,
                     w_gate[zj_idx, :, :, :], w_gate_unc[zj_idx, :, :, :],
                     w_censored[zj_idx, :, :], w_ate, y_pot[zj_idx, :, :, :],
                     y_pot_var[zj_idx, :, :, :], y_pot_mate[zj_idx, :, :, :],
                     y_pot_mate_var[zj_idx, :, :, :], i_d_val, t_probs,
                     no_of_tgates, no_of_out, ct_dic, gen_dic, int_dic, p_dic,
-                    bandw_z, kernel, z_smooth, continuous)
+                    bandw_z, kernel, z_smooth, continuous,
+                    w_gate_agg_zj=w_gate_agg[zj_idx])
                 y_pot, y_pot_var, y_pot_mate, y_pot_mate_var = assign_pot(
                      y_pot, y_pot_var, y_pot_mate, y_pot_mate_var,
                      results_fut_zj, zj_idx)
@@ -196,12 +212,12 @@ def gate_est(mcf_, data_df, weights_dic, w_atemain, gate_type='GATE',
         else:
             if int_dic['ray_or_dask'] == 'ray':
                 still_running = [ray_gate_zj_mp.remote(
-                         z_values[zj_idx], zj_idx, y_dat, cl_dat,
+                         z_values[zj_idx], zj_idx, y_dat, cl_dat, cl_ind,
                          w_dat, z_p, d_p, w_p, z_name_j, weights_all_ref,
                          w_gate0_dim, w_ate, i_d_val, t_probs, no_of_tgates,
                          no_of_out, ct_dic, gen_dic, int_dic, p_dic, n_y,
                          bandw_z, kernel, save_w_file,
-                         z_smooth, continuous)
+                         z_smooth, continuous, w_gate_agg[zj_idx])
                     for zj_idx in range(no_of_zval)]
                 while len(still_running) > 0:
                     finished, still_running = ray.wait(still_running)
@@ -266,10 +282,9 @@ def gate_est(mcf_, data_df, weights_dic, w_atemain, gate_type='GATE',
     if int_dic['ray_or_dask'] == 'ray':
         if 'refs' in int_dic['mp_ray_del']:
             del weights_all_ref
+            mcf_pool.release_shared(mcf_, 'gate_weights')
         if 'rest' in int_dic['mp_ray_del']:
             del finished_res, finished
-        if int_dic['mp_ray_shutdown']:
-            ray.shutdown()
     return (y_pot_all, y_pot_var_all, y_pot_mate_all, y_pot_mate_var_all,
             gate_est_dic, txt_all)
 
@@ -330,8 +345,12 @@ def bamgate_est(mcf_, data_df, weights_dic, w_ate, forest_dic,
         text_sim_all += f'\n{vname_}: ' + txt_sim
         txt += txt_sim
         var_x_values[vname] = z_values[:]
-        weights_dic = mcf_w.get_weights_mp(mcf_, data_df_new, forest_dic,
-                                           'regular', with_output=False)
+        if bgate:   # Copies of observations: Weights of distinct rows only
+            weights_dic = mcf_w.get_weights_unique_mp(mcf_, data_df_new,
+                                                      forest_dic)
+        else:
+            weights_dic = mcf_w.get_weights_mp(mcf_, data_df_new, forest_dic,
+                                               'regular', with_output=False)
         (w_ate, _, _, _) = mcf_ate.ate_est(
             mcf_, data_df_new, weights_dic, with_output=False)
         (y_pot_gate_z, y_pot_var_gate_z, y_pot_mate_gate_z,
@@ -431,35 +450,40 @@ def ref_data_bgate(data_df, z_name, int_dic, p_dic, eva_values, bgate_name):
     data_new_z_np = data_new_df[z_name].to_numpy(copy=True)
     data_org_b_np = data_df[bgate_name].to_numpy()
     data_org_z_np = data_df[z_name].to_numpy()
-    data_org_np = data_df.to_numpy()
     if data_org_b_np.shape[1] > 1:
         bz_cov_inv = invcovariancematrix(data_org_b_np)
         bz_cov_inv[-1, -1] *= 10
     # Give much more additional weight to the z-related component in matching
     incr = 0.2 * np.std(data_new_z_np)
+    match_idx = np.empty(len(data_new_z_np), dtype=np.int64)
+    candidates = {}   # Candidate neighbours are the same for same z_value
     for idx, z_value in enumerate(data_new_z_np):
-        z_true = data_org_z_np == z_value
-        test_val = 0
-        for _ in range(5):
-            if np.count_nonzero(z_true) > 10:
-                break
-            test_val += incr
-            lower_ok = data_org_z_np >= z_value - test_val
-            upper_ok = data_org_z_np <= z_value + test_val
-            lower_upper_ok = lower_ok & upper_ok
-            z_true = np.zeros_like(data_org_z_np, dtype=bool)
-            z_true[lower_upper_ok] = True
-        if not np.any(z_true):
-            z_true = np.ones_like(data_org_z_np, dtype=bool)
-        data_org_np_condz = data_org_np[z_true]
-        data_org_b_np_condz = data_org_b_np[z_true]
+        if z_value not in candidates:
+            z_true = data_org_z_np == z_value
+            test_val = 0
+            for _ in range(5):
+                if np.count_nonzero(z_true) > 10:
+                    break
+                test_val += incr
+                lower_ok = data_org_z_np >= z_value - test_val
+                upper_ok = data_org_z_np <= z_value + test_val
+                lower_upper_ok = lower_ok & upper_ok
+                z_true = np.zeros_like(data_org_z_np, dtype=bool)
+                z_true[lower_upper_ok] = True
+            if not np.any(z_true):
+                z_true = np.ones_like(data_org_z_np, dtype=bool)
+            candidates[z_value] = (np.flatnonzero(z_true),
+                                   data_org_b_np[z_true])
+        z_true_idx, data_org_b_np_condz = candidates[z_value]
         diff = data_org_b_np_condz - data_new_b_np[idx, :]
         if data_org_b_np.shape[1] > 1:
             dist = np.sum(np.dot(diff, bz_cov_inv) * diff, axis=1)
         else:
             dist = diff**2
-        match_neigbour_idx = np.argmin(dist)
-        data_new_df.iloc[idx] = data_org_np_condz[match_neigbour_idx, :]
+        match_idx[idx] = z_true_idx[np.argmin(dist)]
+    # Reference observations are copies of observations of data_df. Copy them
+    # at once instead of row by row.
+    data_new_df = data_df.iloc[match_idx].set_index(data_new_df.index)
     return data_new_df, eva_values, txt
 
 
@@ -558,25 +582,25 @@ def smooth_gate_eva_values(z_dat, no_eva_values):
 
 
 @ray.remote
-def ray_gate_zj_mp(z_val, zj_idx, y_dat, cl_dat, w_dat, z_p, d_p, w_p,
+def ray_gate_zj_mp(z_val, zj_idx, y_dat, cl_dat, cl_ind, w_dat, z_p, d_p, w_p,
                    z_name_j, weights_all, w_gate0_dim, w_ate, i_d_val, t_probs,
                    no_of_tgates, no_of_out, ct_dic, gen_dic, int_dic, p_dic,
                    n_y, bandw_z, kernel, save_w_file=None, smooth_it=False,
-                   continuous=False):
+                   continuous=False, w_gate_agg_zj=None):
     """Make function compatible with Ray."""
-    return gate_zj_mp(z_val, zj_idx, y_dat, cl_dat, w_dat, z_p, d_p, w_p,
-                      z_name_j, weights_all, w_gate0_dim, w_ate, i_d_val,
+    return gate_zj_mp(z_val, zj_idx, y_dat, cl_dat, cl_ind, w_dat, z_p, d_p,
+                      w_p, z_name_j, weights_all, w_gate0_dim, w_ate, i_d_val,
                       t_probs, no_of_tgates, no_of_out, ct_dic, gen_dic,
                       int_dic, p_dic, n_y, bandw_z, kernel, save_w_file,
-                      smooth_it, continuous)
+                      smooth_it, continuous, w_gate_agg_zj)
 
 
-def gate_zj(z_val, zj_idx, y_dat, cl_dat, w_dat, z_p, d_p, w_p, z_name_j,
-            weights_all, w_gate0_dim, w_gate_zj, w_gate_unc_zj, w_censored_zj,
-            w_ate, y_pot_zj, y_pot_var_zj, y_pot_mate_zj, y_pot_mate_var_zj,
-            i_d_val, t_probs, no_of_tgates, no_of_out, ct_dic, gen_dic,
-            int_dic, p_dic, bandw_z, kernel, smooth_it=False,
-            continuous=False):
+def gate_zj(z_val, zj_idx, y_dat, cl_dat, cl_ind, w_dat, z_p, d_p, w_p,
+            z_name_j, weights_all, w_gate0_dim, w_gate_zj, w_gate_unc_zj,
+            w_censored_zj, w_ate, y_pot_zj, y_pot_var_zj, y_pot_mate_zj,
+            y_pot_mate_var_zj, i_d_val, t_probs, no_of_tgates, no_of_out,
+            ct_dic, gen_dic, int_dic, p_dic, bandw_z, kernel, smooth_it=False,
+            continuous=False, w_gate_agg_zj=None):
     """Compute Gates and their variances for MP."""
     if continuous:
         no_of_treat, d_values = ct_dic['ct_grid_w'], ct_dic['ct_grid_w_val']
@@ -585,43 +609,14 @@ def gate_zj(z_val, zj_idx, y_dat, cl_dat, w_dat, z_p, d_p, w_p, z_name_j,
         index_full = ct_dic['ct_w_to_dr_index_full']
     else:
         no_of_treat, d_values = gen_dic['no_of_treat'], gen_dic['d_values']
-    weights, relevant_z,  w_z_val = get_w_rel_z(
-        z_p[:, z_name_j], z_val, weights_all, smooth_it, bandwidth=bandw_z,
-        kernel=kernel, w_is_csr=int_dic['weight_as_sparse'])
-    if p_dic['gatet']:
-        d_p_z = d_p[relevant_z]
-    if gen_dic['weighted']:
-        w_p_z = w_p[relevant_z]
-    n_x = weights[0].shape[0] if int_dic['weight_as_sparse'] else len(weights)
     # Step 1: Aggregate weights
-    for n_idx in range(n_x):
-        w_gadd = np.zeros(w_gate0_dim)
-        for t_idx, _ in enumerate(d_values):
-            if int_dic['weight_as_sparse']:
-                weight_i = weights[t_idx].getrow(n_idx)
-                w_index = weight_i.indices
-                w_i = weight_i.data.copy()
-            else:
-                w_index = weights[n_idx][t_idx][0].copy()  # Ind weights>0
-                w_i = weights[n_idx][t_idx][1].copy()
-            if gen_dic['weighted']:
-                w_i = w_i * w_dat[w_index].reshape(-1)
-            w_i_sum = np.sum(w_i)
-            if not 1-1e-10 < w_i_sum < 1+1e-10:
-                w_i = w_i / w_i_sum
-            if gen_dic['weighted']:
-                w_i = w_i * w_p_z[n_idx]
-            if smooth_it:
-                w_i = w_i * w_z_val[n_idx]
-            if p_dic['choice_based_sampling']:
-                i_pos = i_d_val[d_p[n_idx] == d_values]
-                w_gadd[t_idx, w_index] = w_i * t_probs[int(i_pos)]
-            else:
-                w_gadd[t_idx, w_index] = w_i.copy()
-        w_gate_zj[0, :, :] += w_gadd
-        if p_dic['gatet']:
-            t_pos_i = i_d_val[d_p_z[n_idx] == d_values]
-            w_gate_zj[t_pos_i+1, :, :] += w_gadd
+    if w_gate_agg_zj is None:
+        w_gate_zj = aggregate_w_gate_zj(
+            z_val, z_p, d_p, w_p, w_dat, z_name_j, weights_all, w_gate_zj,
+            w_gate0_dim, d_values, i_d_val, t_probs, gen_dic, int_dic, p_dic,
+            bandw_z, kernel, smooth_it)
+    else:   # Weights already aggregated by gate_weights_sparse
+        w_gate_zj += w_gate_agg_zj
     # Step 2: Get potential outcomes for particular z_value
     if not continuous:
         sum_wgate = np.sum(w_gate_zj, axis=2)
@@ -643,7 +638,7 @@ def gate_zj(z_val, zj_idx, y_dat, cl_dat, w_dat, z_p, d_p, w_p, z_name_j,
                             w_gate_cont, y_dat[:, o_idx], cl_dat, gen_dic,
                             p_dic, weights=w_dat,
                             bootstrap=p_dic['se_boot_gate'],
-                            keep_all=int_dic['keep_w0'])
+                            keep_all=int_dic['keep_w0'], cl_ind=cl_ind)
                         ti_idx = index_full[t_idx, i]  # pylint: disable=E1136
                         y_pot_zj[a_idx, ti_idx, o_idx] = ret[0]
                         y_pot_var_zj[a_idx, ti_idx, o_idx] = ret[1]
@@ -655,7 +650,7 @@ def gate_zj(z_val, zj_idx, y_dat, cl_dat, w_dat, z_p, d_p, w_p, z_name_j,
                                 w_diff_cont, y_dat[:, o_idx], cl_dat, gen_dic,
                                 p_dic, norm=False, weights=w_dat,
                                 bootstrap=p_dic['se_boot_gate'],
-                                keep_all=int_dic['keep_w0'])
+                                keep_all=int_dic['keep_w0'], cl_ind=cl_ind)
                             y_pot_mate_zj[a_idx, ti_idx, o_idx] = ret2[0]
                             y_pot_mate_var_zj[a_idx, ti_idx, o_idx] = ret2[1]
                         if t_idx == (no_of_treat - 1):  # last element,no inter
@@ -665,7 +660,7 @@ def gate_zj(z_val, zj_idx, y_dat, cl_dat, w_dat, z_p, d_p, w_p, z_name_j,
                         w_gate_zj[a_idx, t_idx, :], y_dat[:, o_idx], cl_dat,
                         gen_dic, p_dic, weights=w_dat,
                         bootstrap=p_dic['se_boot_gate'],
-                        keep_all=int_dic['keep_w0'])
+                        keep_all=int_dic['keep_w0'], cl_ind=cl_ind)
                     y_pot_zj[a_idx, t_idx, o_idx] = ret[0]
                     y_pot_var_zj[a_idx, t_idx, o_idx] = ret[1]
                     if int_dic['with_output']:
@@ -673,18 +668,18 @@ def gate_zj(z_val, zj_idx, y_dat, cl_dat, w_dat, z_p, d_p, w_p, z_name_j,
                             w_diff, y_dat[:, o_idx], cl_dat,
                             gen_dic, p_dic, norm=False, weights=w_dat,
                             bootstrap=p_dic['se_boot_gate'],
-                            keep_all=int_dic['keep_w0'])
+                            keep_all=int_dic['keep_w0'], cl_ind=cl_ind)
                         y_pot_mate_zj[a_idx, t_idx, o_idx] = ret2[0]
                         y_pot_mate_var_zj[a_idx, t_idx, o_idx] = ret2[1]
     return (y_pot_zj, y_pot_var_zj, y_pot_mate_zj, y_pot_mate_var_zj,
             w_gate_zj, w_gate_unc_zj, zj_idx, w_censored_zj)
 
 
-def gate_zj_mp(z_val, zj_idx, y_dat, cl_dat, w_dat, z_p, d_p, w_p,
+def gate_zj_mp(z_val, zj_idx, y_dat, cl_dat, cl_ind, w_dat, z_p, d_p, w_p,
                z_name_j, weights_all, w_gate0_dim, w_ate, i_d_val, t_probs,
                no_of_tgates, no_of_out, ct_dic, gen_dic, int_dic, p_dic, n_y,
                bandw_z, kernel, save_w_file=None, smooth_it=False,
-               continuous=False):
+               continuous=False, w_gate_agg_zj=None):
     """Compute Gates and their variances for MP."""
     if continuous:
         no_of_treat, d_values = ct_dic['grid_w'], ct_dic['grid_w_val']
@@ -696,7 +691,7 @@ def gate_zj_mp(z_val, zj_idx, y_dat, cl_dat, w_dat, z_p, d_p, w_p,
     else:
         no_of_treat, d_values = gen_dic['no_of_treat'], gen_dic['d_values']
         no_of_treat_dr, d_values_dr = no_of_treat, d_values
-    if save_w_file is not None:
+    if save_w_file is not None and w_gate_agg_zj is None:
         weights_all = mcf_sys.save_load(save_w_file, save=False,
                                         output=int_dic['with_output'])
     w_gate_zj = np.zeros((no_of_tgates, no_of_treat, n_y))
@@ -707,42 +702,13 @@ def gate_zj_mp(z_val, zj_idx, y_dat, cl_dat, w_dat, z_p, d_p, w_p,
     y_pot_mate_zj = np.empty_like(y_pot_zj)
     y_pot_mate_var_zj = np.empty_like(y_pot_zj)
     # Step 1: Aggregate weights
-    weights, relevant_z, w_z_val = get_w_rel_z(
-        z_p[:, z_name_j], z_val, weights_all, smooth_it, bandwidth=bandw_z,
-        kernel=kernel, w_is_csr=int_dic['weight_as_sparse'])
-    if p_dic['gatet']:
-        d_p_z = d_p[relevant_z]
-    if gen_dic['weighted']:
-        w_p_z = w_p[relevant_z]
-    n_x = weights[0].shape[0] if int_dic['weight_as_sparse'] else len(weights)
-    for n_idx in range(n_x):
-        w_gadd = np.zeros(w_gate0_dim)
-        for t_idx, _ in enumerate(d_values):
-            if int_dic['weight_as_sparse']:
-                weight_i = weights[t_idx].getrow(n_idx)
-                w_index = weight_i.indices
-                w_i = weight_i.data.copy()
-            else:
-                w_index = weights[n_idx][t_idx][0].copy()  # Ind weights>0
-                w_i = weights[n_idx][t_idx][1].copy()
-            if gen_dic['weighted']:
-                w_i = w_i * w_dat[w_index].reshape(-1)
-            w_i_sum = np.sum(w_i)
-            if not (1-1e-10) < w_i_sum < (1+1e-10):
-                w_i = w_i / w_i_sum
-            if gen_dic['weighted']:
-                w_i = w_i * w_p_z[n_idx]
-            if smooth_it:
-                w_i = w_i * w_z_val[n_idx]
-            if p_dic['choice_based_sampling']:
-                i_pos = i_d_val[d_p[n_idx] == d_values]
-                w_gadd[t_idx, w_index] = w_i * t_probs[int(i_pos)]
-            else:
-                w_gadd[t_idx, w_index] = w_i.copy()
-        w_gate_zj[0, :, :] += w_gadd
-        if p_dic['gatet']:
-            t_pos_i = i_d_val[d_p_z[n_idx] == d_values]
-            w_gate_zj[t_pos_i+1, :, :] += w_gadd
+    if w_gate_agg_zj is None:
+        w_gate_zj = aggregate_w_gate_zj(
+            z_val, z_p, d_p, w_p, w_dat, z_name_j, weights_all, w_gate_zj,
+            w_gate0_dim, d_values, i_d_val, t_probs, gen_dic, int_dic, p_dic,
+            bandw_z, kernel, smooth_it)
+    else:   # Weights already aggregated by gate_weights_sparse
+        w_gate_zj += w_gate_agg_zj
     # Step 2: Get potential outcomes for particular z_value
     if not continuous:
         sum_wgate = np.sum(w_gate_zj, axis=2)
@@ -764,7 +730,7 @@ def gate_zj_mp(z_val, zj_idx, y_dat, cl_dat, w_dat, z_p, d_p, w_p,
                             w_gate_cont, y_dat[:, o_idx], cl_dat, gen_dic,
                             p_dic, weights=w_dat,
                             bootstrap=p_dic['se_boot_gate'],
-                            keep_all=int_dic['keep_w0'])
+                            keep_all=int_dic['keep_w0'], cl_ind=cl_ind)
                         ti_idx = index_full[t_idx, i]  # pylint: disable=E1136
                         y_pot_zj[a_idx, ti_idx, o_idx] = ret[0]
                         y_pot_var_zj[a_idx, ti_idx, o_idx] = ret[1]
@@ -776,7 +742,7 @@ def gate_zj_mp(z_val, zj_idx, y_dat, cl_dat, w_dat, z_p, d_p, w_p,
                                 w_diff_cont, y_dat[:, o_idx], cl_dat, gen_dic,
                                 p_dic, norm=False, weights=w_dat,
                                 bootstrap=p_dic['se_boot_gate'],
-                                keep_all=int_dic['keep_w0'])
+                                keep_all=int_dic['keep_w0'], cl_ind=cl_ind)
                             y_pot_mate_zj[a_idx, ti_idx, o_idx] = ret2[0]
                             y_pot_mate_var_zj[a_idx, ti_idx, o_idx] = ret2[1]
                         if t_idx == (no_of_treat - 1):  # last element,no inter
@@ -786,7 +752,7 @@ def gate_zj_mp(z_val, zj_idx, y_dat, cl_dat, w_dat, z_p, d_p, w_p,
                         w_gate_zj[a_idx, t_idx, :], y_dat[:, o_idx], cl_dat,
                         gen_dic, p_dic, weights=w_dat,
                         bootstrap=p_dic['se_boot_gate'],
-                        keep_all=int_dic['keep_w0'])
+                        keep_all=int_dic['keep_w0'], cl_ind=cl_ind)
                     y_pot_zj[a_idx, t_idx, o_idx] = ret[0]
                     y_pot_var_zj[a_idx, t_idx, o_idx] = ret[1]
                     if int_dic['with_output']:
@@ -794,7 +760,7 @@ def gate_zj_mp(z_val, zj_idx, y_dat, cl_dat, w_dat, z_p, d_p, w_p,
                             w_diff, y_dat[:, o_idx], cl_dat, gen_dic,
                             p_dic, norm=False, weights=w_dat,
                             bootstrap=p_dic['se_boot_gate'],
-                            keep_all=int_dic['keep_w0'])
+                            keep_all=int_dic['keep_w0'], cl_ind=cl_ind)
                         y_pot_mate_zj[a_idx, t_idx, o_idx] = ret2[0]
                         y_pot_mate_var_zj[a_idx, t_idx, o_idx] = ret2[1]
     if w_gate_zj.nbytes > 1e+9 and int_dic['ray_or_dask'] != 'ray':
@@ -811,6 +777,128 @@ def gate_zj_mp(z_val, zj_idx, y_dat, cl_dat, w_dat, z_p, d_p, w_p,
             save_name_wunc)
 
 
+def aggregate_w_gate_zj(z_val, z_p, d_p, w_p, w_dat, z_name_j, weights_all,
+                        w_gate_zj, w_gate0_dim, d_values, i_d_val, t_probs,
+                        gen_dic, int_dic, p_dic, bandw_z, kernel,
+                        smooth_it=False):
+    """Aggregate weights of observations with particular z-value."""
+    weights, relevant_z, w_z_val = get_w_rel_z(
+        z_p[:, z_name_j], z_val, weights_all, smooth_it, bandwidth=bandw_z,
+        kernel=kernel, w_is_csr=int_dic['weight_as_sparse'])
+    if p_dic['gatet']:
+        d_p_z = d_p[relevant_z]
+    if gen_dic['weighted']:
+        w_p_z = w_p[relevant_z]
+    n_x = weights[0].shape[0] if int_dic['weight_as_sparse'] else len(weights)
+    for n_idx in range(n_x):
+        w_gadd = np.zeros(w_gate0_dim)
+        for t_idx, _ in enumerate(d_values):
+            if int_dic['weight_as_sparse']:
+                weight_i = weights[t_idx].getrow(n_idx)
+                w_index = weight_i.indices
+                w_i = weight_i.data.copy()
+            else:
+                w_index = weights[n_idx][t_idx][0].copy()  # Ind weights>0
+                w_i = weights[n_idx][t_idx][1].copy()
+            if gen_dic['weighted']:
+                w_i = w_i * w_dat[w_index].reshape(-1)
+            w_i_sum = np.sum(w_i)
+            if not 1-1e-10 < w_i_sum < 1+1e-10:
+                w_i = w_i / w_i_sum
+            if gen_dic['weighted']:
+                w_i = w_i * w_p_z[n_idx]
+            if smooth_it:
+                w_i = w_i * w_z_val[n_idx]
+            if p_dic['choice_based_sampling']:
+                i_pos = i_d_val[d_p[n_idx] == d_values]
+                w_gadd[t_idx, w_index] = w_i * t_probs[int(i_pos)]
+            else:
+                w_gadd[t_idx, w_index] = w_i.copy()
+        w_gate_zj[0, :, :] += w_gadd
+        if p_dic['gatet']:
+            t_pos_i = i_d_val[d_p_z[n_idx] == d_values]
+            w_gate_zj[t_pos_i+1, :, :] += w_gadd
+    return w_gate_zj
+
+
+def gate_weights_sparse(z_dat, z_values, weights_all, d_p, w_p, w_dat,
+                        t_probs, no_of_tgates, d_values, gen_dic, p_dic,
+                        smooth_it=False, bandwidth=1, kernel=1):
+    """Aggregate sparse weights for all values of z, one z-value at a time.
+
+    The (kernel) weights of the prediction observations for each z-value
+    (and treatment group for GATETs) form a sparse group matrix. The weights
+    are rescaled once per treatment. The aggregated weights of each z-value
+    are then obtained by a sparse matrix product of its group matrix with
+    the rescaled weights (only rows of observations relevant for this
+    z-value are used).
+
+    Parameters
+    ----------
+    z_dat : 1D Numpy array. Heterogeneity variable of prediction data.
+    z_values : List. Evaluation points.
+    weights_all : Tuple of scipy.sparse.csr_matrix (N_pred x N_y) or weight
+        store. Weights. A store is aggregated chunk by chunk.
+    d_p : Numpy array or None. Treatment of prediction observations.
+    w_p : Numpy array or None. Sampling weights of prediction observations.
+    w_dat : Numpy array or None. Sampling weights of training observations.
+    t_probs : List or None. Choice based sampling probabilities.
+    no_of_tgates : Int. Number of GATE types (GATE, GATETs).
+    d_values : List. Treatment values.
+    gen_dic, p_dic : Dict. Parameters.
+    smooth_it : Bool. Use kernel smoothing. Default is False.
+    bandwidth : Float. Bandwidth for kernel. Default is 1.
+    kernel : Int. 1: Epanechikov. 2: Normal. Default is 1.
+
+    Returns
+    -------
+    w_gate : List of Numpy arrays (no_of_tgates x no_of_treat x N_y), one
+        for each z-value. Aggregated (not yet normalized) weights.
+
+    """
+    no_of_treat = len(d_values)
+    n_p, n_y = mcf_ws.weights_shape(weights_all)
+    d_pos = mcf_ate.treat_position(d_p, d_values)
+    groups = []
+    for z_val in z_values:
+        if smooth_it:
+            w_z_val = mcf_est.kernel_proc((z_dat - z_val) / bandwidth, kernel)
+            relevant_z = w_z_val > 1e-10
+            w_z_val = w_z_val[relevant_z]
+            w_z_val = w_z_val / np.sum(w_z_val) * len(w_z_val)  # Normalise
+        else:
+            relevant_z = np.isclose(z_dat, z_val)
+            w_z_val = np.ones(np.sum(relevant_z))
+        obs_z = np.flatnonzero(relevant_z)
+        rows = [np.zeros(len(obs_z), dtype=np.int64)]
+        cols, values = [obs_z], [w_z_val]
+        if p_dic['gatet']:
+            rows.append(d_pos[obs_z] + 1)
+            cols.append(obs_z)
+            values.append(w_z_val)
+        groups.append(sparse.csr_matrix(
+            (np.concatenate(values),
+             (np.concatenate(rows), np.concatenate(cols))),
+            shape=(no_of_tgates, n_p)))
+    w_gate = [np.zeros((no_of_tgates, no_of_treat, n_y)) for _ in z_values]
+    for start, weights_block in mcf_ws.weight_blocks(weights_all):
+        rows = slice(start, start + weights_block[0].shape[0])
+        groups_block = [(w_gate_z, group[:, rows])
+                        for w_gate_z, group in zip(w_gate, groups)]
+        groups_block = [(w_gate_z, group_rows)
+                        for w_gate_z, group_rows in groups_block
+                        if group_rows.nnz > 0]
+        for t_idx in range(no_of_treat):
+            weights_t, _, row_mult = mcf_ate.sparse_weights_row_scaling(
+                weights_block[t_idx], None if d_pos is None else d_pos[rows],
+                None if w_p is None else w_p[rows], w_dat, t_probs, gen_dic,
+                p_dic)
+            weights_t = (sparse.diags(row_mult) @ weights_t).tocsr()
+            for w_gate_z, group_rows in groups_block:
+                w_gate_z[:, t_idx, :] += (group_rows @ weights_t).toarray()
+    return w_gate
+
+
 def get_w_rel_z(z_dat, z_val, weights_all, smooth_it, bandwidth=1, kernel=1,
                 w_is_csr=False):
     """
@@ -419,6 +419,62 @@ def primes_reverse(number, int_type=True):
     return list_of_primes
 
 
+def primes_to_bitset(primes_in):
+    """Encode a set of primes as bitset of their positions in primes_list.
+
+    Parameters
+    ----------
+    primes_in : List of INT. Primes (recoded values of categorical variable).
+
+    Returns
+    -------
+    bitset : 1D Numpy array of uint64. Bit k is set if k-th prime is included.
+
+    """
+    positions = primeposition(list(primes_in), start_with_1=False)
+    bitset = np.zeros(max(positions) // 64 + 1, dtype=np.uint64)
+    for pos in positions:
+        bitset[pos // 64] |= np.uint64(1) << np.uint64(pos % 64)
+    return bitset
+
+
+def bitset_to_primes(bitset):
+    """Decode a bitset of prime positions (inverse of primes_to_bitset).
+
+    Parameters
+    ----------
+    bitset : 1D Numpy array of uint64.
+
+    Returns
+    -------
+    primes_out : List of INT. Primes included in bitset.
+
+    """
+    primes = primes_list(1000)
+    primes_out = []
+    for word_idx, word in enumerate(bitset):
+        word = int(word)
+        for bit in range(64):
+            if word >> bit & 1:
+                primes_out.append(primes[word_idx * 64 + bit])
+    return primes_out
+
+
+@memoize
+def prime_position_table():
+    """Give position of prime in primes_list (-1 if not a prime).
+
+    Returns
+    -------
+    table : 1D Numpy array of int64. table[prime] is position of prime.
+
+    """
+    primes = primes_list(1000)
+    table = -np.ones(primes[-1] + 1, dtype=np.int64)
+    table[list(primes)] = np.arange(len(primes))
+    return table
+
+
 def check_if_not_number(data_df, variable):
     """Check if elements in column of pandas dataframe are not a number.
 
@@ -550,3 +606,35 @@ def include_org_variables(names, names_in_data):
                     if name[:-6] not in names:
                         new_names.append(name[:-6])
     return new_names
+
+
+def check_reduce_dataframe(data_df, title='', max_obs=100000000, seed=124535,
+                           ignore_index=True):
+    """Randomly reduce dataframe to a certain number of observations.
+
+    Parameters
+    ----------
+    data_df : Dataframe. Data to reduce.
+    title : String, optional. Used in text returned. The default is ''.
+    max_obs : Integer, optional. Maximum number of observations.
+              The default is 100000000.
+    seed : Integer, optional. Seed of random sampling. The default is 124535.
+    ignore_index : Boolean, optional. Reset index of reduced data.
+              The default is True.
+
+    Returns
+    -------
+    data_df : Dataframe. (Possibly) reduced data.
+    reduce : Boolean. True if data was reduced.
+    txt : String. Information about reduction.
+
+    """
+    total_obs = len(data_df)
+    if reduce := total_obs > max_obs:
+        data_df = data_df.sample(n=max_obs, random_state=seed, replace=False,
+                                 ignore_index=ignore_index)
+        txt = (f'\n{title}: Sample randomly reduced from {total_obs} to '
+               f'{max_obs} observations.')
+    else:
+        txt = ''
+    return data_df, reduce, txt
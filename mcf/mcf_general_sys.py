@@ -14,7 +14,9 @@ from pathlib import Path
 import pickle
 import sys
 
+import numpy as np
 import psutil
+from scipy import sparse
 
 
 def delete_file_if_exists(file_name):
@@ -76,58 +78,131 @@ def get_fig_path(dic_to_update, outpath, add_name, create_dir, no_csv=False):
     return dic_to_update
 
 
-def find_no_of_workers(maxworkers, sys_share=0):
+# Assumptions of the memory scheduler (see task_memory_mb)
+MEM_WORKER_BASE_MB = 250      # Python/Ray process without task data
+MEM_TREE_COPIES = 4           # Copies of (bootstrap) data when building trees
+MEM_BYTES_PER_NNZ = 48        # Sparse weight entry incl. intermediate copies
+MEM_DEFAULT_SHARE = 0.75      # Default budget: share of available RAM
+
+
+def memory_budget_mb(budget_mb=None, sys_share=0):
     """
-    Find the optimal number of workers for MP such that system does not crash.
+    Get memory (MB) that the estimation may use.
+
+    Parameters
+    ----------
+    budget_mb : Float or None. Memory budget of user (MB). None: Share
+                MEM_DEFAULT_SHARE of available RAM. Default is None.
+    sys_share : Float. Share of RAM reserved for the system (0-1).
+                Default is 0.
+
+    Returns
+    -------
+    budget : Float. Memory budget (MB), never larger than available RAM.
+
+    """
+    _, available, _, _, _ = memory_statistics()
+    available *= 1 - min(max(sys_share, 0), 0.9) / 2
+    if budget_mb is None or budget_mb <= 0:
+        return MEM_DEFAULT_SHARE * available
+    return min(budget_mb, available)
+
+
+def task_memory_mb(task, n_rows=0, n_cols=0, nnz=0, object_mb=0):
+    """
+    Estimate memory footprint (MB) of a single parallel task.
+
+    Parameters
+    ----------
+    task : String. 'tree': Building trees on data with n_rows and n_cols.
+           'weights': Computing weights with nnz sparse entries.
+           'iate': Block of IATEs with nnz weights and outcome data with
+           n_rows and n_cols. Other: Only object_mb.
+    n_rows, n_cols : Int. Size of data used in task. Default is 0.
+    nnz : Int. Number of non-zero sparse weights of task. Default is 0.
+    object_mb : Float. Size of additional objects of task (MB), for example
+                the trees. Default is 0.
+
+    Returns
+    -------
+    task_mb : Float. Memory of task (MB) without the worker process itself.
+
+    """
+    data_mb = n_rows * n_cols * 8 / (1024 * 1024)
+    nnz_mb = nnz * MEM_BYTES_PER_NNZ / (1024 * 1024)
+    if task == 'tree':
+        return MEM_TREE_COPIES * data_mb + object_mb
+    if task in ('weights', 'iate'):
+        return nnz_mb + data_mb + object_mb
+    return object_mb
+
+
+def find_no_of_workers(maxworkers, sys_share=0, task_mb=0, shared_mb=0,
+                       budget_mb=None):
+    """
+    Find the number of workers for MP such that the memory budget is kept.
+
+    Every worker needs MEM_WORKER_BASE_MB plus the memory of its task. Objects
+    shared by all workers (Ray object store) are counted only once.
 
     Parameters
     ----------
     maxworkers : Int. Maximum number of workers allowed.
+    sys_share: Float. Share of RAM reserved for the system. Default is 0.
+    task_mb : Float. Memory needed by a single task (MB), see task_memory_mb.
+              Default is 0.
+    shared_mb : Float. Memory of shared objects (MB). Default is 0.
+    budget_mb : Float or None. Memory budget (MB), see memory_budget_mb.
+                Default is None.
 
     Returns
     -------
     workers : Int. Workers used.
-    sys_share: Float. System share.
-    max_cores: Bool. Limit to number of physical(not logical cores)
 
     """
-    share_used = getattr(psutil.virtual_memory(), 'percent') / 100
-    if sys_share >= share_used:
-        sys_share = 0.9 * share_used
-    sys_share = sys_share / 2
-    workers = (1-sys_share) / (share_used-sys_share)
-    if workers > maxworkers:
-        workers = maxworkers
-    elif workers < 1.9:
-        workers = 1
-    else:
-        workers = maxworkers
-    workers = math.floor(workers + 1e-15)
-    return workers
+    budget = memory_budget_mb(budget_mb, sys_share) - shared_mb
+    workers = math.floor(budget / (MEM_WORKER_BASE_MB + task_mb) + 1e-15)
+    return int(min(max(workers, 1), maxworkers))
+
 
+def object_store_bytes(store_bytes, budget_mb=None, sys_share=0,
+                       max_share=0.5):
+    """Limit size of Ray object store (bytes) to share of memory budget.
 
-def no_of_boot_splits_fct(size_of_object_mb, workers):
+    Only an explicit budget (budget_mb > 0) limits the object store.
     """
-    Compute size of chunks for MP.
+    if store_bytes is None or budget_mb is None or budget_mb <= 0:
+        return store_bytes
+    return min(store_bytes, max_share * memory_budget_mb(budget_mb, sys_share)
+               * 1024 * 1024)
+
+
+def no_of_boot_splits_fct(size_of_object_mb, workers, budget_mb=None,
+                          sys_share=0):
+    """
+    Compute number of chunks of trees for MP from memory budget.
+
+    Each worker processes one chunk at a time and needs MEM_TREE_COPIES times
+    its size (chunk and intermediate results).
 
     Parameters
     ----------
     size_of_forest_MB : Float. Size of the object in MB.
     workers : Int. Number of workers in MP.
+    budget_mb : Float or None. Memory budget (MB), see memory_budget_mb.
+                Default is None.
+    sys_share: Float. Share of RAM reserved for the system. Default is 0.
 
     Returns
     -------
     no_of_splits : Int. Number of splits.
+    txt : String. Text to print.
 
     """
-    basic_size_mb = 53
-    _, available, _, _, _ = memory_statistics()
-    if size_of_object_mb > basic_size_mb:
-        multiplier = 1/8 * (14 / workers)
-        chunck_size_mb = basic_size_mb * (1 + (available - 33000) / 33000
-                                          * multiplier)
-        chunck_size_mb = min(chunck_size_mb, 2000)
-        chunck_size_mb = max(chunck_size_mb, 10)
+    budget = memory_budget_mb(budget_mb, sys_share)
+    chunck_size_mb = (budget / workers - MEM_WORKER_BASE_MB) / MEM_TREE_COPIES
+    chunck_size_mb = min(max(chunck_size_mb, 10), 2000)
+    if size_of_object_mb > chunck_size_mb:
         no_of_splits = math.ceil(size_of_object_mb / chunck_size_mb)
     else:
         no_of_splits = 1
@@ -135,15 +210,31 @@ def no_of_boot_splits_fct(size_of_object_mb, workers):
     total, available, used, free, _ = memory_statistics()
     txt = ('\nAutomatic determination of tree batches'
            f'\nSize of object:   {round(size_of_object_mb, 2):6} MB '
-           f'\nAvailable RAM: {available:6} MB '
+           f'\nMemory budget: {round(budget, 2):6} MB '
            f'\nNumber of workers {workers:2} No of splits: {no_of_splits:2}'
-           '\nSize of chunk:  {round(chunck_size_mb, 2):6} MB '
+           f'\nSize of chunk:  {round(chunck_size_mb, 2):6} MB '
            f'\nRAM total: {total:6} MB,  used: {used:6} MB, '
            f'available: {available:6} MB, free: {free:6} MB'
            )
     return no_of_splits, txt
 
 
+def max_nnz_in_budget(workers, in_flight=1, budget_mb=None, sys_share=0,
+                      min_nnz=2**20, max_nnz=2**28):
+    """Get number of sparse weights a task may hold (memory budget)."""
+    budget = memory_budget_mb(budget_mb, sys_share)
+    task_mb = budget / (workers * in_flight) - MEM_WORKER_BASE_MB
+    nnz = int(task_mb * 1024 * 1024 / MEM_BYTES_PER_NNZ)
+    return min(max(nnz, min_nnz), max_nnz)
+
+
+def max_rows_in_budget(n_cols, workers=1, budget_mb=None, sys_share=0):
+    """Get number of rows of training data a tree-building task may hold."""
+    budget = memory_budget_mb(budget_mb, sys_share)
+    task_mb = budget / workers - MEM_WORKER_BASE_MB
+    return int(task_mb * 1024 * 1024 / (MEM_TREE_COPIES * 8 * max(n_cols, 1)))
+
+
 def total_size(ooo, handlers=None, verbose=False):
     """Return the approximate memory footprint an object & all of its contents.
 
@@ -179,6 +270,10 @@ def total_size(ooo, handlers=None, verbose=False):
             return 0
         seen.add(id(ooo))
         sss = sys.getsizeof(ooo, default_size)
+        if sparse.issparse(ooo):  # Arrays are not part of getsizeof
+            sss += sum(getattr(ooo, name).nbytes
+                       for name in ('data', 'indices', 'indptr', 'row', 'col')
+                       if isinstance(getattr(ooo, name, None), np.ndarray))
 
         if verbose:
             print(sss, type(ooo), repr(ooo), file=sys.stderr)
@@ -246,12 +341,16 @@ def print_size_weight_matrix(weights, weight_as_sparse, no_of_treat):
 
     """
     total_bytes = total_size(weights)
-    if weight_as_sparse:
-        for d_idx in range(no_of_treat):
-            total_bytes += (weights[d_idx].data.nbytes
-                            + weights[d_idx].indices.nbytes
-                            + weights[d_idx].indptr.nbytes)
-    return f'Size of weight matrix: {round(total_bytes / (1024 * 1024), 2)} MB'
+    txt = f'Size of weight matrix: {round(total_bytes / (1024 * 1024), 2)} MB'
+    if weight_as_sparse:    # Gain of storing data and indices with less bits
+        bytes_64 = total_bytes
+        for weights_d in weights[:no_of_treat]:
+            bytes_64 += (16 * weights_d.nnz + 8 * len(weights_d.indptr)
+                         - weights_d.data.nbytes - weights_d.indices.nbytes
+                         - weights_d.indptr.nbytes)
+        txt += (' (with 64 bit storage: '
+                f'{round(bytes_64 / (1024 * 1024), 2)} MB)')
+    return txt
 
 
 def save_load(file_name, object_to_save=None, save=True, output=True):
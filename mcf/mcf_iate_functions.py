@@ -8,14 +8,22 @@ Contains the functions needed for computing the IATE.
 @author: MLechner
 -*- coding: utf-8 -*-
 """
+from itertools import islice
+
 import numpy as np
+from numba import njit
 import pandas as pd
 import ray
+from scipy.sparse import csr_matrix
 
 from mcf import mcf_estimation_functions as mcf_est
 from mcf import mcf_general as mcf_gp
 from mcf import mcf_general_sys as mcf_sys
 from mcf import mcf_print_stats_functions as ps
+from mcf import mcf_ray_pool_functions as mcf_pool
+from mcf import mcf_weight_store_functions as mcf_ws
+
+MAX_NNZ_BLOCK = 2_000_000   # Upper limit of sparse weights in IATE block
 
 
 def iate_est_mp(mcf_, weights_dic, w_ate, reg_round=True):
@@ -58,11 +66,11 @@ def iate_est_mp(mcf_, weights_dic, w_ate, reg_round=True):
     weights, y_dat = weights_dic['weights'], weights_dic['y_dat_np']
     w_dat = weights_dic['w_dat_np'] if gen_dic['weighted'] else None
     if p_dic['cluster_std'] and iate_se_flag:
-        cl_dat = weights_dic['cl_dat_np']
-        no_of_cluster = len(np.unique(cl_dat))
+        cl_dat, cl_ind = weights_dic['cl_dat_np'], weights_dic['cl_ind']
     else:
-        no_of_cluster = cl_dat = None
-    n_x = weights[0].shape[0] if int_dic['weight_as_sparse'] else len(weights)
+        cl_dat = cl_ind = None
+    n_x = (mcf_ws.weights_shape(weights)[0] if int_dic['weight_as_sparse']
+           else len(weights))
     n_y, no_of_out = len(y_dat), len(var_dic['y_name'])
     if gen_dic['d_type'] == 'continuous':
         no_of_treat, d_values = ct_dic['grid_w'], ct_dic['grid_w_val']
@@ -87,28 +95,79 @@ def iate_est_mp(mcf_, weights_dic, w_ate, reg_round=True):
         w_ate = w_ate[0, :, :]
     if not p_dic['iate_m_ate']:
         w_ate = None
-    l1_to_9 = [None] * n_x
+    block_est = iate_block_possible(int_dic, gen_dic, p_dic, iate_se_flag,
+                                    se_boot_iate, iate_m_ate_flag)
+    l1_to_9 = [] if block_est else [None] * n_x
     if gen_dic['mp_parallel'] < 1.5:
         maxworkers = 1
     else:
         if gen_dic['mp_automatic']:
-            maxworkers = mcf_sys.find_no_of_workers(gen_dic['mp_parallel'],
-                                                    gen_dic['sys_share'])
+            task_mb = mcf_sys.task_memory_mb(
+                'iate', nnz=(min(mcf_ws.weights_nnz(weights), MAX_NNZ_BLOCK)
+                             if int_dic['weight_as_sparse'] else 0))
+            maxworkers = mcf_sys.find_no_of_workers(
+                gen_dic['mp_parallel'], gen_dic['sys_share'],
+                task_mb=task_mb, shared_mb=y_dat.nbytes / (1024 * 1024),
+                budget_mb=int_dic['mem_budget_mb'])
         else:
             maxworkers = gen_dic['mp_parallel']
     if int_dic['with_output'] and int_dic['verbose']:
         print('Number of parallel processes: ', maxworkers)
-    if int_dic['weight_as_sparse']:
-        iterator = len(weights)
-    if maxworkers == 1:
+    if block_est:   # Two tasks per worker are in flight (see below)
+        blocks = iate_row_blocks(
+            weights, n_x, maxworkers,
+            max_nnz_block=mcf_sys.max_nnz_in_budget(
+                maxworkers, in_flight=2, budget_mb=int_dic['mem_budget_mb'],
+                max_nnz=MAX_NNZ_BLOCK),
+            rows_block=int_dic['iate_chunk_size'])
+    if block_est and maxworkers == 1:
+        for jdx, (start, end) in enumerate(blocks):
+            ret_block = iate_block_for_mp(
+                start, mcf_ws.weight_rows(weights, start, end), w_dat, y_dat,
+                n_y, int_dic, gen_dic, p_dic, iate_se_flag)
+            pot_y, pot_y_var, share_censored = assign_ret_block(
+                pot_y, pot_y_var, l1_to_9, share_censored, ret_block, n_x)
+            if int_dic['with_output'] and int_dic['verbose']:
+                mcf_gp.share_completed(jdx+1, len(blocks))
+    elif block_est:
+        if int_dic['with_output'] and int_dic['verbose']:
+            print('IATE-1: Avg. number of obs per block:',
+                  f'{n_x / len(blocks):5.2f}.',
+                  ' Number of blocks: ', len(blocks))
+        mcf_pool.start_worker_pool(mcf_, maxworkers,
+                                   int_dic['mem_object_store_3'])
+        y_dat_ref = mcf_pool.put_shared(mcf_, 'iate_y_dat', y_dat)
+        w_dat_ref = (None if w_dat is None
+                     else mcf_pool.put_shared(mcf_, 'iate_w_dat', w_dat))
+        tasks = (ray_iate_block_for_mp.remote(
+            start, mcf_ws.weight_rows(weights, start, end), w_dat_ref,
+            y_dat_ref, n_y, int_dic, gen_dic, p_dic, iate_se_flag)
+            for start, end in blocks)
+        still_running, jdx = [], 0
+        while True:
+            # Limited number of blocks in flight: weights of all blocks are
+            # never in memory at the same time.
+            still_running += islice(tasks, 2 * maxworkers - len(still_running))
+            if not still_running:
+                break
+            finished, still_running = ray.wait(still_running)
+            finished_res = ray.get(finished)
+            for ret_block in finished_res:
+                pot_y, pot_y_var, share_censored = assign_ret_block(
+                    pot_y, pot_y_var, l1_to_9, share_censored, ret_block, n_x)
+                if int_dic['with_output'] and int_dic['verbose']:
+                    mcf_gp.share_completed(jdx+1, len(blocks))
+                jdx += 1
+        if 'rest' in int_dic['mp_ray_del']:
+            del finished_res, finished
+    elif maxworkers == 1:
         for idx in range(n_x):
             if int_dic['weight_as_sparse']:
-                weights_idx = [weights[t_idx].getrow(idx) for
-                               t_idx in range(iterator)]
+                weights_idx = mcf_ws.weight_rows(weights, idx, idx+1)
             else:
                 weights_idx = weights[idx]
             ret_all_i = iate_func1_for_mp(
-                idx, weights_idx, cl_dat, no_of_cluster, w_dat, w_ate, y_dat,
+                idx, weights_idx, cl_dat, cl_ind, w_dat, w_ate, y_dat,
                 no_of_out, n_y, ct_dic, int_dic, gen_dic, p_dic,
                 iate_se_flag, se_boot_iate, iate_m_ate_flag)
             (pot_y, pot_y_var, pot_y_m_ate, pot_y_m_ate_var, l1_to_9,
@@ -118,40 +177,38 @@ def iate_est_mp(mcf_, weights_dic, w_ate, reg_round=True):
             if int_dic['with_output'] and int_dic['verbose']:
                 mcf_gp.share_completed(idx+1, n_x)
     else:
-        rows_per_split = 1e9    # Just a large number; feature is not used
+        rows_per_split = (1e9 if int_dic['iate_chunk_size'] is None
+                          else int_dic['iate_chunk_size'])
         no_of_splits = round(n_x / rows_per_split)
+        if mcf_ws.is_weight_store(weights):   # At least one split per chunk
+            no_of_splits = max(no_of_splits, len(weights['files']))
         no_of_splits = min(max(no_of_splits, maxworkers), n_x)
         if int_dic['with_output'] and int_dic['verbose']:
             print('IATE-1: Avg. number of obs per split:',
                   f'{n_x / no_of_splits:5.2f}.',
                   ' Number of splits: ', no_of_splits)
         obs_idx_list = np.array_split(np.arange(n_x), no_of_splits)
-        if int_dic['mem_object_store_3'] is None:
-            if not ray.is_initialized():
-                ray.init(num_cpus=maxworkers, include_dashboard=False)
-        else:
-            if not ray.is_initialized():
-                ray.init(num_cpus=maxworkers, include_dashboard=False,
-                         object_store_memory=int_dic['mem_object_store_3'])
-            if int_dic['with_output'] and int_dic['verbose']:
-                print("Size of Ray Object Store: ", round(
-                    int_dic['mem_object_store_3']/(1024*1024)), ' MB')
+        mcf_pool.start_worker_pool(mcf_, maxworkers,
+                                   int_dic['mem_object_store_3'])
         if int_dic['weight_as_sparse']:
-            still_running = [ray_iate_func1_for_mp_many_obs.remote(
-                idx, [weights[t_idx][idx, :] for t_idx in range(iterator)],
-                cl_dat, no_of_cluster, w_dat, w_ate, y_dat, no_of_out, n_y,
+            tasks = (ray_iate_func1_for_mp_many_obs.remote(
+                idx, mcf_ws.weight_rows(weights, idx[0], idx[-1]+1),
+                cl_dat, cl_ind, w_dat, w_ate, y_dat, no_of_out, n_y,
                 ct_dic, int_dic, gen_dic, p_dic, iate_se_flag, se_boot_iate,
-                iate_m_ate_flag) for idx in obs_idx_list]
+                iate_m_ate_flag) for idx in obs_idx_list)
             if int_dic['with_output'] and int_dic['verbose']:
                 warn_text_to_console()
         else:
-            still_running = [ray_iate_func1_for_mp_many_obs.remote(
+            tasks = (ray_iate_func1_for_mp_many_obs.remote(
                 idx, [weights[idxx] for idxx in idx], cl_dat,
-                no_of_cluster, w_dat, w_ate, y_dat, no_of_out, n_y,
+                cl_ind, w_dat, w_ate, y_dat, no_of_out, n_y,
                 ct_dic, int_dic, gen_dic, p_dic, iate_se_flag,
-                se_boot_iate, iate_m_ate_flag) for idx in obs_idx_list]
-        jdx = 0
-        while len(still_running) > 0:
+                se_boot_iate, iate_m_ate_flag) for idx in obs_idx_list)
+        still_running, jdx = [], 0
+        while True:
+            still_running += islice(tasks, 2 * maxworkers - len(still_running))
+            if not still_running:
+                break
             finished, still_running = ray.wait(still_running)
             finished_res = ray.get(finished)
             for ret_all_i_list in finished_res:
@@ -165,19 +222,17 @@ def iate_est_mp(mcf_, weights_dic, w_ate, reg_round=True):
                 jdx += 1
         if 'rest' in int_dic['mp_ray_del']:
             del finished_res, finished
-        if int_dic['mp_ray_shutdown']:
-            ray.shutdown()
     if reg_round:
-        for idx in range(n_x):
-            larger_0 += l1_to_9[idx][0]
-            equal_0 += l1_to_9[idx][1]
-            mean_pos += l1_to_9[idx][2]
-            std_pos += l1_to_9[idx][3]
-            gini_all += l1_to_9[idx][4]
-            gini_pos += l1_to_9[idx][5]
-            share_largest_q += l1_to_9[idx][6]
-            sum_larger += l1_to_9[idx][7]
-            obs_larger += l1_to_9[idx][8]
+        for l1_9 in l1_to_9:    # One entry per row or per block of rows
+            larger_0 += l1_9[0]
+            equal_0 += l1_9[1]
+            mean_pos += l1_9[2]
+            std_pos += l1_9[3]
+            gini_all += l1_9[4]
+            gini_pos += l1_9[5]
+            share_largest_q += l1_9[6]
+            sum_larger += l1_9[7]
+            obs_larger += l1_9[8]
         if int_dic['with_output']:
             txt = '\n' + '=' * 100
             txt += ('\nAnalysis of weights (normalised to add to 1) of IATE'
@@ -235,8 +290,9 @@ def iate_effects_print(mcf_, effect_dic, effect_m_ate_dic, effect_eff_dic,
         maxworkers = 1
     else:
         if gen_dic['mp_automatic']:
-            maxworkers = mcf_sys.find_no_of_workers(gen_dic['mp_parallel'],
-                                                    gen_dic['sys_share'])
+            maxworkers = mcf_sys.find_no_of_workers(
+                gen_dic['mp_parallel'], gen_dic['sys_share'],
+                budget_mb=int_dic['mem_budget_mb'])
         else:
             maxworkers = gen_dic['mp_parallel']
     if int_dic['with_output'] and int_dic['verbose']:
@@ -277,16 +333,8 @@ def iate_effects_print(mcf_, effect_dic, effect_m_ate_dic, effect_eff_dic,
                 iate_eff[idx, :, :, :] = ret_all_idx[1]
     else:
         if int_dic['ray_or_dask'] == 'ray':
-            if int_dic['mem_object_store_3'] is None:
-                if not ray.is_initialized():
-                    ray.init(num_cpus=maxworkers, include_dashboard=False)
-            else:
-                if not ray.is_initialized():
-                    ray.init(num_cpus=maxworkers, include_dashboard=False,
-                             object_store_memory=int_dic['mem_object_store_3'])
-                if int_dic['with_output'] and int_dic['verbose']:
-                    print("Size of Ray Object Store: ", round(
-                        int_dic['mem_object_store_3']/(1024*1024)), " MB")
+            mcf_pool.start_worker_pool(mcf_, maxworkers,
+                                       int_dic['mem_object_store_3'])
             if p_dic['iate_se'] and p_dic['iate_m_ate']:
                 still_running = [ray_iate_func2_for_mp.remote(
                     idx, no_of_out, y_pot[idx], y_pot_var[idx],
@@ -340,8 +388,6 @@ def iate_effects_print(mcf_, effect_dic, effect_m_ate_dic, effect_eff_dic,
                         jdx += 1
             if 'rest' in int_dic['mp_ray_del']:
                 del finished_res, finished
-            if int_dic['mp_ray_shutdown']:
-                ray.shutdown()
     if int_dic['with_output']:
         txt = ps.print_iate(iate, iate_se, iate_p, effect_list, gen_dic, p_dic,
                             var_dic)
@@ -516,16 +562,16 @@ def iate_effects_print(mcf_, effect_dic, effect_m_ate_dic, effect_eff_dic,
 
 
 @ray.remote
-def ray_iate_func1_for_mp(idx, weights_i, cl_dat, no_of_cluster, w_dat, w_ate,
+def ray_iate_func1_for_mp(idx, weights_i, cl_dat, cl_ind, w_dat, w_ate,
                           y_dat, no_of_out, n_y, ct_dic, int_dic, gen_dic,
                           p_dic, iate_se_flag, se_boot_iate):
     """Make function useful for Ray."""
-    return iate_func1_for_mp(idx, weights_i, cl_dat, no_of_cluster, w_dat,
+    return iate_func1_for_mp(idx, weights_i, cl_dat, cl_ind, w_dat,
                              w_ate, y_dat, no_of_out, n_y, ct_dic, int_dic,
                              gen_dic, p_dic, iate_se_flag, se_boot_iate)
 
 
-def iate_func1_for_mp(idx, weights_i, cl_dat, no_of_cluster, w_dat, w_ate,
+def iate_func1_for_mp(idx, weights_i, cl_dat, cl_ind, w_dat, w_ate,
                       y_dat, no_of_out, n_y, ct_dic, int_dic, gen_dic, p_dic,
                       iate_se_flag, se_boot_iate, iate_m_ate_flag):
     """
@@ -537,7 +583,7 @@ def iate_func1_for_mp(idx, weights_i, cl_dat, no_of_cluster, w_dat, w_ate,
     weights_i : List of int. Indices of non-zero weights.
                 Alternative: Sparse csr matrix
     cl_dat : Numpy vector. Cluster variable.
-    no_of_cluster : Int. Number of clusters.
+    cl_ind : Sparse csr matrix. Cluster-indicator matrix of cl_dat.
     w_dat : Numpy vector. Sampling weights.
     w_ate : Numpy array. Weights for ATE.
     y_dat : Numpy array. Outcome variable.
@@ -586,7 +632,7 @@ def iate_func1_for_mp(idx, weights_i, cl_dat, no_of_cluster, w_dat, w_ate,
     else:
         pot_y_var_i = pot_y_m_ate_var_i = None
         cluster_std = False
-    w_add = (np.zeros((no_of_treat_dr, no_of_cluster)) if cluster_std
+    w_add = (np.zeros((no_of_treat_dr, cl_ind.shape[0])) if cluster_std
              else np.zeros((no_of_treat_dr, n_y)))
     w_add_unc = np.zeros((no_of_treat_dr, n_y))
     for t_idx in range(no_of_treat):
@@ -677,7 +723,8 @@ def iate_func1_for_mp(idx, weights_i, cl_dat, no_of_cluster, w_dat, w_ate,
                         w_cont = (w10 * w_all_i + w01 * w_all_i_p1
                                   if extra_weight_p1 else w_all_i)
                         ret2 = mcf_est.aggregate_cluster_pos_w(
-                            cl_dat, w_cont, y_dat[:, o_idx], sweights=w_dat)
+                            cl_dat, w_cont, y_dat[:, o_idx], sweights=w_dat,
+                            cl_ind=cl_ind)
                         if o_idx == 0:
                             w_add[ti_idx, :] = np.copy(ret2[0])
                             if w_ate is None:
@@ -696,7 +743,7 @@ def iate_func1_for_mp(idx, weights_i, cl_dat, no_of_cluster, w_dat, w_ate,
                                 w_diff, y_dat[:, o_idx], cl_dat, gen_dic,
                                 p_dic, norm=False, weights=w_dat,
                                 bootstrap=se_boot_iate, se_yes=iate_se_flag,
-                                keep_all=int_dic['keep_w0'])
+                                keep_all=int_dic['keep_w0'], cl_ind=cl_ind)
                     else:
                         if o_idx == 0:
                             w_add[ti_idx, w_index_both] = ret[2]
@@ -739,7 +786,8 @@ def iate_func1_for_mp(idx, weights_i, cl_dat, no_of_cluster, w_dat, w_ate,
                     pot_y_var_i[t_idx, o_idx] = ret[1]
                 if cluster_std:
                     ret2 = mcf_est.aggregate_cluster_pos_w(
-                        cl_dat, w_all_i, y_dat[:, o_idx], sweights=w_dat)
+                        cl_dat, w_all_i, y_dat[:, o_idx], sweights=w_dat,
+                        cl_ind=cl_ind)
                     if o_idx == 0:
                         w_add[t_idx, :] = np.copy(ret2[0])
                         if w_ate is None:
@@ -750,7 +798,8 @@ def iate_func1_for_mp(idx, weights_i, cl_dat, no_of_cluster, w_dat, w_ate,
                         ret = mcf_est.weight_var(
                             w_diff, y_dat[:, o_idx], cl_dat, gen_dic, p_dic,
                             norm=False, weights=w_dat, bootstrap=se_boot_iate,
-                            se_yes=iate_se_flag, keep_all=int_dic['keep_w0'])
+                            se_yes=iate_se_flag, keep_all=int_dic['keep_w0'],
+                            cl_ind=cl_ind)
                 else:
                     if o_idx == 0:
                         w_add[t_idx, w_index] = ret[2]
@@ -799,17 +848,17 @@ def assign_ret_all_i(pot_y, pot_y_var, pot_y_m_ate, pot_y_m_ate_var, l1_to_9,
 
 @ray.remote
 def ray_iate_func1_for_mp_many_obs(
-        idx_list, weights_list, cl_dat, no_of_cluster, w_dat, w_ate, y_dat,
+        idx_list, weights_list, cl_dat, cl_ind, w_dat, w_ate, y_dat,
         no_of_out, n_y, ct_dic, int_dic, gen_dic, p_dic, iate_se_flag,
         se_boot_iate, iate_m_ate_flag):
     """Compute IATE for several obs in one loop (MP)."""
     return iate_func1_for_mp_many_obs(
-        idx_list, weights_list, cl_dat, no_of_cluster, w_dat, w_ate, y_dat,
+        idx_list, weights_list, cl_dat, cl_ind, w_dat, w_ate, y_dat,
         no_of_out, n_y, ct_dic, int_dic, gen_dic, p_dic, iate_se_flag,
         se_boot_iate, iate_m_ate_flag)
 
 
-def iate_func1_for_mp_many_obs(idx_list, weights_list, cl_dat, no_of_cluster,
+def iate_func1_for_mp_many_obs(idx_list, weights_list, cl_dat, cl_ind,
                                w_dat, w_ate, y_dat, no_of_out, n_y, ct_dic,
                                int_dic, gen_dic, p_dic, iate_se_flag,
                                se_boot_iate, iate_m_ate_flag):
@@ -823,7 +872,7 @@ def iate_func1_for_mp_many_obs(idx_list, weights_list, cl_dat, no_of_cluster,
                          for t_idx in range(iterator)]
         else:
             weights_i = weights_list[i]
-        ret = iate_func1_for_mp(idx_org, weights_i, cl_dat, no_of_cluster,
+        ret = iate_func1_for_mp(idx_org, weights_i, cl_dat, cl_ind,
                                 w_dat, w_ate, y_dat, no_of_out, n_y, ct_dic,
                                 int_dic, gen_dic, p_dic, iate_se_flag,
                                 se_boot_iate, iate_m_ate_flag)
@@ -831,6 +880,320 @@ def iate_func1_for_mp_many_obs(idx_list, weights_list, cl_dat, no_of_cluster,
     return ret_all
 
 
+def iate_block_possible(int_dic, gen_dic, p_dic, iate_se_flag, se_boot_iate,
+                        iate_m_ate_flag):
+    """Check if IATEs can be computed block-wise from sparse weights.
+
+    Continuous treatments, IATE-ATE, clustered and bootstrapped standard
+    errors, and the Nadaraya-Watson estimator of the conditional variance
+    are only available in the row-wise version (iate_func1_for_mp).
+    """
+    if (not int_dic['weight_as_sparse'] or gen_dic['d_type'] == 'continuous'
+            or iate_m_ate_flag):
+        return False
+    if iate_se_flag:
+        return not (p_dic['cluster_std'] or se_boot_iate
+                    or (p_dic['cond_var'] and not p_dic['knn']))
+    return True
+
+
+def iate_row_blocks(weights, n_x, maxworkers, max_nnz_block=MAX_NNZ_BLOCK,
+                    rows_block=None):
+    """Split rows of sparse weight matrices into contiguous blocks.
+
+    Parameters
+    ----------
+    weights : List of sparse csr matrices (one per treatment) or weight store.
+              Weights.
+    n_x : Int. Number of rows.
+    maxworkers : Int. Number of parallel processes.
+    max_nnz_block : Int. Approximate number of non-zero weights of all
+                    treatments in a block. Default is MAX_NNZ_BLOCK.
+    rows_block : Int or None. Number of rows in a block. None: Determined by
+                 max_nnz_block. Default is None.
+
+    Returns
+    -------
+    blocks : List of tuples of Int. First and last (excl.) row of blocks.
+
+    """
+    if rows_block is None:
+        nnz_row = max(mcf_ws.weights_nnz(weights) / n_x, 1)
+        rows_block = max(int(max_nnz_block / nnz_row), 1)
+    if maxworkers > 1:   # At least one block for each process
+        rows_block = min(rows_block, int(np.ceil(n_x / maxworkers)))
+    return [(start, min(start + rows_block, n_x))
+            for start in range(0, n_x, rows_block)]
+
+
+def assign_ret_block(pot_y, pot_y_var, l1_to_9, share_censored, ret_block,
+                     n_x):
+    """Assign results of iate_block_for_mp (l1_to_9 is appended in place)."""
+    start, pot_y_b, pot_y_var_b = ret_block[0], ret_block[1], ret_block[2]
+    pot_y[start:start+len(pot_y_b), :, :] = pot_y_b
+    if pot_y_var is not None:
+        pot_y_var[start:start+len(pot_y_b), :, :] = pot_y_var_b
+    l1_to_9.append(ret_block[3])
+    share_censored += ret_block[4] / n_x
+    return pot_y, pot_y_var, share_censored
+
+
+@ray.remote
+def ray_iate_block_for_mp(start, weights_block, w_dat, y_dat, n_y, int_dic,
+                          gen_dic, p_dic, iate_se_flag):
+    """Make function compatible with Ray."""
+    return iate_block_for_mp(start, weights_block, w_dat, y_dat, n_y, int_dic,
+                             gen_dic, p_dic, iate_se_flag)
+
+
+def iate_block_for_mp(start, weights_block, w_dat, y_dat, n_y, int_dic,
+                      gen_dic, p_dic, iate_se_flag):
+    """
+    Compute potential outcomes for a block of rows of sparse weights.
+
+    Gives the same results as iate_func1_for_mp for discrete treatments (up
+    to rounding). The weights are normalised and bounded directly in the csr
+    data arrays. The potential outcomes of all rows of the block are obtained
+    by one sparse-dense product per treatment, variances and weight
+    statistics by numba kernels looping over the non-zero weights of the
+    rows only.
+
+    Parameters
+    ----------
+    start : Int. First row of block.
+    weights_block : List of sparse csr matrices. Rows of weights of block.
+    w_dat : Numpy array. Sampling weights (None if unweighted).
+    y_dat : Numpy array. Outcome variables.
+    n_y : Int. Length of outcome data.
+    int_dic, gen_dic, p_dic : Dict. Parameters.
+    iate_se_flag : Boolean. Compute variance of potential outcomes.
+
+    Returns
+    -------
+    start : Int. First row of block.
+    pot_y_b : Numpy array. Potential outcomes (rows x treatment x outcome).
+    pot_y_var_b : Numpy array. Variances (None if iate_se_flag is False).
+    l1_to_9 : Tuple. Weight statistics, summed over rows of block.
+    share_censored : Numpy array. Share of censored weights, summed over rows.
+
+    """
+    no_of_treat = gen_dic['no_of_treat']
+    n_rows, no_of_out = weights_block[0].shape[0], y_dat.shape[1]
+    pot_y_b = np.empty((n_rows, no_of_treat, no_of_out))
+    pot_y_var_b = np.empty_like(pot_y_b) if iate_se_flag else None
+    share_censored = np.zeros(no_of_treat)
+    q_w = np.array(p_dic['q_w'], dtype=np.float64)
+    stats = np.empty((no_of_treat, n_rows, 6))
+    largest_q = np.empty((no_of_treat, n_rows, 3))
+    sum_larger = np.empty((no_of_treat, n_rows, len(q_w)))
+    obs_larger = np.empty_like(sum_larger)
+    few_pos = np.empty((no_of_treat, n_rows), dtype=np.bool_)
+    for t_idx, weights_t in enumerate(weights_block):
+        indptr, indices = weights_t.indptr, weights_t.indices
+        w_data = weights_t.data.astype(np.float64)    # Copy
+        if gen_dic['weighted']:
+            w_data *= w_dat.reshape(-1)[indices]
+        share_t = iate_block_weights_numba(indptr, w_data,
+                                           p_dic['max_weight_share'])
+        share_censored[t_idx] = np.sum(share_t)
+        if int_dic['keep_w0']:
+            n_used = np.diff(indptr)
+        else:
+            used_cum = np.concatenate(
+                ([0], np.cumsum(np.abs(w_data) > 1e-15)))
+            n_used = used_cum[indptr[1:]] - used_cum[indptr[:-1]]
+        w_mat = csr_matrix((w_data, indices, indptr), shape=(n_rows, n_y))
+        pot_y_t = w_mat @ y_dat
+        pot_y_t[n_used < 5, :] = 0    # Same as weight_var
+        pot_y_b[:, t_idx, :] = pot_y_t
+        if iate_se_flag:
+            pot_y_var_b[:, t_idx, :] = iate_block_var_numba(
+                indptr, indices, w_data, y_dat, int_dic['keep_w0'],
+                p_dic['cond_var'], float(p_dic['knn_const']),
+                int(p_dic['knn_min_k']))
+        (stats[t_idx], largest_q[t_idx], sum_larger[t_idx],
+         obs_larger[t_idx], few_pos[t_idx]) = weight_stats_rows_numba(
+             indptr, w_data, n_y, q_w)
+    # analyse_weights resets the quantile based statistics of all treatments
+    # up to the last treatment with less than 6 positive weights.
+    for t_idx in range(no_of_treat):
+        reset = np.any(few_pos[t_idx:], axis=0)
+        largest_q[t_idx, reset, :] = 0
+        sum_larger[t_idx, reset, :] = 0
+        obs_larger[t_idx, reset, :] = 0
+    stats_sum = np.sum(stats, axis=1)
+    l1_to_9 = (stats_sum[:, 0], stats_sum[:, 1], stats_sum[:, 2],
+               stats_sum[:, 3], stats_sum[:, 4], stats_sum[:, 5],
+               np.sum(largest_q, axis=1), np.sum(sum_larger, axis=1),
+               np.sum(obs_larger, axis=1))
+    return start, pot_y_b, pot_y_var_b, l1_to_9, share_censored
+
+
+@njit
+def iate_block_weights_numba(indptr, w_data, max_weight_share):
+    """Normalise and bound weights of all rows of csr data (in place).
+
+    Same steps as in iate_func1_for_mp, bound_norm_weights and weight_var.
+    Returns the share of censored weights of each row.
+    """
+    n_rows = len(indptr) - 1
+    share = np.zeros(n_rows)
+    for row in range(n_rows):
+        start, end = indptr[row], indptr[row+1]
+        if end == start:
+            continue
+        w_row = w_data[start:end]
+        w_sum = np.sum(w_row)
+        if not (1-1e-10) < w_sum < (1+1e-10) and w_sum != 0:
+            w_row /= w_sum
+        if max_weight_share < 1:
+            no_censored = 0
+            for i in range(end - start):
+                if w_row[i] + 1e-15 > max_weight_share:
+                    w_row[i] = max_weight_share
+                    no_censored += 1
+            share[row] = no_censored / (end - start)
+            w_sum = np.sum(w_row)
+            if not ((-1e-10 < w_sum < 1e-10) or (1-1e-10 < w_sum < 1+1e-10)):
+                w_row /= w_sum
+        w_sum = np.abs(np.sum(w_row))
+        if not ((w_sum < 1e-15) or (1-1e-10 < w_sum < 1+1e-10)):
+            w_row /= w_sum
+    return share
+
+
+@njit
+def iate_block_var_numba(indptr, indices, w_data, y_dat, keep_all, cond_var,
+                         knn_const, knn_min_k):
+    """Compute variance of weighted means for all rows of csr data.
+
+    Same as weight_var for the k-NN estimator of the conditional variance and
+    without conditional variance.
+    """
+    n_rows, no_of_out = len(indptr) - 1, y_dat.shape[1]
+    variance = np.ones((n_rows, no_of_out))
+    for row in range(n_rows):
+        w_row = w_data[indptr[row]:indptr[row+1]]
+        idx_row = indices[indptr[row]:indptr[row+1]]
+        if not keep_all:
+            used = np.abs(w_row) > 1e-15
+            w_row, idx_row = w_row[used], idx_row[used]
+        obs = len(w_row)
+        if obs < 5:
+            continue
+        if cond_var:
+            sort_ind = np.argsort(w_row, kind='mergesort')
+            w_row, idx_row = w_row[sort_ind], idx_row[sort_ind]
+            k = int(np.round(knn_const * np.sqrt(obs) * 2))
+            k = max(k, knn_min_k)
+            if k > obs / 2:
+                k = obs // 2
+        for o_idx in range(no_of_out):
+            y_row = y_dat[idx_row, o_idx]
+            if cond_var:
+                exp_y, var_y = moving_avg_mean_var_numba(y_row, k)
+                variance[row, o_idx] = (np.sum(w_row**2 * var_y)
+                                        + obs * np.var(w_row * exp_y))
+            else:
+                variance[row, o_idx] = obs * np.var(w_row * y_row)
+    return variance
+
+
+@njit
+def moving_avg_mean_var_numba(data, k):
+    """Compute moving average of mean and variance (see moving_avg_mean_var).
+
+    Window sums are obtained from cumulative sums of the centred data.
+    """
+    obs = len(data)
+    if k >= obs:
+        return np.full(obs, np.mean(data)), np.full(obs, np.var(data))
+    centre = np.mean(data)
+    cum, cum_s = np.zeros(obs + 1), np.zeros(obs + 1)
+    for i in range(obs):
+        data_c = data[i] - centre
+        cum[i+1], cum_s[i+1] = cum[i] + data_c, cum_s[i] + data_c**2
+    len_valid = obs - k + 1
+    add_dim_first = (obs - len_valid + 1) // 2
+    mean, var = np.empty(obs), np.empty(obs)
+    for i in range(obs):
+        j = min(max(i - add_dim_first, 0), len_valid - 1)
+        mean_c = (cum[j+k] - cum[j]) / k
+        mean[i] = mean_c + centre
+        var[i] = (cum_s[j+k] - cum_s[j]) / k - mean_c**2
+    return mean, var
+
+
+@njit
+def weight_stats_rows_numba(indptr, w_data, n_all, q_w):
+    """Compute statistics of analyse_weights for all rows of csr data.
+
+    Zeros that are not stored do not change the statistics and are only
+    counted. Quantile based statistics are zero for rows with less than 6
+    positive weights (flagged in few_pos). Mean and standard deviation are
+    zero for rows without positive weights (e.g. empty rows).
+    """
+    n_rows = len(indptr) - 1
+    stats = np.zeros((n_rows, 6))
+    largest_q = np.zeros((n_rows, 3))
+    sum_larger = np.zeros((n_rows, len(q_w)))
+    obs_larger = np.zeros((n_rows, len(q_w)))
+    few_pos = np.zeros(n_rows, dtype=np.bool_)
+    qqq_p = np.array([0.99, 0.95, 0.9])
+    for row in range(n_rows):
+        w_row = w_data[indptr[row]:indptr[row+1]].copy()
+        w_sum = np.sum(w_row)
+        if not ((1-1e-10 < w_sum < 1+1e-10) or (-1e-15 < w_sum < 1e-15)):
+            w_row = w_row / w_sum
+        w_pos = np.sort(w_row[w_row > 1e-15])
+        n_pos = len(w_pos)
+        stats[row, 0], stats[row, 1] = n_pos, n_all - n_pos
+        if n_pos > 0:
+            stats[row, 2], stats[row, 3] = np.mean(w_pos), np.std(w_pos)
+        stats[row, 4] = gini_sorted_numba(np.sort(w_row)[::-1], n_all) * 100
+        stats[row, 5] = gini_sorted_numba(w_pos[::-1], n_pos) * 100
+        if n_pos > 5:
+            for i in range(3):
+                qqq = quantile_sorted_numba(w_pos, qqq_p[i])
+                largest_q[row, i] = np.sum(w_pos[w_pos >= (qqq - 1e-15)]
+                                           ) * 100
+            for i in range(len(q_w)):
+                larger = w_pos[w_pos >= (q_w[i] - 1e-15)]
+                sum_larger[row, i] = np.sum(larger) * 100
+                obs_larger[row, i] = len(larger) / n_pos * 100
+        else:
+            few_pos[row] = True
+    return stats, largest_q, sum_larger, obs_larger, few_pos
+
+
+@njit
+def gini_sorted_numba(x_desc, len_x):
+    """Compute Gini coefficient from values sorted in descending order.
+
+    Same as gini_coeff_pos if len_x - len(x_desc) zeros are added.
+    """
+    sss = np.sum(x_desc)
+    if sss > 1e-15:
+        rank_x = 0.0
+        for i, x_i in enumerate(x_desc):
+            rank_x += i * x_i
+        return 1 - (2.0 * rank_x + sss) / (len_x * sss)
+    return 0.0
+
+
+@njit
+def quantile_sorted_numba(x_sorted, quant):
+    """Compute quantile of sorted values (same as np.quantile, linear)."""
+    index = quant * (len(x_sorted) - 1)
+    low = int(np.floor(index))
+    high = min(low + 1, len(x_sorted) - 1)
+    frac = index - low
+    diff = x_sorted[high] - x_sorted[low]
+    if frac >= 0.5:
+        return x_sorted[high] - diff * (1 - frac)
+    return x_sorted[low] + diff * frac
+
+
 @ray.remote
 def ray_iate_func2_for_mp(idx, no_of_out, pot_y_i, pot_y_var_i, pot_y_m_ate_i,
                           pot_y_m_ate_var_i, d_type, d_values, no_of_treat,
@@ -66,7 +66,9 @@ def int_init(del_forest=None, descriptive_stats=None, dpi=None, fontsize=None,
              return_iate_sp=None, seed_sample_split=None,
              share_forest_sample=None, show_plots=None, verbose=None,
              weight_as_sparse=None, weight_as_sparse_splits=None,
-             with_output=None, p_ate_no_se_only=None):
+             with_output=None, p_ate_no_se_only=None,
+             predict_stream_mb=None, iate_chunk_size=None,
+             mem_budget_mb=None, forest_mmap_path=None):
     """Initialise dictionary of parameters of internal variables."""
     dic = {}
     dic['del_forest'] = del_forest is True
@@ -94,7 +96,7 @@ def int_init(del_forest=None, descriptive_stats=None, dpi=None, fontsize=None,
         dic['mp_ray_objstore_multiplier'] = mp_ray_objstore_multiplier
     dic['ray_or_dask'] = 'ray'
     dic['no_ray_in_forest_building'] = False
-    if mp_weights_tree_batch is not None and 0 < mp_weights_tree_batch < 1:
+    if mp_weights_tree_batch is not None and mp_weights_tree_batch > 0:
         dic['mp_weights_tree_batch'] = round(mp_weights_tree_batch)
     else:
         dic['mp_weights_tree_batch'] = 0
@@ -132,6 +134,16 @@ def int_init(del_forest=None, descriptive_stats=None, dpi=None, fontsize=None,
     if p_ate_no_se_only is not None and p_ate_no_se_only:
         dic['return_iate_sp'] = False
     dic['output_no_new_dir'] = output_no_new_dir is True
+    dic['predict_stream_mb'] = (2000 if predict_stream_mb is None
+                                or predict_stream_mb <= 0
+                                else predict_stream_mb)
+    dic['iate_chunk_size'] = (None if iate_chunk_size is None
+                              or iate_chunk_size < 1
+                              else round(iate_chunk_size))
+    dic['mem_budget_mb'] = (None if mem_budget_mb is None
+                            or mem_budget_mb <= 0 else mem_budget_mb)
+    dic['forest_mmap_path'] = (None if forest_mmap_path is None
+                               else str(forest_mmap_path))
     return dic
 
 
@@ -170,6 +182,9 @@ def int_update_train(mcf_):
             dic['mem_object_store_1'] = 0.7 * memory.available
         if dic['mem_object_store_2'] > 0.5 * memory.available:
             dic['mem_object_store_2'] = 0.5 * memory.available
+        for store in ('mem_object_store_1', 'mem_object_store_2'):
+            dic[store] = mcf_sys.object_store_bytes(dic[store],
+                                                    dic['mem_budget_mb'])
     mcf_.int_dict = dic
 
 
@@ -192,6 +207,8 @@ def int_update_pred(mcf_, n_pred):
                 'mp_ray_objstore_multiplier']
         if int_dic['mem_object_store_3'] > 0.5 * memory.available:
             int_dic['mem_object_store_3'] = 0.5 * memory.available
+        int_dic['mem_object_store_3'] = mcf_sys.object_store_bytes(
+            int_dic['mem_object_store_3'], int_dic['mem_budget_mb'])
     mcf_.int_dict = int_dic
 
 
@@ -592,7 +609,9 @@ def cf_init(alpha_reg_grid=None, alpha_reg_max=None, alpha_reg_min=None,
             m_random_poisson=None, match_nn_prog_score=None, mce_vart=None,
             vi_oob_yes=None, n_min_grid=None, n_min_max=None, n_min_min=None,
             n_min_treat=None, p_diff_penalty=None, subsample_factor_eval=None,
-            subsample_factor_forest=None, random_thresholds=None):
+            subsample_factor_forest=None, random_thresholds=None,
+            sorted_split_search=None, nn_tree_search=None, leaf_cache=None,
+            n_min_pruning=None, split_bins=None):
     """Initialise dictionary with parameters of causal forest building."""
     dic = {}
     (dic['alpha_reg_grid'], dic['alpha_reg_max'], dic['alpha_reg_min'],
@@ -601,6 +620,9 @@ def cf_init(alpha_reg_grid=None, alpha_reg_max=None, alpha_reg_min=None,
     dic['boot'] = 1000 if boot is None or boot < 1 else round(boot)
     dic['match_nn_prog_score'] = match_nn_prog_score is not False
     dic['nn_main_diag_only'] = nn_main_diag_only is True
+    dic['nn_tree_search'] = nn_tree_search is not False
+    dic['leaf_cache'] = leaf_cache is not False
+    dic['n_min_pruning'] = n_min_pruning is True
     # Select grid for number of parameters
     if m_share_min is None or not 0 < m_share_min <= 1:
         dic['m_share_min'] = 0.1
@@ -639,9 +661,69 @@ def cf_init(alpha_reg_grid=None, alpha_reg_max=None, alpha_reg_min=None,
     dic['subsample_factor_eval'] = subsample_factor_eval
     dic['subsample_factor_forest'] = subsample_factor_forest
     dic['random_thresholds'] = random_thresholds
+    dic['sorted_split_search'] = sorted_split_search is True
+    if split_bins is True:
+        dic['split_bins'] = 255
+    elif split_bins is None or split_bins is False or split_bins < 2:
+        dic['split_bins'] = None
+    else:
+        dic['split_bins'] = min(round(split_bins), 65536)
+    if dic['split_bins'] is not None and sorted_split_search is None:
+        dic['sorted_split_search'] = True   # Needed for histogram splits
     return dic
 
 
+def chunks_maxsize_in_budget(chunks_maxsize, n_cols, gen_dic, budget_mb,
+                             with_output=True):
+    """Reduce chunk size if training data of workers exceeds memory budget.
+
+    The workers are determined as in build_forest for chunks of size
+    chunks_maxsize. If the budget is too small even for chunks of 1000
+    observations, the chunk size is kept and a warning is printed.
+
+    Parameters
+    ----------
+    chunks_maxsize : Int. Chunk size without memory budget.
+    n_cols : Int. Number of columns of training data.
+    gen_dic : Dict. Parameters.
+    budget_mb : Float. Memory budget (MB) set by user.
+    with_output : Boolean. Print if chunk size is changed. Default is True.
+
+    Returns
+    -------
+    chunks_maxsize : Int. Chunk size.
+
+    """
+    if gen_dic['mp_parallel'] < 1.5:
+        workers = 1
+    elif gen_dic['mp_automatic']:
+        task_mb = mcf_sys.task_memory_mb('tree', n_rows=chunks_maxsize,
+                                         n_cols=n_cols)
+        workers = mcf_sys.find_no_of_workers(
+            gen_dic['mp_parallel'], gen_dic['sys_share'], task_mb=task_mb,
+            shared_mb=task_mb / mcf_sys.MEM_TREE_COPIES, budget_mb=budget_mb)
+    else:
+        workers = round(gen_dic['mp_parallel'])
+    max_rows = mcf_sys.max_rows_in_budget(n_cols, workers=workers,
+                                          budget_mb=budget_mb,
+                                          sys_share=gen_dic['sys_share'])
+    if max_rows >= chunks_maxsize:
+        return chunks_maxsize
+    if max_rows < 1000:
+        txt = (f'\nWARNING: Memory budget of {budget_mb} MB is too small for '
+               f'{workers} worker(s) building forests on chunks of at least '
+               '1000 observations. Chunk size is not reduced '
+               f'({chunks_maxsize} observations).')
+    else:
+        txt = (f'\nChunk size reduced from {chunks_maxsize} to {max_rows} '
+               f'observations to keep the memory budget of {budget_mb} MB '
+               f'with {workers} worker(s).')
+        chunks_maxsize = max_rows
+    if with_output:
+        ps.print_mcf(gen_dic, txt, summary=True)
+    return chunks_maxsize
+
+
 def cf_update_train(mcf_, data_df):
     """Update cf parameters that need information from training data."""
     cf_dic, gen_dic, lc_dic = mcf_.cf_dict, mcf_.gen_dict, mcf_.lc_dict
@@ -668,6 +750,10 @@ def cf_update_train(mcf_, data_df):
         cf_dic['chunks_maxsize'] = round(max(
             base_level + np.sqrt(max(cf_dic['n_train'] - base_level, 0)),
             base_level))
+        if int_dic['mem_budget_mb'] is not None:
+            cf_dic['chunks_maxsize'] = chunks_maxsize_in_budget(
+                cf_dic['chunks_maxsize'], data_df.shape[1], gen_dic,
+                int_dic['mem_budget_mb'], int_dic['with_output'])
     # Effective sample sizes per chuck
     no_of_chucks = np.ceil(cf_dic['n_train'] / cf_dic['chunks_maxsize'])
     # Actual number of chucks could be smaller if lot's of data is deleted in
@@ -699,8 +785,11 @@ def cf_update_train(mcf_, data_df):
         n_d_subsam *= (1 - lc_dic['cs_share'])
 
     # Check only random thresholds to save computation time when building CF
+    # (all bin boundaries are cheap to check in the histogram split mode)
     if cf_dic['random_thresholds'] is None or cf_dic['random_thresholds'] < 0:
-        cf_dic['random_thresholds'] = round(4 + cf_dic['n_train_eff']**0.2)
+        cf_dic['random_thresholds'] = (
+            0 if cf_dic['split_bins'] and cf_dic['random_thresholds'] is None
+            else round(4 + cf_dic['n_train_eff']**0.2))
     # Penalty multiplier in CF building
     if (cf_dic['p_diff_penalty'] is None
             or cf_dic['p_diff_penalty'] < 0):  # Default
@@ -213,8 +213,8 @@ def post_estimation_iate(mcf_, results):
                     low_b = iate_temp.min() - 0.1 * dist
                     up_b = iate_temp.max() + 0.1 * dist
                     grid = np.linspace(low_b, up_b, 1000)
-                    density = mcf_est.kernel_density(iate_temp, grid, 1,
-                                                     bandwidth)
+                    density = mcf_est.kernel_density_fast(
+                        iate_temp, grid, 1, bandwidth)
                     fig, axe = plt.subplots()
                     titel_tmp = titel.replace('_iate', '')
                     titel_tmp = titel_tmp[:-4] + ' ' + titel_tmp[-4:]
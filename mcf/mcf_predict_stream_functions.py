@@ -0,0 +1,369 @@
+"""
+Contains the functions for predicting effects in chunks (out-of-core).
+
+The prediction data is processed in chunks whose size follows from a memory
+budget. In a first pass the (sparse) weights of each chunk are computed,
+aggregated into the sufficient statistics of the ATE and GATE estimators, and
+saved to disk. In the second pass the IATEs of each chunk are computed from
+the saved weights and appended to a csv-file.
+
+Created on Sun Oct 18 15:05:12 2026
+
+@author: MLechner
+# -*- coding: utf-8 -*-
+"""
+from copy import copy, deepcopy
+import os
+from pathlib import Path
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from mcf import mcf_ate_functions as mcf_ate
+from mcf import mcf_common_support_functions as mcf_cs
+from mcf import mcf_data_functions as mcf_data
+from mcf import mcf_estimation_functions as mcf_est
+from mcf import mcf_gate_functions as mcf_gate
+from mcf import mcf_gateout_functions as mcf_gateout
+from mcf import mcf_iate_functions as mcf_iate
+from mcf import mcf_print_stats_functions as ps
+from mcf import mcf_weight_functions as mcf_w
+
+
+def predict_stream_main(mcf_, data, iate_file=None):
+    """Predict ATE, GATE and IATE in chunks with bounded memory.
+
+    Parameters
+    ----------
+    mcf_ : mcf-object. Trained modified causal forest.
+    data : DataFrame or String or Pathlib object. Prediction data or name of
+           csv-file containing the prediction data.
+    iate_file : String or Pathlib object or None. Name of csv-file to which
+           the IATEs are written. None: File iate_stream.csv in output
+           directory (or working directory). Default is None.
+
+    Returns
+    -------
+    results : Dict. Same structure as the results of predict. 'iate_data_df'
+              is None; the IATEs are in the file 'iate_file'.
+    outpath : Pathlib object. Location of directory with output.
+
+    """
+    gen_dic, int_dic, var_dic = mcf_.gen_dict, mcf_.int_dict, mcf_.var_dict
+    if mcf_.forest is None:
+        raise ValueError('Forest must be trained before prediction.')
+    if iate_file is None:
+        iate_file = Path(gen_dic['outpath'] if gen_dic['outpath'] is not None
+                         else os.getcwd()) / 'iate_stream.csv'
+    mcf_s = stream_copy(mcf_)
+    mcf_q = quiet_copy(mcf_s)
+    forests = [fold_list[0] for fold_list in mcf_.forest]
+    txt = stream_not_covered(mcf_)
+    continuous = gen_dic['d_type'] == 'continuous'
+    if continuous:
+        no_of_treat = mcf_.ct_dict['grid_w']
+        d_values = mcf_.ct_dict['grid_w_val']
+    else:
+        no_of_treat, d_values = gen_dic['no_of_treat'], gen_dic['d_values']
+    z_values_l = ([mcf_s.var_x_values[z_name] for z_name in var_dic['z_name']]
+                  if mcf_s.p_dict['gate'] else [])
+    no_of_agg = (no_of_treat + 1) * (1 + sum(len(z_val) for z_val in
+                                             z_values_l))
+    chunk_rows, txt_rows = stream_chunk_rows(mcf_, forests, no_of_treat,
+                                             no_of_agg)
+    if int_dic['with_output']:
+        ps.print_mcf(gen_dic, '\n' + '=' * 100 + '\nPrediction in chunks '
+                     '(out-of-core)' + txt + txt_rows, summary=True)
+    temp_dir = tempfile.mkdtemp(
+        prefix='mcf_stream_', dir=gen_dic['outpath']
+        if gen_dic['outpath'] is not None and os.path.isdir(
+            gen_dic['outpath']) else None)
+    try:
+        # Pass 1: Weights for all chunks and sufficient statistics
+        (chunk_files, w_ate_agg, w_gate_agg, train_dic, eval_df
+         ) = stream_weights(mcf_s, mcf_q, data, forests, chunk_rows,
+                            z_values_l, d_values, temp_dir)
+        # ATE, balancing tests, GATE
+        results, w_ate_export, iate_txt = stream_ate_gate(
+            mcf_s, eval_df, train_dic, w_ate_agg, w_gate_agg)
+        # Pass 2: IATEs for all chunks written to file
+        results['iate_names_dic'] = stream_iate(
+            mcf_s, mcf_q, chunk_files, train_dic, w_ate_export, iate_file,
+            iate_txt)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    results['iate_data_df'], results['iate_file'] = None, iate_file
+    if int_dic['with_output']:
+        ps.print_mcf(gen_dic, f'\nIATEs saved to {iate_file}', summary=True)
+    return results, gen_dic['outpath']
+
+
+def stream_copy(mcf_):
+    """Shallow copy of mcf-object with parameters used in streaming."""
+    mcf_s = copy(mcf_)      # Shares worker pool with mcf_
+    mcf_s.p_dict = deepcopy(mcf_.p_dict)
+    mcf_s.int_dict = copy(mcf_.int_dict)
+    # Sparse weights only, chunks are not split again
+    mcf_s.int_dict['weight_as_sparse'] = True
+    mcf_s.int_dict['weight_as_sparse_splits'] = 1
+    # Evaluation points of smoothed GATEs depend on all prediction data
+    mcf_s.p_dict['gates_smooth'] = False
+    return mcf_s
+
+
+def quiet_copy(mcf_):
+    """Shallow copy of mcf-object without output for the single chunks."""
+    mcf_q = copy(mcf_)
+    mcf_q.int_dict = copy(mcf_.int_dict)
+    mcf_q.gen_dict = copy(mcf_.gen_dict)
+    mcf_q.int_dict['with_output'] = mcf_q.int_dict['verbose'] = False
+    mcf_q.int_dict['return_iate_sp'] = True
+    mcf_q.gen_dict['with_output'] = False
+    return mcf_q
+
+
+def stream_not_covered(mcf_):
+    """Text about the estimands that are not estimated in chunks."""
+    p_dic = mcf_.p_dict
+    not_covered = [name for name, flag in (
+        ('efficient IATE', mcf_.gen_dict['iate_eff']),
+        ('smoothed GATE', p_dic['gate'] and p_dic['gates_smooth']),
+        ('BGATE', p_dic['bgate']), ('AMGATE', p_dic['amgate'])) if flag]
+    if not not_covered:
+        return ''
+    return ('\nNot estimated when predicting in chunks: '
+            + ', '.join(not_covered) + '.')
+
+
+def stream_chunk_rows(mcf_, forests, no_of_treat, no_of_agg):
+    """Get number of prediction observations per chunk from memory budget.
+
+    Parameters
+    ----------
+    mcf_ : mcf-object.
+    forests : List of Dict. Forest and training data of each fold.
+    no_of_treat : Int. Number of treatments.
+    no_of_agg : Int. Upper limit of number of aggregated weight vectors per
+                treatment (ATE, ATETs, GATEs, GATETs).
+
+    Returns
+    -------
+    chunk_rows : Int. Number of observations per chunk.
+    txt : String. Information about memory.
+
+    """
+    budget = mcf_.int_dict['predict_stream_mb'] * 1024 * 1024
+    n_y = max(len(forest_dic['y_train_df']) for forest_dic in forests)
+    boot = len(forests[0]['forest'])
+    # Aggregated ATE and GATE weights of all folds stay in memory
+    fixed = no_of_agg * no_of_treat * n_y * 8 * len(forests)
+    leaves = np.mean([np.sum(tree['leaf_info_int'][:, 7] == 1)
+                      for tree in forests[0]['forest']])
+    # Nonzero weights of one observation (union of leaves over trees)
+    nnz_row = min(n_y, boot * n_y / max(leaves, 1))
+    # CSR data & indices, copies when rescaling, terminal leaves of trees
+    row_bytes = 3 * 12 * nnz_row + 8 * boot
+    chunk_rows = max(int((budget - fixed) // row_bytes), 100)
+    txt = (f'\nMemory budget: {budget / (1024 * 1024):.0f} MB, aggregated'
+           f' weights: {fixed / (1024 * 1024):.0f} MB, observations per'
+           f' chunk: {chunk_rows}')
+    if fixed > budget:
+        txt += ('\nWARNING: Aggregated weights of ATEs and GATEs exceed the'
+                ' memory budget.')
+    return chunk_rows, txt
+
+
+def data_chunks(data, chunk_rows):
+    """Yield prediction data (DataFrame or csv-file) in chunks."""
+    if isinstance(data, pd.DataFrame):
+        for start in range(0, len(data), chunk_rows):
+            yield data.iloc[start:start + chunk_rows]
+    else:
+        yield from pd.read_csv(data, chunksize=chunk_rows)
+
+
+def prepare_chunk(mcf_, data_df):
+    """Clean data, create variables and remove obs. off common support."""
+    if mcf_.dc_dict['clean_data']:
+        data_df = mcf_data.clean_data(mcf_, data_df, train=False)
+    data_df = mcf_data.create_xz_variables(mcf_, data_df, train=False)
+    if mcf_.cs_dict['type'] > 0 and mcf_.gen_dict['d_type'] != 'continuous':
+        data_df, _ = mcf_cs.common_support(mcf_, data_df, None, train=False)
+    return data_df
+
+
+def stream_weights(mcf_, mcf_q, data, forests, chunk_rows, z_values_l,
+                   d_values, temp_dir):
+    """Compute weights chunk by chunk, aggregate them and save them.
+
+    Returns
+    -------
+    chunk_files : List of Dict. Files of data and weights of each chunk.
+    w_ate_agg : List of Numpy arrays. ATE weights (not normalized) per fold.
+    w_gate_agg : List of lists of lists of Numpy arrays. GATE weights (not
+                 normalized) per fold, heterogeneity variable and z-value.
+    train_dic : List of Dict. Training data (Numpy) per fold.
+    eval_df : DataFrame. Treatment, sampling weights and heterogeneity
+              variables of all chunks (as used by ate_est and gate_est).
+
+    """
+    gen_dic, int_dic, p_dic = mcf_.gen_dict, mcf_.int_dict, mcf_.p_dict
+    var_dic = mcf_.var_dict
+    no_of_folds, t_probs = len(forests), p_dic['choice_based_probs']
+    chunk_files, train_dic, eval_l = [], [None] * no_of_folds, []
+    w_ate_agg, w_gate_agg = [None] * no_of_folds, [None] * no_of_folds
+    for chunk_idx, chunk_df in enumerate(data_chunks(data, chunk_rows)):
+        chunk_df = prepare_chunk(mcf_q, chunk_df.reset_index(drop=True))
+        if chunk_df.empty:
+            continue
+        if int_dic['with_output'] and int_dic['verbose']:
+            print(f'\nChunk {chunk_idx + 1}: Weights of {len(chunk_df)} '
+                  'observations')
+        d_p, z_p, w_p, _ = mcf_ate.get_data_for_final_ate_estimation(
+            chunk_df, gen_dic, p_dic, var_dic, ate=False)
+        # Same number of ATEs (GATEs) as in ate_est (gate_est)
+        no_of_ates = (len(d_values) + 1 if d_p is not None
+                      and (p_dic['atet'] or p_dic['gatet']) else 1)
+        no_of_tgates = (len(d_values) + 1 if d_p is not None
+                        and p_dic['gatet'] else 1)
+        files = {'data': os.path.join(temp_dir, f'data{chunk_idx}.pkl'),
+                 'weights': []}
+        chunk_df.to_pickle(files['data'])
+        eval_l.append(chunk_df[eval_names(mcf_, chunk_df)])
+        for fold, forest_dic in enumerate(forests):
+            weights_dic = mcf_w.get_weights_mp(mcf_q, chunk_df, forest_dic,
+                                               True, with_output=False)
+            weights = weights_dic.pop('weights')
+            if train_dic[fold] is None:
+                train_dic[fold] = weights_dic
+            w_dat = weights_dic['w_dat_np'] if gen_dic['weighted'] else None
+            w_ate = mcf_ate.w_ate_sparse(
+                weights, len(weights_dic['y_dat_np']), no_of_ates, d_values,
+                d_p, w_p, w_dat, t_probs, gen_dic, p_dic)
+            w_gate = [mcf_gate.gate_weights_sparse(
+                z_p[:, z_idx], z_values, weights, d_p, w_p, w_dat, t_probs,
+                no_of_tgates, d_values, gen_dic, p_dic)
+                for z_idx, z_values in enumerate(z_values_l)]
+            if w_ate_agg[fold] is None:
+                w_ate_agg[fold], w_gate_agg[fold] = w_ate, w_gate
+            else:
+                w_ate_agg[fold] += w_ate
+                for w_gate_agg_z, w_gate_z in zip(w_gate_agg[fold], w_gate):
+                    for w_gate_agg_zj, w_gate_zj in zip(w_gate_agg_z,
+                                                        w_gate_z):
+                        w_gate_agg_zj += w_gate_zj
+            files_fold = []
+            for t_idx, weights_t in enumerate(weights):
+                file_name = os.path.join(
+                    temp_dir, f'weights{chunk_idx}_{fold}_{t_idx}.npz')
+                sparse.save_npz(file_name, weights_t)
+                files_fold.append(file_name)
+            files['weights'].append(files_fold)
+            del weights
+        chunk_files.append(files)
+    if not chunk_files:
+        raise ValueError('No observations left in prediction data.')
+    eval_df = pd.concat(eval_l, ignore_index=True)
+    return chunk_files, w_ate_agg, w_gate_agg, train_dic, eval_df
+
+
+def eval_names(mcf_, data_df):
+    """Names of variables of prediction data used by ate_est & gate_est."""
+    var_dic = mcf_.var_dict
+    names = [name for name in var_dic['d_name'] if name in data_df.columns]
+    if mcf_.gen_dict['weighted']:
+        names += var_dic['w_name']
+    names += [name for name in var_dic['z_name'] if name not in names]
+    return names
+
+
+def stream_ate_gate(mcf_, data_df, train_dic, w_ate_agg, w_gate_agg):
+    """Estimate ATE, balancing tests and GATE from aggregated weights.
+
+    data_df contains the treatment, the sampling weights and the
+    heterogeneity variables of all chunks, so that the number of ATEs and
+    GATEs (and the data saved with the GATEs) refer to all prediction data.
+    """
+    p_dic, int_dic = mcf_.p_dict, mcf_.int_dict
+    results, w_ate_export = {}, []
+    txt_weights = ''
+    ate_dic = bala_dic = gate_dic = gate_m_ate_dic = gate_est_dic = None
+    for fold, weights_dic in enumerate(train_dic):
+        weights_dic = {**weights_dic, 'weights': None}
+        w_ate_f, y_pot_f, y_pot_var_f, txt_w_f = mcf_ate.ate_est(
+            mcf_, data_df, weights_dic, w_ate_agg=w_ate_agg[fold])
+        w_ate_export.append(w_ate_f)
+        ate_dic = mcf_est.aggregate_pots(mcf_, y_pot_f, y_pot_var_f, txt_w_f,
+                                         ate_dic, fold, title='ATE')
+        if p_dic['bt_yes']:
+            _, y_pot_f, y_pot_var_f, txt_w_f = mcf_ate.ate_est(
+                mcf_, data_df, weights_dic, balancing_test=True,
+                w_ate_agg=w_ate_agg[fold])
+            bala_dic = mcf_est.aggregate_pots(
+                mcf_, y_pot_f, y_pot_var_f, txt_w_f, bala_dic, fold,
+                title='Balancing check')
+        if p_dic['gate']:
+            (y_pot_f, y_pot_var_f, y_pot_mate_f, y_pot_mate_var_f,
+             gate_est_dic, txt_w_f) = mcf_gate.gate_est(
+                 mcf_, data_df, weights_dic, w_ate_f,
+                 w_gate_agg_all=w_gate_agg[fold])
+            gate_dic = mcf_est.aggregate_pots(
+                mcf_, y_pot_f, y_pot_var_f, txt_w_f, gate_dic, fold,
+                pot_is_list=True, title='GATE')
+            if y_pot_mate_f is not None:
+                gate_m_ate_dic = mcf_est.aggregate_pots(
+                    mcf_, y_pot_mate_f, y_pot_mate_var_f, txt_w_f,
+                    gate_m_ate_dic, fold, pot_is_list=True,
+                    title='GATE minus ATE')
+    (results['ate'], results['ate_se'], results['ate effect_list']
+     ) = mcf_ate.ate_effects_print(mcf_, ate_dic, None)
+    if p_dic['bt_yes']:
+        (results['bala'], results['bala_se'], results['bala_effect_list']
+         ) = mcf_ate.ate_effects_print(mcf_, bala_dic, None,
+                                       balancing_test=True)
+    if p_dic['gate']:
+        (results['gate'], results['gate_se'], results['gate_diff'],
+         results['gate_diff_se']) = mcf_gateout.gate_effects_print(
+             mcf_, gate_dic, gate_m_ate_dic, gate_est_dic, results['ate'],
+             results['ate_se'])
+        results['gate_names_values'] = mcf_gateout.get_names_values(
+            mcf_, gate_est_dic, None, None)
+        if int_dic['with_output']:
+            txt_weights = ate_dic['txt_weights']
+    return results, w_ate_export, txt_weights
+
+
+def stream_iate(mcf_, mcf_q, chunk_files, train_dic, w_ate_export, iate_file,
+                txt_weights):
+    """Compute IATEs chunk by chunk from saved weights and write them."""
+    int_dic, var_dic = mcf_.int_dict, mcf_.var_dict
+    names_iate = None
+    if os.path.exists(iate_file):
+        os.remove(iate_file)
+    for chunk_idx, files in enumerate(chunk_files):
+        if int_dic['with_output'] and int_dic['verbose']:
+            print(f'\nChunk {chunk_idx + 1} ({len(chunk_files)}): IATEs')
+        iate_dic = iate_m_ate_dic = None
+        for fold, weights_dic in enumerate(train_dic):
+            weights_dic = {**weights_dic, 'weights': [
+                sparse.load_npz(file) for file in files['weights'][fold]]}
+            y_pot_f, y_pot_var_f, y_pot_m_ate_f, y_pot_m_ate_var_f, _ = (
+                mcf_iate.iate_est_mp(mcf_q, weights_dic, w_ate_export[fold]))
+            iate_dic = mcf_est.aggregate_pots(mcf_q, y_pot_f, y_pot_var_f, '',
+                                              iate_dic, fold, title='IATE')
+            if y_pot_m_ate_f is not None:
+                iate_m_ate_dic = mcf_est.aggregate_pots(
+                    mcf_q, y_pot_m_ate_f, y_pot_m_ate_var_f, '',
+                    iate_m_ate_dic, fold, title='IATE minus ATE')
+        _, _, _, names_iate, iate_df = mcf_iate.iate_effects_print(
+            mcf_q, iate_dic, iate_m_ate_dic, None, None)
+        data_df = pd.read_pickle(files['data'])
+        id_df = data_df[var_dic['id_name']].reset_index(drop=True)
+        pd.concat([id_df, iate_df], axis=1).to_csv(
+            iate_file, mode='a', header=chunk_idx == 0, index=False)
+    if int_dic['with_output']:
+        ps.print_mcf(mcf_.gen_dict, txt_weights, summary=False)
+    return names_iate
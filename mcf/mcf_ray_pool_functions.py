@@ -0,0 +1,134 @@
+"""
+Contains functions for the session-wide pool of Ray workers.
+
+The pool belongs to an instance of ModifiedCausalForest. Ray is started once
+and large objects (forests, training and prediction matrices) are put into
+the object store once. Stages obtain cheap references to these objects
+instead of calling ray.init and ray.put again.
+
+Created on Sun Oct 18 10:12:41 2026
+
+@author: MLechner
+# -*- coding: utf-8 -*-
+"""
+import ray
+
+from mcf import mcf_print_stats_functions as ps
+
+
+def pool_init():
+    """Initialise dictionary of worker pool (no workers started)."""
+    return {'maxworkers': None, 'refs': {}}
+
+
+def worker_pool(mcf_):
+    """Get dictionary of worker pool of mcf instance (create if missing)."""
+    if getattr(mcf_, 'pool_dict', None) is None:
+        mcf_.pool_dict = pool_init()
+    return mcf_.pool_dict
+
+
+def start_worker_pool(mcf_, maxworkers, object_store_memory=None):
+    """Start Ray workers if they are not running already.
+
+    Parameters
+    ----------
+    mcf_ : mcf-object.
+    maxworkers : Int. Number of workers.
+    object_store_memory : Int or None. Size of object store (bytes).
+                          Default is None (Ray default).
+
+    Returns
+    -------
+    None.
+
+    """
+    pool_dic = worker_pool(mcf_)
+    if ray.is_initialized():
+        return
+    # References of an earlier Ray session are invalid
+    pool_dic['refs'] = {}
+    if object_store_memory is None:
+        ray.init(num_cpus=maxworkers, include_dashboard=False)
+    else:
+        ray.init(num_cpus=maxworkers, include_dashboard=False,
+                 object_store_memory=object_store_memory)
+        if mcf_.int_dict['with_output'] and mcf_.int_dict['verbose']:
+            txt = ('\nSize of Ray Object Store: '
+                   f'{round(object_store_memory / (1024 * 1024))} MB')
+            ps.print_mcf(mcf_.gen_dict, txt, summary=False)
+    pool_dic['maxworkers'] = maxworkers
+
+
+def put_shared(mcf_, name, obj, key=None, max_entries=1):
+    """Put object into the object store once and return its reference.
+
+    Parameters
+    ----------
+    mcf_ : mcf-object.
+    name : String. Name of slot in pool.
+    obj : Any object. Object to put into object store.
+    key : Any object or None. Object identifying the content of obj (for
+          example the DataFrame from which obj is computed). The reference is
+          reused if the same key is used again. Default is None (obj is key).
+          Objects must not be modified in place after being published.
+    max_entries : Int or None. Maximum number of objects kept in slot. The
+                  oldest object is released first. None: No limit.
+                  Default is 1.
+
+    Returns
+    -------
+    obj_ref : Ray ObjectRef.
+
+    """
+    key = obj if key is None else key
+    slot = worker_pool(mcf_)['refs'].setdefault(name, {})
+    if (entry := slot.get(id(key))) is not None and entry[0] is key:
+        return entry[1]
+    if max_entries is not None:
+        while len(slot) >= max_entries:
+            del slot[next(iter(slot))]
+    obj_ref = ray.put(obj)
+    slot[id(key)] = (key, obj_ref)   # Keeps key alive: id remains unique
+    return obj_ref
+
+
+def get_shared(mcf_, name, key):
+    """Return reference of object published with key (None if missing)."""
+    slot = worker_pool(mcf_)['refs'].get(name, {})
+    if (entry := slot.get(id(key))) is not None and entry[0] is key:
+        return entry[1]
+    return None
+
+
+def release_shared(mcf_, names=None):
+    """Release references to objects in store (all slots if names is None)."""
+    refs = worker_pool(mcf_)['refs']
+    if names is None:
+        refs.clear()
+    else:
+        for name in [names] if isinstance(names, str) else names:
+            refs.pop(name, None)
+
+
+def end_worker_pool(mcf_, shutdown=None):
+    """Release all references and shut down Ray if required.
+
+    Parameters
+    ----------
+    mcf_ : mcf-object.
+    shutdown : Boolean or None. Shut down Ray. None: Use
+               int_dict['mp_ray_shutdown']. Default is None.
+
+    Returns
+    -------
+    None.
+
+    """
+    if shutdown is None:
+        shutdown = mcf_.int_dict['mp_ray_shutdown']
+    if shutdown:
+        release_shared(mcf_)
+        if ray.is_initialized():
+            ray.shutdown()
+        worker_pool(mcf_)['maxworkers'] = None
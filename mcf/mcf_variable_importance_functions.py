@@ -22,9 +22,10 @@ from mcf import mcf_forest_functions as mcf_fo
 from mcf import mcf_general as gp
 from mcf import mcf_general_sys as mcf_sys
 from mcf import mcf_print_stats_functions as ps
+from mcf import mcf_ray_pool_functions as mcf_pool
 
 
-def variable_importance(mcf_, data_df, forest, x_name_mcf):
+def variable_importance(mcf_, data_df, forest, x_name_mcf, leaf_no_oob=None):
     """Compute variable importance measure.
 
     Parameters
@@ -33,6 +34,10 @@ def variable_importance(mcf_, data_df, forest, x_name_mcf):
     data_df : DataFrame.
     forest : Estimated forest.
     x_name_mcf : List. Variable names from MCF procedure
+    leaf_no_oob : Numpy array (observations x trees) or None. Cached terminal
+                  leaves of the OOB observations of data_df (see
+                  mcf_forest_add_functions.terminal_leaves_oob). None: OOB
+                  observations are sent through the trees. Default is None.
 
 
     Returns
@@ -44,6 +49,11 @@ def variable_importance(mcf_, data_df, forest, x_name_mcf):
     b) For each variable, randomize one or groups of covariates
     c) recompute OOB-MSE with the ys of these more noisy variables
 
+    The terminal leaves of the OOB observations without randomization are
+    computed once (see vi_baseline) or taken from leaf_no_oob. After
+    randomization, only observations in leaves below a node splitting on a
+    randomized variable are sent through the tree again.
+
     Use multiprocessing in new oob prediction in the same way as in forest
     Building
     Outer loop over variables and group of variables
@@ -58,8 +68,8 @@ def variable_importance(mcf_, data_df, forest, x_name_mcf):
     if int_dic['with_output'] and int_dic['verbose']:
         txt = '\nVariable importance measures (OOB data)\nSingle variables'
         ps.print_mcf(gen_dic, txt, summary=True)
-    (x_name, _, _, cf_dic, _, data_np, y_i, y_nn_i, x_i, _, _, d_i, w_i, _, _
-     ) = mcf_data.prepare_data_for_forest(mcf_, data_df)
+    (x_name, _, _, cf_dic, _, data_np, y_i, y_nn_i, x_i, _, _, d_i, w_i, _, _,
+     _) = mcf_data.prepare_data_for_forest(mcf_, data_df)
     no_of_vars = len(x_name)
     partner_k = determine_partner_k(x_name)
     # Loop over all variables to get respective OOB values of MSE
@@ -71,33 +81,35 @@ def variable_importance(mcf_, data_df, forest, x_name_mcf):
         maxworkers = 1
     else:
         if gen_dic['mp_automatic']:
-            maxworkers = mcf_sys.find_no_of_workers(gen_dic['mp_parallel'],
-                                                    gen_dic['sys_share'])
+            maxworkers = mcf_sys.find_no_of_workers(
+                gen_dic['mp_parallel'], gen_dic['sys_share'],
+                budget_mb=int_dic['mem_budget_mb'])
         else:
             maxworkers = gen_dic['mp_parallel']
     if int_dic['with_output'] and int_dic['verbose']:
         txt = f'\nNumber of parallel processes: {maxworkers}'
         ps.print_mcf(gen_dic, txt, summary=False)
     if maxworkers > 1 and int_dic['ray_or_dask'] == 'ray':
-        if int_dic['mem_object_store_2'] is None:
-            if not ray.is_initialized():
-                ray.init(num_cpus=maxworkers, include_dashboard=False)
-        else:
-            if not ray.is_initialized():
-                ray.init(num_cpus=maxworkers, include_dashboard=False,
-                         object_store_memory=int_dic['mem_object_store_2'])
-            if int_dic['with_output'] and int_dic['verbose']:
-                txt = '\nSize of Ray Object Store: '
-                txt += f'{round(int_dic["mem_object_store_2"]/(1024*1024))} MB'
-                ps.print_mcf(gen_dic, txt, summary=False)
-        data_np_ref, forest_ref = ray.put(data_np), ray.put(forest)
-
+        mcf_pool.start_worker_pool(mcf_, maxworkers,
+                                   int_dic['mem_object_store_2'])
+        # Training data is already in object store if forest used Ray
+        data_np_ref = mcf_pool.put_shared(mcf_, 'tree_data', data_np,
+                                          key=data_df)
+        forest_ref = mcf_pool.put_shared(mcf_, 'vi_forest', forest)
+    # Terminal leaves and OOB values without randomization
+    vi_base = vi_baseline(data_np, y_i, y_nn_i, x_i, d_i, w_i, gen_dic, cf_dic,
+                          forest, leaf_no_oob)
+    oob_values[0] = np.mean([tree_base['oob'] for tree_base in vi_base])
+    if int_dic['with_output'] and int_dic['verbose']:
+        gp.share_completed(1, number_of_oobs)
+    if maxworkers > 1 and int_dic['ray_or_dask'] == 'ray':
+        vi_base_ref = mcf_pool.put_shared(mcf_, 'vi_base', vi_base)
     if (int_dic['mp_vim_type'] == 2 and int_dic['ray_or_dask'] != 'ray') or (
             maxworkers == 1):
-        for jdx in range(number_of_oobs):
+        for jdx in range(1, number_of_oobs):
             oob_values[jdx], _ = get_oob_mcf(
                 data_np, y_i, y_nn_i, x_i, d_i, w_i, gen_dic, int_dic, cf_dic,
-                jdx, True, [], forest, False, partner_k[jdx])
+                jdx, True, [], forest, False, partner_k[jdx], vi_base)
             if int_dic['with_output'] and int_dic['verbose']:
                 gp.share_completed(jdx+1, number_of_oobs)
     else:  # Fast but needs a lot of memory because it copied a lot
@@ -105,9 +117,10 @@ def variable_importance(mcf_, data_df, forest, x_name_mcf):
         if int_dic['ray_or_dask'] == 'ray':
             still_running = [ray_get_oob_mcf.remote(
                 data_np_ref, y_i, y_nn_i, x_i, d_i, w_i, gen_dic, int_dic,
-                cf_dic, idx, True, [], forest_ref, True, partner_k[idx])
-                for idx in range(number_of_oobs)]
-            jdx = 0
+                cf_dic, idx, True, [], forest_ref, True, partner_k[idx],
+                vi_base_ref)
+                for idx in range(1, number_of_oobs)]
+            jdx = 1
             while len(still_running) > 0:
                 finished, still_running = ray.wait(still_running)
                 finished_res = ray.get(finished)
@@ -136,7 +149,8 @@ def variable_importance(mcf_, data_df, forest, x_name_mcf):
         if maxworkers > 1 and int_dic['ray_or_dask'] == 'ray':
             still_running = [ray_get_oob_mcf.remote(
                 data_np_ref, y_i, y_nn_i, x_i, d_i, w_i, gen_dic, int_dic,
-                cf_dic, idx, False, ind_groups, forest_ref, True, partner_k)
+                cf_dic, idx, False, ind_groups, forest_ref, True, partner_k,
+                vi_base_ref)
                 for idx in range(n_g)]
             idx = 0
             while len(still_running) > 0:
@@ -152,7 +166,8 @@ def variable_importance(mcf_, data_df, forest, x_name_mcf):
             for idx in range(n_g):
                 oob_values[idx], _ = get_oob_mcf(
                     data_np, y_i, y_nn_i, x_i, d_i, w_i, gen_dic, int_dic,
-                    cf_dic, idx, False, ind_groups, forest, False, partner_k)
+                    cf_dic, idx, False, ind_groups, forest, False, partner_k,
+                    vi_base)
                 if int_dic['with_output'] and int_dic['verbose']:
                     gp.share_completed(idx+1, n_g)
         vim_g, txt = vim_print(mse_ref, np.array(oob_values), x_name,
@@ -171,7 +186,8 @@ def variable_importance(mcf_, data_df, forest, x_name_mcf):
         if maxworkers > 1 and int_dic['ray_or_dask'] == 'ray':
             still_running = [ray_get_oob_mcf.remote(
                 data_np_ref, y_i, y_nn_i, x_i, d_i, w_i, gen_dic, int_dic,
-                cf_dic, idx, False, ind_groups, forest_ref, True, partner_k)
+                cf_dic, idx, False, ind_groups, forest_ref, True, partner_k,
+                vi_base_ref)
                 for idx in range(n_g)]
             idx = 0
             while len(still_running) > 0:
@@ -187,7 +203,8 @@ def variable_importance(mcf_, data_df, forest, x_name_mcf):
             for idx in range(n_g):
                 oob_values[idx], _ = get_oob_mcf(
                     data_np, y_i, y_nn_i, x_i, d_i, w_i, gen_dic, int_dic,
-                    cf_dic, idx, False, ind_groups, forest, False, partner_k)
+                    cf_dic, idx, False, ind_groups, forest, False, partner_k,
+                    vi_base)
                 if int_dic['with_output'] and int_dic['verbose']:
                     gp.share_completed(idx+1, n_g)
         vim_mg, txt = vim_print(mse_ref, np.array(oob_values), x_name,
@@ -198,11 +215,11 @@ def variable_importance(mcf_, data_df, forest, x_name_mcf):
         vim_mg = None
     if int_dic['ray_or_dask'] == 'ray' and maxworkers > 1:
         if 'refs' in int_dic['mp_ray_del']:
-            del data_np_ref, forest_ref
+            del data_np_ref, forest_ref, vi_base_ref
+            mcf_pool.release_shared(mcf_, ('tree_data', 'vi_forest',
+                                           'vi_base'))
         if 'rest' in int_dic['mp_ray_del']:
             del finished_res, finished
-        if int_dic['mp_ray_shutdown']:
-            ray.shutdown()
     return vim, vim_g, vim_mg, x_name
 
 
@@ -353,16 +370,16 @@ def vim_print(mse_ref, mse_values, x_name, ind_list=0, with_output=True,
 @ray.remote
 def ray_get_oob_mcf(data_np, y_i, y_nn_i, x_i, d_i, w_i, gen_dic, int_dic,
                     cf_dic, k, single, group_ind_list, forest, no_mp=False,
-                    partner_k=None):
+                    partner_k=None, vi_base=None):
     """Make function usable for Ray."""
     return get_oob_mcf(data_np, y_i, y_nn_i, x_i, d_i, w_i, gen_dic, int_dic,
                        cf_dic, k, single, group_ind_list, forest, no_mp,
-                       partner_k)
+                       partner_k, vi_base)
 
 
 def get_oob_mcf(data_np, y_i, y_nn_i, x_i, d_i, w_i, gen_dic, int_dic, cf_dic,
                 k, single, group_ind_list, forest, no_mp=False,
-                partner_k=None):
+                partner_k=None, vi_base=None):
     """Get the OOB value of a forest.
 
     Parameters
@@ -381,6 +398,9 @@ def get_oob_mcf(data_np, y_i, y_nn_i, x_i, d_i, w_i, gen_dic, int_dic, cf_dic,
     no_mp : Bool. No multiprocessing.  Default is False.
     partner_k : For single variables only: Allows to jointly randomize another
                 single variables that strongly covaries with variable k.
+    vi_base : List of Dicts or None. Results without randomization (see
+              vi_baseline). None: All OOB observations are sent through the
+              trees. Default is None.
 
     Returns
     -------
@@ -393,8 +413,9 @@ def get_oob_mcf(data_np, y_i, y_nn_i, x_i, d_i, w_i, gen_dic, int_dic, cf_dic,
         maxworkers = 1
     else:
         if gen_dic['mp_automatic']:
-            maxworkers = mcf_sys.find_no_of_workers(gen_dic['mp_parallel'],
-                                                    gen_dic['sys_share'])
+            maxworkers = mcf_sys.find_no_of_workers(
+                gen_dic['mp_parallel'], gen_dic['sys_share'],
+                budget_mb=int_dic['mem_budget_mb'])
         else:
             maxworkers = gen_dic['mp_parallel']
     if int_dic['with_output'] and not no_mp and int_dic['verbose']:
@@ -405,7 +426,8 @@ def get_oob_mcf(data_np, y_i, y_nn_i, x_i, d_i, w_i, gen_dic, int_dic, cf_dic,
             data_np_oob = data_np[forest[idx]['oob_indices']]
             oob_tree = get_oob_mcf_b(
                 data_np_oob, y_i, y_nn_i, x_i, d_i, w_i, gen_dic, cf_dic, k,
-                single, group_ind_list, forest[idx], partner_k=partner_k)
+                single, group_ind_list, forest[idx], partner_k=partner_k,
+                tree_base=None if vi_base is None else vi_base[idx])
             oob_value += oob_tree
     else:
         if int_dic['mp_weights_tree_batch'] > 1:  # User defined # of batches
@@ -414,7 +436,9 @@ def get_oob_mcf(data_np, y_i, y_nn_i, x_i, d_i, w_i, gen_dic, int_dic, cf_dic,
         elif int_dic['mp_weights_tree_batch'] == 0:  # Automatic # of batches
             size_of_forest_mb = mcf_sys.total_size(forest) / (1024 * 1024)
             no_of_boot_splits, txt = mcf_sys.no_of_boot_splits_fct(
-                size_of_forest_mb, maxworkers)
+                size_of_forest_mb, maxworkers,
+                budget_mb=int_dic['mem_budget_mb'],
+                sys_share=gen_dic['sys_share'])
             if int_dic['with_output'] and int_dic['verbose']:
                 ps.print_mcf(gen_dic, txt, summary=False)
             split_forest = bool(no_of_boot_splits < cf_dic['boot'])
@@ -430,10 +454,12 @@ def get_oob_mcf(data_np, y_i, y_nn_i, x_i, d_i, w_i, gen_dic, int_dic, cf_dic,
                 ret_fut = {}
                 for idx, b_ind in enumerate(b_ind_list):
                     forest_temp = forest[b_ind[0]:b_ind[-1]+1]
+                    base_temp = (None if vi_base is None
+                                 else vi_base[b_ind[0]:b_ind[-1]+1])
                     ret_fut_t = {fpp.submit(
                         get_oob_mcf_chuncks, data_np, y_i, y_nn_i, x_i, d_i,
                         w_i, gen_dic, cf_dic, k, single, group_ind_list,
-                        forest_temp, b_ind, partner_k): idx}
+                        forest_temp, b_ind, partner_k, base_temp): idx}
                     ret_fut.update(ret_fut_t)
                 for frv in futures.as_completed(ret_fut):
                     oob_value += frv.result()
@@ -445,47 +471,175 @@ def get_oob_mcf(data_np, y_i, y_nn_i, x_i, d_i, w_i, gen_dic, int_dic, cf_dic,
 
 def get_oob_mcf_chuncks(data, y_i, y_nn_i, x_i, d_i, w_i, gen_dic, cf_dic, k,
                         single, group_ind_list, tree_dics, index_list,
-                        partner_k=None):
+                        partner_k=None, vi_base=None):
     """Compute OOB value in chuncks."""
     oob_value = 0
     for idx, _ in enumerate(index_list):
         data_np_oob = data[tree_dics[idx]['oob_indices']]
         oob_value += get_oob_mcf_b(
             data_np_oob, y_i, y_nn_i, x_i, d_i, w_i, gen_dic, cf_dic, k,
-            single, group_ind_list, tree_dics[idx], partner_k)
+            single, group_ind_list, tree_dics[idx], partner_k,
+            None if vi_base is None else vi_base[idx])
     return oob_value
 
 
 def get_oob_mcf_b(data, y_i, y_nn_i, x_i, d_i, w_i, gen_dic, cf_dic, k, single,
-                  group_ind_list, tree_dict, partner_k=None):
-    """Generate OOB contribution for single bootstrap."""
-    x_dat, y_dat = data[:, x_i], data[:, y_i]
-    y_nn = data[:, y_nn_i]
-    d_dat = np.int16(np.round(data[:, d_i]))
-    w_dat = data[:, [w_i]] if gen_dic['weighted'] else None
-    obs = len(y_dat)
+                  group_ind_list, tree_dict, partner_k=None, tree_base=None):
+    """Generate OOB contribution for single bootstrap.
+
+    If tree_base (see vi_baseline_tree) is available, only observations in
+    leaves below a node splitting on a randomized variable are sent through
+    the tree again. All other observations keep their terminal leaf. The
+    contributions to the OOB value are only recomputed for leaves that lose
+    or gain observations.
+    """
+    if single and (k == 0) and tree_base is not None:
+        return tree_base['oob']
+    x_dat = data[:, x_i]
+    obs = x_dat.shape[0]
     rng = np.random.default_rng(55436356)
     if not (single and (k == 0)):
         if single:
             rng.shuffle(x_dat[:, k-1])
+            x_random = [k-1]
             if partner_k is not None:   # Randomises variable related to k-1
                 rng.shuffle(x_dat[:, partner_k-1])
+                x_random.append(partner_k-1)
         else:
             rand_ind = np.arange(obs)
             rng.shuffle(rand_ind)
             for i in group_ind_list[k]:
                 x_dat[:, i] = x_dat[rand_ind, i]
-    obs_in_leaf = np.empty((obs, 2), dtype=np.uint32)
-    for idx in range(obs):
-        leaf_no = mcf_fo_add.get_terminal_leaf_no(tree_dict, x_dat[idx, :])
-        obs_in_leaf[idx, 0], obs_in_leaf[idx, 1] = idx, leaf_no
-    oob_tree = mcf_fo.oob_in_tree(
-        obs_in_leaf, y_dat, y_nn, d_dat, w_dat, cf_dic['mtot'],
-        gen_dic['no_of_treat'], gen_dic['d_values'], gen_dic['weighted'],
-        cont=gen_dic['d_type'] == 'continuous')
+            x_random = list(group_ind_list[k])
+    if tree_base is None:
+        leaf_no = mcf_fo_add.terminal_leaves_tree(tree_dict, x_dat)
+    else:
+        vars_above = np.unpackbits(tree_base['vars_above'], axis=1)
+        reroute = np.any(vars_above[:, x_random], axis=1)[tree_base['leaf']]
+        if not np.any(reroute):
+            return tree_base['oob']
+        leaf_base = tree_base['leaf'].astype(np.int64)
+        leaf_no = leaf_base.copy()
+        leaf_no[reroute] = mcf_fo_add.terminal_leaves_tree(tree_dict,
+                                                           x_dat[reroute])
+        moved = leaf_no != leaf_base
+        if not np.any(moved):
+            return tree_base['oob']
+        changed = np.union1d(leaf_base[moved], leaf_no[moved])
+        if 2 * len(changed) < len(np.unique(leaf_base)):
+            return oob_of_leaves(data, y_i, y_nn_i, d_i, w_i, gen_dic, cf_dic,
+                                 leaf_no, tree_base, leaf_base, changed)
+    return oob_of_leaves(data, y_i, y_nn_i, d_i, w_i, gen_dic, cf_dic,
+                         leaf_no)[0]
+
+
+def oob_of_leaves(data, y_i, y_nn_i, d_i, w_i, gen_dic, cf_dic, leaf_no,
+                  tree_base=None, leaf_base=None, changed=None):
+    """Compute OOB value of tree given terminal leaves of OOB observations.
+
+    If tree_base is given, the sums of the leaves in changed are replaced
+    in the sums of tree_base (leaf_base: terminal leaves of tree_base).
+    """
+    y_dat, y_nn = data[:, y_i], data[:, y_nn_i]
+    d_dat = np.int16(np.round(data[:, d_i]))
+    w_dat = data[:, [w_i]] if gen_dic['weighted'] else None
+    args = (y_dat, y_nn, d_dat, w_dat, cf_dic['mtot'], gen_dic['no_of_treat'],
+            gen_dic['d_values'], gen_dic['weighted'],
+            gen_dic['d_type'] == 'continuous')
+    if tree_base is None:
+        mse_mce_tree, obs_t_tree = mcf_fo.oob_sums_in_tree(leaf_no, *args)
+    else:
+        mse_mce_old, obs_t_old = mcf_fo.oob_sums_in_tree(
+            leaf_base, *args, leaves=changed)
+        mse_mce_new, obs_t_new = mcf_fo.oob_sums_in_tree(
+            leaf_no, *args, leaves=changed)
+        mse_mce_tree = tree_base['sums'][0] - mse_mce_old + mse_mce_new
+        obs_t_tree = tree_base['sums'][1] - obs_t_old + obs_t_new
+    oob_tree = mcf_fo.oob_from_sums(mse_mce_tree, obs_t_tree, cf_dic['mtot'],
+                                    gen_dic['no_of_treat'])
+    if tree_base is None:
+        return oob_tree, (mse_mce_tree, obs_t_tree)
     return oob_tree
 
 
+def vi_baseline(data_np, y_i, y_nn_i, x_i, d_i, w_i, gen_dic, cf_dic, forest,
+                leaf_no_oob=None):
+    """Compute results of all trees needed for variable importance once.
+
+    If leaf_no_oob (see mcf_forest_add_functions.terminal_leaves_oob) is
+    given, the terminal leaves of the OOB observations are looked up instead
+    of sending the observations through the trees.
+
+    Returns
+    -------
+    vi_base : List of Dicts (see vi_baseline_tree).
+
+    """
+    return [vi_baseline_tree(
+        data_np[tree['oob_indices']], y_i, y_nn_i, x_i, d_i, w_i, gen_dic,
+        cf_dic, tree, None if leaf_no_oob is None
+        else leaf_no_oob[tree['oob_indices'], idx])
+        for idx, tree in enumerate(forest[:cf_dic['boot']])]
+
+
+def vi_baseline_tree(data, y_i, y_nn_i, x_i, d_i, w_i, gen_dic, cf_dic,
+                     tree_dict, leaf_no=None):
+    """Compute terminal leaves & OOB value of tree (no randomization).
+
+    Parameters
+    ----------
+    leaf_no : Numpy array or None. Terminal leaves of the observations in
+              data. None: Computed with terminal_leaves_tree.
+              Default is None.
+
+    Returns
+    -------
+    tree_base : Dict. Terminal leaves of OOB observations ('leaf'), bit-packed
+                indicator of variables used for splitting on the path to each
+                leaf ('vars_above'), OOB value of the tree ('oob') and sums of
+                the leaves it is computed from ('sums').
+
+    """
+    if leaf_no is None:
+        leaf_no = mcf_fo_add.terminal_leaves_tree(tree_dict, data[:, x_i])
+    no_of_leaves = len(tree_dict['leaf_info_int'])
+    oob_tree, sums = oob_of_leaves(data, y_i, y_nn_i, d_i, w_i, gen_dic,
+                                   cf_dic, leaf_no)
+    return {'leaf': leaf_no.astype(np.min_scalar_type(no_of_leaves)),
+            'vars_above': np.packbits(split_vars_above(tree_dict, len(x_i)),
+                                      axis=1),
+            'oob': oob_tree, 'sums': sums}
+
+
+def split_vars_above(tree_dict, no_of_vars):
+    """Indicate variables used for splitting on the path to each leaf.
+
+    Parameters
+    ----------
+    tree_dict : Dict. Single tree.
+    no_of_vars : INT. Number of variables.
+
+    Returns
+    -------
+    vars_above : 2D Numpy array of Bool (leaves x variables).
+
+    """
+    leaf_info_int = tree_dict['leaf_info_int'].astype(np.int64)
+    parent, split_var = leaf_info_int[:, 1], leaf_info_int[:, 4]
+    no_of_vars = max(no_of_vars, split_var.max() + 1)
+    vars_above = np.zeros((len(parent), no_of_vars), dtype=bool)
+    # Parents are processed before their daughters (level by level)
+    depth, ancestor = np.zeros(len(parent), dtype=np.int64), parent.copy()
+    while np.any(ancestor >= 0):
+        depth[ancestor >= 0] += 1
+        ancestor = np.where(ancestor >= 0, parent[ancestor], -1)
+    for level in range(1, depth.max() + 1):
+        leaves = np.flatnonzero(depth == level)
+        vars_above[leaves] = vars_above[parent[leaves]]
+        vars_above[leaves, split_var[parent[leaves]]] = True
+    return vars_above
+
+
 def determine_partner_k(x_name):
     """Find variable that is descretized equivalent to other variable.
 
@@ -8,17 +8,19 @@ Contains the functions needed for computing the weights.
 @author: MLechner
 -*- coding: utf-8 -*-
 """
-import os
-from pathlib import Path
 
 import numpy as np
 from scipy import sparse
 import ray
 
+from mcf import mcf_estimation_functions as mcf_est
 from mcf import mcf_forest_add_functions as mcf_fo_add
+from mcf import mcf_forest_asdict_functions as mcf_fo_asdict
 from mcf import mcf_general as mcf_gp
 from mcf import mcf_general_sys as mcf_sys
 from mcf import mcf_print_stats_functions as ps
+from mcf import mcf_ray_pool_functions as mcf_pool
+from mcf import mcf_weight_store_functions as mcf_ws
 
 
 def get_weights_mp(mcf_, data_df, forest_dic, reg_round, with_output=True):
@@ -40,6 +42,8 @@ def get_weights_mp(mcf_, data_df, forest_dic, reg_round, with_output=True):
     cf_dic, ct_dic, p_dic = mcf_.cf_dict, mcf_.ct_dict, mcf_.p_dict
     if int_dic['with_output'] and int_dic['verbose'] and with_output:
         print('\nObtaining weights from estimated forest')
+    # Forests saved with earlier versions encode categorical splits as primes
+    mcf_fo_asdict.convert_forest_cats_prime_to_bitset(forest_dic['forest'])
     if int_dic['weight_as_sparse_splits'] is None:
         if len(data_df) < 5000:
             int_dic['weight_as_sparse_splits'] = 1
@@ -53,17 +57,12 @@ def get_weights_mp(mcf_, data_df, forest_dic, reg_round, with_output=True):
     if int_dic['weight_as_sparse_splits'] == 1 or not int_dic[
             'weight_as_sparse']:
         weights, y_dat, x_bala, cl_dat, w_dat = get_weights_mp_inner(
-            forest_dic, x_dat_all, cf_dic.copy(), ct_dic, gen_dic, int_dic,
-            p_dic, with_output=with_output)
+            mcf_, forest_dic, x_dat_all, cf_dic.copy(), ct_dic, gen_dic,
+            int_dic, p_dic, with_output=with_output)
     else:
-        if gen_dic['outpath'] is None or not os.path.isdir(gen_dic['outpath']):
-            base_file = str(Path(__file__).parent.absolute()) + '/temp_weights'
-        else:
-            base_file = gen_dic['outpath'] + '/' + 'temp_weights'
         x_dat_list = np.array_split(x_dat_all,
                                     int_dic['weight_as_sparse_splits'], axis=0)
         no_x_bala_return = True
-        f_name = []
         for idx, x_dat in enumerate(x_dat_list):
             if int_dic['with_output'] and int_dic['verbose'] and with_output:
                 print('\nWeights computation with additional splitting. ',
@@ -71,53 +70,117 @@ def get_weights_mp(mcf_, data_df, forest_dic, reg_round, with_output=True):
             if idx == len(x_dat_list) - 1:  # Last iteration, get x_bala
                 no_x_bala_return = False
             weights_i, y_dat, x_bala, cl_dat, w_dat = get_weights_mp_inner(
-                forest_dic, x_dat, cf_dic.copy(), ct_dic, gen_dic, int_dic,
-                p_dic, no_x_bala_return=no_x_bala_return,
+                mcf_, forest_dic, x_dat, cf_dic.copy(), ct_dic, gen_dic,
+                int_dic, p_dic, no_x_bala_return=no_x_bala_return,
                 with_output=with_output)
-            f_name_i = []
-            if int_dic['weight_as_sparse_splits'] > 1:
-                elem_per_chunk = len(weights_i)
-                for d_idx, weight_di in enumerate(weights_i):
-                    f_name_d_idx = (base_file + str(idx) + '_' + str(d_idx)
-                                    + '.npz')
-                    mcf_sys.delete_file_if_exists(f_name_d_idx)
-                    sparse.save_npz(f_name_d_idx, weight_di)
-                    f_name_i.append(f_name_d_idx)
-                f_name.append(f_name_i)
-                del weights_i
-            else:
-                weights = weights_i
+            # Chunks stay on disk (memory-mapped, never stacked in RAM)
+            if idx == 0:
+                weights = mcf_ws.weight_store_init(
+                    len(y_dat), len(weights_i), gen_dic['outpath'])
+            mcf_ws.weight_store_add(weights, weights_i)
+            del weights_i
         del x_dat_list, x_dat_all
-        if int_dic['weight_as_sparse_splits'] > 1:
-            weights = []
-            for d_idx in range(elem_per_chunk):
-                w_list = []
-                for idx in range(int_dic['weight_as_sparse_splits']):
-                    file_to_load = f_name[idx][d_idx]
-                    w_list.append(sparse.load_npz(file_to_load))
-                    mcf_sys.delete_file_if_exists(file_to_load)
-                w_all = sparse.vstack(w_list)
-                weights.append(w_all)
-            del w_all, w_list
     if (int_dic['with_output'] and int_dic['verbose']
             and reg_round and with_output):
         no_of_treat = (len(ct_dic['grid_w_val'])
                        if gen_dic['d_type'] == 'continuous'
                        else gen_dic['no_of_treat'])
-        txt = mcf_sys.print_size_weight_matrix(
-            weights, int_dic['weight_as_sparse'], no_of_treat)
+        if mcf_ws.is_weight_store(weights):
+            txt = ('Size of weight matrix (memory-mapped from disk): '
+                   f'{round(weights["nbytes"] / (1024 * 1024), 2)} MB')
+        else:
+            txt = mcf_sys.print_size_weight_matrix(
+                weights, int_dic['weight_as_sparse'], no_of_treat)
         ps.print_mcf(gen_dic, ' ' + txt, summary=False)
+    # Cluster-indicator matrix is built once and used for all effects
+    cl_ind = (mcf_est.cluster_indicator(cl_dat)
+              if p_dic['cluster_std'] and cl_dat is not None else None)
     weights_dic = {'weights': weights, 'y_dat_np': y_dat, 'x_bala_np': x_bala,
-                   'cl_dat_np': cl_dat, 'w_dat_np': w_dat}
+                   'cl_dat_np': cl_dat, 'cl_ind': cl_ind, 'w_dat_np': w_dat}
+    return weights_dic
+
+
+def get_weights_unique_mp(mcf_, data_df, forest_dic, with_output=False):
+    """Get weights for data with many identical rows (BGATE).
+
+    The reference data of the BGATEs replicate the prediction data for every
+    evaluation point of the heterogeneity variable and consist of matched
+    copies of observations. Only the distinct rows of the features are routed
+    through the forest. The weights of all rows are obtained by selecting the
+    rows of the weight matrices. Not used for AMGATEs, whose reference
+    observations all differ (in the heterogeneity variable).
+
+    Parameters
+    ----------
+    mcf_ : mcf-object.
+    data_df : DataFrame: Prediction data (with identical rows).
+    forest_dic : Dict. Forest and Training data as DataFrame.
+    with_output : Boolean. Print output. Default is False.
+
+    Returns
+    -------
+    weights_dic : Dict. Weights and training data as Numpy arrays (as in
+                  get_weights_mp).
+
+    """
+    x_dat_all = data_df[mcf_.var_dict['x_name']].to_numpy()
+    _, first_idx, inverse = np.unique(x_dat_all, axis=0, return_index=True,
+                                      return_inverse=True)
+    if len(first_idx) == len(x_dat_all):   # Nothing to gain
+        return get_weights_mp(mcf_, data_df, forest_dic, 'regular',
+                              with_output=with_output)
+    if (mcf_.int_dict['with_output'] and mcf_.int_dict['verbose']
+            and with_output):
+        print(f'\nWeights for {len(first_idx)} distinct of {len(x_dat_all)}'
+              ' observations')
+    weights_dic = get_weights_mp(mcf_, data_df.iloc[first_idx], forest_dic,
+                                 'regular', with_output=with_output)
+    weights_dic['weights'] = weights_of_rows(
+        weights_dic['weights'], inverse.reshape(-1),
+        mcf_.int_dict['weight_as_sparse'], mcf_.gen_dict['outpath'])
     return weights_dic
 
 
-def get_weights_mp_inner(forest_dic, x_dat, cf_dic, ct_dic, gen_dic, int_dic,
-                         p_dic, no_x_bala_return=False, with_output=True):
+def weights_of_rows(weights, rows, weight_as_sparse, outpath=None):
+    """Select (and replicate) rows of weights.
+
+    Parameters
+    ----------
+    weights : List of csr matrices, weight store, or list (one element per
+              observation, if not weight_as_sparse). Weights.
+    rows : 1D Numpy array of Int. Rows to select (may repeat).
+    weight_as_sparse : Boolean. Weights are sparse.
+    outpath : String or None. Directory of weight store. Default is None.
+
+    Returns
+    -------
+    weights_rows : Weights of rows (same type as weights).
+
+    """
+    if not weight_as_sparse:
+        return [weights[row] for row in rows]
+    if not mcf_ws.is_weight_store(weights):
+        return [weights_t[rows] for weights_t in weights]
+    # Replicated rows go chunk by chunk from the store into a new store
+    n_rows, n_y = mcf_ws.weights_shape(weights)
+    no_of_chunks = round(len(weights['files']) * len(rows) / n_rows)
+    no_of_chunks = min(max(no_of_chunks, 1), len(rows))
+    weights_rows = mcf_ws.weight_store_init(n_y, weights['no_of_treat'],
+                                            outpath)
+    for rows_chunk in np.array_split(rows, no_of_chunks):
+        mcf_ws.weight_store_add(
+            weights_rows, mcf_ws.weight_store_select(weights, rows_chunk))
+    return weights_rows
+
+
+def get_weights_mp_inner(mcf_, forest_dic, x_dat, cf_dic, ct_dic, gen_dic,
+                         int_dic, p_dic, no_x_bala_return=False,
+                         with_output=True):
     """Get weights for obs in pred_data & outcome and cluster from y_data.
 
     Parameters
     ----------
+    mcf_ : mcf-object. Owner of the pool of workers.
     forest_dic : Dict. Contains data and node table of estimated forest.
     x_dat : Numpy array. X-data to make predictions for.
     cf_dic :  Dict. Variables.
@@ -150,8 +213,9 @@ def get_weights_mp_inner(forest_dic, x_dat, cf_dic, ct_dic, gen_dic, int_dic,
         maxworkers = 1
     else:
         if gen_dic['mp_automatic']:
-            maxworkers = mcf_sys.find_no_of_workers(gen_dic['mp_parallel'],
-                                                    gen_dic['sys_share'])
+            maxworkers = mcf_sys.find_no_of_workers(
+                gen_dic['mp_parallel'], gen_dic['sys_share'],
+                budget_mb=int_dic['mem_budget_mb'])
         else:
             maxworkers = gen_dic['mp_parallel']
     if int_dic['with_output'] and int_dic['verbose'] and with_output:
@@ -164,7 +228,16 @@ def get_weights_mp_inner(forest_dic, x_dat, cf_dic, ct_dic, gen_dic, int_dic,
     no_of_treat = (len(ct_dic['grid_w_val'])
                    if gen_dic['d_type'] == 'continuous'
                    else gen_dic['no_of_treat'])
-    if maxworkers == 1 or mp_over_boots:
+    if int_dic['weight_as_sparse'] and gen_dic['d_type'] != 'continuous':
+        # Assemble sparse weight matrices directly from leaf memberships
+        weights, empty_leaf_counter = weights_csr_direct(
+            forest_dic['forest'], x_dat, d_dat, n_y, gen_dic['d_values'],
+            no_of_tree_batches=int_dic['mp_weights_tree_batch'],
+            max_leaf_entries=mcf_sys.max_nnz_in_budget(
+                1, budget_mb=int_dic['mem_budget_mb'], max_nnz=2**26),
+            leaf_cache=forest_dic.get('leaf_cache'))
+        split_forest = False
+    elif maxworkers == 1 or mp_over_boots:
         weights = initialise_weights(n_x, n_y, no_of_treat,
                                      int_dic['weight_as_sparse'])
         split_forest = False
@@ -210,10 +283,12 @@ def get_weights_mp_inner(forest_dic, x_dat, cf_dic, ct_dic, gen_dic, int_dic,
                     txt = '\nUser determined number of tree batches'
                     ps.print_mcf(gen_dic, txt, summary=False)
             elif int_dic['mp_weights_tree_batch'] == 0:  # Automatic # of batch
-                size_of_forest_mb = mcf_sys.total_size(forest_dic['forest']
-                                                       / (1024 * 1024))
+                size_of_forest_mb = mcf_sys.total_size(
+                    forest_dic['forest']) / (1024 * 1024)
                 no_of_boot_splits, txt = mcf_sys.no_of_boot_splits_fct(
-                    size_of_forest_mb, maxworkers)
+                    size_of_forest_mb, maxworkers,
+                    budget_mb=int_dic['mem_budget_mb'],
+                    sys_share=gen_dic['sys_share'])
                 if (int_dic['with_output'] and int_dic['verbose']
                         and with_output):
                     ps.print_mcf(gen_dic, txt, summary=False)
@@ -265,21 +340,12 @@ def get_weights_mp_inner(forest_dic, x_dat, cf_dic, ct_dic, gen_dic, int_dic,
                 if int_dic['ray_or_dask'] != 'ray':
                     forest_temp = forest_dic['forest']
             if int_dic['ray_or_dask'] == 'ray':
-                if int_dic['mem_object_store_3'] is None:
-                    if not ray.is_initialized():
-                        ray.init(num_cpus=maxworkers, include_dashboard=False)
-                else:
-                    if not ray.is_initialized():
-                        ray.init(
-                            num_cpus=maxworkers, include_dashboard=False,
-                            object_store_memory=int_dic['mem_object_store_3'])
-                    if (int_dic['with_output'] and int_dic['verbose']
-                            and with_output):
-                        size = round(int_dic['mem_object_store_3']/(1024*1024))
-                        txt = f'Size of Ray Object Store: {size} MB'
-                        ps.print_mcf(gen_dic, txt, summary=False)
-                x_dat_ref = ray.put(x_dat)
-                forest_ref = ray.put(forest_dic['forest'])
+                mcf_pool.start_worker_pool(mcf_, maxworkers,
+                                           int_dic['mem_object_store_3'])
+                # Forest is put into object store only once per session
+                x_dat_ref = mcf_pool.put_shared(mcf_, 'pred_data', x_dat)
+                forest_ref = mcf_pool.put_shared(
+                    mcf_, 'forest', forest_dic['forest'], max_entries=None)
                 still_running = [ray_weights_many_obs_i.remote(
                     idx_list, n_y, forest_ref, x_dat_ref, d_dat, cf_dic,
                     ct_dic, gen_dic, split_forest)
@@ -316,8 +382,6 @@ def get_weights_mp_inner(forest_dic, x_dat, cf_dic, ct_dic, gen_dic, int_dic,
                     del x_dat_ref, forest_ref
                 if 'rest' in int_dic['mp_ray_del']:
                     del finished_res, finished
-                if int_dic['mp_ray_shutdown']:
-                    ray.shutdown()
             if int_dic['weight_as_sparse']:
                 weights = weights_to_csr(weights, no_of_treat)
             if split_forest:
@@ -329,10 +393,14 @@ def get_weights_mp_inner(forest_dic, x_dat, cf_dic, ct_dic, gen_dic, int_dic,
                 if (int_dic['with_output'] and int_dic['verbose']
                         and with_output):
                     print()
-                    mcf_gp.print_size_weight_matrix(
+                    txt = mcf_sys.print_size_weight_matrix(
                         weights_all, int_dic['weight_as_sparse'], no_of_treat)
-                    _, _, _, _, txt = mcf_sys.memory_statistics()
-                    ps.print_mcf(gen_dic, ' ' + txt, summary=False)
+                    _, _, _, _, txt_mem = mcf_sys.memory_statistics()
+                    ps.print_mcf(gen_dic, ' ' + txt + '\n ' + txt_mem,
+                                 summary=False)
+        if (int_dic['ray_or_dask'] == 'ray'
+                and 'refs' in int_dic['mp_ray_del']):
+            mcf_pool.release_shared(mcf_, 'pred_data')
     if split_forest:
         cf_dic['boot'] = total_bootstraps
         weights = normalize_weights(weights_all, no_of_treat,
@@ -347,14 +415,128 @@ def get_weights_mp_inner(forest_dic, x_dat, cf_dic, ct_dic, gen_dic, int_dic,
     return weights, y_dat, x_bala, cl_dat, w_dat
 
 
+def weights_csr_direct(forest, x_dat, d_dat, n_y, d_values,
+                       no_of_tree_batches=0, normalize=True,
+                       max_leaf_entries=2**26, leaf_cache=None):
+    """Assemble weight matrices (CSR) directly from leaf memberships.
+
+    For every tree, the prediction observations are routed to their terminal
+    leaves (giving a sparse obs x leaf indicator matrix) and the training
+    observations of each complete leaf get the weight 1 / (number of
+    observations with the same treatment in the leaf) (giving a sparse leaf x
+    training obs matrix). The weights are the sums of their products over
+    the trees. Discrete treatments only.
+
+    Parameters
+    ----------
+    forest : List of dict. Trees filled with indices of training data.
+    x_dat : Numpy array. Prediction data.
+    d_dat : Numpy array. Treatment of training data.
+    n_y : Int. Number of training observations.
+    d_values : List of Int. Treatment values.
+    no_of_tree_batches : Int. Minimum number of batches of trees that are
+        processed together. Default is 0.
+    normalize : Bool. Normalize weights to row sum of 1. Default is True.
+    max_leaf_entries : Int. Maximum number of leaf-training obs entries per
+        batch of trees. Default is 2**26.
+    leaf_cache : Dict or None. Cache of terminal leaves of the data used to
+        fill the trees (see mcf_forest_add_functions.terminal_leaves_cached).
+        Used if x_dat is these data. Other data are routed through the trees
+        batch by batch and not cached. Default is None.
+
+    Returns
+    -------
+    weights : List of scipy.sparse.csr_matrix (N_pred x N_y), float32.
+    obs_without_leaf : Int. Number of prediction observations without any
+        complete leaf.
+
+    """
+    n_x, no_of_treat = len(x_dat), len(d_values)
+    d_dat = d_dat.reshape(-1)
+    # Leaves of all trees if x_dat are the data used to fill the trees
+    leaf_no = mcf_fo_add.terminal_leaves_cached(forest, x_dat, leaf_cache)
+    no_of_batches = max(no_of_tree_batches,
+                        int(np.ceil(len(forest) * n_y / max_leaf_entries)), 1)
+    weights = [sparse.csr_matrix((n_x, n_y)) for _ in range(no_of_treat)]
+    no_complete_leaves = np.zeros(n_x, dtype=np.int64)
+    for trees_idx in np.array_split(np.arange(len(forest)), no_of_batches):
+        if len(trees_idx) == 0:
+            continue
+        rows_leaf, cols_leaf, leaf_y_list = [], [], []
+        offset = 0
+        if leaf_no is None:          # Route observations batch by batch
+            leaf_no_batch = mcf_fo_add.terminal_leaves_forest(
+                [forest[b_idx] for b_idx in trees_idx], x_dat)
+        for pos, b_idx in enumerate(trees_idx):
+            complete, leaf_y = leaf_treatment_weights(
+                forest[b_idx], d_dat, d_values, n_y)
+            leaf_no_b = (leaf_no_batch[:, pos] if leaf_no is None
+                         else leaf_no[:, b_idx])
+            leaf_row = np.where(complete, np.arange(len(complete)) + offset,
+                                -1)[leaf_no_b]
+            rows_leaf.append(np.flatnonzero(leaf_row >= 0))
+            cols_leaf.append(leaf_row[leaf_row >= 0])
+            leaf_y_list.append(leaf_y)
+            offset += len(complete)
+        rows_leaf = np.concatenate(rows_leaf)
+        obs_leaf = sparse.csr_matrix(
+            (np.ones(len(rows_leaf)), (rows_leaf, np.concatenate(cols_leaf))),
+            shape=(n_x, offset))
+        no_complete_leaves += np.bincount(rows_leaf, minlength=n_x)
+        for d_idx in range(no_of_treat):
+            leaf_y_d = sparse.vstack([leaf_y[d_idx] for leaf_y in leaf_y_list],
+                                     format='csr')
+            weights[d_idx] = weights[d_idx] + obs_leaf @ leaf_y_d
+    if normalize:
+        weights = normalize_weights(weights, no_of_treat, True, n_x)
+    else:
+        weights = [weights_d.astype(np.float32) for weights_d in weights]
+    return weights, int(np.sum(no_complete_leaves == 0))
+
+
+def leaf_treatment_weights(tree_dict, d_dat, d_values, n_y):
+    """Get weights of training observations in terminal leaves of tree.
+
+    Returns
+    -------
+    complete : 1D Numpy array of Bool. Leaf is filled and contains all
+        treatments.
+    leaf_y : List (no of treatments) of scipy.sparse.csr_matrix (leaves x
+        N_y) with weight 1 / (no. of obs. with treatment in leaf).
+
+    """
+    offsets, indices = mcf_fo_asdict.fill_y_csr(tree_dict)
+    no_of_leaves = len(offsets) - 1
+    no_in_leaf = np.diff(offsets)
+    complete = (no_in_leaf > 0) & (tree_dict['fill_y_empty_leave'] != 1)
+    leaf_id_all = np.repeat(np.arange(no_of_leaves), no_in_leaf)
+    keep = complete[leaf_id_all]
+    leaf_id_all = leaf_id_all[keep]
+    indices_all = indices[keep].astype(np.int64)
+    d_leaf = d_dat[indices_all]
+    treat_masks = [d_leaf == treat for treat in d_values]
+    counts = [np.bincount(leaf_id_all[mask], minlength=no_of_leaves)
+              for mask in treat_masks]
+    for counts_d in counts:
+        complete &= counts_d > 0
+    leaf_y = []
+    for counts_d, mask in zip(counts, treat_masks):
+        mask = mask & complete[leaf_id_all]
+        leaf_id_d = leaf_id_all[mask]
+        leaf_y.append(sparse.csr_matrix(
+            (1 / counts_d[leaf_id_d], (leaf_id_d, indices_all[mask])),
+            shape=(no_of_leaves, n_y)))
+    return complete, leaf_y
+
+
 def normalize_weights(weights, no_of_treat, sparse_m, n_x):
     """Normalise weight matrix (needed when forest is split)."""
     for d_idx in range(no_of_treat):
         if sparse_m:
-            row_sum = 1 / weights[d_idx].sum(axis=1)
-            for i in range(n_x):
-                weights[d_idx][i, :] = weights[d_idx][i, :].multiply(
-                    row_sum[i])
+            row_sum = np.asarray(weights[d_idx].sum(axis=1)).reshape(-1)
+            row_sum_inv = np.divide(1, row_sum, out=np.zeros_like(row_sum),
+                                    where=row_sum > 0)
+            weights[d_idx] = sparse.diags(row_sum_inv) @ weights[d_idx].tocsr()
             weights[d_idx] = weights[d_idx].astype(np.float32,
                                                    casting='same_kind')
         else:
@@ -474,7 +656,8 @@ def weights_obs_i_inside_boot(forest_b, x_dat_i, n_y, no_of_treat,
             leaf_id = mcf_fo_add.get_terminal_leaf_no(forest_b, x_dat_i_t)
             leaf_id_list.append(leaf_id)
             if (forest_b['fill_y_empty_leave'][leaf_id] == 1
-                    or forest_b['fill_y_indices_list'][leaf_id] is None):
+                    or mcf_fo_asdict.leaf_fill_y_indices(forest_b, leaf_id)
+                    is None):
                 empty_leaf, weights_ij_np = True, 0
                 # If any of the subleaves is None, then stop ...
                 break
@@ -483,16 +666,18 @@ def weights_obs_i_inside_boot(forest_b, x_dat_i, n_y, no_of_treat,
     else:
         leaf_id = mcf_fo_add.get_terminal_leaf_no(forest_b, x_dat_i)
         if (forest_b['fill_y_empty_leave'][leaf_id] == 1
-                or forest_b['fill_y_indices_list'][leaf_id] is None):
+                or mcf_fo_asdict.leaf_fill_y_indices(forest_b, leaf_id)
+                is None):
             empty_leaf, weights_ij_np = True, 0
         else:
             empty_leaf = False
     if not empty_leaf:
         if continuous:
-            fb_lid_14_list = [forest_b['fill_y_indices_list'][leaf_id]
-                              for leaf_id in leaf_id_list]
+            fb_lid_14_list = [
+                mcf_fo_asdict.leaf_fill_y_indices(forest_b, leaf_id)
+                for leaf_id in leaf_id_list]
         else:
-            fb_lid_14 = forest_b['fill_y_indices_list'][leaf_id]
+            fb_lid_14 = mcf_fo_asdict.leaf_fill_y_indices(forest_b, leaf_id)
         weights_ij_np = np.zeros((n_y, no_of_treat))
         if continuous:
             # We need to collect information over various leafs for the 0
@@ -0,0 +1,164 @@
+"""
+Contains functions for the out-of-core store of sparse weight matrices.
+
+The weights of a large prediction sample are computed in chunks of rows.
+Every chunk is kept on disk as the three arrays of a CSR matrix (one set for
+each treatment) and is memory-mapped when it is used. A row-offset index
+locates the chunk of every row. The estimators read the weights by blocks of
+rows and never need the full matrix in RAM.
+
+Functions accept either a list of scipy.sparse.csr_matrix (one per
+treatment, as before) or a weight store. A weight store is a dictionary; its
+temporary directory is removed when the store is garbage collected.
+
+Created on Sun Oct 18 19:37:06 2026
+
+@author: MLechner
+# -*- coding: utf-8 -*-
+"""
+import os
+import tempfile
+
+import numpy as np
+from scipy import sparse
+
+
+def weight_store_init(n_y, no_of_treat, outpath=None):
+    """Create an empty store of sparse weight matrices.
+
+    Parameters
+    ----------
+    n_y : Int. Number of columns (training observations).
+    no_of_treat : Int. Number of weight matrices (treatments).
+    outpath : String or None. Directory in which the temporary directory of
+              the store is created. None: Default directory for temporary
+              files. Default is None.
+
+    Returns
+    -------
+    store : Dict. Weight store.
+
+    """
+    if outpath is None or not os.path.isdir(outpath):
+        outpath = None
+    return {'temp_dir': tempfile.TemporaryDirectory(
+                prefix='mcf_weights_', dir=outpath,
+                ignore_cleanup_errors=True),
+            'n_y': n_y, 'no_of_treat': no_of_treat, 'row_start': [0],
+            'files': [], 'nnz': 0, 'nbytes': 0, 'loaded': (None, None)}
+
+
+def weight_store_add(store, weights_chunk):
+    """Append a chunk of rows (list of csr matrices) to the store."""
+    chunk_idx, files = len(store['files']), []
+    for t_idx, weights_t in enumerate(weights_chunk):
+        weights_t = weights_t.tocsr()
+        files_t = []
+        for name in ('data', 'indices', 'indptr'):
+            file_name = os.path.join(store['temp_dir'].name,
+                                     f'w{chunk_idx}_{t_idx}_{name}.npy')
+            array = getattr(weights_t, name)
+            np.save(file_name, array)
+            store['nbytes'] += array.nbytes
+            files_t.append(file_name)
+        files.append(files_t)
+    store['files'].append(files)
+    store['row_start'].append(store['row_start'][-1]
+                              + weights_chunk[0].shape[0])
+    store['nnz'] += sum(weights_t.nnz for weights_t in weights_chunk)
+
+
+def weight_store_chunk(store, chunk_idx):
+    """Get chunk of store as list of memory-mapped csr matrices."""
+    if store['loaded'][0] == chunk_idx:
+        return store['loaded'][1]
+    shape = (store['row_start'][chunk_idx+1] - store['row_start'][chunk_idx],
+             store['n_y'])
+    weights_chunk = []
+    for files_t in store['files'][chunk_idx]:
+        data, indices, indptr = [np.load(file_name, mmap_mode='r')
+                                 for file_name in files_t]
+        weights_chunk.append(sparse.csr_matrix((data, indices, indptr),
+                                               shape=shape, copy=False))
+    store['loaded'] = (chunk_idx, weights_chunk)
+    return weights_chunk
+
+
+def weight_store_select(store, rows):
+    """Get rows (in any order, may repeat) of store as list of csr matrices.
+
+    The rows are selected chunk by chunk of the store, so only the chunks
+    containing the rows are memory-mapped.
+    """
+    rows = np.asarray(rows)
+    row_start = np.asarray(store['row_start'])
+    chunk_of_row = np.searchsorted(row_start, rows, side='right') - 1
+    order = np.argsort(chunk_of_row, kind='stable')
+    chunks, first = np.unique(chunk_of_row[order], return_index=True)
+    pieces = []
+    for chunk_idx, rows_chunk in zip(chunks,
+                                     np.split(rows[order], first[1:])):
+        rows_chunk = rows_chunk - row_start[chunk_idx]
+        pieces.append([weights_t[rows_chunk] for weights_t
+                       in weight_store_chunk(store, chunk_idx)])
+    position = np.empty_like(order)
+    position[order] = np.arange(len(order))
+    return [sparse.vstack([piece[t_idx] for piece in pieces],
+                          format='csr')[position]
+            for t_idx in range(store['no_of_treat'])]
+
+
+def is_weight_store(weights):
+    """Check if weights are a weight store."""
+    return isinstance(weights, dict) and 'row_start' in weights
+
+
+def weights_shape(weights):
+    """Get shape (rows x training obs) of sparse weights (list or store)."""
+    if is_weight_store(weights):
+        return weights['row_start'][-1], weights['n_y']
+    return weights[0].shape
+
+
+def weights_nnz(weights):
+    """Get number of non-zero weights of all treatments (list or store)."""
+    if is_weight_store(weights):
+        return weights['nnz']
+    return sum(weights_t.nnz for weights_t in weights)
+
+
+def weight_blocks(weights):
+    """Iterate over blocks of rows of sparse weights (list or store).
+
+    Yields
+    ------
+    start : Int. First row of block.
+    weights_block : List of csr matrices. Weights of rows of block.
+
+    """
+    if is_weight_store(weights):
+        for chunk_idx in range(len(weights['files'])):
+            yield (weights['row_start'][chunk_idx],
+                   weight_store_chunk(weights, chunk_idx))
+    else:
+        yield 0, weights
+
+
+def weight_rows(weights, start, end):
+    """Get rows start to end (excl.) of sparse weights (list or store)."""
+    if not is_weight_store(weights):
+        return [weights_t[start:end] for weights_t in weights]
+    row_start = weights['row_start']
+    chunk_idx = np.searchsorted(row_start, start, side='right') - 1
+    pieces = []
+    while chunk_idx < len(weights['files']) and row_start[chunk_idx] < end:
+        first, last = row_start[chunk_idx], row_start[chunk_idx+1]
+        pieces.append([weights_t[max(start, first) - first:
+                                 min(end, last) - first]
+                       for weights_t in weight_store_chunk(weights,
+                                                           chunk_idx)])
+        chunk_idx += 1
+    if len(pieces) == 1:
+        return pieces[0]
+    return [sparse.vstack([piece[t_idx] for piece in pieces], format='csr')
+            for t_idx in range(weights['no_of_treat'])]
@@ -0,0 +1,120 @@
+"""
+Tests of the aggregation of sparse weights to ATE and GATE weights.
+
+w_ate_sparse and gate_weights_sparse must give the same (not yet normalized)
+weights as summing the normalized weights of the prediction observations one
+by one, also for weights kept in a weight store. Treatments of the
+prediction data that are not among the treatments of the training data are
+an error.
+
+@author: MLechner
+-*- coding: utf-8 -*-
+"""
+import numpy as np
+import pytest
+from scipy import sparse
+
+from mcf import mcf_ate_functions as mcf_ate
+from mcf import mcf_gate_functions as mcf_gate
+from mcf import mcf_weight_store_functions as mcf_ws
+
+D_VALUES = [0, 1, 2]
+
+
+def random_weights(rng, n_p=30, n_y=60):
+    """Get sparse weights without empty rows for all treatments."""
+    weights = []
+    for _ in D_VALUES:
+        w_dense = rng.uniform(0, 1, (n_p, n_y)) * (
+            rng.uniform(0, 1, (n_p, n_y)) < 0.2)
+        w_dense[:, 0] += 0.1
+        weights.append(sparse.csr_matrix(w_dense))
+    return weights
+
+
+def dictionaries(weighted, choice_based):
+    """Get parameters needed for the aggregation."""
+    gen_dic = {'weighted': weighted, 'with_output': False}
+    p_dic = {'atet': True, 'gatet': True,
+             'choice_based_sampling': choice_based}
+    return gen_dic, p_dic
+
+
+def row_wise_weights(weights, rows, d_p, w_p, w_dat, t_probs, weighted,
+                     choice_based):
+    """Sum normalized weights of rows by target population (all, D=d)."""
+    w_ref = np.zeros((len(D_VALUES) + 1, len(D_VALUES), weights[0].shape[1]))
+    for i in rows:
+        for t_ind, weights_t in enumerate(weights):
+            w_i = weights_t[i].toarray().reshape(-1)
+            if weighted:
+                w_i = w_i * w_dat.reshape(-1)
+            w_i = w_i / np.sum(w_i)
+            if weighted:
+                w_i = w_i * w_p[i, 0]
+            if choice_based:
+                w_i = w_i * t_probs[D_VALUES.index(d_p[i, 0])]
+            w_ref[0, t_ind] += w_i
+            w_ref[D_VALUES.index(d_p[i, 0]) + 1, t_ind] += w_i
+    return w_ref
+
+
+@pytest.mark.parametrize('choice_based', [False, True])
+@pytest.mark.parametrize('weighted', [False, True])
+def test_w_ate_sparse_equals_row_wise(weighted, choice_based):
+    """ATE and ATET weights agree with summing rows one by one."""
+    rng = np.random.default_rng(11)
+    weights = random_weights(rng)
+    n_p, n_y = weights[0].shape
+    d_p = rng.choice(D_VALUES, (n_p, 1))
+    w_p = rng.uniform(0.5, 2, (n_p, 1))
+    w_dat = rng.uniform(0.5, 2, (n_y, 1))
+    t_probs = [0.5, 0.3, 0.2]
+    gen_dic, p_dic = dictionaries(weighted, choice_based)
+    w_ate = mcf_ate.w_ate_sparse(weights, n_y, len(D_VALUES) + 1, D_VALUES,
+                                 d_p, w_p, w_dat, t_probs, gen_dic, p_dic)
+    w_ref = row_wise_weights(weights, range(n_p), d_p, w_p, w_dat, t_probs,
+                             weighted, choice_based)
+    np.testing.assert_allclose(w_ate, w_ref, rtol=1e-12, atol=1e-14)
+
+
+@pytest.mark.parametrize('store', [False, True])
+@pytest.mark.parametrize('weighted', [False, True])
+def test_gate_weights_sparse_equals_row_wise(weighted, store):
+    """GATE and GATET weights agree with summing rows of each z-value."""
+    rng = np.random.default_rng(13)
+    weights = random_weights(rng)
+    n_p, n_y = weights[0].shape
+    d_p = rng.choice(D_VALUES, (n_p, 1))
+    w_p = rng.uniform(0.5, 2, (n_p, 1))
+    w_dat = rng.uniform(0.5, 2, (n_y, 1))
+    z_dat, z_values = rng.choice([1.0, 2.0, 3.0], n_p), [1.0, 2.0, 3.0, 4.0]
+    gen_dic, p_dic = dictionaries(weighted, False)
+    if store:
+        weights_all = mcf_ws.weight_store_init(n_y, len(D_VALUES))
+        for rows in np.array_split(np.arange(n_p), 3):
+            mcf_ws.weight_store_add(weights_all, [weights_t[rows]
+                                                  for weights_t in weights])
+    else:
+        weights_all = weights
+    w_gate = mcf_gate.gate_weights_sparse(
+        z_dat, z_values, weights_all, d_p, w_p, w_dat, None,
+        len(D_VALUES) + 1, D_VALUES, gen_dic, p_dic)
+    assert len(w_gate) == len(z_values)
+    for w_gate_z, z_val in zip(w_gate, z_values):
+        w_ref = row_wise_weights(weights, np.flatnonzero(z_dat == z_val),
+                                 d_p, w_p, w_dat, None, weighted, False)
+        np.testing.assert_allclose(w_gate_z, w_ref, rtol=1e-12, atol=1e-14)
+
+
+def test_unknown_treatment_raises():
+    """Treatment of prediction data not in d_values is an error."""
+    rng = np.random.default_rng(12)
+    weights = random_weights(rng)
+    n_p, n_y = weights[0].shape
+    d_p = np.zeros((n_p, 1), dtype=np.int16)
+    d_p[3] = 5
+    gen_dic, p_dic = dictionaries(False, False)
+    with pytest.raises(ValueError):
+        mcf_ate.w_ate_sparse(weights, n_y, len(D_VALUES) + 1, D_VALUES, d_p,
+                             None, None, None, gen_dic, p_dic)
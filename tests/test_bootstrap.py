@@ -0,0 +1,77 @@
+"""
+Tests of the bootstrap of weighted means used for standard errors.
+
+bootstrap_weighted_means must draw the same random numbers as the loop over
+bootstrap replications it replaces, so the replications are the same for
+the iid and the block (cluster) bootstrap.
+
+@author: MLechner
+-*- coding: utf-8 -*-
+"""
+import numpy as np
+import pytest
+
+from mcf import mcf_estimation_functions as mcf_est
+
+OBS, BOOTSTRAP = 500, 199
+
+
+def bootstrap_loop(w_dat, y_dat, bootstrap, norm=True, cl_dat=None):
+    """Bootstrap replication by replication (previous implementation)."""
+    if cl_dat is not None:
+        unique_cl_id = np.unique(cl_dat)
+        obs_cl = len(unique_cl_id)
+        cl_dat = np.round(cl_dat)
+    rng = np.random.default_rng(123345)
+    est_b = np.empty(bootstrap)
+    for b_idx in range(bootstrap):
+        if cl_dat is not None:
+            idx_cl = rng.integers(0, high=obs_cl, size=obs_cl)
+            idx = []
+            for cl_i in np.round(unique_cl_id[idx_cl]):
+                idx.extend(np.nonzero(cl_dat == cl_i)[0])
+        else:
+            idx = rng.integers(0, high=len(w_dat), size=len(w_dat))
+        w_b = np.copy(w_dat[idx])
+        if norm:
+            w_b = w_b / np.abs(np.sum(w_b))
+        est_b[b_idx] = np.dot(w_b, y_dat[idx])
+    return est_b
+
+
+@pytest.mark.parametrize('max_mem_mb', [256, 0.01])
+@pytest.mark.parametrize('norm', [True, False])
+@pytest.mark.parametrize('cluster', [False, True])
+def test_bootstrap_equals_loop(cluster, norm, max_mem_mb):
+    """Same replications as the loop (matrix product and numba kernel)."""
+    rng = np.random.default_rng(4)
+    w_dat = rng.uniform(0, 1, OBS) * (rng.uniform(0, 1, OBS) < 0.7)
+    y_dat = rng.normal(size=OBS)
+    # Unsorted, non-contiguous cluster ids
+    cl_dat = (rng.choice(rng.permutation(400)[:80], OBS) * 3.0 if cluster
+              else None)
+    est_b = mcf_est.bootstrap_weighted_means(
+        w_dat, y_dat, BOOTSTRAP, norm=norm, cl_dat=cl_dat,
+        max_mem_mb=max_mem_mb)
+    est_ref = bootstrap_loop(w_dat, y_dat, BOOTSTRAP, norm=norm,
+                             cl_dat=cl_dat)
+    np.testing.assert_allclose(est_b, est_ref, rtol=1e-12, atol=1e-14)
+
+
+def test_small_budget_uses_numba_kernel(monkeypatch):
+    """The numba kernel is used if the multipliers do not fit in memory."""
+    calls = []
+    kernel = mcf_est.bootstrap_sums_numba
+
+    def counted_kernel(idx, wy_w):
+        calls.append(idx.shape)
+        return kernel(idx, wy_w)
+
+    monkeypatch.setattr(mcf_est, 'bootstrap_sums_numba', counted_kernel)
+    rng = np.random.default_rng(5)
+    w_dat, y_dat = rng.uniform(0, 1, OBS), rng.normal(size=OBS)
+    mcf_est.bootstrap_weighted_means(w_dat, y_dat, BOOTSTRAP)
+    assert not calls
+    mcf_est.bootstrap_weighted_means(w_dat, y_dat, BOOTSTRAP,
+                                     max_mem_mb=0.01)
+    assert sum(shape[0] for shape in calls) == BOOTSTRAP
@@ -0,0 +1,44 @@
+"""
+Tests of the bitset encoding of categorical splits.
+
+Categorical splits of forests saved with earlier versions are encoded as
+products of primes. Converting them to bitsets and decoding the bitsets
+(bitset_to_primes) must give back the primes of the old encoding.
+
+@author: MLechner
+-*- coding: utf-8 -*-
+"""
+import math
+
+import numpy as np
+import pytest
+
+from mcf import mcf_forest_asdict_functions as mcf_fo_asdict
+from mcf import mcf_general as mcf_gp
+from tree_examples import small_tree
+
+
+@pytest.mark.parametrize('no_primes', [1, 5, 30])
+def test_prime_product_round_trip(no_primes):
+    """Primes of product agree with primes decoded from bitset."""
+    rng = np.random.default_rng(no_primes)
+    primes = mcf_gp.primes_list(1000)[:200]    # Bitsets with several words
+    for _ in range(10):
+        left = sorted(rng.choice(primes, no_primes, replace=False).tolist())
+        bitset = mcf_gp.primes_to_bitset(
+            mcf_gp.primes_reverse(math.prod(left), False))
+        assert mcf_gp.bitset_to_primes(bitset) == left
+
+
+def test_convert_prime_encoded_tree():
+    """Conversion of prime encoded tree agrees with primes of the tree."""
+    tree = small_tree(np.random.default_rng(8), depth=4, prime_encoding=True)
+    cats_prime = list(tree['cats_prime'])
+    mcf_fo_asdict.convert_forest_cats_prime_to_bitset([tree])
+    assert tree['cats_prime'] is None
+    for leaf_id, prime_prod in enumerate(cats_prime):
+        primes = mcf_gp.bitset_to_primes(tree['cats_bitset'][leaf_id])
+        if prime_prod > 1:
+            assert math.prod(primes) == prime_prod
+        else:
+            assert not primes
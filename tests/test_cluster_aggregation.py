@@ -0,0 +1,119 @@
+"""
+Tests of the aggregation of weights and outcomes within clusters.
+
+aggregate_cluster_pos_w (sparse cluster-indicator matrix, single weight
+vectors and batches) must give the same cluster sums and means as a loop
+over clusters.
+
+@author: MLechner
+-*- coding: utf-8 -*-
+"""
+import numpy as np
+import pytest
+
+from mcf import mcf_estimation_functions as mcf_est
+
+OBS, BATCH = 400, 3
+
+
+def aggregate_loop(cl_dat, w_dat, y_dat, norma=True, w2_dat=None,
+                   sweights=None, y2_compute=False):
+    """Aggregate weights and outcomes cluster by cluster (reference)."""
+    cluster_no = np.unique(cl_dat)
+    y_agg = np.zeros((len(cluster_no), y_dat.shape[1]))
+    y2_agg = np.zeros_like(y_agg)
+    w_agg, w2_agg = np.zeros(len(cluster_no)), np.zeros(len(cluster_no))
+    sweights = np.ones(len(w_dat)) if sweights is None else sweights
+    w_pos = np.abs(w_dat) > 1e-15
+    w2_pos = None if w2_dat is None else np.abs(w2_dat) > 1e-15
+    for j, cl_j in enumerate(cluster_no):
+        in_cluster = cl_dat == cl_j
+        pos = in_cluster & w_pos
+        if not np.any(pos):
+            continue
+        w_agg[j] = np.sum(w_dat[pos])
+        y_agg[j] = (w_dat[pos] * sweights[pos]) @ y_dat[pos] / w_agg[j]
+        if w2_dat is not None:
+            w2_agg[j] = np.sum(w2_dat[in_cluster])
+        if y2_compute:
+            pos2 = in_cluster & w2_pos
+            y2_agg[j] = (w2_dat[pos2] * sweights[pos2]) @ y_dat[pos2] / (
+                w2_agg[j])
+    if norma:
+        w_agg = w_agg / np.sum(w_agg)
+        if w2_dat is not None:
+            w2_agg = w2_agg / np.sum(w2_agg)
+    return (w_agg, y_agg, None if w2_dat is None else w2_agg,
+            y2_agg if y2_compute else None)
+
+
+def cluster_data(rng, no_of_y=2):
+    """Get data with unsorted cluster ids and clusters without weights."""
+    cl_dat = rng.choice(rng.permutation(300)[:60], OBS).astype(np.float64)
+    w_dat = rng.uniform(0, 1, (OBS, BATCH)) * (
+        rng.uniform(0, 1, (OBS, BATCH)) < 0.6)
+    # Some clusters only have zero weights
+    w_dat[np.isin(cl_dat, np.unique(cl_dat)[:5])] = 0
+    w2_dat = rng.uniform(0.1, 1, (OBS, BATCH))
+    y_dat = rng.normal(size=(OBS, no_of_y))
+    return cl_dat, w_dat, w2_dat, y_dat
+
+
+@pytest.mark.parametrize('norma', [True, False])
+@pytest.mark.parametrize('sweighted', [False, True])
+@pytest.mark.parametrize('with_w2', [False, True])
+def test_single_and_batch_equal_loop(with_w2, sweighted, norma):
+    """Single vectors and batches agree with the loop over clusters."""
+    rng = np.random.default_rng(1)
+    cl_dat, w_dat, w2_dat, y_dat = cluster_data(rng)
+    sweights = rng.uniform(0.5, 2, OBS) if sweighted else None
+    w2_dat = w2_dat if with_w2 else None
+    cl_ind = mcf_est.cluster_indicator(cl_dat)
+    batch = mcf_est.aggregate_cluster_pos_w(
+        cl_dat, w_dat, y_dat, norma=norma, w2_dat=w2_dat, sweights=sweights,
+        y2_compute=with_w2, cl_ind=cl_ind)
+    for b_idx in range(BATCH):
+        w2_b = None if w2_dat is None else w2_dat[:, b_idx]
+        ref = aggregate_loop(cl_dat, w_dat[:, b_idx], y_dat, norma=norma,
+                             w2_dat=w2_b, sweights=sweights,
+                             y2_compute=with_w2)
+        single = mcf_est.aggregate_cluster_pos_w(
+            cl_dat, w_dat[:, b_idx], y_dat, norma=norma, w2_dat=w2_b,
+            sweights=sweights, y2_compute=with_w2)
+        for res_ref, res_single, res_batch in zip(ref, single, batch):
+            if res_ref is None:
+                assert res_single is None and res_batch is None
+                continue
+            assert res_single.shape == res_ref.shape
+            np.testing.assert_allclose(res_single, res_ref, rtol=1e-12,
+                                       atol=1e-14)
+            np.testing.assert_allclose(res_batch[..., b_idx], res_ref,
+                                       rtol=1e-12, atol=1e-14)
+
+
+def test_cluster_indicator_order():
+    """Rows of the indicator matrix follow the sorted cluster ids."""
+    cl_dat = np.array([7, 2, 7, 11, 2, 7.0])
+    cl_ind = mcf_est.cluster_indicator(cl_dat).toarray()
+    np.testing.assert_array_equal(cl_ind, [[0, 1, 0, 0, 1, 0],
+                                           [1, 0, 1, 0, 0, 1],
+                                           [0, 0, 0, 1, 0, 0]])
+
+
+@pytest.mark.parametrize('y_shape', ['1d', 'column'])
+def test_weight_var_clustered(y_shape):
+    """Clustered variance of a single outcome, also for (n, 1) outcomes."""
+    rng = np.random.default_rng(2)
+    cl_dat, w_dat, _, y_dat = cluster_data(rng, no_of_y=1)
+    w_dat = w_dat[:, 0]
+    gen_dic = {'weighted': False}
+    p_dic = {'cluster_std': True, 'iate_se': True, 'cond_var': False}
+    y_in = y_dat[:, 0] if y_shape == '1d' else y_dat
+    est, variance, w_ret = mcf_est.weight_var(w_dat, y_in, cl_dat, gen_dic,
+                                              p_dic)
+    w_agg, y_agg, _, _ = aggregate_loop(cl_dat, w_dat, y_dat)
+    w_y = (w_agg * y_agg[:, 0])[np.abs(w_agg) > 1e-15]
+    assert np.ndim(est) == 0 and np.ndim(variance) == 0
+    np.testing.assert_allclose(est, np.sum(w_y), rtol=1e-12)
+    np.testing.assert_allclose(variance, len(w_y) * np.var(w_y), rtol=1e-12)
+    np.testing.assert_allclose(w_ret, w_agg, rtol=1e-12)
@@ -0,0 +1,61 @@
+"""
+Tests of the rows of clusters used to draw subsamples of clusters.
+
+rows_of_clusters (with the index of cluster_row_index) must select the
+same rows as np.isin for cluster ids that are not contiguous, not sorted
+and partly not in the data.
+
+@author: MLechner
+-*- coding: utf-8 -*-
+"""
+import numpy as np
+import pytest
+
+from mcf import mcf_forest_data_functions as mcf_fo_data
+
+
+def cluster_data(rng, obs=500):
+    """Get unsorted, non-contiguous cluster ids and all possible ids."""
+    cl_all = rng.permutation(1000)[:120] * 2.5 - 300
+    cl_dat = rng.choice(cl_all[:90], obs)        # Other 30 ids not in data
+    return cl_dat, cl_all
+
+
+def test_cluster_row_index():
+    """Rows sorted by cluster, start and size of each cluster."""
+    cl_dat = np.array([7, 2, 7, 11, 2, 7.0])
+    order, start, count = mcf_fo_data.cluster_row_index(cl_dat)
+    np.testing.assert_array_equal(order, [1, 4, 0, 2, 5, 3])
+    np.testing.assert_array_equal(start, [0, 2, 5])
+    np.testing.assert_array_equal(count, [2, 3, 1])
+
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_rows_of_clusters_equal_isin(seed):
+    """Same rows as np.isin for random selections of cluster ids."""
+    rng = np.random.default_rng(seed)
+    cl_dat, cl_all = cluster_data(rng)
+    cl_rows = mcf_fo_data.cluster_row_index(cl_dat)
+    cl_unique = np.unique(cl_dat)
+    assert len(cl_rows[1]) == len(cl_unique)
+    for no_of_ids in (0, 1, 40, len(cl_all)):
+        # Selected ids in random order, including ids not in the data
+        cl_sel = rng.choice(cl_all, size=no_of_ids, replace=False)
+        clusters = np.flatnonzero(np.isin(cl_unique, cl_sel))
+        rows = mcf_fo_data.rows_of_clusters(cl_rows, rng.permutation(
+            clusters))
+        np.testing.assert_array_equal(
+            rows, np.flatnonzero(np.isin(cl_dat, cl_sel)))
+
+
+def test_rows_of_subsample_of_clusters():
+    """Rows of a subsample of clusters drawn as in build_tree_mcf."""
+    rng = np.random.default_rng(4)
+    cl_dat, _ = cluster_data(rng)
+    cl_rows = mcf_fo_data.cluster_row_index(cl_dat)
+    n_cl = len(cl_rows[1])
+    indices_cl = rng.choice(n_cl, size=round(n_cl * 0.5), replace=False)
+    rows = mcf_fo_data.rows_of_clusters(cl_rows, indices_cl)
+    np.testing.assert_array_equal(rows, np.flatnonzero(
+        np.isin(cl_dat, np.unique(cl_dat)[indices_cl])))
+    assert len(np.unique(cl_dat[rows])) == len(indices_cl)
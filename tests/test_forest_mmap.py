@@ -0,0 +1,128 @@
+"""
+Tests of saving forests as memory-mapped arrays compared to pickle.
+
+@author: MLechner
+-*- coding: utf-8 -*-
+"""
+import copy
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from mcf import mcf_forest_add_functions as mcf_fo_add
+from mcf import mcf_forest_asdict_functions as mcf_fo_asdict
+from mcf import mcf_general_sys as mcf_sys
+from mcf import mcf_weight_functions as mcf_w
+from tree_examples import fill_tree, small_data, small_tree
+
+N_Y = 300
+D_VALUES = [0, 1, 2]
+
+
+@pytest.fixture(name='forest_dic')
+def fixture_forest_dic():
+    """Filled forest with training data (as from train_save_data)."""
+    rng = np.random.default_rng(11)
+    forest = [fill_tree(rng, small_tree(rng, depth=depth,
+                                        prime_encoding=depth == 2), N_Y)
+              for depth in (2, 3, 3, 4)]
+    return {'forest': forest,
+            'y_train_df': pd.DataFrame({'y': rng.normal(size=N_Y)}),
+            'd_train_df': pd.DataFrame({'d': rng.choice(D_VALUES, N_Y)}),
+            'x_bala_df': None, 'cl_train_df': None, 'w_train_df': None,
+            'leaf_cache': None}
+
+
+def forest_weights(forest_dic, x_dat):
+    """Weights of prediction data implied by forest."""
+    weights, _ = mcf_w.weights_csr_direct(
+        forest_dic['forest'], x_dat, forest_dic['d_train_df'].to_numpy(),
+        N_Y, D_VALUES)
+    return weights
+
+
+def test_mmap_equals_pickle(forest_dic, tmp_path):
+    """Forests loaded from pickle and memory-mapped files agree."""
+    x_dat = small_data(np.random.default_rng(12), obs=100)
+    pickle_file = str(tmp_path / 'forest.pickle')
+    mcf_sys.save_load(pickle_file, forest_dic, save=True, output=False)
+    forest_pickle = mcf_sys.save_load(pickle_file, save=False, output=False)
+    mcf_fo_asdict.save_forest_dic_mmap(str(tmp_path / 'mmap'), forest_dic)
+    forest_mmap = mcf_fo_asdict.load_forest_dic_mmap(str(tmp_path / 'mmap'))
+    assert isinstance(forest_mmap['forest'][0]['leaf_info_int'], np.memmap)
+    np.testing.assert_array_equal(
+        mcf_fo_add.terminal_leaves_forest(forest_pickle['forest'], x_dat),
+        mcf_fo_add.terminal_leaves_forest(forest_mmap['forest'], x_dat))
+    for tree_p, tree_m in zip(forest_pickle['forest'], forest_mmap['forest']):
+        for leaf_id in range(len(tree_p['leaf_info_int'])):
+            leaf_p = mcf_fo_asdict.leaf_fill_y_indices(tree_p, leaf_id)
+            leaf_m = mcf_fo_asdict.leaf_fill_y_indices(tree_m, leaf_id)
+            assert (leaf_p is None) == (leaf_m is None)
+            if leaf_p is not None:
+                np.testing.assert_array_equal(leaf_p, leaf_m)
+    for weights_p, weights_m in zip(forest_weights(forest_pickle, x_dat),
+                                    forest_weights(forest_mmap, x_dat)):
+        assert (weights_p != weights_m).nnz == 0
+    pd.testing.assert_frame_equal(forest_pickle['y_train_df'],
+                                  forest_mmap['y_train_df'])
+
+
+def test_save_does_not_change_forest(forest_dic, tmp_path):
+    """Saving keeps the prime encoding of trees of earlier versions."""
+    forest_before = copy.deepcopy(forest_dic['forest'])
+    mcf_fo_asdict.save_forest_dic_mmap(str(tmp_path), forest_dic)
+    for tree, tree_before in zip(forest_dic['forest'], forest_before):
+        assert tree['cats_prime'] == tree_before['cats_prime']
+        assert ((tree['cats_bitset'] is None)
+                == (tree_before['cats_bitset'] is None))
+
+
+def test_forest_list_ignores_earlier_saves(forest_dic, tmp_path):
+    """Folds of an earlier, larger save in the same directory are ignored."""
+    path = str(tmp_path)
+    mcf_fo_asdict.save_forest_list_mmap(path, [[forest_dic, None]] * 3)
+    mcf_fo_asdict.save_forest_list_mmap(path, [[forest_dic]])
+    forest_list = mcf_fo_asdict.load_forest_list_mmap(path)
+    assert len(forest_list) == 1 and len(forest_list[0]) == 1
+    assert len(forest_list[0][0]['forest']) == len(forest_dic['forest'])
+
+
+def test_save_mcf_pickle(forest_dic, tmp_path):
+    """Instance keeps its forests, loaded instance has memory-mapped ones."""
+    mcf_ = SimpleNamespace(int_dict={'forest_mmap_path': 'forests'},
+                           forest=[[forest_dic]])
+    forest = mcf_.forest
+    pickle_file = str(tmp_path / 'mcf.pickle')
+    mcf_fo_asdict.save_mcf_pickle(mcf_, pickle_file, output=False)
+    assert mcf_.forest is forest
+    assert (tmp_path / 'forests' / 'forest_list.json').exists()
+    mcf_load = mcf_fo_asdict.load_mcf_pickle(pickle_file, output=False)
+    tree = mcf_load.forest[0][0]['forest'][0]
+    assert isinstance(tree['leaf_info_int'], np.memmap)
+    np.testing.assert_array_equal(tree['leaf_info_int'],
+                                  forest_dic['forest'][0]['leaf_info_int'])
+
+
+def test_training_data_round_trip(forest_dic, tmp_path):
+    """Index, column names and dtypes of training data survive saving."""
+    rng = np.random.default_rng(13)
+    index = pd.Index(rng.permutation(N_Y) * 3 + 7, name='id')
+    forest_dic['d_train_df'] = pd.DataFrame(
+        {'d': rng.choice(D_VALUES, N_Y).astype(np.int16)}, index=index)
+    forest_dic['x_bala_df'] = pd.DataFrame(
+        {'x1': rng.normal(size=N_Y), 'city': rng.choice(['a', 'bc'], N_Y),
+         'n': rng.integers(0, 9, N_Y)}, index=index)
+    forest_dic['cl_train_df'] = pd.DataFrame({5: rng.integers(0, 9, N_Y)},
+                                             index=index.astype(str))
+    path = str(tmp_path)
+    mcf_fo_asdict.save_forest_dic_mmap(path, forest_dic)
+    forest_mmap = mcf_fo_asdict.load_forest_dic_mmap(path)
+    for key in ('y_train_df', 'd_train_df', 'x_bala_df', 'cl_train_df'):
+        pd.testing.assert_frame_equal(forest_mmap[key], forest_dic[key])
+    for key in ('y_train_df', 'd_train_df'):     # Numeric: memory mapped
+        values = forest_mmap[key].to_numpy()
+        while values.base is not None and not isinstance(values, np.memmap):
+            values = values.base
+        assert isinstance(values, np.memmap)
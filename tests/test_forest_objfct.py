@@ -0,0 +1,60 @@
+"""
+Tests of the numba versions of the objective function of the forest.
+
+mcf_mse (mcf_mse_numba, mcf_mse_numba_w) must give the same MSE and MCE as
+the reference implementation mcf_mse_not_numba. Treatment shares are not
+compared as they are not used (and not computed identically for mtot=3).
+
+@author: MLechner
+-*- coding: utf-8 -*-
+"""
+import numpy as np
+import pytest
+
+from mcf import mcf_forest_objfct_functions as mcf_obj
+
+
+def random_leaf(rng, no_of_treat, obs):
+    """Get data of a leaf with all treatments present."""
+    d_dat = np.concatenate((np.arange(no_of_treat),
+                            rng.integers(0, no_of_treat, obs - no_of_treat)))
+    y_dat = rng.normal(5, 2, (obs, 1))
+    y_nn = rng.normal(3, 1, (obs, no_of_treat))
+    w_dat = rng.uniform(0.1, 3, (obs, 1))
+    return y_dat, y_nn, d_dat.reshape(-1, 1), w_dat
+
+
+@pytest.mark.parametrize('splitting', [False, True])
+@pytest.mark.parametrize('w_yes', [False, True])
+@pytest.mark.parametrize('mtot', [1, 2, 3, 4])
+@pytest.mark.parametrize('no_of_treat', [2, 3, 4])
+def test_numba_equals_not_numba(no_of_treat, mtot, w_yes, splitting):
+    """MSE and MCE of numba version agree with reference implementation."""
+    rng = np.random.default_rng(10 * no_of_treat + mtot)
+    treat_values = list(range(no_of_treat))
+    for obs in (3 * no_of_treat, 50, 300):
+        y_dat, y_nn, d_dat, w_dat = random_leaf(rng, no_of_treat, obs)
+        mse_mce, _, obs_by_treat = mcf_obj.mcf_mse(
+            y_dat, y_nn, d_dat, w_dat, obs, mtot, no_of_treat, treat_values,
+            w_yes=w_yes, splitting=splitting)
+        mse_mce_ref, _, obs_by_treat_ref = mcf_obj.mcf_mse_not_numba(
+            y_dat, y_nn, d_dat, w_dat, obs, mtot, no_of_treat, treat_values,
+            w_yes, splitting=splitting)
+        np.testing.assert_allclose(mse_mce, mse_mce_ref, rtol=1e-10,
+                                   atol=1e-12)
+        np.testing.assert_array_equal(obs_by_treat, obs_by_treat_ref)
+
+
+@pytest.mark.parametrize('w_yes', [False, True])
+@pytest.mark.parametrize('mtot', [2, 3])
+def test_without_matched_outcomes(mtot, w_yes):
+    """Methods without MCE accept leaves without matched outcomes (0)."""
+    rng = np.random.default_rng(mtot)
+    y_dat, y_nn, d_dat, w_dat = random_leaf(rng, 3, 60)
+    mse_mce, _, obs_by_treat = mcf_obj.mcf_mse(
+        y_dat, 0, d_dat, w_dat if w_yes else 0, 60, mtot, 3, [0, 1, 2],
+        w_yes=w_yes)
+    mse_mce_ref, _, obs_by_treat_ref = mcf_obj.mcf_mse_not_numba(
+        y_dat, y_nn, d_dat, w_dat, 60, mtot, 3, [0, 1, 2], w_yes)
+    np.testing.assert_allclose(mse_mce, mse_mce_ref, rtol=1e-10, atol=1e-12)
+    np.testing.assert_array_equal(obs_by_treat, obs_by_treat_ref)
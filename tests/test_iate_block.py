@@ -0,0 +1,93 @@
+"""
+Tests of the block-wise computation of IATEs from sparse weights.
+
+iate_block_for_mp must give the same potential outcomes, variances and
+weight statistics as the row-wise iate_func1_for_mp, also for rows of
+weights without any non-zero entry and with capped weight shares.
+
+@author: MLechner
+-*- coding: utf-8 -*-
+"""
+import warnings
+
+import numpy as np
+import pytest
+from scipy.sparse import csr_matrix
+
+from mcf import mcf_iate_functions as mcf_iate
+
+
+def random_weights(rng, n_rows, n_y, empty_rows=(0, 2)):
+    """Get sparse weights of one treatment with some empty rows."""
+    w_dense = np.zeros((n_rows, n_y))
+    for row in range(n_rows):
+        if row not in empty_rows:
+            no_pos = rng.choice((3, 8, 20))
+            idx = rng.choice(n_y, no_pos, replace=False)
+            w_dense[row, idx] = rng.integers(1, 4, no_pos) / 7
+    return csr_matrix(w_dense)
+
+
+def dictionaries(weighted, cond_var, keep_w0, max_weight_share):
+    """Get parameters needed for the IATE computations."""
+    gen_dic = {'d_type': 'discrete', 'no_of_treat': 3, 'd_values': [0, 1, 2],
+               'weighted': weighted, 'with_output': False, 'verbose': False}
+    int_dic = {'weight_as_sparse': True, 'keep_w0': keep_w0,
+               'ray_or_dask': 'ray'}
+    p_dic = {'max_weight_share': max_weight_share, 'cond_var': cond_var,
+             'knn': True, 'knn_const': 1, 'knn_min_k': 10, 'iate_se': True,
+             'cluster_std': False, 'q_w': [0.5, 0.25, 0.1, 0.05]}
+    return gen_dic, int_dic, p_dic
+
+
+@pytest.mark.parametrize('max_weight_share', [0.05, 1])
+@pytest.mark.parametrize('keep_w0', [False, True])
+@pytest.mark.parametrize('cond_var', [False, True])
+@pytest.mark.parametrize('weighted', [False, True])
+def test_block_equals_row_wise(weighted, cond_var, keep_w0,
+                               max_weight_share):
+    """Block computation agrees with row-wise computation."""
+    rng = np.random.default_rng(7)
+    n_rows, n_y = 12, 100
+    gen_dic, int_dic, p_dic = dictionaries(weighted, cond_var, keep_w0,
+                                           max_weight_share)
+    # Row-wise reference divides by zero when capping empty rows
+    empty_rows = (0, 2) if max_weight_share == 1 else ()
+    weights = [random_weights(rng, n_rows, n_y, empty_rows)
+               for _ in range(3)]
+    y_dat = rng.normal(5, 3, (n_y, 2))
+    w_dat = rng.uniform(0.5, 2, (n_y, 1))
+    with warnings.catch_warnings():   # Mean of empty rows in reference
+        warnings.simplefilter('ignore', RuntimeWarning)
+        ref = [mcf_iate.iate_func1_for_mp(
+            row, [w_t.getrow(row) for w_t in weights], None, None, w_dat,
+            None, y_dat, 2, n_y, {}, int_dic, gen_dic, p_dic, True, False,
+            False) for row in range(n_rows)]
+    _, pot_y, pot_y_var, l1_to_9, share = mcf_iate.iate_block_for_mp(
+        0, weights, w_dat, y_dat, n_y, int_dic, gen_dic, p_dic, True)
+    np.testing.assert_allclose(pot_y, [r[1] for r in ref], atol=1e-12)
+    np.testing.assert_allclose(pot_y_var, [r[2] for r in ref], rtol=1e-9)
+    np.testing.assert_allclose(share, np.sum([r[6] for r in ref], axis=0))
+    if max_weight_share < 1:
+        assert np.all(share > 0)    # Capping kernel is used
+    for k, stat in enumerate(l1_to_9):
+        if k == 6:    # Not initialised in analyse_weights for few weights
+            continue
+        # Reference gives nan for mean and std of rows without weights
+        stat_ref = np.nansum([np.asarray(r[5][k], dtype=np.float64)
+                              for r in ref], axis=0)
+        np.testing.assert_allclose(stat, stat_ref, rtol=1e-10, atol=1e-10)
+
+
+def test_weight_stats_rows_without_positive_weights():
+    """Empty rows and rows of zeros give zero statistics."""
+    indptr = np.array([0, 0, 3, 5])
+    w_data = np.array([0.2, 0.3, 0.5, 0.0, 0.0])
+    q_w = np.array([0.5, 0.25])
+    stats, largest_q, sum_larger, obs_larger, few_pos = (
+        mcf_iate.weight_stats_rows_numba(indptr, w_data, 10, q_w))
+    for row in (0, 2):
+        np.testing.assert_array_equal(stats[row], [0, 10, 0, 0, 0, 0])
+    assert np.all(few_pos)
+    for stat in (largest_q, sum_larger, obs_larger):
+        assert np.all(stat == 0)
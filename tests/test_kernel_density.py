@@ -0,0 +1,72 @@
+"""
+Tests of the linear-time kernel density and Nadaraya-Watson estimators.
+
+kernel_density and nadaraya_watson are the exact references. The sorted
+window estimator of the Epanechikov kernel must agree with them up to
+rounding, the binned estimator (used for the normal kernel with large data)
+up to its approximation error.
+
+@author: MLechner
+-*- coding: utf-8 -*-
+"""
+import numpy as np
+import pytest
+
+from mcf import mcf_estimation_functions as mcf_est
+
+
+def sample(obs=2000, seed=11):
+    """Get skewed data, outcomes and grid including points outside data."""
+    rng = np.random.default_rng(seed)
+    x_dat = rng.gamma(2, 1, obs)
+    y_dat = np.sin(x_dat) + rng.normal(0, 0.3, obs)
+    grid = np.concatenate((np.linspace(-1, 12, 101), x_dat[:50]))
+    return x_dat, y_dat, grid
+
+
+@pytest.mark.parametrize('bandwidth', [0.05, 0.3, 2])
+def test_window_equals_reference(bandwidth):
+    """Epanechikov density (of data * y) from windows is exact."""
+    x_dat, y_dat, grid = sample()
+    np.testing.assert_allclose(
+        mcf_est.kernel_density_window(x_dat, grid, bandwidth),
+        mcf_est.kernel_density(x_dat, grid, 1, bandwidth), atol=1e-12)
+    np.testing.assert_allclose(
+        mcf_est.kernel_density_window(x_dat, grid, bandwidth, y_dat=y_dat),
+        mcf_est.kernel_density_y(y_dat.reshape(-1, 1), x_dat, grid, 1,
+                                 bandwidth), atol=1e-12)
+
+
+@pytest.mark.parametrize('kernel', [1, 2])
+def test_fast_exact_path_equals_reference(kernel):
+    """Nadaraya-Watson below max_exact equals reference (data as grid)."""
+    x_dat, y_dat, _ = sample(obs=1000)
+    band = mcf_est.bandwidth_nw_rule_of_thumb(x_dat)
+    np.testing.assert_allclose(
+        mcf_est.nadaraya_watson_fast(y_dat, x_dat, x_dat, kernel, band),
+        mcf_est.nadaraya_watson(y_dat, x_dat, x_dat, kernel, band),
+        rtol=1e-9, atol=1e-12)
+
+
+@pytest.mark.parametrize('kernel', [1, 2])
+@pytest.mark.parametrize('bandwidth', [0.1, 0.5])
+def test_binned_close_to_reference(kernel, bandwidth):
+    """Binned density (of data * y) approximates the reference closely."""
+    x_dat, y_dat, grid = sample()
+    f_ref = mcf_est.kernel_density(x_dat, grid, kernel, bandwidth)
+    fy_ref = mcf_est.kernel_density_y(y_dat.reshape(-1, 1), x_dat, grid,
+                                      kernel, bandwidth)
+    f_bin = mcf_est.kernel_density_binned(x_dat, grid, kernel, bandwidth)
+    fy_bin = mcf_est.kernel_density_binned(x_dat, grid, kernel, bandwidth,
+                                           y_dat=y_dat)
+    np.testing.assert_allclose(f_bin, f_ref, atol=5e-4 * f_ref.max())
+    np.testing.assert_allclose(fy_bin, fy_ref, atol=5e-4 * f_ref.max())
+
+
+def test_fast_normal_kernel_binned_above_max_exact():
+    """Normal kernel switches to the binned estimator above max_exact."""
+    x_dat, y_dat, grid = sample()
+    np.testing.assert_array_equal(
+        mcf_est.kernel_density_fast(x_dat, grid, 2, 0.3, y_dat=y_dat,
+                                    max_exact=len(x_dat) * len(grid) - 1),
+        mcf_est.kernel_density_binned(x_dat, grid, 2, 0.3, y_dat=y_dat))
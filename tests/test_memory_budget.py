@@ -0,0 +1,84 @@
+"""
+Tests of the memory budget used to choose workers and chunk sizes.
+
+The available memory is fixed (memory_statistics is replaced), so that the
+number of workers, the chunk sizes and the size of the Ray object stores
+follow from the formulas of the scheduler.
+
+@author: MLechner
+-*- coding: utf-8 -*-
+"""
+import pytest
+
+from mcf import mcf_general_sys as mcf_sys
+from mcf import mcf_init_functions as mcf_init
+
+AVAILABLE_MB = 16000
+MB = 1024 * 1024
+
+
+@pytest.fixture(autouse=True)
+def fixed_memory(monkeypatch):
+    """Available memory of AVAILABLE_MB."""
+    monkeypatch.setattr(
+        mcf_sys, 'memory_statistics',
+        lambda: (32000, AVAILABLE_MB, 16000, AVAILABLE_MB, ''))
+
+
+@pytest.mark.parametrize('budget_mb, sys_share, expected', [
+    (None, 0, 12000), (0, 0, 12000), (None, 0.5, 9000), (4000, 0, 4000),
+    (50000, 0, AVAILABLE_MB)])
+def test_memory_budget(budget_mb, sys_share, expected):
+    """Default share of available memory, user budget capped at it."""
+    assert mcf_sys.memory_budget_mb(budget_mb, sys_share) == pytest.approx(
+        expected)
+
+
+@pytest.mark.parametrize('maxworkers, task_mb, shared_mb, budget_mb, expected',
+                         [(8, 750, 0, 4000, 4), (8, 750, 1000, 4000, 3),
+                          (2, 750, 0, 4000, 2), (8, 750, 0, 100, 1),
+                          (8, 0, 0, None, 8), (64, 0, 0, None, 48)])
+def test_find_no_of_workers(maxworkers, task_mb, shared_mb, budget_mb,
+                            expected):
+    """Workers (and their tasks) fit into the budget minus shared objects."""
+    assert mcf_sys.find_no_of_workers(
+        maxworkers, task_mb=task_mb, shared_mb=shared_mb,
+        budget_mb=budget_mb) == expected
+
+
+def test_no_of_boot_splits():
+    """Chunks of trees of each worker fit into its share of the budget."""
+    # Chunk: (4000 / 2 - 250) / 4 = 437.5 MB
+    no_of_splits, _ = mcf_sys.no_of_boot_splits_fct(3000, 2, budget_mb=4000)
+    assert no_of_splits == 7
+    no_of_splits, _ = mcf_sys.no_of_boot_splits_fct(100, 2, budget_mb=4000)
+    assert no_of_splits == 1
+
+
+def test_max_nnz_in_budget():
+    """Sparse weights per task follow the budget within their bounds."""
+    assert mcf_sys.max_nnz_in_budget(2, budget_mb=4000) == (
+        1750 * MB // mcf_sys.MEM_BYTES_PER_NNZ)
+    assert mcf_sys.max_nnz_in_budget(2, budget_mb=100) == 2**20
+    assert mcf_sys.max_nnz_in_budget(1, budget_mb=None, max_nnz=2**26) == (
+        2**26)
+
+
+def test_object_store_only_for_explicit_budget():
+    """Object stores are limited only if the user sets a budget."""
+    assert mcf_sys.object_store_bytes(10**12) == 10**12
+    assert mcf_sys.object_store_bytes(10**12, budget_mb=0) == 10**12
+    assert mcf_sys.object_store_bytes(10**12, budget_mb=4000) == (
+        0.5 * 4000 * MB)
+    assert mcf_sys.object_store_bytes(10**6, budget_mb=4000) == 10**6
+    assert mcf_sys.object_store_bytes(None, budget_mb=4000) is None
+
+
+@pytest.mark.parametrize('budget_mb, expected', [
+    (4000, 60000), (3000, 2750 * MB // (4 * 8 * 2000)), (260, 60000)])
+def test_chunks_maxsize_in_budget(budget_mb, expected):
+    """Chunk size is reduced to the rows fitting into the budget."""
+    gen_dic = {'mp_parallel': 1, 'mp_automatic': False, 'sys_share': 0,
+               'with_output': False}
+    assert mcf_init.chunks_maxsize_in_budget(
+        60000, 2000, gen_dic, budget_mb, with_output=False) == expected
@@ -0,0 +1,60 @@
+"""
+Tests of the nearest neighbour matching of outcomes.
+
+The KD-tree search (nn_neighbour_tree) must give the same matched outcomes
+as the brute force Mahalanobis search, including the averaging over tied
+nearest neighbours.
+
+@author: MLechner
+-*- coding: utf-8 -*-
+"""
+import numpy as np
+import pytest
+
+from mcf import mcf_forest_data_functions as mcf_fo_data
+
+OBS, NO_OF_TREAT = 300, 3
+
+
+def matched_outcomes(x_dat, cov_x_inv, seed):
+    """Get matched outcomes of all treatments with and without KD-tree."""
+    rng = np.random.default_rng(seed)
+    d_dat = rng.integers(0, NO_OF_TREAT, (OBS, 1))
+    y_dat = rng.normal(size=(OBS, 1))
+    for treat_value in range(NO_OF_TREAT):
+        yield tuple(mcf_fo_data.nn_neighbour_mcf2(
+            y_dat, x_dat, d_dat, OBS, cov_x_inv, treat_value,
+            tree_search=tree_search) for tree_search in (True, False))
+
+
+def test_tree_equals_brute_force_continuous():
+    """Same matches for continuous covariates (no ties)."""
+    rng = np.random.default_rng(1)
+    x_dat = rng.normal(size=(OBS, 4)) @ rng.normal(size=(4, 4))
+    cov_x_inv = np.linalg.inv(np.cov(x_dat, rowvar=False))
+    for y_tree, y_brute in matched_outcomes(x_dat, cov_x_inv, 1):
+        np.testing.assert_allclose(y_tree, y_brute, rtol=1e-12)
+
+
+def test_tree_equals_brute_force_ties():
+    """Same averages of tied neighbours for discrete covariates."""
+    rng = np.random.default_rng(2)
+    x_dat = rng.integers(0, 3, (OBS, 2)).astype(np.float64)
+    cov_x_inv = np.linalg.inv(np.cov(x_dat, rowvar=False))
+    # 9 cells for 300 observations: more ties than neighbours of 1st query
+    assert len(np.unique(x_dat, axis=0)) == 9
+    for y_tree, y_brute in matched_outcomes(x_dat, cov_x_inv, 2):
+        np.testing.assert_allclose(y_tree, y_brute, rtol=1e-12)
+
+
+@pytest.mark.parametrize('scalar', [False, True])
+def test_tree_equals_brute_force_diagonal(scalar):
+    """Same matches for diagonal and scalar inverse covariance matrices."""
+    rng = np.random.default_rng(3)
+    if scalar:
+        x_dat, cov_x_inv = rng.normal(size=(OBS, 1)), 2.5
+    else:
+        x_dat = rng.normal(size=(OBS, 3)) * [1, 4, 0.5]
+        cov_x_inv = np.diag(1 / np.var(x_dat, axis=0))
+    for y_tree, y_brute in matched_outcomes(x_dat, cov_x_inv, 3):
+        np.testing.assert_allclose(y_tree, y_brute, rtol=1e-12)
@@ -0,0 +1,129 @@
+"""
+Tests of the prediction in chunks (out-of-core).
+
+stream_weights must aggregate the ATE and GATE weights of several chunks to
+the weights of all prediction data. predict_stream must give the same ATEs,
+GATEs and IATEs as predict when the prediction data is split into several
+chunks.
+
+@author: MLechner
+-*- coding: utf-8 -*-
+"""
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+
+from mcf.example_data_functions import example_data
+from mcf import mcf_ate_functions as mcf_ate
+from mcf import mcf_gate_functions as mcf_gate
+from mcf import mcf_predict_stream_functions as mcf_stream
+
+D_VALUES, Z_VALUES = [0, 1, 2], [0, 1, 2]
+N_P, N_Y = 250, 60
+
+
+def fold_weights(rng):
+    """Get sparse weights of all prediction observations for one fold."""
+    weights = []
+    for _ in D_VALUES:
+        w_dense = rng.uniform(0, 1, (N_P, N_Y)) * (
+            rng.uniform(0, 1, (N_P, N_Y)) < 0.2)
+        w_dense[:, 0] += 0.1
+        weights.append(sparse.csr_matrix(w_dense))
+    return weights
+
+
+def fake_get_weights_mp(mcf_, data_df, forest_dic, reg_round,
+                        with_output=True):
+    """Weights of the chunk: Rows of the weights of all observations."""
+    rows = data_df['row'].to_numpy()
+    return {'weights': [w_t[rows] for w_t in forest_dic['weights']],
+            'y_dat_np': forest_dic['y_dat_np'],
+            'w_dat_np': forest_dic['w_dat_np']}
+
+
+@pytest.mark.parametrize('weighted', [False, True])
+def test_stream_weights_equal_weights_of_all_data(weighted, tmp_path,
+                                                  monkeypatch):
+    """Aggregated weights of chunks agree with aggregation in one go."""
+    rng = np.random.default_rng(5)
+    data_df = pd.DataFrame({'row': np.arange(N_P),
+                            'd': rng.choice(D_VALUES, N_P),
+                            'w': rng.uniform(0.5, 2, N_P),
+                            'z': rng.choice(Z_VALUES, N_P)})
+    forests = [{'weights': fold_weights(rng),
+                'y_dat_np': rng.normal(size=(N_Y, 1)),
+                'w_dat_np': rng.uniform(0.5, 2, (N_Y, 1))} for _ in range(2)]
+    gen_dic = {'weighted': weighted, 'with_output': False,
+               'd_type': 'discrete'}
+    p_dic = {'atet': True, 'gatet': True, 'choice_based_sampling': False,
+             'choice_based_probs': None}
+    mcf_ = SimpleNamespace(
+        gen_dict=gen_dic, p_dict=p_dic,
+        int_dict={'with_output': False, 'verbose': False},
+        var_dict={'d_name': ['d'], 'w_name': ['w'], 'z_name': ['z']})
+    monkeypatch.setattr(mcf_stream, 'prepare_chunk',
+                        lambda mcf_, data_df: data_df)
+    monkeypatch.setattr(mcf_stream.mcf_w, 'get_weights_mp',
+                        fake_get_weights_mp)
+    chunk_files, w_ate_agg, w_gate_agg, train_dic, eval_df = (
+        mcf_stream.stream_weights(mcf_, mcf_, data_df, forests, 100,
+                                  [Z_VALUES], D_VALUES, str(tmp_path)))
+    assert len(chunk_files) == 3
+    pd.testing.assert_frame_equal(
+        eval_df, data_df[['d', 'w', 'z'] if weighted else ['d', 'z']])
+    d_p, w_p = data_df[['d']].to_numpy(), data_df[['w']].to_numpy()
+    for fold, forest_dic in enumerate(forests):
+        assert train_dic[fold]['y_dat_np'] is forest_dic['y_dat_np']
+        w_dat = forest_dic['w_dat_np'] if weighted else None
+        w_ate = mcf_ate.w_ate_sparse(
+            forest_dic['weights'], N_Y, len(D_VALUES) + 1, D_VALUES, d_p,
+            w_p, w_dat, None, gen_dic, p_dic)
+        w_gate = mcf_gate.gate_weights_sparse(
+            data_df['z'].to_numpy(), Z_VALUES, forest_dic['weights'], d_p,
+            w_p, w_dat, None, len(D_VALUES) + 1, D_VALUES, gen_dic, p_dic)
+        np.testing.assert_allclose(w_ate_agg[fold], w_ate, rtol=1e-12)
+        for w_gate_agg_zj, w_gate_zj in zip(w_gate_agg[fold][0], w_gate):
+            np.testing.assert_allclose(w_gate_agg_zj, w_gate_zj, rtol=1e-12)
+        for t_idx, weights_t in enumerate(forest_dic['weights']):
+            weights_saved = sparse.vstack([sparse.load_npz(
+                files['weights'][fold][t_idx]) for files in chunk_files])
+            assert (weights_saved != weights_t).nnz == 0
+
+
+def test_predict_stream_equals_predict(tmp_path):
+    """ATE, ATET, GATE and IATE agree with prediction in one go."""
+    mcf_functions = pytest.importorskip('mcf.mcf_functions')
+    train_df, pred_df, name_dict = example_data(
+        obs_y_d_x_iate=600, obs_x_iate=250, no_features=4, no_treatments=2,
+        seed=3, descr_stats=False)
+    mymcf = mcf_functions.ModifiedCausalForest(
+        var_d_name=name_dict['d_name'], var_y_name=name_dict['y_name'],
+        var_id_name=name_dict['id_name'],
+        var_x_name_ord=name_dict['x_name_ord'],
+        var_x_name_unord=name_dict['x_name_unord'],
+        var_z_name_ord=name_dict['x_name_ord'][-1:],
+        cf_boot=40, gen_mp_parallel=1, gen_outpath=str(tmp_path),
+        p_atet=True, p_gatet=True, p_gates_smooth=False, p_bt_yes=False,
+        post_est_stats=False, _int_show_plots=False, _int_with_output=False,
+        _int_verbose=False, _int_predict_stream_mb=1)
+    mymcf.train(train_df)
+    results, _ = mymcf.predict(pred_df)
+    iate_file = tmp_path / 'iate_stream.csv'
+    # Smallest chunks (100 observations): 3 chunks
+    results_s, _ = mymcf.predict_stream(pred_df, iate_file=iate_file)
+    np.testing.assert_allclose(results_s['ate'], results['ate'], rtol=1e-8)
+    np.testing.assert_allclose(results_s['ate_se'], results['ate_se'],
+                               rtol=1e-8)
+    for gate_s, gate in zip(results_s['gate'], results['gate']):
+        np.testing.assert_allclose(gate_s, gate, rtol=1e-8, atol=1e-12)
+    iate_s_df = pd.read_csv(iate_file)
+    id_name = name_dict['id_name']
+    iate_df = results['iate_data_df'].set_index(id_name).loc[
+        iate_s_df[id_name]]
+    for name in iate_s_df.columns.drop(id_name):
+        np.testing.assert_allclose(iate_s_df[name], iate_df[name],
+                                   rtol=1e-8, atol=1e-10)
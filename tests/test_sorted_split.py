@@ -0,0 +1,174 @@
+"""
+Tests of the sorted split search.
+
+On data without ties (continuous features and outcomes), next_split must
+choose the same split with the sorted split search (one pass over the sorted
+data of each variable) as with the evaluation of each splitting value. In
+histogram split mode, the statistics of the bin boundaries must be those of
+the sorted split search at the same values, also if the histogram of a leaf
+is obtained from the histograms of its parent and sibling.
+
+@author: MLechner
+-*- coding: utf-8 -*-
+"""
+import inspect
+
+import numpy as np
+import pytest
+
+from mcf import mcf_forest_data_functions as mcf_fo_data
+from mcf import mcf_forest_functions as mcf_fo
+from mcf import mcf_init_functions as mcf_init
+import tree_examples as te
+
+NO_OF_TREAT, K_CONT, NO_OF_CATS = 3, 3, 4
+
+
+def leaf_data(rng, obs, effect_var):
+    """Get data of leaf (y, d, y_nn, w, ordered x, categorical x)."""
+    d_dat = np.concatenate((np.arange(NO_OF_TREAT),
+                            rng.integers(0, NO_OF_TREAT, obs - NO_OF_TREAT)))
+    x_dat = rng.normal(size=(obs, K_CONT))
+    x_cat = rng.integers(0, NO_OF_CATS, obs)
+    if effect_var < K_CONT:
+        effect = 2 * x_dat[:, effect_var]
+    else:
+        effect = rng.permutation(NO_OF_CATS)[x_cat].astype(np.float64)
+    y_dat = effect * (d_dat > 0) + rng.normal(size=obs)
+    y_nn = rng.normal(size=(obs, NO_OF_TREAT)) + effect.reshape(-1, 1)
+    w_dat = rng.uniform(0.5, 2, obs)
+    return np.column_stack((y_dat, d_dat, y_nn, w_dat, x_dat, x_cat))
+
+
+def find_split(data_train, data_oob, mtot, weighted, sorted_search, seed):
+    """Get split of next_split."""
+    y_i, d_i, y_nn_i = [0], [1], list(range(2, 2 + NO_OF_TREAT))
+    w_i = 2 + NO_OF_TREAT
+    x_i = np.arange(w_i + 1, w_i + 2 + K_CONT)
+    x_type = np.array([0] * K_CONT + [1])
+    x_values = [[] for _ in range(K_CONT)] + [list(range(NO_OF_CATS))]
+    cf_dic = {'mtot': mtot, 'n_min_treat': 3, 'random_thresholds': 0,
+              'sorted_split_search': sorted_search,
+              'm_random_poisson': False, 'm_random_poisson_min': 10}
+    gen_dic = {'d_type': 'discrete', 'no_of_treat': NO_OF_TREAT,
+               'd_values': list(range(NO_OF_TREAT)), 'weighted': weighted}
+    return mcf_fo.next_split(
+        data_train, data_oob, y_i, y_nn_i, d_i, None, x_i, w_i, x_type,
+        x_values, np.arange(K_CONT + 1), [], cf_dic, gen_dic, None,
+        K_CONT + 1, 20, 0.05, 1.0, np.random.default_rng(seed))
+
+
+@pytest.mark.parametrize('effect_var', [0, 2, K_CONT])
+@pytest.mark.parametrize('weighted', [False, True])
+@pytest.mark.parametrize('mtot', [1, 2, 3, 4])
+def test_sorted_equals_reference_search(mtot, weighted, effect_var):
+    """Same splitting variable, value and leaves as reference search."""
+    for seed in range(3):
+        rng = np.random.default_rng(100 * effect_var + seed)
+        data_train = leaf_data(rng, 400, effect_var)
+        data_oob = leaf_data(rng, 100, effect_var)
+        split = find_split(data_train, data_oob, mtot, weighted, True, seed)
+        split_ref = find_split(data_train, data_oob, mtot, weighted, False,
+                               seed)
+        assert split[0] is split_ref[0] is False     # Not terminal
+        assert split[1:5] == split_ref[1:5]          # Variable, type, sizes
+        for leaf, leaf_ref in zip(split[5:9], split_ref[5:9]):
+            np.testing.assert_array_equal(np.ravel(leaf), np.ravel(leaf_ref))
+        assert split[9:11] == split_ref[9:11]        # OOB sizes
+        np.testing.assert_array_equal(split[11], split_ref[11])  # Value
+
+
+@pytest.mark.parametrize('weighted', [False, True])
+@pytest.mark.parametrize('mtot', [1, 2, 3])
+def test_histogram_equals_sorted_statistics(mtot, weighted):
+    """Statistics of bin boundaries agree with the sorted split search."""
+    rng = np.random.default_rng(7)
+    data = leaf_data(rng, 600, 0)
+    y_nn_i, w_i = np.arange(2, 2 + NO_OF_TREAT), 2 + NO_OF_TREAT
+    x_i = np.arange(w_i + 1, w_i + 1 + K_CONT)
+    x_bins = mcf_fo_data.bin_ordered_features(
+        data, [0], y_nn_i, x_i, np.zeros(K_CONT), [[]] * K_CONT, 16)
+    y_dat, d_dat, y_nn, w_dat = (data[:, [0]], data[:, [1]], data[:, y_nn_i],
+                                 data[:, [w_i]])
+    for var_i in range(K_CONT):
+        hist_dic = {'x_bins': x_bins, 'leaf': {}, 'codes': x_bins['codes'],
+                    'parent': None, 'sibling': None}
+        split_values, split_stats = mcf_fo.histogram_split_statistics(
+            hist_dic, var_i, y_dat, y_nn, d_dat, w_dat, 3, mtot, NO_OF_TREAT,
+            list(range(NO_OF_TREAT)), weighted, 0, rng)
+        split_stats_ref = mcf_fo.sorted_split_statistics(
+            y_dat, y_nn, d_dat, w_dat, data[:, x_i[var_i]], 0, split_values,
+            3, mtot, NO_OF_TREAT, list(range(NO_OF_TREAT)), weighted)
+        assert len(split_values) == 15
+        for key in ('cand', 'n_l', 'n_r'):
+            np.testing.assert_array_equal(split_stats[key],
+                                          split_stats_ref[key])
+        np.testing.assert_allclose(split_stats['mse'], split_stats_ref['mse'],
+                                   rtol=1e-10)
+        if mtot == 1:
+            np.testing.assert_allclose(split_stats['penalty'],
+                                       split_stats_ref['penalty'], rtol=1e-10)
+
+
+def test_histogram_of_parent_minus_sibling(monkeypatch):
+    """Histograms from parent and sibling agree with direct histograms."""
+    histogram_split_statistics = mcf_fo.histogram_split_statistics
+    subtracted = []
+
+    def checked_statistics(hist_dic, var_i, y_dat, y_nn, d_dat, w_dat,
+                           n_min_treat, mtot, no_of_treat, d_values, w_yes,
+                           random_thresholds, rng):
+        parent, sibling = hist_dic['parent'], hist_dic['sibling']
+        results = histogram_split_statistics(
+            hist_dic, var_i, y_dat, y_nn, d_dat, w_dat, n_min_treat, mtot,
+            no_of_treat, d_values, w_yes, random_thresholds, rng)
+        if (parent is not None and sibling is not None and var_i in parent
+                and var_i in sibling):
+            x_bins = hist_dic['x_bins']
+            hist = mcf_fo.bin_histogram(
+                y_dat, y_nn, d_dat, w_dat,
+                hist_dic['codes'][:, x_bins['col'][var_i]],
+                len(x_bins['edges'][var_i]), x_bins['y_center'],
+                x_bins['y_nn_center'], mtot, no_of_treat, d_values, w_yes)
+            np.testing.assert_allclose(hist_dic['leaf'][var_i], hist,
+                                       rtol=1e-9, atol=1e-9)
+            subtracted.append(var_i)
+        return results
+
+    monkeypatch.setattr(mcf_fo, 'histogram_split_statistics',
+                        checked_statistics)
+    data_np, pos = te.example_forest_data(weighted=True)
+    cf_dic, gen_dic, ct_dic = te.example_tree_params(
+        weighted=True, split_bins=16, m_values=[6], n_min_values=[5])
+    x_bins = mcf_fo.histogram_bins(data_np, pos['y_i'], pos['y_nn_i'],
+                                   pos['x_i'], pos['x_type'], pos['x_values'],
+                                   cf_dic, gen_dic)
+    for boot in range(3):
+        te.example_tree(data_np, pos, cf_dic, gen_dic, ct_dic, boot, x_bins)
+    assert len(subtracted) > 10
+
+
+def test_split_bins_alone_bins_features():
+    """cf_split_bins without cf_sorted_split_search yields binned features."""
+    cf_dic = mcf_init.cf_init(split_bins=32)
+    assert cf_dic['sorted_split_search']
+    rng = np.random.default_rng(3)
+    data_np = leaf_data(rng, 400, 0)
+    x_i = np.arange(3 + NO_OF_TREAT, 4 + NO_OF_TREAT + K_CONT)
+    x_type = np.array([0] * K_CONT + [1])
+    x_values = [[] for _ in range(K_CONT)] + [list(range(NO_OF_CATS))]
+    x_bins = mcf_fo.histogram_bins(
+        data_np, [0], np.arange(2, 2 + NO_OF_TREAT), x_i, x_type, x_values,
+        cf_dic | {'mtot': 1}, {'d_type': 'discrete'})
+    assert x_bins is not None
+    np.testing.assert_array_equal(x_bins['col'] >= 0,
+                                  [True] * K_CONT + [False])
+    assert x_bins['codes'].max() < 32
+
+
+def test_sorted_split_search_default_is_none():
+    """Default of cf_sorted_split_search leaves it to cf_split_bins."""
+    mcf_functions = pytest.importorskip('mcf.mcf_functions')
+    params = inspect.signature(
+        mcf_functions.ModifiedCausalForest.__init__).parameters
+    assert params['cf_sorted_split_search'].default is None
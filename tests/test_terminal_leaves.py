@@ -0,0 +1,110 @@
+"""
+Tests of the batch routing of observations to terminal leaves.
+
+The batch version (terminal_leaves_tree, terminal_leaves_forest) must give
+the same leaves as the routing of single observations (get_terminal_leaf_no).
+
+@author: MLechner
+-*- coding: utf-8 -*-
+"""
+import numpy as np
+import pytest
+
+from mcf import mcf_forest_add_functions as mcf_fo_add
+from mcf import mcf_forest_asdict_functions as mcf_fo_asdict
+import tree_examples as te
+from tree_examples import small_data, small_tree
+
+
+@pytest.mark.parametrize('prime_encoding', [False, True])
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_batch_equals_single_observation(seed, prime_encoding):
+    """Batch traversal gives the leaves of traversal by observation."""
+    rng = np.random.default_rng(seed)
+    tree = small_tree(rng, prime_encoding=prime_encoding)
+    x_dat = small_data(rng)
+    leaf_no = mcf_fo_add.terminal_leaves_tree(tree, x_dat)
+    leaf_no_single = [mcf_fo_add.get_terminal_leaf_no(tree, x_i)
+                      for x_i in x_dat]
+    np.testing.assert_array_equal(leaf_no, leaf_no_single)
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_grown_trees_equal_single_observation(compact):
+    """Leaf by leaf agreement for trees grown by build_tree_mcf."""
+    data_np, positions = te.example_forest_data(obs=600)
+    x_dat = data_np[:, positions['x_i']]
+    cf_dic, gen_dic, ct_dic = te.example_tree_params(
+        n_min_values=[5, 20], m_values=[2, 6])
+    trees = [tree for boot in range(2) for tree in te.example_tree(
+        data_np, positions, cf_dic, gen_dic, ct_dic, boot)]
+    for tree in trees:
+        oob_data_list = tree['oob_data_list']
+        if compact:    # Smaller data types, OOB data removed
+            tree = mcf_fo_asdict.compact_tree(tree)
+        leaf_no = mcf_fo_add.terminal_leaves_tree(tree, x_dat)
+        leaf_no_single = [mcf_fo_add.get_terminal_leaf_no(tree, x_i)
+                          for x_i in x_dat]
+        np.testing.assert_array_equal(leaf_no, leaf_no_single)
+        # OOB observations of terminal leaves of tree building
+        for leaf_id in np.flatnonzero(tree['leaf_info_int'][:, 7] == 1):
+            assert np.all(leaf_no[oob_data_list[leaf_id]] == leaf_id)
+
+
+def test_forest_equals_single_observation():
+    """Leaves of all trees of forest agree with traversal by observation."""
+    rng = np.random.default_rng(4)
+    forest = [small_tree(rng, depth=depth) for depth in (1, 2, 4)]
+    x_dat = small_data(rng, obs=200)
+    leaf_no = mcf_fo_add.terminal_leaves_forest(forest, x_dat)
+    for idx, tree in enumerate(forest):
+        np.testing.assert_array_equal(
+            leaf_no[:, idx],
+            [mcf_fo_add.get_terminal_leaf_no(tree, x_i) for x_i in x_dat])
+
+
+def test_active_leaf_raises():
+    """Routing into a leaf that is still active is an error."""
+    rng = np.random.default_rng(5)
+    tree = small_tree(rng, depth=1)
+    tree['leaf_info_int'][1:, 7] = 2
+    with pytest.raises(RuntimeError):
+        mcf_fo_add.terminal_leaves_tree(tree, small_data(rng, obs=10))
+
+
+def test_oob_leaves_equal_routing():
+    """Leaves from the OOB lists of tree building agree with routing."""
+    rng = np.random.default_rng(7)
+    forest = [small_tree(rng, depth=depth) for depth in (1, 2, 4)]
+    x_dat = small_data(rng, obs=150)
+    oob_indices = []
+    for tree in forest:
+        oob = np.sort(rng.choice(len(x_dat), 50, replace=False))
+        leaf_no = mcf_fo_add.terminal_leaves_tree(tree, x_dat[oob])
+        tree['oob_data_list'] = [oob[leaf_no == leaf_id] if terminal == 1
+                                 else None for leaf_id, terminal
+                                 in enumerate(tree['leaf_info_int'][:, 7])]
+        oob_indices.append(oob)
+    leaf_no_oob = mcf_fo_add.terminal_leaves_oob(forest, len(x_dat))
+    leaf_no = mcf_fo_add.terminal_leaves_forest(forest, x_dat)
+    for idx, oob in enumerate(oob_indices):
+        np.testing.assert_array_equal(leaf_no_oob[oob, idx],
+                                      leaf_no[oob, idx])
+        not_oob = np.setdiff1d(np.arange(len(x_dat)), oob)
+        assert np.all(leaf_no_oob[not_oob, idx] == -1)
+
+
+def test_leaf_cache_only_for_fill_data():
+    """Cache is used for the data it was computed from and not extended."""
+    rng = np.random.default_rng(6)
+    forest = [small_tree(rng, depth=depth) for depth in (1, 2, 4)]
+    x_fill, x_pred = small_data(rng, obs=100), small_data(rng, obs=50)
+    leaf_no = mcf_fo_add.compact_leaf_numbers(
+        mcf_fo_add.terminal_leaves_forest(forest, x_fill))
+    leaf_cache = {'fill': {'fingerprint': mcf_fo_add.data_fingerprint(x_fill),
+                           'leaf_no': leaf_no}}
+    assert mcf_fo_add.terminal_leaves_cached(forest, x_fill,
+                                             leaf_cache) is leaf_no
+    assert mcf_fo_add.terminal_leaves_cached(forest, x_pred,
+                                             leaf_cache) is None
+    assert list(leaf_cache) == ['fill']
@@ -0,0 +1,106 @@
+"""
+Tests of growing the trees of the grid of tuning parameters.
+
+Sharing split statistics between the trees of one sample (split cache) must
+not change the trees. Pruning the tree grown with the smallest minimum leaf
+size (and growing the pruned leaves further) must give the tree grown with
+the larger minimum leaf size.
+
+@author: MLechner
+-*- coding: utf-8 -*-
+"""
+import numpy as np
+import pytest
+
+from mcf import mcf_forest_add_functions as mcf_fo_add
+from mcf import mcf_forest_functions as mcf_fo
+import tree_examples as te
+
+N_MIN_VALUES = [5, 25]
+
+
+@pytest.fixture(scope='module')
+def forest_data():
+    """Example data and positions of variables."""
+    return te.example_forest_data(obs=1000)
+
+
+def leaf_partition(tree, x_dat):
+    """Label observations by terminal leaf (in order of first occurrence)."""
+    leaf_no = mcf_fo_add.terminal_leaves_tree(tree, x_dat)
+    _, first, inverse = np.unique(leaf_no, return_index=True,
+                                  return_inverse=True)
+    return np.argsort(np.argsort(first))[inverse]
+
+
+def terminal_values(tree):
+    """Leaf sizes and OOB values of terminal leaves (sorted by size)."""
+    terminal = tree['leaf_info_int'][:, 7] == 1
+    values = np.column_stack((tree['leaf_info_int'][terminal, 8:10],
+                              tree['leaf_info_float'][terminal, 2]))
+    return values[np.lexsort(values.T[::-1])]
+
+
+@pytest.mark.parametrize('boot', [0, 1])
+@pytest.mark.parametrize('mtot', [1, 2, 3])
+def test_split_cache_does_not_change_trees(forest_data, mtot, boot,
+                                           monkeypatch):
+    """Trees of the grid are the same with and without split cache."""
+    data_np, positions = forest_data
+    cf_dic, gen_dic, ct_dic = te.example_tree_params(
+        mtot=mtot, n_min_values=N_MIN_VALUES, alpha_reg_values=[0, 0.1])
+    assert mcf_fo.init_split_cache(500, 4, cf_dic, gen_dic) is not None
+    trees_cache = te.example_tree(data_np, positions, cf_dic, gen_dic,
+                                  ct_dic, boot)
+    monkeypatch.setattr(mcf_fo, 'init_split_cache', lambda *args: None)
+    trees = te.example_tree(data_np, positions, cf_dic, gen_dic, ct_dic,
+                            boot)
+    assert len(trees_cache) == len(trees) == 4
+    for tree_cache, tree in zip(trees_cache, trees):
+        for key in ('leaf_info_int', 'leaf_info_float', 'cats_bitset'):
+            np.testing.assert_array_equal(tree_cache[key], tree[key])
+        assert tree_cache['oob_obj'] == tree['oob_obj']
+
+
+@pytest.mark.parametrize('boot', [0, 1, 2])
+@pytest.mark.parametrize('mtot', [1, 2, 3])
+def test_pruned_equals_grown_tree(forest_data, mtot, boot):
+    """Pruned (and regrown) trees equal trees grown with larger n_min."""
+    data_np, positions = forest_data
+    x_dat = data_np[:, positions['x_i']]
+    # All features are used for every split (no random draws of variables)
+    trees = {n_min_pruning: te.example_tree(
+        data_np, positions, *te.example_tree_params(
+            mtot=mtot, m_values=[len(positions['x_i'])],
+            n_min_values=N_MIN_VALUES, n_min_pruning=n_min_pruning), boot)
+        for n_min_pruning in (True, False)}
+    for tree_pruned, tree in zip(trees[True], trees[False]):
+        np.testing.assert_array_equal(leaf_partition(tree_pruned, x_dat),
+                                      leaf_partition(tree, x_dat))
+        np.testing.assert_allclose(terminal_values(tree_pruned),
+                                   terminal_values(tree), rtol=1e-12)
+        assert np.min(tree_pruned['leaf_info_int'][:, 8]) >= min(
+            N_MIN_VALUES)
+    assert np.min(trees[True][1]['leaf_info_int'][:, 8]) >= N_MIN_VALUES[1]
+
+
+def test_prune_tree_n_min_returns_leaves_to_grow(forest_data):
+    """Pruned leaves with at least 2 * n_min observations are grown again."""
+    data_np, positions = forest_data
+    cf_dic, gen_dic, ct_dic = te.example_tree_params(
+        m_values=[len(positions['x_i'])], n_min_values=[5])
+    tree = te.example_tree(data_np, positions, cf_dic, gen_dic, ct_dic)[0]
+    tree_pruned, leaves_to_grow = mcf_fo.prune_tree_n_min(
+        tree, 25, data_np, positions['y_i'], positions['y_nn_i'],
+        positions['d_i'], positions['d_grid_i'], positions['w_i'], None,
+        gen_dic, cf_dic, np.random.default_rng(1))
+    leaf_info_int = tree_pruned['leaf_info_int']
+    assert len(leaf_info_int) < len(tree['leaf_info_int'])
+    assert np.all(leaf_info_int[leaves_to_grow, 7] == 1)
+    assert np.all(leaf_info_int[leaves_to_grow, 8] >= 50)
+    split = leaf_info_int[:, 7] == 0
+    assert np.all(leaf_info_int[leaf_info_int[split, 2:4], 8] >= 25)
+    assert mcf_fo.prune_tree_n_min(
+        tree, 5, data_np, positions['y_i'], positions['y_nn_i'],
+        positions['d_i'], positions['d_grid_i'], positions['w_i'], None,
+        gen_dic, cf_dic, np.random.default_rng(1))[0] is tree
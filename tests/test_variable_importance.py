@@ -0,0 +1,99 @@
+"""
+Tests of the incremental computation of variable importance.
+
+With the baseline of the trees (vi_baseline), get_oob_mcf reroutes only
+observations below nodes splitting on randomized variables and updates the
+sums of the affected leaves. It must give the same OOB values as sending all
+OOB observations through the trees (vi_base=None).
+
+@author: MLechner
+-*- coding: utf-8 -*-
+"""
+import numpy as np
+import pytest
+
+from mcf import mcf_forest_add_functions as mcf_fo_add
+from mcf import mcf_variable_importance_functions as mcf_vi
+
+import tree_examples as te
+
+NO_OF_TREAT, NO_ORDERED, NO_CAT = 3, 2, 2
+
+
+def forest_data(rng, depth, no_of_trees=6, obs=600):
+    """Get data (y, d, y_nn, w, x) and forest with OOB indices."""
+    x_dat = te.small_data(rng, obs, NO_ORDERED, NO_CAT)
+    d_dat = rng.integers(0, NO_OF_TREAT, obs)
+    y_dat = x_dat[:, 0] * (d_dat > 0) + rng.normal(size=obs)
+    y_nn = rng.normal(size=(obs, NO_OF_TREAT)) + x_dat[:, [1]]
+    w_dat = rng.uniform(0.5, 2, obs)
+    data_np = np.column_stack((y_dat, d_dat, y_nn, w_dat, x_dat))
+    forest = []
+    for _ in range(no_of_trees):
+        tree = te.small_tree(rng, depth, NO_ORDERED, NO_CAT)
+        tree['oob_indices'] = np.sort(rng.choice(obs, obs // 3,
+                                                 replace=False))
+        # OOB lists of terminal leaves as kept during tree building
+        leaf_no = mcf_fo_add.terminal_leaves_tree(
+            tree, x_dat[tree['oob_indices']])
+        tree['oob_data_list'] = [
+            tree['oob_indices'][leaf_no == leaf_id] if terminal == 1
+            else None
+            for leaf_id, terminal in enumerate(tree['leaf_info_int'][:, 7])]
+        forest.append(tree)
+    return data_np, forest
+
+
+@pytest.mark.parametrize('depth', [2, 4])
+@pytest.mark.parametrize('weighted', [False, True])
+@pytest.mark.parametrize('mtot', [1, 2, 3])
+def test_incremental_equals_full_traversal(mtot, weighted, depth):
+    """Same OOB values for single variables, partners and groups."""
+    rng = np.random.default_rng(10 * mtot + depth)
+    data_np, forest = forest_data(rng, depth)
+    y_i, d_i, y_nn_i = [0], [1], list(range(2, 2 + NO_OF_TREAT))
+    w_i = 2 + NO_OF_TREAT
+    x_i = list(range(w_i + 1, w_i + 1 + NO_ORDERED + NO_CAT))
+    gen_dic = {'d_type': 'discrete', 'no_of_treat': NO_OF_TREAT,
+               'd_values': list(range(NO_OF_TREAT)), 'weighted': weighted,
+               'mp_parallel': 1}
+    int_dic = {'with_output': False, 'verbose': False}
+    cf_dic = {'boot': len(forest), 'mtot': mtot}
+    vi_base = mcf_vi.vi_baseline(data_np, y_i, y_nn_i, x_i, d_i, w_i,
+                                 gen_dic, cf_dic, forest)
+    groups = [[0, 2], [1, 3], [0, 1, 2, 3]]
+    cases = ([(k, True, [], None) for k in range(len(x_i) + 1)]
+             + [(2, True, [], 3)]
+             + [(k, False, groups, None) for k in range(len(groups))])
+    for k, single, group_ind_list, partner_k in cases:
+        args = (data_np, y_i, y_nn_i, x_i, d_i, w_i, gen_dic, int_dic,
+                cf_dic, k, single, group_ind_list, forest, True, partner_k)
+        oob_inc, _ = mcf_vi.get_oob_mcf(*args, vi_base)
+        oob_ref, _ = mcf_vi.get_oob_mcf(*args, None)
+        np.testing.assert_allclose(oob_inc, oob_ref, rtol=1e-10, atol=1e-12)
+
+
+@pytest.mark.parametrize('weighted', [False, True])
+def test_baseline_with_oob_leaves_of_tree_building(weighted):
+    """Baseline is the same if OOB leaves come from tree building."""
+    rng = np.random.default_rng(3)
+    data_np, forest = forest_data(rng, 4)
+    y_i, d_i, y_nn_i = [0], [1], list(range(2, 2 + NO_OF_TREAT))
+    w_i = 2 + NO_OF_TREAT
+    x_i = list(range(w_i + 1, w_i + 1 + NO_ORDERED + NO_CAT))
+    gen_dic = {'d_type': 'discrete', 'no_of_treat': NO_OF_TREAT,
+               'd_values': list(range(NO_OF_TREAT)), 'weighted': weighted,
+               'mp_parallel': 1}
+    cf_dic = {'boot': len(forest), 'mtot': 1}
+    leaf_no_oob = mcf_fo_add.terminal_leaves_oob(forest, len(data_np))
+    vi_base = mcf_vi.vi_baseline(data_np, y_i, y_nn_i, x_i, d_i, w_i,
+                                 gen_dic, cf_dic, forest)
+    vi_base_oob = mcf_vi.vi_baseline(data_np, y_i, y_nn_i, x_i, d_i, w_i,
+                                     gen_dic, cf_dic, forest, leaf_no_oob)
+    for tree_base, tree_base_oob in zip(vi_base, vi_base_oob):
+        np.testing.assert_array_equal(tree_base_oob['leaf'],
+                                      tree_base['leaf'])
+        np.testing.assert_array_equal(tree_base_oob['vars_above'],
+                                      tree_base['vars_above'])
+        np.testing.assert_allclose(tree_base_oob['oob'], tree_base['oob'],
+                                   rtol=1e-12)
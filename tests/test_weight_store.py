@@ -0,0 +1,72 @@
+"""
+Tests of the out-of-core store of sparse weight matrices.
+
+Rows selected from a weight store (chunk by chunk) must be the same as rows
+selected from the weight matrices in memory.
+
+@author: MLechner
+-*- coding: utf-8 -*-
+"""
+import numpy as np
+from scipy import sparse
+
+from mcf import mcf_weight_functions as mcf_w
+from mcf import mcf_weight_store_functions as mcf_ws
+
+
+def weights_and_store(rng, n_rows=50, n_y=40, no_of_treat=3, chunks=4,
+                      outpath=None):
+    """Get random sparse weights in memory and as weight store."""
+    weights = [sparse.random(n_rows, n_y, density=0.2, format='csr',
+                             random_state=rng)
+               for _ in range(no_of_treat)]
+    store = mcf_ws.weight_store_init(n_y, no_of_treat, outpath)
+    for rows in np.array_split(np.arange(n_rows), chunks):
+        mcf_ws.weight_store_add(store, [weights_t[rows]
+                                        for weights_t in weights])
+    return weights, store
+
+
+def test_store_select_equals_memory():
+    """Selected (repeated, unordered) rows agree with rows in memory."""
+    rng = np.random.default_rng(1)
+    weights, store = weights_and_store(rng)
+    rows = rng.integers(0, 50, 120)
+    selected = mcf_ws.weight_store_select(store, rows)
+    for weights_t, selected_t in zip(weights, selected):
+        np.testing.assert_array_equal(selected_t.toarray(),
+                                      weights_t[rows].toarray())
+
+
+def test_weights_of_rows_store(tmp_path):
+    """Replicated rows of a store agree with replicated rows in memory."""
+    rng = np.random.default_rng(2)
+    weights, store = weights_and_store(rng, outpath=str(tmp_path))
+    rows = np.repeat(rng.permutation(50), 3)
+    weights_rows = mcf_w.weights_of_rows(store, rows, True, str(tmp_path))
+    assert mcf_ws.is_weight_store(weights_rows)
+    assert mcf_ws.weights_shape(weights_rows) == (150, 40)
+    expected = mcf_w.weights_of_rows(weights, rows, True)
+    for weights_t, expected_t in zip(
+            mcf_ws.weight_rows(weights_rows, 0, 150), expected):
+        np.testing.assert_array_equal(weights_t.toarray(),
+                                      expected_t.toarray())
+
+
+def test_rows_across_chunks_equal_memory(tmp_path):
+    """Row ranges within and across chunks agree with rows in memory."""
+    rng = np.random.default_rng(3)
+    weights, store = weights_and_store(rng, n_rows=53, chunks=5,
+                                       outpath=str(tmp_path))
+    bounds = store['row_start']
+    ranges = [(0, 53), (0, bounds[1]), (bounds[1], bounds[2]),
+              (bounds[1] - 1, bounds[1] + 1), (3, bounds[3] + 2),
+              (bounds[2] + 1, 53), (52, 53), (7, 7)]
+    for start, end in ranges:
+        rows_store = mcf_ws.weight_rows(store, start, end)
+        rows_memory = mcf_ws.weight_rows(weights, start, end)
+        assert len(rows_store) == len(weights)
+        for rows_store_t, rows_memory_t in zip(rows_store, rows_memory):
+            assert rows_store_t.shape == (end - start, 40)
+            np.testing.assert_array_equal(rows_store_t.toarray(),
+                                          rows_memory_t.toarray())
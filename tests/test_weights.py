@@ -0,0 +1,165 @@
+"""
+Tests of the weights implied by the forest.
+
+weights_csr_direct (sparse weight matrices assembled from leaf memberships)
+must give the weights of weights_obs_i (observation by observation),
+including leaves that are empty or lack a treatment. get_weights_unique_mp
+(weights of distinct rows only, replicated by row selection) must give the
+weights of get_weights_mp for data with many identical rows, in the
+original order of the rows.
+
+@author: MLechner
+-*- coding: utf-8 -*-
+"""
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from mcf import mcf_weight_functions as mcf_w
+from mcf import mcf_weight_store_functions as mcf_ws
+from tree_examples import fill_tree, small_data, small_tree
+
+N_Y = 300
+D_VALUES = [0, 1, 2]
+
+
+def forest_and_data(rng, obs=120):
+    """Get filled forest, training data and prediction data."""
+    forest = [fill_tree(rng, small_tree(rng, depth=depth), N_Y)
+              for depth in (2, 3, 3, 4)]
+    forest_dic = {'forest': forest,
+                  'y_train_df': pd.DataFrame({'y': rng.normal(size=N_Y)}),
+                  'd_train_df': pd.DataFrame({'d': rng.choice(D_VALUES,
+                                                              N_Y)}),
+                  'x_bala_df': None, 'cl_train_df': None, 'w_train_df': None,
+                  'leaf_cache': None}
+    x_dat = small_data(rng, obs=obs)
+    data_df = pd.DataFrame(x_dat, columns=[f'x{i}' for i in range(
+        x_dat.shape[1])])
+    return forest_dic, data_df
+
+
+def mcf_object(data_df, outpath, weight_as_sparse=True, splits=1):
+    """Get the parts of the mcf-object used to compute weights."""
+    gen_dic = {'d_type': 'discrete', 'no_of_treat': len(D_VALUES),
+               'd_values': D_VALUES, 'weighted': False, 'mp_parallel': 1,
+               'with_output': False, 'outpath': str(outpath),
+               'sys_share': 0.7}
+    int_dic = {'with_output': False, 'verbose': False,
+               'weight_as_sparse': weight_as_sparse,
+               'weight_as_sparse_splits': splits, 'mem_budget_mb': None,
+               'mp_weights_tree_batch': 0, 'ray_or_dask': 'ray'}
+    return SimpleNamespace(
+        gen_dict=gen_dic, int_dict=int_dic, cf_dict={'folds': 1, 'boot': 4},
+        ct_dict={}, p_dict={'cluster_std': False, 'bt_yes': False},
+        var_dict={'x_name': list(data_df.columns)})
+
+
+def dense_weights(weights, weight_as_sparse):
+    """Weights as list (one dense array per treatment)."""
+    if not weight_as_sparse:
+        no_of_treat = len(weights[0])
+        dense = [np.zeros((len(weights), N_Y)) for _ in range(no_of_treat)]
+        for row, weights_row in enumerate(weights):
+            for t_idx, (indices, values) in enumerate(weights_row):
+                dense[t_idx][row, indices] = values
+        return dense
+    if mcf_ws.is_weight_store(weights):
+        weights = mcf_ws.weight_store_select(
+            weights, np.arange(mcf_ws.weights_shape(weights)[0]))
+    return [weights_t.toarray() for weights_t in weights]
+
+
+def empty_some_leaves(rng, forest, d_dat):
+    """Make leaves empty, not filled or without all treatments."""
+    for tree in forest:
+        terminal = np.flatnonzero(tree['leaf_info_int'][:, 7] == 1)
+        leaf_empty, leaf_none, leaf_one_treat = rng.choice(terminal, 3,
+                                                           replace=False)
+        tree['fill_y_empty_leave'][leaf_empty] = 1
+        tree['fill_y_indices_list'][leaf_none] = None
+        tree['fill_y_indices_list'][leaf_one_treat] = np.flatnonzero(
+            d_dat == D_VALUES[0])[:5]
+    return forest
+
+
+@pytest.mark.parametrize('normalize', [True, False])
+def test_csr_direct_equals_obs_i(normalize):
+    """Weights of each treatment agree with observation-wise weights."""
+    rng = np.random.default_rng(3)
+    forest_dic, data_df = forest_and_data(rng)
+    d_dat = forest_dic['d_train_df'].to_numpy()
+    forest = empty_some_leaves(rng, forest_dic['forest'], d_dat.reshape(-1))
+    x_dat = data_df.to_numpy()
+    weights, obs_without_leaf = mcf_w.weights_csr_direct(
+        forest, x_dat, d_dat, N_Y, D_VALUES, normalize=normalize)
+    gen_dic = {'d_type': 'discrete', 'no_of_treat': len(D_VALUES),
+               'd_values': D_VALUES}
+    obs_without_leaf_i = 0
+    for idx in range(len(x_dat)):
+        _, weights_i, without_leaf_i, _ = mcf_w.weights_obs_i(
+            idx, N_Y, forest, x_dat, d_dat, {'boot': len(forest)}, {},
+            gen_dic, split_forest=not normalize)
+        obs_without_leaf_i += without_leaf_i
+        for weights_t, (indices, values) in zip(weights, weights_i):
+            row = weights_t.getrow(idx)
+            np.testing.assert_array_equal(row.indices, indices)
+            np.testing.assert_allclose(row.data, values, rtol=1e-6)
+    assert obs_without_leaf == obs_without_leaf_i > 0
+    assert all(weights_t.nnz > 0 for weights_t in weights)
+
+
+def test_sparse_equals_dense_weights(tmp_path):
+    """Sparse (direct) and dense (observation-wise) weights agree."""
+    rng = np.random.default_rng(4)
+    forest_dic, data_df = forest_and_data(rng)
+    empty_some_leaves(rng, forest_dic['forest'],
+                      forest_dic['d_train_df'].to_numpy().reshape(-1))
+    weights = {
+        weight_as_sparse: dense_weights(mcf_w.get_weights_mp(
+            mcf_object(data_df, tmp_path, weight_as_sparse), data_df,
+            forest_dic, 'regular')['weights'], weight_as_sparse)
+        for weight_as_sparse in (True, False)}
+    for w_sparse, w_dense in zip(weights[True], weights[False]):
+        np.testing.assert_allclose(w_sparse, w_dense, rtol=1e-6, atol=1e-7)
+
+
+@pytest.mark.parametrize('weight_as_sparse, splits',
+                         [(True, 1), (True, 2), (False, 1)])
+def test_unique_equals_all_rows(weight_as_sparse, splits, tmp_path):
+    """Weights of replicated rows agree with weights of all rows."""
+    rng = np.random.default_rng(1)
+    forest_dic, data_df = forest_and_data(rng)
+    # Copies of rows in random order (as in the reference data of BGATEs)
+    data_rep_df = data_df.iloc[rng.integers(0, len(data_df), 500)]
+    mcf_ = mcf_object(data_rep_df, tmp_path, weight_as_sparse, splits)
+    weights_unique = mcf_w.get_weights_unique_mp(mcf_, data_rep_df,
+                                                 forest_dic)['weights']
+    weights_all = mcf_w.get_weights_mp(mcf_, data_rep_df, forest_dic,
+                                       'regular')['weights']
+    assert mcf_ws.is_weight_store(weights_unique) == (splits > 1)
+    for w_unique, w_all in zip(
+            dense_weights(weights_unique, weight_as_sparse),
+            dense_weights(weights_all, weight_as_sparse)):
+        assert w_unique.shape == (len(data_rep_df), N_Y) and w_unique.any()
+        np.testing.assert_allclose(w_unique, w_all, rtol=1e-6, atol=1e-7)
+
+
+def test_distinct_rows_routed_once(tmp_path, monkeypatch):
+    """Only distinct rows are passed to get_weights_mp."""
+    rng = np.random.default_rng(2)
+    forest_dic, data_df = forest_and_data(rng, obs=30)
+    data_rep_df = pd.concat([data_df] * 4)
+    mcf_ = mcf_object(data_rep_df, tmp_path)
+    rows_weighted = []
+    get_weights_mp = mcf_w.get_weights_mp
+
+    def counted_get_weights_mp(mcf_, data_df, *args, **kwargs):
+        rows_weighted.append(len(data_df))
+        return get_weights_mp(mcf_, data_df, *args, **kwargs)
+
+    monkeypatch.setattr(mcf_w, 'get_weights_mp', counted_get_weights_mp)
+    mcf_w.get_weights_unique_mp(mcf_, data_rep_df, forest_dic)
+    assert rows_weighted == [len(data_df)]
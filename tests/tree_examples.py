@@ -0,0 +1,136 @@
+"""
+Small trees and data for the tests of routing and saving forests.
+
+Trees grown by build_tree_mcf on example data are used to compare
+alternative ways of growing and routing.
+
+@author: MLechner
+-*- coding: utf-8 -*-
+"""
+import math
+
+import numpy as np
+
+from mcf.example_data_functions import example_data
+from mcf import mcf_forest_asdict_functions as mcf_fo_asdict
+from mcf import mcf_forest_functions as mcf_fo
+from mcf import mcf_general as mcf_gp
+
+PRIMES = list(mcf_gp.primes_list(12))
+
+
+def small_tree(rng, depth=3, no_ordered=2, no_cat=2, prime_encoding=False):
+    """Build complete tree with random ordered and categorical splits."""
+    no_leaves = 2 ** (depth + 1) - 1
+    leaf_info_int = -np.ones((no_leaves, 10), dtype=np.int64)
+    leaf_info_float = -np.ones((no_leaves, 3))
+    leaf_info_int[:, 0] = np.arange(no_leaves)
+    leaf_info_int[1:, 1] = (leaf_info_int[1:, 0] - 1) // 2     # Parent
+    cats_prime, bitsets = [0] * no_leaves, [None] * no_leaves
+    for leaf_id in range(no_leaves):
+        if leaf_id >= 2 ** depth - 1:          # Terminal leaf
+            leaf_info_int[leaf_id, 7] = 1
+            continue
+        leaf_info_int[leaf_id, [2, 3, 7]] = 2 * leaf_id + 1, 2 * leaf_id + 2, 0
+        var = rng.integers(no_ordered + no_cat)
+        leaf_info_int[leaf_id, 4] = var
+        if var < no_ordered:
+            leaf_info_int[leaf_id, 5] = 0
+            leaf_info_float[leaf_id, 1] = np.round(rng.normal(), 1)
+        else:
+            leaf_info_int[leaf_id, 5] = 1
+            left = rng.choice(PRIMES, rng.integers(1, len(PRIMES)),
+                              replace=False).tolist()
+            cats_prime[leaf_id] = math.prod(left)
+            bitsets[leaf_id] = mcf_gp.primes_to_bitset(left)
+    tree = {'leaf_info_int': leaf_info_int, 'leaf_info_float': leaf_info_float,
+            'cats_prime': cats_prime, 'cats_bitset': None}
+    if not prime_encoding:
+        tree['cats_bitset'] = mcf_fo_asdict.pack_bitsets(bitsets)
+    return tree
+
+
+def small_data(rng, obs=500, no_ordered=2, no_cat=2):
+    """Draw data with ties at the cut-off values and unknown categories."""
+    x_ord = np.round(rng.normal(size=(obs, no_ordered)), 1)
+    x_cat = rng.choice(PRIMES + [1], size=(obs, no_cat))
+    return np.column_stack((x_ord, x_cat)).astype(np.float64)
+
+
+def fill_tree(rng, tree, n_y):
+    """Fill terminal leaves of tree with random indices of outcomes."""
+    terminal = tree['leaf_info_int'][:, 7] == 1
+    tree['fill_y_indices_list'] = [
+        np.sort(rng.choice(n_y, rng.integers(1, 20), replace=False))
+        if is_terminal else None for is_terminal in terminal]
+    tree['fill_y_empty_leave'] = np.zeros(len(terminal), dtype=np.int8)
+    return tree
+
+
+def example_forest_data(obs=800, seed=3, weighted=False):
+    """Get example data prepared for build_tree_mcf (as in build_forest).
+
+    Returns
+    -------
+    data_np : Numpy array. Outcome, treatment, matched outcomes, features
+              (and weights).
+    positions : Dict. Positions and types of variables in data_np.
+
+    """
+    train_df, _, name_dict = example_data(
+        obs_y_d_x_iate=obs, obs_x_iate=10, no_features=6, no_treatments=3,
+        seed=seed, descr_stats=False)
+    rng = np.random.default_rng(seed)
+    x_name = name_dict['x_name_ord'] + name_dict['x_name_unord']
+    x_dat = train_df[x_name].to_numpy()
+    for idx in range(len(name_dict['x_name_ord']), len(x_name)):
+        # Categories are coded as primes (as in the data preparation of mcf)
+        _, codes = np.unique(x_dat[:, idx], return_inverse=True)
+        x_dat[:, idx] = np.array(PRIMES)[codes.reshape(-1)]
+    y_dat = train_df[[name_dict['y_name']]].to_numpy()
+    # Matched outcomes are replaced by noisy outcomes
+    y_nn = y_dat + rng.normal(size=(obs, 3))
+    data_np = np.column_stack((y_dat, train_df[name_dict['d_name']], y_nn,
+                               x_dat))
+    x_i = np.arange(5, 5 + len(x_name))
+    x_type = np.array([0] * len(name_dict['x_name_ord'])
+                      + [1] * len(name_dict['x_name_unord']))
+    x_values = [sorted(np.unique(x_dat[:, idx]).tolist())
+                if x_type[idx] == 1 or len(np.unique(x_dat[:, idx])) < 10
+                else [] for idx in range(len(x_name))]
+    w_i = None
+    if weighted:
+        data_np = np.column_stack((data_np, train_df[name_dict[
+            'weight_name']]))
+        w_i = data_np.shape[1] - 1
+    positions = {'y_i': [0], 'y_nn_i': np.arange(2, 5), 'x_i': x_i,
+                 'd_i': [1], 'd_grid_i': None, 'cl_i': None, 'w_i': w_i,
+                 'x_type': x_type, 'x_values': x_values,
+                 'x_ind': np.arange(len(x_name)), 'x_ai_ind': []}
+    return data_np, positions
+
+
+def example_tree_params(mtot=1, weighted=False, **cf_params):
+    """Get parameters of build_tree_mcf for example_forest_data."""
+    cf_dic = {'mtot': mtot, 'n_min_treat': 3, 'random_thresholds': 0,
+              'sorted_split_search': True, 'split_bins': None,
+              'm_random_poisson': False, 'm_random_poisson_min': 10,
+              'subsample_share_forest': 0.5, 'm_values': [3],
+              'n_min_values': [10], 'alpha_reg_values': [0.05],
+              'n_min_pruning': False, 'mtot_no_mce': 0,
+              'compare_only_to_zero': False, 'vi_oob_yes': False,
+              'boot': 4} | cf_params
+    gen_dic = {'d_type': 'discrete', 'no_of_treat': 3, 'd_values': [0, 1, 2],
+               'weighted': weighted, 'panel_in_rf': False}
+    return cf_dic, gen_dic, {'grid_nn_val': None}
+
+
+def example_tree(data_np, positions, cf_dic, gen_dic, ct_dic, boot=0,
+                 x_bins=None):
+    """Build the trees of one bootstrap sample with build_tree_mcf."""
+    pos = positions
+    return mcf_fo.build_tree_mcf(
+        data_np, pos['y_i'], pos['y_nn_i'], pos['x_i'], pos['d_i'],
+        pos['d_grid_i'], pos['cl_i'], pos['w_i'], pos['x_type'],
+        pos['x_values'], pos['x_ind'], pos['x_ai_ind'], gen_dic, cf_dic,
+        ct_dic, boot, np.var(data_np[:, 0]), x_bins=x_bins)